@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+分析请求的准入控制
+流量突增时不再来者不拒：新会话在写入任务队列前检查两个上限，超出时返回 429 与估算的 Retry-After，
+被接受的会话返回排队位置与预计开始时间（进度接口在会话排队期间持续更新这两个值）。
+
+- ADMISSION_MAX_ACTIVE_SESSIONS：排队中与执行中的会话总数上限（含本进程的同步简化分析的后台会话）。
+- ADMISSION_MAX_QUEUED_PRODUCTS：排队中（尚未开始）的会话待分析的产品总数上限；队列为空时不限制，
+  产品数超过上限的单个请求仍可被接受。
+- 估算：按领取顺序模拟执行槽位（槽位数取本进程的 JOB_WORKERS 与当前执行中的任务数中较大者，多 worker 部署时
+  后者即为全部进程的并行度），每个产品耗时取 ADMISSION_SECONDS_PER_PRODUCT 为初值、之后按实测滑动平均。
+- 检查在创建会话的写事务内进行（BEGIN IMMEDIATE 串行化各 worker 的写入），并发请求不会同时越过上限。
+
+上限设为 0 表示不限制。
+"""
+
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_ACTIVE_SESSIONS = int(os.environ.get("ADMISSION_MAX_ACTIVE_SESSIONS", "50"))
+ADMISSION_MAX_QUEUED_PRODUCTS = int(os.environ.get("ADMISSION_MAX_QUEUED_PRODUCTS", "300"))
+ADMISSION_SECONDS_PER_PRODUCT = float(os.environ.get("ADMISSION_SECONDS_PER_PRODUCT", "10"))
+ADMISSION_MAX_RETRY_AFTER = int(os.environ.get("ADMISSION_MAX_RETRY_AFTER", "600"))
+
+_SMOOTHING = 0.2  # 每个产品耗时的滑动平均权重
+_MIN_SECONDS_PER_PRODUCT = 0.05
+
+
+def _remaining(job: Dict[str, Any]) -> int:
+    """任务尚未分析的产品数（续跑的任务已有断点）"""
+    return max((job["products"] or 0) - job["finished"], 0)
+
+
+class AdmissionRejected(Exception):
+    """超出准入上限；retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: int, limit: str):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+        self.limit = limit
+
+
+class AdmissionController:
+    """基于任务队列积压情况的准入检查与排队时间估算"""
+
+    def __init__(self, queue, max_active_sessions: int = ADMISSION_MAX_ACTIVE_SESSIONS,
+                 max_queued_products: int = ADMISSION_MAX_QUEUED_PRODUCTS,
+                 seconds_per_product: float = ADMISSION_SECONDS_PER_PRODUCT,
+                 max_retry_after: int = ADMISSION_MAX_RETRY_AFTER):
+        self.queue = queue
+        self.max_active_sessions = max_active_sessions
+        self.max_queued_products = max_queued_products
+        self.seconds_per_product = max(seconds_per_product, _MIN_SECONDS_PER_PRODUCT)
+        self.max_retry_after = max(1, max_retry_after)
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()  # 本进程内检查与计入之间不被其他请求插入
+        self._local: Dict[str, Any] = {}  # 不经过队列的本进程会话 -> (开始时间, 产品数)
+        self.stats = {"admitted": 0, "rejected_sessions": 0, "rejected_products": 0}
+
+    # ---- 实测耗时 ----
+
+    def observe(self, products: int, seconds: float):
+        """记录一次实际分析耗时，更新每个产品耗时的滑动平均"""
+        if products <= 0:
+            return
+        sample = max(seconds / products, _MIN_SECONDS_PER_PRODUCT)
+        with self._lock:
+            self.seconds_per_product += _SMOOTHING * (sample - self.seconds_per_product)
+
+    # ---- 估算 ----
+
+    def _snapshot(self) -> Dict[str, Any]:
+        backlog = self.queue.backlog()
+        now = time.monotonic()
+        with self._lock:
+            per_product = self.seconds_per_product
+            local = [max(products * per_product - (now - started), 0.0) for started, products in self._local.values()]
+        running = [j for j in backlog if j["status"] == "running"]
+        queued = [j for j in backlog if j["status"] == "queued"]
+        # 执行中任务的剩余时间占住槽位；排队任务按领取顺序依次落到最早空出的槽位
+        slots = [_remaining(j) * per_product for j in running]
+        finishes = slots + local
+        slots = slots + [0.0] * max(self.queue.workers - len(slots), 0) or [0.0]
+        heapq.heapify(slots)
+        starts = []
+        for job in queued:
+            start = heapq.heappop(slots)
+            finish = start + _remaining(job) * per_product
+            heapq.heappush(slots, finish)
+            starts.append(start)
+            finishes.append(finish)
+        return {
+            "queued": queued,
+            "starts": starts,
+            "finishes": sorted(finishes),
+            "next_start": slots[0],
+            "active": len(backlog) + len(local),
+        }
+
+    def _retry_after(self, seconds: float) -> int:
+        return min(max(int(math.ceil(seconds)), 1), self.max_retry_after)
+
+    def _check(self, products: int, plan: Dict[str, Any], queued: bool):
+        active = plan["active"]
+        if self.max_active_sessions and active >= self.max_active_sessions:
+            # 需要先结束的会话数：active - 上限 + 1
+            finishes = plan["finishes"]
+            wait = finishes[min(active - self.max_active_sessions, len(finishes) - 1)] if finishes else 0.0
+            self.stats["rejected_sessions"] += 1
+            raise AdmissionRejected(
+                f"进行中的分析会话已达上限（{self.max_active_sessions}），请稍后重试",
+                self._retry_after(wait), "active_sessions"
+            )
+        waiting = sum(_remaining(j) for j in plan["queued"])
+        if queued and self.max_queued_products and waiting and waiting + products > self.max_queued_products:
+            # 排在前面的任务依次开始后，排队产品数降到上限以内的时刻
+            wait = plan["starts"][-1]
+            for job, start in zip(plan["queued"], plan["starts"]):
+                waiting -= _remaining(job)
+                if waiting + products <= self.max_queued_products:
+                    wait = start
+                    break
+            self.stats["rejected_products"] += 1
+            raise AdmissionRejected(
+                f"排队中的待分析产品已达上限（{self.max_queued_products}），请稍后重试",
+                self._retry_after(wait), "queued_products"
+            )
+
+    @staticmethod
+    def _estimate(position: int, wait: float) -> Dict[str, Any]:
+        return {
+            "queue_position": position,
+            "estimated_wait_seconds": round(wait, 1),
+            "estimated_start_at": datetime.fromtimestamp(time.time() + wait).isoformat(timespec="seconds"),
+        }
+
+    def admit(self, products: int) -> Dict[str, Any]:
+        """
+        检查能否再排入一个含 products 个产品的会话；超出上限时抛出 AdmissionRejected。
+        应在入队的同一事务内、入队之前调用。返回排队位置（1 起）与预计开始时间
+        """
+        plan = self._snapshot()
+        self._check(products, plan, queued=True)
+        self.stats["admitted"] += 1
+        return self._estimate(len(plan["queued"]) + 1, plan["next_start"])
+
+    def position(self, session_id: int) -> Optional[Dict[str, Any]]:
+        """排队中会话的当前位置与预计开始时间；会话不在排队中时为 None"""
+        plan = self._snapshot()
+        for index, job in enumerate(plan["queued"]):
+            if job["session_id"] == session_id:
+                return self._estimate(index + 1, plan["starts"][index])
+        return None
+
+    def reserve_local(self, key: str, products: int):
+        """不经过队列、直接在本进程线程中执行的会话：检查会话数上限并计入，结束时调用 release_local"""
+        with self._reserve_lock:
+            self._check(products, self._snapshot(), queued=False)
+            with self._lock:
+                self._local[key] = (time.monotonic(), products)
+        self.stats["admitted"] += 1
+
+    def release_local(self, key: str):
+        with self._lock:
+            self._local.pop(key, None)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            local = len(self._local)
+            per_product = self.seconds_per_product
+        return {
+            "max_active_sessions": self.max_active_sessions,
+            "max_queued_products": self.max_queued_products,
+            "seconds_per_product": round(per_product, 3),
+            "local_sessions": local,
+            **self.stats,
+        }
@@ -5,10 +5,13 @@
 
 import json
 import os
+import re
 from typing import List, Dict, Any, Optional
 import random
 import string
 
+from nutrition_utils import normalize_nutrition, to_percent
+
 # 评分权重配置
 SCORING_WEIGHTS = {
     "ideal": {
@@ -24,6 +27,39 @@ SCORING_WEIGHTS = {
     }
 }
 
+# 包装重量单位 -> 克；没有单位时按千克处理（与前端换算一致）
+_WEIGHT_UNITS = {"kg": 1000.0, "千克": 1000.0, "公斤": 1000.0, "g": 1.0, "克": 1.0, "斤": 500.0,
+                 "lb": 453.592, "lbs": 453.592, "磅": 453.592}
+_WEIGHT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(kg|千克|公斤|lbs|lb|磅|g|克|斤)?", re.IGNORECASE)
+
+
+def parse_weight_grams(weight: Any) -> Optional[float]:
+    """把 "2kg" / "1.5 千克" / "500g" / "3斤" / 2 之类的包装重量转换为克，无法解析时返回 None"""
+    if weight is None or isinstance(weight, bool):
+        return None
+    if isinstance(weight, (int, float)):
+        return float(weight) * 1000 if weight > 0 else None
+    match = _WEIGHT_PATTERN.search(str(weight))
+    if not match:
+        return None
+    grams = float(match.group(1)) * _WEIGHT_UNITS[(match.group(2) or "kg").lower()]
+    return grams if grams > 0 else None
+
+
+def product_price_per_jin(product: Dict[str, Any]) -> Optional[float]:
+    """
+    每斤价格：产品库已有 price_per_jin 时直接使用，否则与产品库相同按 price / (weight_g / 500)
+    由包装价格与重量换算（自定义产品只有包装价格与 weight 文本）；缺少价格或重量时返回 None
+    """
+    per_jin = to_percent(product.get("price_per_jin"))
+    if per_jin is not None:
+        return per_jin
+    price = to_percent(product.get("price"))
+    weight_g = product.get("weight_g") or parse_weight_grams(product.get("weight"))
+    if price is None or not weight_g:
+        return None
+    return round(price / (weight_g / 500), 2)
+
 
 class AnalysisEngine:
     """产品分析引擎"""
@@ -58,6 +94,9 @@ class AnalysisEngine:
         for result in results:
             result["ideal_score"] = self._calculate_ideal_score(result)
             result["budget_score"] = self._calculate_budget_score(result, pet_info)
+            # 与Dify结果对齐的字段，便于两种来源的结果混合排序/渲染
+            result["final_score"] = result["ideal_score"]
+            result["reason"] = result["fit_reason"]
         
         # 排序
         ideal_ranking = sorted(results, key=lambda x: x["ideal_score"], reverse=True)
@@ -98,10 +137,10 @@ class AnalysisEngine:
         scores = self._simulate_llm_analysis(pet_info, product, nutrition_data, ingredients, additives)
         
         return {
-            "product_id": product["id"],
-            "brand": product["brand"],
-            "product_name": product["product_name"],
-            "price_per_jin": product["price_per_jin"],
+            "product_id": product.get("id"),
+            "brand": product.get("brand", ""),
+            "product_name": product.get("product_name", ""),
+            "price_per_jin": product_price_per_jin(product),
             "nutrition_score": scores["nutrition_score"],
             "fit_score": scores["fit_score"],
             "safe_score": scores["safe_score"],
@@ -139,7 +178,7 @@ class AnalysisEngine:
         fit_reasons = []
         
         # 根据健康状况调整
-        health_status = pet_info.get("health_status", "").split(",")
+        health_status = (pet_info.get("health_status") or "").split(",")
         
         if "肾脏问题" in health_status and protein > 35:
             fit_score -= 15
@@ -162,7 +201,7 @@ class AnalysisEngine:
                 fit_reasons.append("纤维含量适中，有助于肠道健康")
         
         # 检查过敏源
-        allergies = pet_info.get("allergies", "")
+        allergies = pet_info.get("allergies") or ""
         if allergies:
             allergy_list = allergies.split(",")
             for allergy in allergy_list:
@@ -184,8 +223,10 @@ class AnalysisEngine:
         if not safe_reasons:
             safe_reasons.append("未发现明显安全风险")
         
-        # 性价比评分
-        price = product["price_per_jin"]
+        # 性价比评分（缺少价格或重量、无法换算每斤价格时按基准价处理）
+        price = product_price_per_jin(product)
+        if price is None:
+            price = 30.0
         value_score = max(0, 100 - (price - 30) * 2)  # 基准价30元/斤
         
         value_reasons = []
@@ -201,7 +242,7 @@ class AnalysisEngine:
         # 预算匹配
         budget_mode = pet_info.get("budget_mode", "A")
         if budget_mode == "B":
-            price_max = pet_info.get("price_range_max", 100)
+            price_max = pet_info.get("price_range_max") or 100
             if price > price_max:
                 value_reasons.append(f"超出预算上限（{price_max}元/斤）")
             elif price <= price_max * 0.8:
@@ -284,14 +325,13 @@ class AnalysisEngine:
         return mapping
     
     def _parse_nutrition(self, nutrition_str: str) -> Dict[str, float]:
-        """解析营养成分JSON"""
-        try:
-            return json.loads(nutrition_str)
-        except:
-            return {}
+        """解析营养成分JSON（键名统一为 粗蛋白/粗脂肪/粗纤维 等）"""
+        return normalize_nutrition(nutrition_str)
     
     def _parse_ingredients(self, ingredients_str: str) -> List[str]:
         """解析配料表JSON"""
+        if isinstance(ingredients_str, list):
+            return ingredients_str
         try:
             return json.loads(ingredients_str)
         except:
@@ -299,6 +339,8 @@ class AnalysisEngine:
     
     def _parse_additives(self, additives_str: str) -> List[str]:
         """解析添加剂JSON"""
+        if isinstance(additives_str, list):
+            return additives_str
         try:
             return json.loads(additives_str)
         except:
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+数据库性能基准
+
+用法:
+    python benchmark_db.py insert [--rows 100000]
+    python benchmark_db.py rows [--rows 100000]
+    python benchmark_db.py replica [--rows 20000] [--queries 10000] [--threads 4] [--writer]
+    python benchmark_db.py results [--sessions 100000]
+    python benchmark_db.py pets [--pets 20000] [--threads 8]
+    python benchmark_db.py jobs [--jobs 2000] [--workers 4] [--lease 3]
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlite_db_utils import SQLiteDB
+
+
+def _temp_db(name: str) -> SQLiteDB:
+    path = os.path.join(tempfile.mkdtemp(prefix="petfood-bench-"), name)
+    return SQLiteDB(path)
+
+
+def _products_table(database: SQLiteDB):
+    database.execute_update("""
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        brand TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        species TEXT,
+        price_per_jin REAL,
+        nutrition_analysis TEXT
+    )
+    """)
+
+
+def _product_rows(count: int):
+    return [
+        (f"品牌{i % 50}", f"测试产品{i}", "cat" if i % 2 else "dog", 10 + i % 90,
+         '{"粗蛋白": "36%", "粗脂肪": "16%"}')
+        for i in range(count)
+    ]
+
+
+def bench_insert(rows: int):
+    """逐行 execute_update（每行一次提交）对比 execute_many（一次提交）"""
+    insert_sql = ("INSERT INTO products (brand, product_name, species, price_per_jin, nutrition_analysis) "
+                  "VALUES (?, ?, ?, ?, ?)")
+    data = _product_rows(rows)
+    
+    before = _temp_db("row_by_row.db")
+    _products_table(before)
+    started = time.perf_counter()
+    for row in data:
+        before.execute_update(insert_sql, row)
+    row_by_row = time.perf_counter() - started
+    before.close()
+    
+    after = _temp_db("execute_many.db")
+    _products_table(after)
+    started = time.perf_counter()
+    after.execute_many(insert_sql, data)
+    batched = time.perf_counter() - started
+    after.close()
+    
+    print(f"插入 {rows} 行")
+    print(f"  逐行 execute_update: {row_by_row:8.2f}s  {rows / row_by_row:>12,.0f} 行/秒")
+    print(f"  execute_many       : {batched:8.2f}s  {rows / batched:>12,.0f} 行/秒")
+    print(f"  提升 {row_by_row / batched:.1f} 倍")
+
+
+def bench_rows(rows: int):
+    """读取全部行：execute_query（sqlite3.Row -> dict 列表）对比 iter_query 各种行工厂"""
+    database = _temp_db("rows.db")
+    _products_table(database)
+    database.execute_many(
+        "INSERT INTO products (brand, product_name, species, price_per_jin, nutrition_analysis) VALUES (?, ?, ?, ?, ?)",
+        _product_rows(rows)
+    )
+    query = "SELECT * FROM products"
+    cases = [("execute_query（列表）", lambda: database.execute_query(query))]
+    for factory in ("dict", "tuple", "namedtuple", "record"):
+        # 逐行消费，不保留行对象
+        cases.append((f"iter_query {factory}", lambda f=factory: sum(
+            1 for _ in database.iter_query(query, row_factory=f)
+        )))
+    # 保留全部行时各行对象的内存占用
+    for factory in ("dict", "namedtuple", "record"):
+        cases.append((f"list(iter_query {factory})", lambda f=factory: list(
+            database.iter_query(query, row_factory=f)
+        )))
+    
+    print(f"读取 {rows} 行")
+    for label, run in cases:
+        run()  # 预热语句缓存
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        # 峰值内存单独测量（tracemalloc 本身会显著拖慢执行）
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {label:<26} {elapsed:7.3f}s  峰值内存 {peak / 1024 / 1024:8.1f} MB")
+    database.close()
+
+
+def _percentile(sorted_values, percent: float) -> float:
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def _run_reads(database, queries, threads: int):
+    """threads 个线程共同执行 queries，返回 (总耗时, 每条查询耗时列表)"""
+    latencies = []
+    lock = threading.Lock()
+    chunks = [queries[i::threads] for i in range(threads)]
+    
+    def worker(chunk):
+        local = []
+        for sql, params in chunk:
+            started = time.perf_counter()
+            database.execute_query(sql, params)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+    
+    workers = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - started, sorted(latencies)
+
+
+def bench_replica(rows: int, queries: int, threads: int, writer: bool = False):
+    """产品列表 / 详情 / 营养素筛选的混合读取：数据库文件 vs 内存副本（catalog_replica.py）"""
+    from catalog_replica import CatalogReplica
+    from db_migrations import apply_migrations
+    
+    database = _temp_db("catalog.db")
+    apply_migrations(database)
+    database.execute_many(
+        "INSERT INTO products (brand, product_name, species, product_type, price_per_jin, nutrition_analysis) "
+        "VALUES (?, ?, ?, 'dry', ?, ?)",
+        _product_rows(rows)
+    )
+    replica = CatalogReplica(database, enabled=True, check_interval=3600)
+    load = replica.refresh()
+    
+    workload = []
+    for i in range(queries):
+        kind = 2 if i % 10 == 9 else i % 2
+        if kind == 0:
+            workload.append((
+                "SELECT * FROM products WHERE species = ? AND (price_per_jin, id) > (?, ?) "
+                "ORDER BY price_per_jin, id LIMIT 51", ("cat" if i % 2 else "dog", 10 + i % 80, i % rows)
+            ))
+        elif kind == 1:
+            workload.append(("SELECT * FROM products WHERE id = ?", (1 + (i * 7919) % rows,)))
+        else:
+            workload.append((
+                "SELECT * FROM products WHERE id IN (SELECT product_id FROM product_nutrients "
+                "WHERE protein >= ? AND fat <= ?) ORDER BY price_per_jin, id LIMIT 51", (30 + i % 8, 18)
+            ))
+    
+    # 可选：后台持续写入分析会话，模拟读取期间数据库文件上的写事务与 WAL 增长
+    stop = threading.Event()
+    
+    def write_sessions():
+        while not stop.is_set():
+            database.execute_update(
+                "INSERT INTO analysis_sessions (product_ids, status, analysis_results) VALUES ('[]', 'running', ?)",
+                ("x" * 2000,)
+            )
+    
+    if writer:
+        threading.Thread(target=write_sessions, daemon=True).start()
+    
+    print(f"产品 {rows} 个，查询 {queries} 条（列表 45% / 详情 45% / 营养素筛选 10%），{threads} 线程"
+          + ("，后台持续写入会话" if writer else ""))
+    print(f"  内存副本加载耗时 {load['seconds']:.3f}s")
+    for label, target in (("数据库文件", database), ("内存副本", replica)):
+        _run_reads(target, workload[:200], threads)  # 预热
+        elapsed, latencies = _run_reads(target, workload, threads)
+        print(f"  {label:<6} {queries / elapsed:>10,.0f} 查询/秒  "
+              f"p50 {_percentile(latencies, 50) * 1000:6.3f}ms  p99 {_percentile(latencies, 99) * 1000:6.3f}ms")
+    stop.set()
+    replica.close()
+    database.close()
+
+
+def _session_results(seed: int):
+    """与 run_dify_analysis_task 写入结构一致的一次分析结果（5~10 个产品，含中文理由与证据）"""
+    results = []
+    for i in range(5 + seed % 6):
+        results.append({
+            "anonymous_code": "ABCDEFGHIJ"[i],
+            "product_id": 1 + (seed * 7 + i) % 500,
+            "scores": {"overall": 60 + (seed + i * 13) % 40, "nutrition": 20 + i, "compatibility": 15 + seed % 10,
+                       "safety": 18, "value": 9 + i % 3},
+            "reason": f"第{i + 1}款产品蛋白质含量{30 + i}%，以鸡肉和三文鱼为主要动物蛋白来源，"
+                      f"脂肪含量适中，适合{['幼猫', '成猫', '老年猫'][seed % 3]}日常喂养；"
+                      "含有谷物成分，对谷物敏感的宠物需谨慎选择，建议搭配湿粮补充水分。",
+            "key_evidence": ["粗蛋白≥%d%%" % (30 + i), "第一原料为鲜鸡肉", "添加牛磺酸", "不含人工色素"],
+            "health_tags": ["高蛋白", "无诱食剂"][: 1 + i % 2],
+            "hit_avoid": [] if i % 3 else ["玉米"],
+            "hard_fail": False,
+            "success": True,
+            "error": "",
+            "elapsed_time": round(8 + (seed + i) % 20 * 0.37, 2),
+            "workflow_run_id": f"{seed:08x}-{i:04x}-4c1e-9b7a-{seed * 31 + i:012x}",
+        })
+    return results
+
+
+def bench_results(sessions: int):
+    """analysis_results 存储：原 json.dumps 文本 vs result_codec 压缩编码（体积、编码与解码耗时）"""
+    import json
+    from result_codec import decode_results, encode_results
+    
+    payloads = [_session_results(i) for i in range(sessions)]
+    cases = [
+        ("JSON 文本（原）", lambda r: json.dumps(r), json.loads),
+        ("zlib JSON（版本1）", encode_results, decode_results),
+    ]
+    print(f"分析会话 {sessions} 个")
+    for label, encode, decode in cases:
+        database = _temp_db("results.db")
+        database.execute_update(
+            "CREATE TABLE analysis_sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT, analysis_results TEXT)"
+        )
+        started = time.perf_counter()
+        encoded = [encode(r) for r in payloads]
+        encode_seconds = time.perf_counter() - started
+        database.execute_many(
+            "INSERT INTO analysis_sessions (status, analysis_results) VALUES ('completed', ?)",
+            [(value,) for value in encoded]
+        )
+        database.execute_update("VACUUM")
+        with database.connection() as conn:
+            size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        
+        # 逐个会话读取并解析（/api/analysis/result 的路径），只计解析耗时
+        values = [row[0] for row in database.iter_query(
+            "SELECT analysis_results FROM analysis_sessions", row_factory="tuple"
+        )]
+        started = time.perf_counter()
+        for value in values:
+            decode(value)
+        decode_seconds = time.perf_counter() - started
+        
+        # 按主键随机读取单个会话（读 + 解析）
+        started = time.perf_counter()
+        for i in range(0, sessions, max(1, sessions // 5000)):
+            row = database.execute_query("SELECT analysis_results FROM analysis_sessions WHERE id = ?", (i + 1,))
+            decode(row[0]["analysis_results"])
+        lookups = len(range(0, sessions, max(1, sessions // 5000)))
+        lookup_seconds = time.perf_counter() - started
+        
+        avg_bytes = sum(len(v) for v in encoded) / sessions
+        print(f"  {label:<16} 数据库 {size / 1024 / 1024:7.1f} MB  平均 {avg_bytes:7.0f} 字节/会话  "
+              f"编码 {encode_seconds / sessions * 1e6:6.1f}µs  解码 {decode_seconds / sessions * 1e6:6.1f}µs  "
+              f"按ID读取+解码 {lookup_seconds / lookups * 1e6:6.1f}µs")
+        database.close()
+
+
+def bench_pets(pets: int, threads: int):
+    """并发创建宠物：逐行提交 vs 延迟批量写入（write_behind.py），按接口返回 ID 为止计时"""
+    from db_migrations import apply_migrations
+    from write_behind import WriteBehindBuffer
+    
+    columns = ("species", "breed", "age_months", "weight_kg", "health_status")
+    row = ("cat", "英短", 12, 4.2, "健康")
+    print(f"创建宠物 {pets} 个，{threads} 线程")
+    for label, enabled in (("逐行提交", False), ("延迟批量写入", True)):
+        database = _temp_db("pets.db")
+        apply_migrations(database)
+        buffer = WriteBehindBuffer(database, "pet_info", columns, enabled=enabled)
+        latencies = []
+        lock = threading.Lock()
+        
+        def worker(count):
+            local = []
+            for _ in range(count):
+                started = time.perf_counter()
+                buffer.insert(row)
+                local.append(time.perf_counter() - started)
+            with lock:
+                latencies.extend(local)
+        
+        workers = [threading.Thread(target=worker, args=(pets // threads,)) for _ in range(threads)]
+        started = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - started
+        buffer.stop()
+        total = time.perf_counter() - started
+        latencies.sort()
+        written = database.execute_query("SELECT COUNT(*) AS n FROM pet_info")[0]["n"]
+        status = buffer.status()
+        print(f"  {label:<8} {len(latencies) / elapsed:>10,.0f} 个/秒  "
+              f"p50 {_percentile(latencies, 50) * 1000:6.3f}ms  p99 {_percentile(latencies, 99) * 1000:6.3f}ms  "
+              f"全部落盘 {total:.2f}s  写入 {written} 行"
+              + (f"，{status['batches']} 批" if enabled else ""))
+        database.close()
+
+
+def _crashing_worker(db_path: str, workers: int, lease: float):
+    """子进程：领取任务后在执行中途直接退出（模拟崩溃 / 被强制重启），不释放租约"""
+    from job_queue import JobQueue
+    
+    database = SQLiteDB(db_path)
+    queue = JobQueue(database, lambda job: time.sleep(3600), workers=workers, lease_seconds=lease, poll_seconds=0.01)
+    queue.start()
+    while queue.status()["in_flight"] < workers:
+        time.sleep(0.01)
+    os._exit(1)
+
+
+def _drain(database, queue) -> float:
+    started = time.perf_counter()
+    queue.start()
+    while sum(queue.counts().values()):
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    queue.stop()
+    return elapsed
+
+
+def bench_jobs(jobs: int, workers: int, lease: float):
+    """分析任务队列（job_queue.py）：空任务的领取吞吐，以及进程崩溃后被中断任务的恢复耗时"""
+    from db_migrations import apply_migrations
+    from job_queue import JobQueue
+    
+    database = _temp_db("jobs.db")
+    apply_migrations(database)
+    with database.transaction():
+        for i in range(jobs):
+            JobQueue(database, None).enqueue(i, "noop", {})
+    queue = JobQueue(database, lambda job: None, workers=workers, lease_seconds=lease, poll_seconds=0.01)
+    elapsed = _drain(database, queue)
+    print(f"吞吐：{jobs} 个空任务，{workers} 线程，{jobs / elapsed:,.0f} 个/秒")
+    
+    # 崩溃恢复：子进程领取 workers 个任务后退出，新进程接管
+    for label, other_host in (("同一台机器，检测到持有进程已退出", False), ("其他机器，等待租约过期", True)):
+        database.execute_update("DELETE FROM analysis_jobs")
+        for i in range(workers * 5):
+            JobQueue(database, None).enqueue(i, "noop", {})
+        crashed = multiprocessing.get_context("fork").Process(
+            target=_crashing_worker, args=(database.db_path, workers, lease)
+        )
+        crashed.start()
+        crashed.join()
+        if other_host:
+            database.execute_update(
+                "UPDATE analysis_jobs SET lease_owner = 'another-host:1:x' WHERE lease_owner IS NOT NULL"
+            )
+        held = database.execute_query("SELECT COUNT(*) AS n FROM analysis_jobs WHERE status = 'running'")[0]["n"]
+        queue = JobQueue(database, lambda job: None, workers=workers, lease_seconds=lease, poll_seconds=0.01)
+        elapsed = _drain(database, queue)
+        print(f"恢复（{label}）：崩溃时持有 {held} 个任务，全部完成耗时 {elapsed:.2f}s（租约 {lease:g}s）")
+    database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+    insert = sub.add_parser("insert", help="批量插入：逐行提交 vs execute_many")
+    insert.add_argument("--rows", type=int, default=100000)
+    rows = sub.add_parser("rows", help="读取行：execute_query vs iter_query 行工厂")
+    rows.add_argument("--rows", type=int, default=100000)
+    replica = sub.add_parser("replica", help="产品读取：数据库文件 vs 内存副本")
+    replica.add_argument("--rows", type=int, default=20000)
+    replica.add_argument("--queries", type=int, default=10000)
+    replica.add_argument("--threads", type=int, default=4)
+    replica.add_argument("--writer", action="store_true", help="读取期间后台持续写入分析会话")
+    results = sub.add_parser("results", help="分析结果存储：JSON 文本 vs 压缩编码")
+    results.add_argument("--sessions", type=int, default=100000)
+    pets = sub.add_parser("pets", help="并发创建宠物：逐行提交 vs 延迟批量写入")
+    pets.add_argument("--pets", type=int, default=20000)
+    pets.add_argument("--threads", type=int, default=8)
+    jobs = sub.add_parser("jobs", help="分析任务队列：领取吞吐与崩溃恢复耗时")
+    jobs.add_argument("--jobs", type=int, default=2000)
+    jobs.add_argument("--workers", type=int, default=4)
+    jobs.add_argument("--lease", type=float, default=3)
+    args = parser.parse_args()
+    
+    if args.command == "insert":
+        bench_insert(args.rows)
+    elif args.command == "rows":
+        bench_rows(args.rows)
+    elif args.command == "replica":
+        bench_replica(args.rows, args.queries, args.threads, args.writer)
+    elif args.command == "results":
+        bench_results(args.sessions)
+    elif args.command == "pets":
+        bench_pets(args.pets, args.threads)
+    elif args.command == "jobs":
+        bench_jobs(args.jobs, args.workers, args.lease)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+多 worker 吞吐基准
+
+在临时数据库副本上依次以 1、2、4 个 uvicorn worker 启动服务（默认 PROGRESS_BACKEND=sqlite），
+启动一个分析会话后由多个客户端进程并发请求进度与产品列表，统计吞吐、延迟与"会话不存在"的次数。
+
+用法:
+    python benchmark_workers.py [--workers 1 2 4] [--seconds 10] [--clients 8] [--backend sqlite|memory]
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SOURCE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pet_food_selection.db")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str, body=None):
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read() or b"null")
+
+
+def _copy_database(path: str):
+    """用在线备份复制仓库数据库，不受其 WAL 状态影响"""
+    source = sqlite3.connect(SOURCE_DB)
+    target = sqlite3.connect(path)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+def _start_server(workers: int, db_path: str, port: int, backend: str) -> subprocess.Popen:
+    # 关闭时不必等基准用的分析会话跑完
+    env = dict(os.environ, SQLITE_DB_PATH=db_path, PROGRESS_BACKEND=backend, JOB_DRAIN_SECONDS="1")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main_sqlite:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            # 每个 worker 都完成启动后健康检查才稳定成功，多试几次
+            if all(_request(conn, "GET", "/api/health")[0] == 200 for _ in range(workers * 4)):
+                conn.close()
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("服务启动超时")
+
+
+def _client(port: int, session_id: int, seconds: float, queue):
+    """一个客户端：每个请求新建连接（模拟负载均衡后的大量独立客户端），进度与产品列表交替请求"""
+    latencies = []
+    not_found = errors = 0
+    deadline = time.time() + seconds
+    i = 0
+    while time.time() < deadline:
+        path = f"/api/analysis/progress/{session_id}" if i % 2 == 0 else "/api/products?limit=20&species=cat"
+        started = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            status, body = _request(conn, "GET", path)
+            conn.close()
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        if status != 200:
+            errors += 1
+        elif i % 2 == 0 and body.get("status") == "not_found":
+            not_found += 1
+        i += 1
+    queue.put((latencies, not_found, errors))
+
+
+def bench(workers: int, seconds: float, clients: int, backend: str = "sqlite") -> dict:
+    db_path = os.path.join(tempfile.mkdtemp(prefix="petfood-workers-"), "bench.db")
+    _copy_database(db_path)
+    port = _free_port()
+    server = _start_server(workers, db_path, port, backend)
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        _, pet = _request(conn, "POST", "/api/pet/create", {"species": "cat", "breed": "英短", "age_months": 24})
+        _, products = _request(conn, "GET", "/api/products?limit=10&species=cat")
+        product_ids = [p["id"] for p in products["products"]][:10]
+        # 模拟分析每个产品耗时约 2 秒，基准期间会话保持 running
+        _, started = _request(conn, "POST", "/api/analysis/start",
+                              {"pet_id": pet["pet_id"], "product_ids": product_ids, "use_dify": False})
+        conn.close()
+
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_client, args=(port, started["session_id"], seconds, queue))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        results = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        server.terminate()
+        server.wait(30)
+
+    latencies = sorted(x for r in results for x in r[0])
+    return {
+        "workers": workers,
+        "backend": backend,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / seconds, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+        "not_found": sum(r[1] for r in results),
+        "errors": sum(r[2] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 吞吐基准")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite",
+                        help="memory 为改动前的进程内进度，多 worker 时部分进度请求返回会话不存在")
+    args = parser.parse_args()
+    print(f"CPU 核数: {os.cpu_count()}")
+    for workers in args.workers:
+        print(json.dumps(bench(workers, args.seconds, args.clients, args.backend), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+产品目录快照与发布
+把产品目录打包成一个可校验的文件，在另一个实例上一次性原子替换，代替手工导出 SQL / 逐个产品上传。
+
+- snapshot：在一个读事务内用 SQLite 备份 API 复制数据库（WAL 下不阻塞写入），
+  只保留产品相关的表（与 catalog_replica.CATALOG_TABLES 相同），写出 catalog-v<版本>-<时间>.tar.gz，
+  其中 manifest.json 记录 catalog.db 的 sha256、产品数、目录版本号与迁移版本；
+- load：校验 sha256 与完整性后，在一个写事务内用快照中的产品整体替换 products，
+  全文检索与营养素数值表由触发器同步重建，读请求要么看到旧目录，要么看到新目录；
+- publish：把快照上传到运行中实例的 POST /api/admin/catalog（需要 ADMIN_TOKEN）。
+
+    python catalog_publish.py snapshot --out-dir dist
+    python catalog_publish.py load dist/catalog-v42-20250101-120000.tar.gz
+    python catalog_publish.py publish dist/catalog-v42-....tar.gz --url https://... --token ...
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import tempfile
+import time
+from typing import Any, Callable, Dict, Optional
+
+from catalog_replica import CATALOG_TABLES
+from db_migrations import current_version
+from sqlite_db_utils import db
+
+logger = logging.getLogger(__name__)
+
+CATALOG_ARTIFACT_DIR = os.environ.get("CATALOG_ARTIFACT_DIR", "catalog_artifacts")
+# 备份每步复制的页数：步与步之间释放 GIL，进程内其他线程不会长时间等待
+CATALOG_BACKUP_STEP_PAGES = int(os.environ.get("CATALOG_BACKUP_STEP_PAGES", "1024"))
+# 快照文件格式版本，格式不兼容时递增
+ARTIFACT_FORMAT = 1
+MANIFEST_NAME = "manifest.json"
+DATABASE_NAME = "catalog.db"
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def snapshot(database=db, out_dir: str = CATALOG_ARTIFACT_DIR,
+             pages_per_step: int = CATALOG_BACKUP_STEP_PAGES,
+             progress: Optional[Callable[[int, int, int], None]] = None) -> Dict[str, Any]:
+    """
+    生成产品目录快照，返回 manifest（含 path）
+
+    整个备份在源连接的同一个读事务内完成：复制的是事务开始时的一致状态，
+    期间其他连接的写入照常提交，不会使备份重新开始。progress 透传给 sqlite3 的 backup。
+    """
+    started = time.perf_counter()
+    schema_version = current_version(database)
+    with tempfile.TemporaryDirectory(prefix="catalog_snapshot_") as tmp:
+        db_path = os.path.join(tmp, DATABASE_NAME)
+        dest = sqlite3.connect(db_path)
+        try:
+            with database.connection() as src:
+                src.execute("BEGIN")
+                try:
+                    version_row = src.execute(
+                        "SELECT version FROM catalog_version WHERE id = 1"
+                    ).fetchone() if _has_table(src, "catalog_version") else None
+                    src.backup(dest, pages=pages_per_step, progress=progress, sleep=0)
+                finally:
+                    src.rollback()
+            for (table,) in dest.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall():
+                if table not in CATALOG_TABLES and not table.startswith("products_fts_"):
+                    dest.execute(f'DROP TABLE IF EXISTS "{table}"')
+            dest.commit()
+            # 快照是独立文件，不需要 WAL
+            dest.execute("PRAGMA journal_mode = DELETE")
+            dest.execute("VACUUM")
+            products = dest.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        finally:
+            dest.close()
+
+        manifest = {
+            "format": ARTIFACT_FORMAT,
+            "catalog_version": version_row[0] if version_row else None,
+            "schema_version": schema_version,
+            "products": products,
+            "sha256": _sha256_file(db_path),
+            "size": os.path.getsize(db_path),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        os.makedirs(out_dir, exist_ok=True)
+        name = f"catalog-v{manifest['catalog_version'] or 0}-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz"
+        path = os.path.join(out_dir, name)
+        # 先写临时文件再改名，目录中不会出现写了一半的快照
+        partial = path + ".partial"
+        with tarfile.open(partial, "w:gz") as tar:
+            data = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+            tar.add(db_path, arcname=DATABASE_NAME)
+        os.replace(partial, path)
+
+    manifest["path"] = path
+    manifest["compressed_size"] = os.path.getsize(path)
+    manifest["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(
+        f"📦 产品目录快照已生成：{products} 个产品，版本 {manifest['catalog_version']}，"
+        f"{manifest['size']} -> {manifest['compressed_size']} 字节，耗时 {manifest['seconds']}s：{path}"
+    )
+    return manifest
+
+
+def _extract(artifact_path: str, workdir: str, expected_sha256: Optional[str] = None) -> Dict[str, Any]:
+    """解包快照并校验 sha256，返回 manifest（含解包后的 db_path）；文件损坏或不匹配时抛出 ValueError"""
+    try:
+        with tarfile.open(artifact_path, "r:gz") as tar:
+            manifest = json.load(tar.extractfile(MANIFEST_NAME))
+            if manifest.get("format") != ARTIFACT_FORMAT:
+                raise ValueError(f"不支持的快照格式: {manifest.get('format')}")
+            db_path = os.path.join(workdir, DATABASE_NAME)
+            digest = hashlib.sha256()
+            with tar.extractfile(DATABASE_NAME) as src, open(db_path, "wb") as dest:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    dest.write(chunk)
+    except (tarfile.TarError, KeyError, OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"快照文件无法读取: {e}")
+    actual = digest.hexdigest()
+    for expected in (manifest.get("sha256"), expected_sha256):
+        if expected and expected != actual:
+            raise ValueError(f"快照校验和不匹配：期望 {expected}，实际 {actual}")
+    manifest["db_path"] = db_path
+    return manifest
+
+
+def _product_columns(conn: sqlite3.Connection, schema: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(products)")]
+
+
+def load_catalog(database=db, artifact_path: str = "", expected_sha256: Optional[str] = None) -> Dict[str, Any]:
+    """
+    用快照中的产品整体替换当前数据库的 products，返回 {products, catalog_version, sha256, seconds}
+
+    快照的迁移版本高于当前数据库时拒绝加载（目标实例需先升级）；低于时按两边共有的列导入。
+    替换在一个 BEGIN IMMEDIATE 事务内完成，失败时整体回滚。
+    """
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="catalog_load_") as tmp:
+        manifest = _extract(artifact_path, tmp, expected_sha256)
+        check = sqlite3.connect(manifest["db_path"])
+        try:
+            integrity = check.execute("PRAGMA integrity_check").fetchone()[0]
+            products = check.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            raise ValueError(f"快照数据库无法打开: {e}")
+        finally:
+            check.close()
+        if integrity != "ok":
+            raise ValueError(f"快照数据库完整性检查失败: {integrity}")
+        if products != manifest.get("products"):
+            raise ValueError(f"快照产品数与 manifest 不一致：{products} != {manifest.get('products')}")
+        target_version = current_version(database)
+        if manifest.get("schema_version", 0) > target_version:
+            raise ValueError(
+                f"快照的数据库迁移版本 {manifest['schema_version']} 高于当前实例的 {target_version}，请先升级实例"
+            )
+
+        with database.connection() as conn:
+            conn.execute("ATTACH DATABASE ? AS incoming", (manifest["db_path"],))
+            try:
+                incoming = set(_product_columns(conn, "incoming"))
+                columns = ", ".join(c for c in _product_columns(conn, "main") if c in incoming)
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("DELETE FROM main.products")
+                    conn.execute(f"INSERT INTO main.products ({columns}) SELECT {columns} FROM incoming.products")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            finally:
+                conn.execute("DETACH DATABASE incoming")
+
+    version = database.execute_query("SELECT version FROM catalog_version WHERE id = 1")
+    report = {
+        "products": products,
+        "catalog_version": version[0]["version"] if version else None,
+        "sha256": manifest["sha256"],
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    logger.info(f"📥 产品目录已替换：{products} 个产品，耗时 {report['seconds']}s（快照 {manifest['sha256'][:12]}）")
+    return report
+
+
+def publish(artifact_path: str, url: str, token: str, timeout: float = 120) -> Dict[str, Any]:
+    """把快照上传到运行中实例的 /api/admin/catalog"""
+    import requests
+
+    with open(artifact_path, "rb") as f:
+        data = f.read()
+    response = requests.post(
+        f"{url.rstrip('/')}/api/admin/catalog",
+        data=data,
+        headers={
+            "Content-Type": "application/gzip",
+            "X-Admin-Token": token,
+            "X-Catalog-Sha256": _manifest_of(artifact_path)["sha256"],
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _manifest_of(artifact_path: str) -> Dict[str, Any]:
+    with tarfile.open(artifact_path, "r:gz") as tar:
+        return json.load(tar.extractfile(MANIFEST_NAME))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="产品目录快照、加载与发布")
+    commands = parser.add_subparsers(dest="command", required=True)
+    snap = commands.add_parser("snapshot", help="生成产品目录快照")
+    snap.add_argument("--out-dir", default=CATALOG_ARTIFACT_DIR)
+    load = commands.add_parser("load", help="用快照替换本地数据库中的产品目录")
+    load.add_argument("artifact")
+    load.add_argument("--sha256", help="额外核对的校验和")
+    pub = commands.add_parser("publish", help="上传快照到运行中的实例")
+    pub.add_argument("artifact")
+    pub.add_argument("--url", default=os.environ.get("RENDER_API_BASE", "https://pet-food-advisor.onrender.com"))
+    pub.add_argument("--token", default=os.environ.get("ADMIN_TOKEN", ""))
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        result = snapshot(db, args.out_dir)
+    elif args.command == "load":
+        result = load_catalog(db, args.artifact, args.sha256)
+    else:
+        result = publish(args.artifact, args.url, args.token)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+产品目录的内存只读副本
+启动时用 SQLite 备份 API 把数据库文件复制到内存，只保留产品相关的表（products、全文检索、营养素数值），
+产品列表 / 搜索 / 详情的读取都走内存副本，不再访问磁盘文件。
+
+- 本进程写入产品后调用 refresh() 立即重新加载；
+- 其他进程（导入脚本、其他 worker）的写入通过 catalog_version（products 触发器维护的版本号）发现，
+  读取时最多每 CATALOG_REPLICA_CHECK_SECONDS 秒检查一次，版本变化则重新加载；
+- 重新加载时新建一份副本再整体替换，读请求要么读到旧副本，要么读到新副本；
+  旧副本在最后一个读请求结束后关闭。
+
+通过环境变量 CATALOG_REPLICA=1 启用；未启用或尚未加载时所有读取直接走数据库文件。
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from repository import Repository
+from sqlite_db_utils import SQLiteDB, db
+
+logger = logging.getLogger(__name__)
+
+CATALOG_REPLICA_ENABLED = os.environ.get("CATALOG_REPLICA", "0").lower() in ("1", "true", "yes")
+CATALOG_REPLICA_CHECK_SECONDS = float(os.environ.get("CATALOG_REPLICA_CHECK_SECONDS", "5"))
+CATALOG_REPLICA_POOL_SIZE = int(os.environ.get("CATALOG_REPLICA_POOL_SIZE", "8"))
+
+# 副本中保留的表（及其索引、触发器，全文检索的影子表 products_fts_* 一并保留），其余表加载后删除
+CATALOG_TABLES = ("products", "products_fts", "product_nutrients", "catalog_version", "sqlite_sequence")
+
+
+class _ReplicaDB(SQLiteDB):
+    """内存副本的连接池：各连接共享同一个内存数据库，加载完成后只读"""
+
+    read_only = False
+
+    def _new_connection(self):
+        conn = super()._new_connection()
+        if self.read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+class _Generation:
+    """一次加载得到的副本，记录正在使用它的读请求数"""
+
+    def __init__(self, database: _ReplicaDB, version: Optional[int]):
+        self.database = database
+        self.version = version
+        self.loaded_at = time.time()
+        self.readers = 0
+        self.retired = False
+
+
+class CatalogReplica:
+    """
+    产品目录读取入口：提供与 SQLiteDB 相同的 iter_query / execute_query
+
+    enabled 为 False 时直接转发给 source。
+    """
+
+    _names = itertools.count(1)
+
+    def __init__(self, source: Repository, enabled: bool = CATALOG_REPLICA_ENABLED,
+                 check_interval: float = CATALOG_REPLICA_CHECK_SECONDS,
+                 pool_size: int = CATALOG_REPLICA_POOL_SIZE):
+        self.source = source
+        # 内存副本基于 SQLite 备份 API，其他数据库类型直接读源库
+        self.enabled = enabled and getattr(source, "dialect", "sqlite") == "sqlite"
+        self.check_interval = check_interval
+        self.pool_size = pool_size
+        self._current: Optional[_Generation] = None
+        self._lock = threading.Lock()  # 保护 _current 与读请求计数
+        self._refresh_lock = threading.Lock()  # 同一时间只做一次重新加载
+        self._checked_at = 0.0
+        self.stats = {"refreshes": 0, "replica_reads": 0, "source_reads": 0}
+
+    @property
+    def dialect(self) -> str:
+        """与源库一致：副本同样是 SQLite，源库不是时副本不启用"""
+        return getattr(self.source, "dialect", "sqlite")
+
+    # ---- 加载 ----
+
+    def _source_version(self) -> Optional[int]:
+        try:
+            rows = self.source.execute_query("SELECT version FROM catalog_version WHERE id = 1")
+        except Exception:
+            return None  # 旧数据库尚未执行迁移 6
+        return rows[0]["version"] if rows else None
+
+    def _load(self) -> _Generation:
+        # 共享缓存的命名内存数据库：同名的连接共享一份数据，每次加载用新名字
+        name = f"catalog-{os.getpid()}-{next(self._names)}-{uuid.uuid4().hex[:8]}"
+        replica = _ReplicaDB(f"file:{name}?mode=memory&cache=shared", pool_size=self.pool_size)
+        # 副本上的语句耗时计入数据库文件的统计，重新加载后不丢失
+        replica.query_stats = self.source.query_stats
+        with self.source.connection() as src, replica.connection() as dest:
+            # 版本号与数据取自同一个读事务，保证两者一致
+            src.execute("BEGIN")
+            try:
+                version_row = src.execute(
+                    "SELECT version FROM catalog_version WHERE id = 1"
+                ).fetchone() if self._has_table(src, "catalog_version") else None
+                src.backup(dest)
+            finally:
+                src.rollback()
+            extra = [
+                row[0] for row in dest.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+                )
+                if row[0] not in CATALOG_TABLES and not row[0].startswith("products_fts_")
+            ]
+            for table in extra:
+                dest.execute(f'DROP TABLE IF EXISTS "{table}"')
+            dest.commit()
+            if extra:
+                dest.execute("VACUUM")
+        replica.read_only = True
+        with replica.connection() as conn:
+            conn.execute("PRAGMA query_only = ON")
+        return _Generation(replica, version_row[0] if version_row else None)
+
+    @staticmethod
+    def _has_table(conn, name: str) -> bool:
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone() is not None
+
+    def refresh(self) -> Dict[str, Any]:
+        """重新加载副本并原子替换，返回 {version, products, seconds}"""
+        with self._refresh_lock:
+            started = time.perf_counter()
+            generation = self._load()
+            with self._lock:
+                old, self._current = self._current, generation
+                self._checked_at = time.monotonic()
+                self.stats["refreshes"] += 1
+                if old is not None:
+                    old.retired = True
+                    close_old = old.readers == 0
+                else:
+                    close_old = False
+            if close_old:
+                old.database.close()
+            products = generation.database.execute_query("SELECT COUNT(*) AS count FROM products")[0]["count"]
+            seconds = time.perf_counter() - started
+            logger.info(f"📚 产品目录内存副本已加载：{products} 个产品，版本 {generation.version}，耗时 {seconds:.3f}s")
+            return {"version": generation.version, "products": products, "seconds": round(seconds, 3)}
+
+    def products_changed(self):
+        """本进程写入产品后调用：副本已加载时立即重新加载（失败只记录日志，写入本身已成功）"""
+        if not self.enabled or self._current is None:
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"❌ 产品目录内存副本刷新失败，将在下次版本检查时重试: {e}")
+
+    def _check_stale(self):
+        """超过检查间隔时比较版本号；版本变化则重新加载（已有其他线程在加载时不等待，继续读旧副本）"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            loaded_version = self._current.version
+        if self._source_version() == loaded_version:
+            return
+        if self._refresh_lock.locked():
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"❌ 产品目录内存副本刷新失败，继续使用旧副本: {e}")
+
+    # ---- 读取 ----
+
+    @contextmanager
+    def reader(self) -> Iterator[SQLiteDB]:
+        """借出当前用于读取的数据库：副本可用时为内存副本，否则为数据库文件"""
+        if not self.enabled or self._current is None:
+            self.stats["source_reads"] += 1
+            yield self.source
+            return
+        self._check_stale()
+        with self._lock:
+            generation = self._current
+            generation.readers += 1
+            self.stats["replica_reads"] += 1
+        try:
+            yield generation.database
+        finally:
+            with self._lock:
+                generation.readers -= 1
+                close = generation.retired and generation.readers == 0
+            if close:
+                generation.database.close()
+
+    def iter_query(self, query: str, params: tuple = None, **kwargs) -> Iterator[Any]:
+        with self.reader() as database:
+            yield from database.iter_query(query, params, **kwargs)
+
+    def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
+        with self.reader() as database:
+            return database.execute_query(query, params)
+
+    def status(self) -> Dict[str, Any]:
+        generation = self._current
+        return {
+            "enabled": self.enabled,
+            "loaded": generation is not None,
+            "version": generation.version if generation else None,
+            "loaded_at": generation.loaded_at if generation else None,
+            **self.stats,
+        }
+
+    def close(self):
+        with self._lock:
+            generation, self._current = self._current, None
+        if generation is not None:
+            generation.database.close()
+
+
+# 全局产品目录读取入口
+catalog = CatalogReplica(db)
@@ -0,0 +1,11 @@
+"""
+pytest 公共配置：测试使用临时数据库，避免改动仓库内的 pet_food_selection.db
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault(
+    "SQLITE_DB_PATH",
+    os.path.join(tempfile.mkdtemp(prefix="pet_food_test_"), "test.db")
+)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+SQLite 数据库版本化迁移
+每个迁移有唯一递增的版本号，执行后记录到 schema_migrations 表；
+init_sqlite_database 启动时只执行尚未记录的迁移，重复执行是安全的。
+
+新增迁移：在 MIGRATIONS 末尾追加 (版本号, 说明, 函数)，函数接收一个 sqlite3 连接，
+在调用方开启的事务内执行，不要自行 commit。
+"""
+
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+from nutrition_utils import NUTRIENT_ALIASES, NUTRIENT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_TABLE = "schema_migrations"
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_missing_columns(conn: sqlite3.Connection, table: str, columns: List[Tuple[str, str]]):
+    existing = _columns(conn, table)
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _create_base_tables(conn: sqlite3.Connection):
+    """基础表结构（已有数据库上不做任何改动）"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS pet_info (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        species TEXT NOT NULL,
+        breed TEXT,
+        age_months INTEGER,
+        weight_kg REAL,
+        health_status TEXT,
+        allergies TEXT,
+        doctor_notes TEXT,
+        budget_mode TEXT,
+        monthly_budget REAL,
+        price_range_min REAL,
+        price_range_max REAL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        brand TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        category TEXT,
+        life_stage TEXT,
+        species TEXT DEFAULT 'cat',
+        product_type TEXT DEFAULT 'dry',
+        price REAL,
+        weight_g INTEGER,
+        price_per_jin REAL,
+        ingredients TEXT,
+        nutrition_analysis TEXT,
+        additives TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pet_id INTEGER,
+        product_ids TEXT,
+        analysis_results TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (pet_id) REFERENCES pet_info (id)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS anonymous_mapping (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER,
+        product_id INTEGER,
+        anonymous_code TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES analysis_sessions (id),
+        FOREIGN KEY (product_id) REFERENCES products (id)
+    )
+    """)
+
+
+def _add_product_columns(conn: sqlite3.Connection):
+    """补齐老数据库 products 表缺少的列（与 migrate_database.py 生成的结构一致）"""
+    _add_missing_columns(conn, "products", [
+        ("species", "TEXT DEFAULT 'cat'"),
+        ("product_type", "TEXT DEFAULT 'dry'"),
+        ("description", "TEXT"),
+        ("weight", "TEXT"),
+    ])
+
+
+def _add_hot_path_indexes(conn: sqlite3.Connection):
+    """main_sqlite.py 中按条件查询的索引（主键查询无需额外索引）"""
+    # /api/products：按物种/分类/阶段筛选并按每斤价格排序；无筛选时直接按价格排序
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_price_per_jin ON products (price_per_jin)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_species_price ON products (species, price_per_jin)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category_price ON products (category, price_per_jin)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_life_stage_price ON products (life_stage, price_per_jin)")
+    # 匿名码查询：WHERE session_id = ? [AND anonymous_code = ?]
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_anonymous_mapping_session_code "
+        "ON anonymous_mapping (session_id, anonymous_code)"
+    )
+
+
+# 原料列为JSON数组时拼接为空格分隔的文本再索引，否则原样索引
+_FTS_INGREDIENTS = (
+    "CASE WHEN json_valid({row}ingredients) AND json_type({row}ingredients) = 'array' "
+    "THEN (SELECT group_concat(value, ' ') FROM json_each({row}ingredients)) "
+    "ELSE {row}ingredients END"
+)
+
+
+def _create_product_search(conn: sqlite3.Connection):
+    """
+    产品全文检索：products_fts（rowid 即产品ID），由触发器与 products 保持同步
+
+    trigram 分词不依赖空格切词，中文按任意连续3个字符建索引，适合中英文混排的产品名称。
+    """
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        product_name, brand, description, ingredients,
+        tokenize = 'trigram'
+    )
+    """)
+    columns = "rowid, product_name, brand, description, ingredients"
+    new_values = f"NEW.id, NEW.product_name, NEW.brand, NEW.description, {_FTS_INGREDIENTS.format(row='NEW.')}"
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts ({columns}) VALUES ({new_values});
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = OLD.id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = OLD.id;
+        INSERT INTO products_fts ({columns}) VALUES ({new_values});
+    END
+    """)
+    conn.execute("DELETE FROM products_fts")
+    conn.execute(
+        f"INSERT INTO products_fts ({columns}) "
+        f"SELECT id, product_name, brand, description, {_FTS_INGREDIENTS.format(row='')} FROM products"
+    )
+
+
+def _nutrient_expression(nutrition: str, standard_key: str) -> str:
+    """
+    从 nutrition_analysis JSON 中取出某营养素的数值（SQL表达式）
+
+    匹配该营养素的所有同义键（与 nutrition_utils.NUTRIENT_ALIASES 一致），多个同义键并存时取第一个，
+    与 normalize_nutrition 一致；用 json_each 遍历是因为它会还原 \\uXXXX 转义的键名，json_extract 不会。
+    取值去掉 "≥"、"约" 等前缀后按数字前缀转换（"32%" -> 32.0），无法解析时为 NULL。
+    """
+    keys = ", ".join(f"'{alias}'" for alias, key in NUTRIENT_ALIASES.items() if key == standard_key)
+    raw = (
+        f"(SELECT value FROM json_each(CASE WHEN json_valid({nutrition}) THEN {nutrition} ELSE '{{}}' END) "
+        f"WHERE key IN ({keys}) ORDER BY id LIMIT 1)"
+    )
+    text = f"ltrim(CAST({raw} AS TEXT), '≥≤<>=~约 ')"
+    return f"CASE WHEN {text} GLOB '[0-9]*' OR {text} GLOB '.[0-9]*' THEN CAST({text} AS REAL) END"
+
+
+def _create_product_nutrients(conn: sqlite3.Connection):
+    """
+    营养素数值表：product_nutrients（每个产品一行，各营养素一列并分别建索引）
+
+    由 products 上的触发器在写入时解析 nutrition_analysis 填充，范围筛选直接走索引。
+    """
+    columns = list(NUTRIENT_COLUMNS)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS product_nutrients (
+        product_id INTEGER PRIMARY KEY,
+        {", ".join(f"{c} REAL" for c in columns)}
+    )
+    """)
+    for column in columns:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_product_nutrients_{column} ON product_nutrients ({column})")
+
+    def values(row: str) -> str:
+        return ", ".join(_nutrient_expression(f"{row}nutrition_analysis", NUTRIENT_COLUMNS[c]) for c in columns)
+
+    column_list = ", ".join(["product_id"] + columns)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS product_nutrients_ai AFTER INSERT ON products BEGIN
+        INSERT OR REPLACE INTO product_nutrients ({column_list}) VALUES (NEW.id, {values("NEW.")});
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS product_nutrients_au AFTER UPDATE OF id, nutrition_analysis ON products BEGIN
+        DELETE FROM product_nutrients WHERE product_id = OLD.id;
+        INSERT OR REPLACE INTO product_nutrients ({column_list}) VALUES (NEW.id, {values("NEW.")});
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS product_nutrients_ad AFTER DELETE ON products BEGIN
+        DELETE FROM product_nutrients WHERE product_id = OLD.id;
+    END
+    """)
+    conn.execute(
+        f"INSERT OR REPLACE INTO product_nutrients ({column_list}) SELECT id, {values('')} FROM products"
+    )
+
+
+def _create_catalog_version(conn: sqlite3.Connection):
+    """
+    产品目录版本号：catalog_version 单行计数器，products 每次增删改由触发器加一
+
+    内存只读副本（catalog_replica.py）据此判断是否需要重新加载，其他进程写入的产品也能被发现。
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)")
+    for name, event in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS catalog_version_{name} AFTER {event} ON products BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END
+        """)
+
+
+def _add_retention_indexes(conn: sqlite3.Connection):
+    """数据保留任务（retention.py）按创建时间分批删除，以及删除宠物前检查是否仍被会话引用"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_sessions_created_at ON analysis_sessions (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_sessions_pet_id ON analysis_sessions (pet_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pet_info_created_at ON pet_info (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_anonymous_mapping_created_at ON anonymous_mapping (created_at)")
+
+
+def _create_progress_results(conn: sqlite3.Connection):
+    """
+    进度存储（progress_store.py）中已结束会话的完整结果
+
+    /api/simple-analysis 的会话只存在于内存中，结束后结果写入本表，内存只保留引用。
+    result 使用 result_codec 编码，按 created_at 由数据保留任务清理。
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_progress_results (
+        session_key TEXT PRIMARY KEY,
+        result BLOB NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_analysis_progress_results_created_at ON analysis_progress_results (created_at)"
+    )
+
+
+def _create_shared_progress(conn: sqlite3.Connection):
+    """
+    进程间共享的会话进度（PROGRESS_BACKEND=sqlite，多 worker 部署）
+
+    state 为 result_codec 编码的会话状态，version 只增不减，updated_at 为 Unix 时间，按其清理过期会话。
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_progress (
+        session_key TEXT PRIMARY KEY,
+        state BLOB NOT NULL,
+        version INTEGER NOT NULL,
+        status TEXT,
+        updated_at REAL NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_progress_updated_at ON analysis_progress (updated_at)")
+
+
+def _create_job_queue(conn: sqlite3.Connection):
+    """
+    持久化的分析任务队列（job_queue.py）
+
+    analysis_jobs 每个 /api/analysis/start 会话一行，lease_owner / lease_expires_at 为租约（Unix 时间）；
+    analysis_job_checkpoints 记录任务中已完成产品的结果，任务被重新领取后跳过这些产品。
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires_at REAL,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        updated_at REAL NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status, lease_expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_session_id ON analysis_jobs (session_id)")
+    # 启动时查找仍为 running 的会话
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_sessions_status ON analysis_sessions (status)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_job_checkpoints (
+        session_id INTEGER NOT NULL,
+        item_key TEXT NOT NULL,
+        result BLOB NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (session_id, item_key)
+    )
+    """)
+
+
+# (版本号, 说明, 迁移函数)，版本号只增不改
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "创建基础表", _create_base_tables),
+    (2, "补齐 products 表列", _add_product_columns),
+    (3, "热点查询索引", _add_hot_path_indexes),
+    (4, "产品全文检索", _create_product_search),
+    (5, "营养素数值列", _create_product_nutrients),
+    (6, "产品目录版本号", _create_catalog_version),
+    (7, "数据保留任务索引", _add_retention_indexes),
+    (8, "进度结果持久化", _create_progress_results),
+    (9, "进程间共享的会话进度", _create_shared_progress),
+    (10, "持久化分析任务队列", _create_job_queue),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_schema_table(conn: sqlite3.Connection):
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.commit()
+
+
+def _applied_versions(conn: sqlite3.Connection) -> set:
+    return {row[0] for row in conn.execute(f"SELECT version FROM {SCHEMA_TABLE}")}
+
+
+def current_version(database) -> int:
+    """返回数据库当前的迁移版本（未执行过任何迁移时为 0）"""
+    with database.connection() as conn:
+        _ensure_schema_table(conn)
+        row = conn.execute(f"SELECT MAX(version) FROM {SCHEMA_TABLE}").fetchone()
+        return row[0] or 0
+
+
+def apply_migrations(database) -> List[int]:
+    """
+    执行所有未执行的迁移，返回本次执行的版本号列表
+
+    每个迁移在独立的 BEGIN IMMEDIATE 事务中执行并在事务内再次确认未被执行，
+    多个进程同时启动时只会有一个执行成功，其余直接跳过。
+    """
+    applied_now = []
+    with database.connection() as conn:
+        _ensure_schema_table(conn)
+        for version, description, migrate in MIGRATIONS:
+            if version in _applied_versions(conn):
+                continue
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                if version in _applied_versions(conn):
+                    conn.rollback()
+                    continue
+                migrate(conn)
+                conn.execute(
+                    f"INSERT INTO {SCHEMA_TABLE} (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"❌ 数据库迁移 {version}（{description}）失败: {e}")
+                raise
+            applied_now.append(version)
+            logger.info(f"✅ 数据库迁移 {version}: {description}")
+    return applied_now
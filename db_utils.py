@@ -2,19 +2,48 @@
 """
 稳健的数据库连接工具
 解决MySQL连接器版本兼容性问题
+
+MySQLDB 是与 SQLiteDB 接口相同的 MySQL 实现（见 repository.py，DB_BACKEND=mysql 时使用）：
+有上限的连接池，借出闲置过久的连接前先 ping 检查，失效连接丢弃重建。
 """
 
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector import errors as mysql_errors
 
 # 尝试导入MySQLInterfaceError，如果不存在则使用Error
 try:
     from mysql.connector import MySQLInterfaceError
 except ImportError:
     MySQLInterfaceError = Error
+import functools
+import logging
 import os
+import queue
+import re
 import sys
-from typing import Optional, Dict, Any
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterable, Iterator, List, Tuple, Union
+
+from query_stats import QueryStats
+from repository import ROW_FACTORIES, PoolTimeoutError, RowFactory
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置（可通过环境变量调整）
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "8"))
+# 连接全部借出时最多等待的秒数，超时抛出 PoolTimeoutError
+MYSQL_POOL_TIMEOUT = float(os.environ.get("MYSQL_POOL_TIMEOUT", "10"))
+# 连接闲置超过该秒数后，借出前先 ping 检查（MySQL 会按 wait_timeout 断开闲置连接）
+MYSQL_HEALTH_CHECK_SECONDS = float(os.environ.get("MYSQL_HEALTH_CHECK_SECONDS", "30"))
+# 连接最长使用时间（秒），超过后下次借出时关闭重建；0 表示不限
+MYSQL_MAX_LIFETIME_SECONDS = float(os.environ.get("MYSQL_MAX_LIFETIME_SECONDS", "3600"))
+MYSQL_SLOW_QUERY_MS = float(os.environ.get("MYSQL_SLOW_QUERY_MS", "100"))
+
+# 说明连接本身已不可用的错误（服务端断开、网络中断等），出现时丢弃该连接
+CONNECTION_ERRORS = (mysql_errors.OperationalError, mysql_errors.InterfaceError)
 
 def safe_str_exception(exception) -> str:
     """
@@ -32,6 +61,23 @@ def safe_str_exception(exception) -> str:
         # 如果连str()都失败了，返回类型名
         return f"{type(exception).__name__}: 无法获取详细错误信息"
 
+def mysql_config_from_env() -> Dict[str, Any]:
+    """由 MYSQL_* 环境变量组成的连接参数"""
+    return {
+        "host": os.getenv("MYSQL_HOST", "localhost"),
+        "port": int(os.getenv("MYSQL_PORT", 3306)),
+        "user": os.getenv("MYSQL_USER", "root"),
+        "password": os.getenv("MYSQL_PASSWORD", ""),
+        "database": os.getenv("MYSQL_DATABASE", "7hmbua0z"),
+        "charset": "utf8mb4",
+        "collation": "utf8mb4_unicode_ci",
+        "autocommit": True,
+        # 解决 caching_sha2_password 认证问题
+        "ssl_disabled": True,
+        "auth_plugin": "mysql_native_password",
+        "connect_timeout": 10
+    }
+
 def get_safe_db_connection(config: Optional[Dict[str, Any]] = None) -> mysql.connector.MySQLConnection:
     """
     获取稳健的数据库连接
@@ -47,23 +93,10 @@ def get_safe_db_connection(config: Optional[Dict[str, Any]] = None) -> mysql.con
     """
     
     if config is None:
-        config = {
-            "host": os.getenv("MYSQL_HOST", "localhost"),
-            "port": int(os.getenv("MYSQL_PORT", 3306)),
-            "user": os.getenv("MYSQL_USER", "root"),
-            "password": os.getenv("MYSQL_PASSWORD", ""),
-            "database": os.getenv("MYSQL_DATABASE", "7hmbua0z"),
-            "charset": "utf8mb4",
-            "collation": "utf8mb4_unicode_ci",
-            "autocommit": True,
-            # 解决 caching_sha2_password 认证问题
-            "ssl_disabled": True,
-            "auth_plugin": "mysql_native_password",
-            "connect_timeout": 10
-        }
+        config = mysql_config_from_env()
     
-    print(f"[DEBUG] 尝试连接数据库: {config['host']}:{config['port']}/{config['database']}")
-    print(f"[DEBUG] 使用用户: {config['user']}")
+    logger.debug(f"尝试连接数据库: {config['host']}:{config['port']}/{config['database']}")
+    logger.debug(f"使用用户: {config['user']}")
     
     # 尝试多种连接配置
     connection_attempts = [
@@ -96,7 +129,7 @@ def get_safe_db_connection(config: Optional[Dict[str, Any]] = None) -> mysql.con
     
     for attempt in connection_attempts:
         try:
-            print(f"[DEBUG] 尝试连接方式: {attempt['name']}")
+            logger.debug(f"尝试连接方式: {attempt['name']}")
             
             # 创建连接
             connection = mysql.connector.connect(**attempt['config'])
@@ -106,53 +139,398 @@ def get_safe_db_connection(config: Optional[Dict[str, Any]] = None) -> mysql.con
                 cursor = connection.cursor()
                 try:
                     cursor.execute(f"USE `{config['database']}`")
-                    print(f"[DEBUG] 成功选择数据库: {config['database']}")
+                    logger.debug(f"成功选择数据库: {config['database']}")
                 except Error as e:
-                    print(f"[WARNING] 无法选择数据库 {config['database']}: {safe_str_exception(e)}")
-                    print(f"[INFO] 数据库可能不存在，但连接已建立")
+                    logger.warning(f"无法选择数据库 {config['database']}: {safe_str_exception(e)}")
+                    logger.info(f"数据库可能不存在，但连接已建立")
                 finally:
                     cursor.close()
             
-            print(f"[DEBUG] 数据库连接成功！")
+            logger.debug(f"数据库连接成功！")
             return connection
             
         except Error as e:
             last_error = e
             error_msg = safe_str_exception(e)
-            print(f"[ERROR] 连接方式 '{attempt['name']}' 失败: {error_msg}")
+            logger.error(f"连接方式 '{attempt['name']}' 失败: {error_msg}")
             
             # 根据错误类型提供建议
             if "caching_sha2_password" in error_msg:
-                print(f"[INFO] 检测到MySQL 8.0+认证问题")
+                logger.info(f"检测到MySQL 8.0+认证问题")
             elif "Access denied" in error_msg:
-                print(f"[INFO] 认证失败，请检查用户名和密码")
+                logger.info(f"认证失败，请检查用户名和密码")
             elif "Can't connect" in error_msg:
-                print(f"[INFO] 网络连接问题，请检查主机和端口")
+                logger.info(f"网络连接问题，请检查主机和端口")
             elif "Unknown database" in error_msg:
-                print(f"[INFO] 数据库不存在，需要先创建")
+                logger.info(f"数据库不存在，需要先创建")
             
         except Exception as e:
             last_error = e
             error_msg = safe_str_exception(e)
-            print(f"[ERROR] 连接方式 '{attempt['name']}' 发生未知错误: {error_msg}")
+            logger.error(f"连接方式 '{attempt['name']}' 发生未知错误: {error_msg}")
     
     # 所有连接方式都失败了
-    print(f"[ERROR] 所有连接方式都失败了")
+    logger.error(f"所有连接方式都失败了")
     
     # 提供详细的故障排除建议
     error_msg = safe_str_exception(last_error) if last_error else "未知错误"
     
-    print(f"[ERROR] 最后错误: {error_msg}")
-    print(f"[INFO] 故障排除建议:")
-    print(f"[INFO] 1. 检查MySQL服务是否运行: systemctl status mysql")
-    print(f"[INFO] 2. 检查网络连接: telnet {config['host']} {config['port']}")
-    print(f"[INFO] 3. 检查用户权限和密码")
-    print(f"[INFO] 4. 如果是MySQL 8.0+，尝试修改用户认证:")
-    print(f"[INFO]    ALTER USER '{config['user']}'@'%' IDENTIFIED WITH mysql_native_password BY 'your_password';")
-    print(f"[INFO]    FLUSH PRIVILEGES;")
+    logger.error(f"最后错误: {error_msg}")
+    logger.info(f"故障排除建议:")
+    logger.info(f"1. 检查MySQL服务是否运行: systemctl status mysql")
+    logger.info(f"2. 检查网络连接: telnet {config['host']} {config['port']}")
+    logger.info(f"3. 检查用户权限和密码")
+    logger.info(f"4. 如果是MySQL 8.0+，尝试修改用户认证:")
+    logger.info(f"   ALTER USER '{config['user']}'@'%' IDENTIFIED WITH mysql_native_password BY 'your_password';")
+    logger.info(f"   FLUSH PRIVILEGES;")
     
     raise Exception(f"数据库连接失败: {error_msg}")
 
+# 字符串 / 标识符字面量原样保留，其外的 ? 才是占位符
+_SQL_TOKENS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|`[^`]*`|\?")
+
+@functools.lru_cache(maxsize=2048)
+def to_mysql_paramstyle(query: str) -> str:
+    """把 SQLite 风格的 ? 占位符转换为 mysql.connector 的 %s（字面量中的 ? 不变）"""
+    return _SQL_TOKENS.sub(lambda m: "%s" if m.group(0) == "?" else m.group(0), query)
+
+class _PooledConnection:
+    __slots__ = ("conn", "created_at", "last_used", "broken")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = self.last_used = time.monotonic()
+        self.broken = False
+
+class MySQLDB:
+    """
+    MySQL 数据库访问，接口与 SQLiteDB 相同（见 repository.py）
+
+    连接池上限为 pool_size，全部借出时最多等待 pool_timeout 秒；
+    借出闲置超过 health_check_after 秒的连接前先 ping，失效则丢弃并新建；
+    语句执行时遇到连接错误会丢弃该连接与所有闲置连接（服务端重启后它们同样失效），
+    事务外的查询在新连接上重试一次，写语句不重试（无法确定是否已执行）。
+    """
+
+    dialect = "mysql"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None, pool_size: int = MYSQL_POOL_SIZE,
+                 pool_timeout: float = MYSQL_POOL_TIMEOUT,
+                 health_check_after: float = MYSQL_HEALTH_CHECK_SECONDS,
+                 max_lifetime: float = MYSQL_MAX_LIFETIME_SECONDS,
+                 connect_fn=None):
+        self.config = config or mysql_config_from_env()
+        self.pool_size = max(1, pool_size)
+        self.pool_timeout = pool_timeout
+        self.health_check_after = health_check_after
+        self.max_lifetime = max_lifetime
+        self._connect_fn = connect_fn or mysql.connector.connect
+        self._idle = queue.LifoQueue()
+        self._opened = 0  # 已创建（含正在创建）的连接数
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()  # 当前线程进行中的事务所持有的连接
+        self.query_stats = QueryStats(slow_ms=MYSQL_SLOW_QUERY_MS)
+        self.pool_stats = {"created": 0, "discarded": 0, "health_checks": 0, "retries": 0, "timeouts": 0}
+        self.connect()
+
+    def connect(self):
+        """建立第一个连接，确认配置可用"""
+        try:
+            with self._pool_lock:
+                self._opened += 1
+            self._idle.put(self._open())
+            logger.info(
+                f"✅ MySQL数据库连接成功: {self.config.get('host')}:{self.config.get('port')}/"
+                f"{self.config.get('database')}（连接池上限 {self.pool_size}）"
+            )
+        except Exception as e:
+            with self._pool_lock:
+                self._opened -= 1
+            logger.error(f"❌ MySQL数据库连接失败: {safe_str_exception(e)}")
+            raise
+
+    def _open(self) -> _PooledConnection:
+        conn = self._connect_fn(**self.config)
+        conn.autocommit = True  # 事务外每条语句自动提交，与 SQLiteDB 一致
+        with self._pool_lock:
+            self.pool_stats["created"] += 1
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled: _PooledConnection):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        with self._pool_lock:
+            self._opened -= 1
+            self.pool_stats["discarded"] += 1
+
+    def _drain_idle(self):
+        """丢弃所有闲置连接"""
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(pooled)
+
+    def _healthy(self, pooled: _PooledConnection) -> bool:
+        now = time.monotonic()
+        if self.max_lifetime and now - pooled.created_at >= self.max_lifetime:
+            return False
+        if now - pooled.last_used < self.health_check_after:
+            return True
+        with self._pool_lock:
+            self.pool_stats["health_checks"] += 1
+        try:
+            pooled.conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _acquire(self) -> _PooledConnection:
+        deadline = time.monotonic() + self.pool_timeout
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                pooled = None
+            if pooled is None:
+                with self._pool_lock:
+                    can_grow = self._opened < self.pool_size
+                    if can_grow:
+                        self._opened += 1
+                if can_grow:
+                    try:
+                        return self._open()
+                    except Exception:
+                        with self._pool_lock:
+                            self._opened -= 1
+                        raise
+                # 连接已全部借出，等待归还
+                try:
+                    pooled = self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    with self._pool_lock:
+                        self.pool_stats["timeouts"] += 1
+                    raise PoolTimeoutError(
+                        f"等待 MySQL 连接超时（{self.pool_timeout:g}s，连接池上限 {self.pool_size}）"
+                    )
+            if self._healthy(pooled):
+                return pooled
+            logger.info("♻️ MySQL 闲置连接已失效或超过最长使用时间，重新建立连接")
+            self._discard(pooled)
+
+    def _release(self, pooled: _PooledConnection):
+        if pooled.broken:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        self._idle.put(pooled)
+
+    def _in_transaction(self) -> bool:
+        return getattr(self._local, "conn", None) is not None
+
+    @contextmanager
+    def _checkout(self) -> Iterator[_PooledConnection]:
+        pinned = getattr(self._local, "conn", None)
+        if pinned is not None:
+            yield pinned
+            return
+        pooled = self._acquire()
+        try:
+            yield pooled
+        except CONNECTION_ERRORS:
+            pooled.broken = True
+            raise
+        finally:
+            self._release(pooled)
+
+    def _connection_lost(self, pooled: _PooledConnection, error: Exception):
+        pooled.broken = True
+        self._drain_idle()
+        logger.warning(f"⚠️ MySQL 连接已断开，已丢弃闲置连接: {safe_str_exception(error)}")
+
+    @contextmanager
+    def connection(self):
+        """借出一个 mysql.connector 连接，退出时归还连接池；在 transaction() 内则复用事务的连接"""
+        with self._checkout() as pooled:
+            yield pooled.conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        显式事务：块内当前线程的 execute_* 共用一个连接，
+        正常退出时一次性提交，抛出异常时整体回滚。嵌套使用时并入外层事务。
+        """
+        if self._in_transaction():
+            yield self._local.conn.conn
+            return
+        with self._checkout() as pooled:
+            pooled.conn.start_transaction()
+            self._local.conn = pooled
+            try:
+                yield pooled.conn
+                pooled.conn.commit()
+            except Exception:
+                try:
+                    pooled.conn.rollback()
+                except CONNECTION_ERRORS:
+                    pooled.broken = True
+                raise
+            finally:
+                self._local.conn = None
+
+    def _record(self, pooled: _PooledConnection, query: str, params: Any, elapsed: float, rows: int):
+        """记录一次语句耗时；慢语句顺带在同一连接上获取执行计划（EXPLAIN 不会执行语句本身）"""
+        elapsed_ms = elapsed * 1000
+        plan = None
+        if not pooled.broken and self.query_stats.is_slow(elapsed_ms) and self.query_stats.needs_plan(query):
+            try:
+                cursor = pooled.conn.cursor()
+                try:
+                    cursor.execute(f"EXPLAIN {to_mysql_paramstyle(query)}", tuple(params or ()))
+                    plan = [" ".join(str(v) for v in row if v is not None) for row in cursor.fetchall()]
+                finally:
+                    cursor.close()
+            except Error:
+                plan = None
+        self.query_stats.record(query, params, elapsed_ms, rows, plan)
+
+    def _close_cursor(self, pooled: _PooledConnection, cursor, exhausted: bool):
+        try:
+            if not exhausted and not pooled.broken:
+                # 提前结束的流式查询：读掉剩余结果，连接才能执行下一条语句
+                pooled.conn.consume_results()
+            cursor.close()
+        except Error:
+            pooled.broken = True
+
+    def iter_query(
+        self,
+        query: str,
+        params: tuple = None,
+        row_factory: Union[str, RowFactory] = "dict",
+        batch_size: int = 256
+    ) -> Iterator[Any]:
+        """流式查询：与 SQLiteDB.iter_query 相同，按 batch_size 分批取行"""
+        factory = ROW_FACTORIES[row_factory] if isinstance(row_factory, str) else row_factory
+        sql = to_mysql_paramstyle(query)
+        can_retry = not self._in_transaction()
+        while True:
+            with self._checkout() as pooled:
+                cursor = pooled.conn.cursor()
+                elapsed = 0.0
+                count = 0
+                executed = False
+                exhausted = False
+                try:
+                    started = time.perf_counter()
+                    try:
+                        cursor.execute(sql, tuple(params or ()))
+                        executed = True
+                    except CONNECTION_ERRORS as e:
+                        self._connection_lost(pooled, e)
+                        if not can_retry:
+                            raise
+                        can_retry = False
+                        with self._pool_lock:
+                            self.pool_stats["retries"] += 1
+                        continue
+                    except Exception as e:
+                        logger.error(f"查询执行失败: {e}")
+                        logger.error(f"SQL: {query}")
+                        logger.error(f"参数: {params}")
+                        raise
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    columns = tuple(d[0] for d in cursor.description or ())
+                    make_row = factory(columns)
+                    while True:
+                        started = time.perf_counter()
+                        rows = cursor.fetchmany(batch_size)
+                        elapsed += time.perf_counter() - started
+                        if not rows:
+                            break
+                        count += len(rows)
+                        if make_row is None:
+                            yield from rows
+                        else:
+                            yield from map(make_row, rows)
+                    exhausted = True
+                finally:
+                    self._close_cursor(pooled, cursor, exhausted)
+                    if executed:
+                        self._record(pooled, query, params, elapsed, count)
+            return
+
+    def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
+        """执行查询并返回结果"""
+        return list(self.iter_query(query, params))
+
+    def execute_update(self, query: str, params: tuple = None) -> int:
+        """执行更新/插入/删除操作，返回新插入行的 id（无则为影响行数）"""
+        last_id, affected_rows = self._execute(query, params)
+        return last_id if last_id else affected_rows
+
+    def execute_rowcount(self, query: str, params: tuple = None) -> int:
+        """执行更新/删除操作，返回影响的行数"""
+        return self._execute(query, params)[1]
+
+    def _execute(self, query: str, params: tuple = None) -> Tuple[int, int]:
+        """执行单条写语句，返回 (lastrowid, rowcount)"""
+        with self._checkout() as pooled:
+            cursor = pooled.conn.cursor()
+            try:
+                started = time.perf_counter()
+                cursor.execute(to_mysql_paramstyle(query), tuple(params or ()))
+                affected_rows = cursor.rowcount
+                last_id = cursor.lastrowid
+                self._record(pooled, query, params, time.perf_counter() - started, affected_rows)
+                return last_id, affected_rows
+            except Exception as e:
+                logger.error(f"更新执行失败: {e}")
+                logger.error(f"SQL: {query}")
+                logger.error(f"参数: {params}")
+                if isinstance(e, CONNECTION_ERRORS):
+                    self._connection_lost(pooled, e)
+                raise
+            finally:
+                self._close_cursor(pooled, cursor, True)
+
+    def execute_many(self, query: str, params_seq: Iterable[tuple]) -> int:
+        """同一语句批量执行（INSERT 由 mysql.connector 合并为多行 VALUES），返回影响的行数"""
+        params_list = [tuple(params) for params in params_seq]
+        if not params_list:
+            return 0
+        with self._checkout() as pooled:
+            cursor = pooled.conn.cursor()
+            try:
+                started = time.perf_counter()
+                cursor.executemany(to_mysql_paramstyle(query), params_list)
+                affected_rows = cursor.rowcount
+                self._record(pooled, query, params_list[0], time.perf_counter() - started, affected_rows)
+                return affected_rows
+            except Exception as e:
+                logger.error(f"批量执行失败: {e}")
+                logger.error(f"SQL: {query}")
+                if isinstance(e, CONNECTION_ERRORS):
+                    self._connection_lost(pooled, e)
+                raise
+            finally:
+                self._close_cursor(pooled, cursor, True)
+
+    def status(self) -> Dict[str, Any]:
+        """连接池状态：已建立 / 闲置连接数与累计计数"""
+        with self._pool_lock:
+            return {"opened": self._opened, "idle": self._idle.qsize(), "pool_size": self.pool_size,
+                    **self.pool_stats}
+
+    def close(self):
+        """关闭连接池中的闲置连接"""
+        self._drain_idle()
+        logger.info("MySQL 数据库连接已关闭")
+
 def test_connection_safety():
     """
     测试连接安全性
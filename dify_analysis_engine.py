@@ -22,23 +22,26 @@ class DifyAnalysisEngine:
         self.api_key = os.environ.get("DIFY_API_KEY", "app-H3Owfh8VRao6bUv6wFgRt7Kg")
         self.api_url = "https://api.dify.ai/v1/workflows/run"
         self.timeout = 90  # 90秒超时
+        self.submit_interval = float(os.environ.get("DIFY_SUBMIT_INTERVAL", "5"))  # 相邻两次提交之间的间隔（秒）
     
     def analyze_products_with_progress(
         self,
         pet_info: Dict[str, Any],
         products: List[Dict[str, Any]],
         user_id: Optional[str] = None,
-        progress_callback: Optional[callable] = None
+        progress_callback: Optional[callable] = None,
+        result_callback: Optional[callable] = None
     ) -> Dict[str, Any]:
         """带进度回调的分析方法"""
-        return self.analyze_products(pet_info, products, user_id, progress_callback)
+        return self.analyze_products(pet_info, products, user_id, progress_callback, result_callback)
     
     def analyze_products(
         self,
         pet_info: Dict[str, Any],
         products: List[Dict[str, Any]],
         user_id: Optional[str] = None,
-        progress_callback: Optional[callable] = None
+        progress_callback: Optional[callable] = None,
+        result_callback: Optional[callable] = None
     ) -> Dict[str, Any]:
         """
         分析产品列表（并发版本）
@@ -49,6 +52,8 @@ class DifyAnalysisEngine:
             products: 产品列表
             user_id: 用户ID，用于Dify请求标识
             progress_callback: 进度回调函数，参数为(completed, total, current_product_name)
+            result_callback: 单个产品Dify分析成功时的回调，参数为(product_index, analysis)；
+                失败的产品不会回调（调用方可保留自己的降级结果）
             
         Returns:
             分析结果，包含评分和排序
@@ -73,9 +78,9 @@ class DifyAnalysisEngine:
                 start_times[product_id] = time.time()
                 
                 # 每5秒提交下一个请求（最后一个不需要等待）
-                if i < len(products) - 1:
-                    time.sleep(5)
-                    print(f"[DEBUG] 已等待5秒，继续提交下一个请求...")
+                if i < len(products) - 1 and self.submit_interval > 0:
+                    time.sleep(self.submit_interval)
+                    print(f"[DEBUG] 已等待{self.submit_interval}秒，继续提交下一个请求...")
             
             # 收集所有结果，使用as_completed实时获取完成的结果
             print(f"[DEBUG] 所有请求已提交，等待结果返回...")
@@ -107,6 +112,9 @@ class DifyAnalysisEngine:
                     results.append(analysis)
                     completed_count += 1
                     
+                    if result_callback:
+                        result_callback(product_index, analysis)
+                    
                     # 更新进度
                     if progress_callback:
                         progress_callback(completed_count, total_count, product_name)
@@ -125,6 +133,24 @@ class DifyAnalysisEngine:
         
         print(f"[DEBUG] 所有并发请求已完成，共 {len(results)} 个结果")
         
+        ranking = self.rank_results(results, pet_info, products)
+        
+        print(f"[DEBUG] 所有产品分析完成，已排序")
+        
+        return ranking
+    
+    def rank_results(
+        self,
+        results: List[Dict[str, Any]],
+        pet_info: Dict[str, Any],
+        products: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """
+        对分析结果排序，生成与前端约定的结果结构
+        
+        Returns:
+            {results, ideal_ranking, budget_ranking, anonymous_mapping}
+        """
         # 按final_score排序；若分数相同，则按价格从低到高排序（更符合"同分时便宜优先"的直觉）
         def sort_key(item: Dict[str, Any]):
             score = item.get("final_score", 0) or 0
@@ -138,16 +164,11 @@ class DifyAnalysisEngine:
 
         results_sorted = sorted(results, key=sort_key)
         
-        # 生成匿名映射
-        anonymous_mapping = self._generate_anonymous_mapping(products)
-        
-        print(f"[DEBUG] 所有产品分析完成，已排序")
-        
         return {
             "results": results_sorted,
             "ideal_ranking": results_sorted,  # 使用final_score作为理想排名
             "budget_ranking": self._calculate_budget_ranking(results_sorted, pet_info),
-            "anonymous_mapping": anonymous_mapping
+            "anonymous_mapping": self._generate_anonymous_mapping(products)
         }
     
     def _analyze_single_product(
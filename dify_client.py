@@ -204,7 +204,8 @@ dify_client = DifyClient(
     base_url="https://api.dify.ai"
 )
 
-def analyze_products_with_dify(pet_info: Dict[str, Any], products: list, user_id: str = "chenyuanguo") -> list:
+def analyze_products_with_dify(pet_info: Dict[str, Any], products: list, user_id: str = "chenyuanguo",
+                               result_callback=None) -> list:
     """
     使用Dify分析多个产品
     
@@ -212,6 +213,7 @@ def analyze_products_with_dify(pet_info: Dict[str, Any], products: list, user_id
         pet_info: 宠物信息
         products: 产品列表
         user_id: 用户ID
+        result_callback: 每个产品分析完成后的回调，参数为该产品的分析结果
         
     Returns:
         分析结果列表，按final_score降序排列
@@ -226,6 +228,8 @@ def analyze_products_with_dify(pet_info: Dict[str, Any], products: list, user_id
         # 调用Dify API分析单个产品
         result = dify_client.analyze_pet_food(pet_info, product, user_id)
         results.append(result)
+        if result_callback:
+            result_callback(result)
         
         # 添加进度延迟，避免API频率限制
         if i < len(products):
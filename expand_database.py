@@ -180,15 +180,9 @@ def expand_database_from_excel():
         df = pd.read_excel('宠物食品产品调研汇总表_扩展版_final.xlsx')
         logger.info(f"📊 成功读取Excel文件，共{len(df)}个产品")
         
-        # 清空现有产品数据（保留表结构）
-        db.execute_update("DELETE FROM products")
-        logger.info("🗑️ 清空现有产品数据")
-        
-        # 重置自增ID
-        db.execute_update("DELETE FROM sqlite_sequence WHERE name='products'")
-        
         success_count = 0
         error_count = 0
+        rows_to_insert = []
         
         for idx, row in df.iterrows():
             try:
@@ -235,14 +229,7 @@ def expand_database_from_excel():
                 if price:
                     description += f"，价格约{price}元"
                 
-                # 插入数据库
-                db.execute_update("""
-                    INSERT INTO products (
-                        product_name, brand, species, product_type, 
-                        description, price, weight, 
-                        nutrition_analysis, ingredients, additives
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
+                rows_to_insert.append((
                     product_name,
                     brand,
                     species,
@@ -266,6 +253,20 @@ def expand_database_from_excel():
                 error_count += 1
                 continue
         
+        # 清空现有产品并批量写入（同一事务内完成，失败时保留原有数据）
+        with db.transaction():
+            db.execute_update("DELETE FROM products")
+            # 重置自增ID
+            db.execute_update("DELETE FROM sqlite_sequence WHERE name='products'")
+            db.execute_many("""
+                INSERT INTO products (
+                    product_name, brand, species, product_type, 
+                    description, price, weight, 
+                    nutrition_analysis, ingredients, additives
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows_to_insert)
+        logger.info("🗑️ 已清空原有产品数据并写入新数据")
+        
         logger.info(f"✅ 数据库扩展完成！")
         logger.info(f"   成功导入: {success_count} 个产品")
         logger.info(f"   失败: {error_count} 个产品")
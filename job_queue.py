@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+持久化的分析任务队列（SQLite）
+/api/analysis/start 的会话不再直接交给守护线程，而是写入 analysis_jobs 表，由本进程（以及其他 worker）的
+队列线程领取执行。进程崩溃或重新部署不会丢失任务：
+
+- 租约：领取任务时写入 lease_owner 与 lease_expires_at（JOB_LEASE_SECONDS 秒后过期），心跳线程每
+  JOB_HEARTBEAT_SECONDS 秒为本进程持有的全部任务续约；租约过期（持有者已退出）的任务可被任意 worker 重新领取。
+- 同一台机器上持有者进程已不存在时，启动时立即释放其任务，不必等租约过期。
+- 断点续跑：任务执行过程中每完成一个产品就写入 analysis_job_checkpoints，重新领取后只分析剩余的产品。
+- 执行出错的任务按 JOB_RETRY_SECONDS 指数退避后重新排队（排队任务的 lease_expires_at 为最早可领取时间）；
+  执行或领取次数达到 JOB_MAX_ATTEMPTS 的任务（反复出错或导致进程崩溃）标记为 failed 并交给 on_give_up 处理。
+- 关闭时停止领取新任务，等待执行中的任务最多 JOB_DRAIN_SECONDS 秒，仍未完成的释放租约，由下次启动（或其他 worker）续跑。
+
+只适用于 SQLite（表由迁移创建）；其他数据库类型或 JOB_WORKERS=0 时 enabled 为 False，调用方应退回直接执行。
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from result_codec import decode_results, encode_results
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "30"))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# 第 n 次执行出错后等待 JOB_RETRY_SECONDS * 2^(n-1) 秒再重试
+JOB_RETRY_SECONDS = float(os.environ.get("JOB_RETRY_SECONDS", "5"))
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "0.5"))
+JOB_DRAIN_SECONDS = float(os.environ.get("JOB_DRAIN_SECONDS", "20"))
+
+def _owner_id() -> str:
+    """主机名:进程号:随机串；随机串区分同一进程号的前后两次启动（容器内进程号常为 1）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _owner_is_dead(owner: str, me: str) -> bool:
+    """owner 是否为本机上已退出的进程（其他机器上的持有者无法判断，只能等租约过期）"""
+    try:
+        host, pid, token = owner.rsplit(":", 2)
+        pid = int(pid)
+    except ValueError:
+        return False
+    my_host, my_pid, my_token = me.rsplit(":", 2)
+    if host != my_host or owner == me:
+        return False
+    if pid == int(my_pid):
+        return True  # 同一进程号的上一次启动
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+class JobQueue:
+    """
+    按会话排队的分析任务
+
+    handler(job) 执行一个任务（job 含 id、session_id、kind、payload、attempts），正常返回即完成，
+    抛出异常时退避后重试，最多执行 JOB_MAX_ATTEMPTS 次；on_give_up(job, error) 在任务最终失败时调用。
+    """
+
+    def __init__(self, database, handler: Callable[[Dict[str, Any]], None],
+                 on_give_up: Optional[Callable[[Dict[str, Any], str], None]] = None,
+                 workers: int = JOB_WORKERS, lease_seconds: float = JOB_LEASE_SECONDS,
+                 heartbeat_seconds: float = JOB_HEARTBEAT_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS,
+                 retry_seconds: float = JOB_RETRY_SECONDS, poll_seconds: float = JOB_POLL_SECONDS,
+                 owner: Optional[str] = None):
+        self.database = database
+        self.handler = handler
+        self.on_give_up = on_give_up
+        self.enabled = getattr(database, "dialect", "sqlite") == "sqlite" and workers > 0
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = min(heartbeat_seconds, lease_seconds / 3)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_seconds = max(0.0, retry_seconds)
+        self.poll_seconds = poll_seconds
+        self.owner = owner or _owner_id()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._drained = threading.Event()
+        self._running: Dict[int, float] = {}  # 本进程执行中的任务 -> 开始时间
+        self._started_at: Optional[float] = None
+        self.stats = {"enqueued": 0, "completed": 0, "retried": 0, "given_up": 0, "lost_leases": 0,
+                      "recovered": 0, "released_on_shutdown": 0, "busy_seconds": 0.0}
+
+    # ---- 入队与断点 ----
+
+    def enqueue(self, session_id: int, kind: str, payload: Dict[str, Any]) -> int:
+        """写入一个任务并唤醒本进程的队列线程；在调用方的事务内调用时随事务一起提交"""
+        now = time.time()
+        job_id = self.database.execute_update(
+            "INSERT INTO analysis_jobs (session_id, kind, payload, status, attempts, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'queued', 0, ?, ?)",
+            (session_id, kind, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        self.stats["enqueued"] += 1
+        return job_id
+
+    def notify(self):
+        """有新任务（入队事务已提交）：确保队列线程在运行并立即检查"""
+        self.start()
+        self._wake.set()
+
+    def checkpoint(self, session_id: int, item_key: Any, result: Any):
+        """记录一个已完成产品的结果，任务被重新领取后不再重复分析"""
+        if not self.enabled:
+            return
+        self.database.execute_update(
+            "INSERT OR REPLACE INTO analysis_job_checkpoints (session_id, item_key, result) VALUES (?, ?, ?)",
+            (session_id, str(item_key), encode_results(result))
+        )
+
+    def checkpoints(self, session_id: int) -> Dict[str, Any]:
+        """会话已完成产品的结果（item_key -> result），没有时为空"""
+        if not self.enabled:
+            return {}
+        return {
+            row["item_key"]: decode_results(row["result"])
+            for row in self.database.iter_query(
+                "SELECT item_key, result FROM analysis_job_checkpoints WHERE session_id = ?", (session_id,)
+            )
+        }
+
+    # ---- 领取与完成 ----
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """领取一个已到重试时间的排队任务或租约已过期的任务；超过最大领取次数的任务直接判定失败"""
+        while True:
+            now = time.time()
+            given_up = None
+            with self.database.transaction():
+                rows = self.database.execute_query(
+                    "SELECT * FROM analysis_jobs WHERE (status = 'queued' AND COALESCE(lease_expires_at, 0) <= ?) "
+                    "OR (status = 'running' AND lease_expires_at < ?) ORDER BY id LIMIT 1", (now, now)
+                )
+                if not rows:
+                    return None
+                job = rows[0]
+                if job["attempts"] >= self.max_attempts:
+                    error = f"已领取 {job['attempts']} 次仍未完成"
+                    self.database.execute_update(
+                        "UPDATE analysis_jobs SET status = 'failed', error = ?, lease_owner = NULL, "
+                        "lease_expires_at = NULL, updated_at = ? WHERE id = ?", (error, now, job["id"])
+                    )
+                    given_up = (job, error)
+                else:
+                    self.database.execute_update(
+                        "UPDATE analysis_jobs SET status = 'running', lease_owner = ?, lease_expires_at = ?, "
+                        "attempts = attempts + 1, started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                        (self.owner, now + self.lease_seconds, now, now, job["id"])
+                    )
+            if given_up is None:
+                job.update(status="running", attempts=job["attempts"] + 1, payload=json.loads(job["payload"]))
+                if job["lease_owner"]:
+                    logger.info(f"♻️ 接管任务 {job['id']}（会话 {job['session_id']}，原持有者 {job['lease_owner']}）")
+                return job
+            self.stats["given_up"] += 1
+            logger.error(f"❌ 任务 {given_up[0]['id']}（会话 {given_up[0]['session_id']}）{given_up[1]}，放弃执行")
+            if self.on_give_up is not None:
+                self.on_give_up(dict(given_up[0], payload=json.loads(given_up[0]["payload"])), given_up[1])
+
+    def complete(self, job: Dict[str, Any]) -> bool:
+        """标记任务完成并清理断点；租约已被其他 worker 接管时返回 False"""
+        now = time.time()
+        with self.database.transaction():
+            updated = self.database.execute_rowcount(
+                "UPDATE analysis_jobs SET status = 'done', lease_owner = NULL, lease_expires_at = NULL, "
+                "finished_at = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (now, now, job["id"], self.owner)
+            )
+            if updated:
+                self.database.execute_update(
+                    "DELETE FROM analysis_job_checkpoints WHERE session_id = ?", (job["session_id"],)
+                )
+        if not updated:
+            self.stats["lost_leases"] += 1
+            logger.warning(f"⚠️ 任务 {job['id']} 的租约已被其他 worker 接管，本次结果以对方为准")
+            return False
+        self.stats["completed"] += 1
+        return True
+
+    def fail(self, job: Dict[str, Any], error: str):
+        """执行出错：未到最大次数时放回队列，退避后重试，否则判定失败"""
+        now = time.time()
+        final = job["attempts"] >= self.max_attempts
+        retry_at = None if final else now + self.retry_seconds * 2 ** (job["attempts"] - 1)
+        updated = self.database.execute_rowcount(
+            "UPDATE analysis_jobs SET status = ?, error = ?, lease_owner = NULL, lease_expires_at = ?, "
+            "updated_at = ? WHERE id = ? AND lease_owner = ?",
+            ("failed" if final else "queued", error[:1000], retry_at, now, job["id"], self.owner)
+        )
+        if not updated:
+            self.stats["lost_leases"] += 1
+            return
+        if final:
+            self.stats["given_up"] += 1
+            logger.error(f"❌ 任务 {job['id']}（会话 {job['session_id']}）第 {job['attempts']} 次执行失败，放弃: {error}")
+            if self.on_give_up is not None:
+                self.on_give_up(job, error)
+        else:
+            self.stats["retried"] += 1
+            logger.warning(f"⚠️ 任务 {job['id']} 第 {job['attempts']} 次执行失败，{retry_at - now:g} 秒后重试: {error}")
+            self._wake.set()
+
+    def heartbeat(self) -> int:
+        """为本进程持有的全部任务续约，返回续约的任务数"""
+        return self.database.execute_rowcount(
+            "UPDATE analysis_jobs SET lease_expires_at = ? WHERE lease_owner = ? AND status = 'running'",
+            (time.time() + self.lease_seconds, self.owner)
+        )
+
+    def release_owned(self) -> int:
+        """释放本进程持有的任务（放回队列，不计入领取次数），返回释放的任务数"""
+        return self.database.execute_rowcount(
+            "UPDATE analysis_jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL, "
+            "attempts = MAX(attempts - 1, 0), updated_at = ? WHERE lease_owner = ? AND status = 'running'",
+            (time.time(), self.owner)
+        )
+
+    def recover(self) -> int:
+        """释放本机上已退出进程持有的任务（这些任务因此立即可被领取），返回释放的任务数"""
+        owners = [row["lease_owner"] for row in self.database.execute_query(
+            "SELECT DISTINCT lease_owner FROM analysis_jobs WHERE status = 'running' AND lease_owner IS NOT NULL"
+        )]
+        released = 0
+        for owner in owners:
+            if _owner_is_dead(owner, self.owner):
+                released += self.database.execute_rowcount(
+                    "UPDATE analysis_jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL, "
+                    "updated_at = ? WHERE lease_owner = ? AND status = 'running'", (time.time(), owner)
+                )
+        if released:
+            self.stats["recovered"] += released
+            logger.info(f"♻️ 释放 {released} 个已退出进程持有的任务，立即续跑")
+        return released
+
+    # ---- 后台线程 ----
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.claim()
+            except Exception as e:
+                logger.error(f"❌ 领取任务失败: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+            started = time.monotonic()
+            with self._lock:
+                self._running[job["id"]] = started
+            try:
+                self.handler(job)
+            except Exception as e:
+                try:
+                    self.fail(job, str(e))
+                except Exception as db_error:
+                    logger.error(f"❌ 记录任务 {job['id']} 失败状态出错，租约过期后重试: {db_error}")
+            else:
+                try:
+                    self.complete(job)
+                except Exception as e:
+                    logger.error(f"❌ 标记任务 {job['id']} 完成失败，租约过期后将被重新执行: {e}")
+            finally:
+                with self._lock:
+                    self._running.pop(job["id"], None)
+                    self.stats["busy_seconds"] += time.monotonic() - started
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"❌ 任务续约失败: {e}")
+        # 停止领取后仍在排空执行中的任务，继续续约直到 stop() 结束
+        while self._threads_alive() and not self._drained.is_set():
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"❌ 任务续约失败: {e}")
+            time.sleep(min(self.heartbeat_seconds, 1.0))
+
+    def _threads_alive(self) -> bool:
+        return any(t.is_alive() for t in self._threads if t.name.startswith("job-worker"))
+
+    def start(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._threads and any(t.is_alive() for t in self._threads) and not self._stopping.is_set():
+                return
+            self._stopping.clear()
+            self._drained.clear()
+            self._started_at = time.monotonic()
+            try:
+                self.recover()
+            except Exception as e:
+                logger.error(f"❌ 检查中断任务失败: {e}")
+            self._threads = [
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True))
+            for thread in self._threads:
+                thread.start()
+        logger.info(f"📮 分析任务队列已启动：{self.workers} 个线程，租约 {self.lease_seconds:g} 秒")
+
+    def stop(self, timeout: float = JOB_DRAIN_SECONDS) -> Dict[str, int]:
+        """停止领取新任务，等待执行中的任务最多 timeout 秒；仍未完成的释放租约"""
+        self._stopping.set()
+        self._wake.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            if thread.name.startswith("job-worker"):
+                thread.join(max(0.0, deadline - time.monotonic()))
+        self._drained.set()
+        with self._lock:
+            unfinished = len(self._running)
+        released = 0
+        if unfinished and self.enabled:
+            try:
+                released = self.release_owned()
+            except Exception as e:
+                logger.error(f"❌ 释放未完成任务失败，租约过期后由其他 worker 接管: {e}")
+            self.stats["released_on_shutdown"] += released
+            logger.warning(f"⚠️ {unfinished} 个任务未在 {timeout:g} 秒内完成，已放回队列等待续跑")
+        return {"unfinished": unfinished, "released": released}
+
+    # ---- 统计 ----
+
+    def counts(self) -> Dict[str, int]:
+        rows = self.database.execute_query(
+            "SELECT status, COUNT(*) AS n FROM analysis_jobs WHERE status IN ('queued', 'running') GROUP BY status"
+        )
+        counts = {"queued": 0, "running": 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def backlog(self) -> List[Dict[str, Any]]:
+        """排队中与执行中的任务（按领取顺序），含产品数与已完成（有断点）的产品数"""
+        if not self.enabled:
+            return []
+        return self.database.execute_query(
+            "SELECT j.id, j.session_id, j.status, json_array_length(j.payload, '$.product_ids') AS products, "
+            "(SELECT COUNT(*) FROM analysis_job_checkpoints c WHERE c.session_id = j.session_id) AS finished "
+            "FROM analysis_jobs j WHERE j.status IN ('queued', 'running') ORDER BY j.id"
+        )
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._running)
+            stats = dict(self.stats)
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        stats["busy_seconds"] = round(stats["busy_seconds"], 3)
+        return {
+            "enabled": self.enabled,
+            "owner": self.owner,
+            "workers": self.workers,
+            "in_flight": in_flight,
+            "jobs_per_second": round(stats["completed"] / uptime, 3) if uptime else 0.0,
+            **stats,
+        }
@@ -6,24 +6,39 @@
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+import asyncio
 import json
 import requests
 import logging
 import os
+import tempfile
 import threading
 import time
 from datetime import datetime
 
 # 导入SQLite数据库工具
-from sqlite_db_utils import db, init_sqlite_database
+from sqlite_db_utils import db, adb, init_sqlite_database
+from catalog_replica import catalog
+from catalog_publish import load_catalog
+from retention import retention_job
+from write_behind import WriteBehindBuffer, WriteBehindError, WEB_CONCURRENCY
+from job_queue import JobQueue
+from admission import AdmissionController, AdmissionRejected
+from progress_store import PROGRESS_BACKEND, ProgressStore, SQLiteProgressBackend
 
 # 导入Dify客户端
 from dify_client import analyze_products_with_dify
 from dify_analysis_engine import DifyAnalysisEngine
+from analysis_engine import AnalysisEngine, product_price_per_jin
+from partial_ranking import PartialRankingTracker, result_key, snapshot_delta
+from webhooks import webhook_dispatcher
+from product_search import search_products
+from result_codec import encode_results, decode_results
+from pagination import filter_fingerprint, decode_cursor, after_keyset, paginate, count_capped
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -67,6 +82,7 @@ class AnalysisRequest(BaseModel):
     product_ids: List[int]
     lazy_mode: Optional[bool] = False
     use_dify: Optional[bool] = True  # 是否使用真实Dify API
+    callback_url: Optional[str] = None  # 分析完成/失败时POST最终结果到该地址
 
 class SimpleCustomProduct(BaseModel):
     name: str
@@ -81,6 +97,7 @@ class SimpleAnalysisRequest(BaseModel):
     custom_products: Optional[List[SimpleCustomProduct]] = []
     use_dify: Optional[bool] = True
     user_id: Optional[str] = None  # 用户ID，用于Dify请求标识
+    callback_url: Optional[str] = None  # 分析完成/失败时POST最终结果到该地址
 
 class ManualProductInput(BaseModel):
     brand: str
@@ -97,13 +114,146 @@ class ManualProductInput(BaseModel):
     weight_g: Optional[int] = None
     description: Optional[str] = None
 
-# 全局变量存储分析状态
-analysis_status = {}
+def save_progress_result(session_key: str, result: Any):
+    """进度存储的结果持久化：已结束会话的完整排名写入 analysis_progress_results"""
+    with db.transaction():
+        db.execute_update("DELETE FROM analysis_progress_results WHERE session_key = ?", (session_key,))
+        db.execute_update(
+            "INSERT INTO analysis_progress_results (session_key, result) VALUES (?, ?)",
+            (session_key, encode_results(result))
+        )
+
+def load_progress_result(session_key: str) -> Any:
+    rows = db.execute_query("SELECT result FROM analysis_progress_results WHERE session_key = ?", (session_key,))
+    return decode_results(rows[0]["result"]) if rows else None
+
+def _drop_partial_ranking(session_key: str):
+    partial_rankings.pop(session_key, None)
+
+# 分析会话进度（键为字符串形式的会话ID；写入统一走 set/update_analysis_status）
+# analysis_progress_results / analysis_progress 表由 SQLite 迁移创建，其他数据库类型不持久化结果，
+# 结果留在内存中（受内存上限约束），也不支持进程间共享进度
+_persist_results = getattr(db, "dialect", "sqlite") == "sqlite"
+if PROGRESS_BACKEND == "sqlite" and not _persist_results:
+    logger.warning("⚠️ PROGRESS_BACKEND=sqlite 仅支持 SQLite 数据库，会话进度只保存在本进程")
+progress_store = ProgressStore(
+    result_saver=save_progress_result if _persist_results else None,
+    result_loader=load_progress_result if _persist_results else None,
+    on_evict=_drop_partial_ranking,
+    shared=SQLiteProgressBackend(db) if PROGRESS_BACKEND == "sqlite" and _persist_results else None
+)
+# 其他 worker 的会话没有进程内通知，长轮询/SSE 按此间隔（秒）检查共享进度的版本号
+PROGRESS_POLL_INTERVAL = float(os.environ.get("PROGRESS_POLL_INTERVAL", "0.25"))
+# 等待状态变化的长轮询/SSE连接：session_id -> [(event_loop, asyncio.Event)]
+_status_waiters: Dict[str, list] = {}
+_status_waiters_lock = threading.Lock()
+
+# 长轮询单次最长等待时间、SSE心跳间隔（秒）
+LONG_POLL_MAX_WAIT = float(os.environ.get("LONG_POLL_MAX_WAIT", "25"))
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", "15"))
+
+# 各会话已完成产品的渐进式排名（session_id -> PartialRankingTracker）
+partial_rankings = {}
+
+def session_partial_ranking_item(result: Dict[str, Any], product: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """/api/analysis/start 会话的单个产品结果转为渐进式排名条目（按综合分与每斤价格排名，不带品牌名称）"""
+    item = dict(result, final_score=result.get("final_score", (result.get("scores") or {}).get("overall", 0)))
+    if product and item.get("price_per_jin") is None:
+        item["price_per_jin"] = product.get("price_per_jin")
+    return item
+
+def shared_partial_ranking(tracker: PartialRankingTracker) -> Dict[str, Any]:
+    """共享进度时渐进式排名的快照随会话状态写入，其他 worker 据此计算增量"""
+    return {"partial_snapshot": tracker.export()} if progress_store.shared is not None else {}
+
+# 会话截止时间（秒）：超时后先返回已完成产品的排名，未完成的标记为 pending 并继续在后台分析
+ANALYSIS_SESSION_DEADLINE = float(os.environ.get("ANALYSIS_SESSION_DEADLINE", "30"))
+# 模拟分析（use_dify=false）每个产品的耗时（秒）
+MOCK_ANALYSIS_DELAY = float(os.environ.get("MOCK_ANALYSIS_DELAY", "2"))
+
+# 简化分析（不入库）的会话ID：带 s- 前缀，不会与 /api/analysis/start 的整数会话ID 在进度存储中重叠
+SIMPLE_SESSION_PREFIX = "s-"
 
-# 生成唯一的分析会话ID
 def generate_analysis_session_id():
     import uuid
-    return str(uuid.uuid4())[:8]
+    return f"{SIMPLE_SESSION_PREFIX}{uuid.uuid4().hex[:12]}"
+
+def run_with_session_deadline(label: str, work, on_deadline):
+    """
+    在工作线程中执行 work，并最多等待 ANALYSIS_SESSION_DEADLINE 秒。
+    超时后调用 on_deadline 发布部分结果，然后继续等待 work 结束（迟到的结果由 work 自行合并）。
+    work 抛出的异常在其结束后于调用线程重新抛出。
+    """
+    errors = []
+    
+    def run():
+        try:
+            work()
+        except Exception as e:
+            errors.append(e)
+    
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    worker.join(ANALYSIS_SESSION_DEADLINE)
+    if worker.is_alive():
+        logger.warning(f"{label} 超过截止时间 {ANALYSIS_SESSION_DEADLINE:g} 秒，先发布部分结果")
+        on_deadline()
+        worker.join()
+    if errors:
+        raise errors[0]
+
+def notify_analysis_callback(callback_url: Optional[str], session_id, status: str,
+                             result: Optional[Dict[str, Any]] = None, message: str = ""):
+    """会话结束时投递完成回调（未提供 callback_url 时不做任何事）"""
+    if not callback_url:
+        return
+    payload = {"session_id": session_id, "status": status, "message": message, "result": result}
+    webhook_dispatcher.enqueue(callback_url, f"analysis.{status}", payload)
+
+PRODUCT_JSON_FIELDS = ("ingredients", "nutrition_analysis", "additives")
+
+# 产品列表的排序键（游标分页），id 作为同价格时的决胜键；products 上的价格索引隐含 rowid，可直接按此顺序扫描
+PRODUCT_SORT_KEYS = ("price_per_jin", "id")
+PRODUCT_PAGE_DEFAULT = 50
+PRODUCT_PAGE_MAX = 500
+
+SPECIES_MAPPING = {
+    '猫': 'cat',
+    '狗': 'dog',
+    'cat': 'cat',
+    'dog': 'dog'
+}
+
+def normalize_species(species: str) -> str:
+    """物种参数支持中英文（猫/cat、狗/dog），其他取值原样返回"""
+    return SPECIES_MAPPING.get(str(species).lower(), species)
+
+def decode_product_json(product: Dict[str, Any]) -> Dict[str, Any]:
+    """原地解析产品行中的JSON字段（解析失败的字段保留原字符串）"""
+    for key in PRODUCT_JSON_FIELDS:
+        if product.get(key):
+            try:
+                product[key] = json.loads(product[key])
+            except (json.JSONDecodeError, TypeError):
+                pass
+    return product
+
+def load_products_by_ids(product_ids: List[int]) -> List[Dict[str, Any]]:
+    """按给定顺序一次查出多个产品并解析JSON字段，不存在的ID跳过"""
+    if not product_ids:
+        return []
+    placeholders = ','.join(['?'] * len(product_ids))
+    by_id = {
+        row["id"]: decode_product_json(row)
+        for row in catalog.iter_query(f"SELECT * FROM products WHERE id IN ({placeholders})", tuple(product_ids))
+    }
+    return [by_id[pid] for pid in product_ids if pid in by_id]
+
+def tag_result_source(item: Dict[str, Any], source: str) -> Dict[str, Any]:
+    """给单个产品结果打上来源标记：local（本地引擎初评）/ dify（大模型精评）"""
+    tagged = dict(item)
+    tagged["source"] = source
+    return tagged
 
 def review_product_catalog():
     """
@@ -121,6 +271,7 @@ def review_product_catalog():
                 logger.warning(f"移除产品[{prod['id']}]基础校验失败: {msg}")
                 continue
         if removed:
+            catalog.products_changed()
             logger.info(f"产品库启动自检完成，移除无效产品 {removed} 条")
         else:
             logger.info("产品库启动自检完成，未发现无效产品")
@@ -176,21 +327,38 @@ async def favicon():
 @app.get("/api/health")
 async def health_check():
     """健康检查接口"""
-    return {"status": "ok", "message": "宠物口粮智能决策助手运行正常", "database": "SQLite"}
+    return {
+        "status": "ok",
+        "message": "宠物口粮智能决策助手运行正常",
+        "database": "SQLite" if db.dialect == "sqlite" else "MySQL",
+        "catalog_replica": catalog.status(),
+        "pet_write_behind": pet_writer.status(),
+        "progress_store": progress_store.memory_stats(),
+        "analysis_queue": analysis_queue.status(),
+        "admission": admission.status(),
+    }
+
+# 宠物信息插入缓冲（WRITE_BEHIND=1 时批量写入，见 write_behind.py），按 ID 读取前先 wait_for
+# 只支持单 worker：WEB_CONCURRENCY > 1 或共享会话进度（多 worker 部署）时直接写入
+pet_writer = WriteBehindBuffer(db, "pet_info", (
+    "species", "breed", "age_months", "weight_kg", "health_status", "allergies", "doctor_notes",
+    "budget_mode", "monthly_budget", "price_range_min", "price_range_max"
+), multi_worker=WEB_CONCURRENCY > 1 or progress_store.shared is not None)
+
+async def wait_for_pet(pet_id: int):
+    """按 ID 读取宠物信息前确保其已写入；缓冲中的该行无法写入（已丢弃）时返回 409，提示重新提交"""
+    try:
+        await adb.run(pet_writer.wait_for, pet_id)
+    except WriteBehindError as e:
+        logger.error(f"❌ 宠物信息 {pet_id} 未能保存: {e}")
+        raise HTTPException(status_code=409, detail="宠物信息保存失败，请重新提交宠物信息")
 
 @app.post("/api/pet/create")
 async def create_pet(pet_info: PetInfo):
     """创建宠物信息"""
     try:
         # 插入宠物信息
-        insert_query = """
-        INSERT INTO pet_info (species, breed, age_months, weight_kg, health_status, 
-                             allergies, doctor_notes, budget_mode, monthly_budget, 
-                             price_range_min, price_range_max)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        
-        pet_id = db.execute_update(insert_query, (
+        pet_id = await adb.run(pet_writer.insert, (
             pet_info.species,
             pet_info.breed,
             pet_info.age_months,
@@ -218,9 +386,51 @@ async def get_products(
     life_stage: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
-    limit: Optional[int] = 50
+    limit: Optional[int] = 50,
+    # 营养素范围（百分比），如 min_protein=38&max_fat=16
+    min_protein: Optional[float] = None,
+    max_protein: Optional[float] = None,
+    min_fat: Optional[float] = None,
+    max_fat: Optional[float] = None,
+    min_fiber: Optional[float] = None,
+    max_fiber: Optional[float] = None,
+    min_moisture: Optional[float] = None,
+    max_moisture: Optional[float] = None,
+    min_ash: Optional[float] = None,
+    max_ash: Optional[float] = None,
+    min_calcium: Optional[float] = None,
+    max_calcium: Optional[float] = None,
+    min_phosphorus: Optional[float] = None,
+    max_phosphorus: Optional[float] = None,
+    # 游标分页：传入上一页返回的 next_cursor 获取下一页
+    cursor: Optional[str] = None,
+    include_total: bool = False
 ):
-    """获取产品列表"""
+    """
+    获取产品列表，按 (price_per_jin, id) 升序做游标分页
+    include_total=true 时附带总数（超过上限只返回下界，total_exact 为 false）
+    """
+    limit = min(max(1, limit or PRODUCT_PAGE_DEFAULT), PRODUCT_PAGE_MAX)
+    nutrient_ranges = {
+        "protein": (min_protein, max_protein),
+        "fat": (min_fat, max_fat),
+        "fiber": (min_fiber, max_fiber),
+        "moisture": (min_moisture, max_moisture),
+        "ash": (min_ash, max_ash),
+        "calcium": (min_calcium, max_calcium),
+        "phosphorus": (min_phosphorus, max_phosphorus),
+    }
+    fingerprint = filter_fingerprint({
+        "species": species, "category": category, "life_stage": life_stage,
+        "price": (min_price, max_price), "nutrients": nutrient_ranges,
+    })
+    try:
+        after = decode_cursor(cursor, len(PRODUCT_SORT_KEYS), fingerprint) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # product_nutrients 只由 SQLite 迁移创建
+    if catalog.dialect != "sqlite" and any(v is not None for pair in nutrient_ranges.values() for v in pair):
+        raise HTTPException(status_code=400, detail="当前数据库不支持按营养素范围筛选")
     try:
         # 构建查询条件
         conditions = []
@@ -228,22 +438,17 @@ async def get_products(
         
         # 处理物种参数 - 支持中英文
         if species:
-            species_mapping = {
-                '猫': 'cat',
-                '狗': 'dog',
-                'cat': 'cat',
-                'dog': 'dog'
-            }
-            mapped_species = species_mapping.get(str(species).lower(), species)
             conditions.append("species = ?")
-            params.append(mapped_species)
+            params.append(normalize_species(species))
         
         if category:
             conditions.append("category = ?")
             params.append(category)
         
         if life_stage:
-            conditions.append("life_stage = ? OR life_stage = '全阶段'")
+            # 一元 + 让规划器不用 (life_stage, price_per_jin) 索引：两个取值的 OR 要合并排序（临时 B 树），
+            # 按价格索引顺序扫描并过滤可在取够 LIMIT 行后停止
+            conditions.append("(+life_stage = ? OR +life_stage = '全阶段')")
             params.append(life_stage)
         
         if min_price is not None:
@@ -254,33 +459,64 @@ async def get_products(
             conditions.append("price_per_jin <= ?")
             params.append(max_price)
         
-        # 构建完整查询
+        # 营养素范围：由 product_nutrients 上各营养素的索引筛选
+        nutrient_conditions = []
+        for column, (low, high) in nutrient_ranges.items():
+            if low is not None:
+                nutrient_conditions.append(f"{column} >= ?")
+                params.append(low)
+            if high is not None:
+                nutrient_conditions.append(f"{column} <= ?")
+                params.append(high)
+        if nutrient_conditions:
+            conditions.append(
+                "id IN (SELECT product_id FROM product_nutrients WHERE " + " AND ".join(nutrient_conditions) + ")"
+            )
+        
+        filter_where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        filter_params = tuple(params)
+        
+        # 游标条件只影响取数，不影响总数
+        if after is not None:
+            keyset_sql, keyset_params = after_keyset(PRODUCT_SORT_KEYS, after)
+            conditions.append(keyset_sql)
+            params.extend(keyset_params)
+        
+        # 构建完整查询：多取一行用于判断是否还有下一页
         base_query = "SELECT * FROM products"
         if conditions:
             base_query += " WHERE " + " AND ".join(conditions)
-        base_query += f" ORDER BY price_per_jin ASC LIMIT {limit}"
+        base_query += f" ORDER BY {', '.join(PRODUCT_SORT_KEYS)} LIMIT ?"
+        params.append(limit + 1)
+        
+        # 流式读取，每行只处理一次（解析JSON与兼容字段），整体在数据库线程池中执行
+        def load_products():
+            products = []
+            for product in catalog.iter_query(base_query, tuple(params)):
+                decode_product_json(product)
+                
+                # 兼容前端字段
+                if product.get('weight_g'):
+                    product['weight'] = f"{round(product['weight_g'] / 1000, 2)}kg"
+                product['product_type'] = product.get('product_type') or 'dry'
+                products.append(product)
+            return products
         
-        products = db.execute_query(base_query, tuple(params))
-        
-        # 处理字段与JSON
-        for product in products:
-            try:
-                if product.get('ingredients'):
-                    product['ingredients'] = json.loads(product['ingredients'])
-                if product.get('nutrition_analysis'):
-                    product['nutrition_analysis'] = json.loads(product['nutrition_analysis'])
-                if product.get('additives'):
-                    product['additives'] = json.loads(product['additives'])
-            except json.JSONDecodeError:
-                pass
-            
-            # 兼容前端字段
-            if product.get('weight_g'):
-                product['weight'] = f"{round(product['weight_g'] / 1000, 2)}kg"
-            product['product_type'] = product.get('product_type') or 'dry'
+        rows = await adb.run(load_products)
+        products, next_cursor = paginate(rows, limit, PRODUCT_SORT_KEYS, fingerprint)
         
         logger.info(f"查询到 {len(products)} 个产品")
-        return {"success": True, "products": products}
+        response = {
+            "success": True,
+            "products": products,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        }
+        if include_total:
+            total, exact = await adb.run(count_capped, catalog, f"FROM products{filter_where}", filter_params)
+            response["total"] = total
+            response["total_exact"] = exact
+        return response
         
     except Exception as e:
         logger.error(f"获取产品列表失败: {e}")
@@ -322,7 +558,7 @@ async def create_manual_product(product: ManualProductInput):
                               price, weight_g, price_per_jin, ingredients, nutrition_analysis, additives)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
-        new_id = db.execute_update(insert_sql, (
+        new_id = await adb.execute_update(insert_sql, (
             product.brand,
             product.product_name,
             product.category,
@@ -336,6 +572,7 @@ async def create_manual_product(product: ManualProductInput):
             to_json_text(product.nutrition_analysis),
             to_json_text(product.additives),
         ))
+        await adb.run(catalog.products_changed)
 
         return {"success": True, "product_id": new_id, "message": "产品创建成功"}
     except HTTPException:
@@ -344,27 +581,50 @@ async def create_manual_product(product: ManualProductInput):
         logger.error(f"手动创建产品失败: {e}")
         raise HTTPException(status_code=500, detail=f"创建产品失败: {str(e)}")
 
+@app.get("/api/products/search")
+async def search_products_endpoint(
+    q: str,
+    species: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20,
+    cursor: Optional[str] = None
+):
+    """
+    产品全文检索：按名称、品牌、描述、原料匹配，BM25 相关度排序，分页返回并附带高亮片段
+    多个关键词用空格分隔，须全部命中。翻页优先使用返回的 next_cursor，page 仅为兼容保留。
+    """
+    if not q or not q.strip():
+        raise HTTPException(status_code=400, detail="搜索关键词不能为空")
+    page = max(1, page)
+    page_size = min(max(1, page_size), 50)
+    try:
+        result = await adb.run(
+            search_products, catalog, q, normalize_species(species) if species else None, page, page_size, cursor
+        )
+        for product in result["products"]:
+            decode_product_json(product)
+            # 与 /api/products 相同的兼容字段
+            if product.get('weight_g'):
+                product['weight'] = f"{round(product['weight_g'] / 1000, 2)}kg"
+            product['product_type'] = product.get('product_type') or 'dry'
+        return {"success": True, "query": q, **result}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"产品搜索失败: {e}")
+        raise HTTPException(status_code=500, detail=f"产品搜索失败: {str(e)}")
+
 @app.get("/api/products/{product_id}")
 async def get_product(product_id: int):
     """获取单个产品详情"""
     try:
-        products = db.execute_query("SELECT * FROM products WHERE id = ?", (product_id,))
+        products = await adb.run(catalog.execute_query, "SELECT * FROM products WHERE id = ?", (product_id,))
         
         if not products:
             raise HTTPException(status_code=404, detail="产品不存在")
         
-        product = products[0]
-        
         # 处理JSON字段
-        try:
-            if product['ingredients']:
-                product['ingredients'] = json.loads(product['ingredients'])
-            if product['nutrition_analysis']:
-                product['nutrition_analysis'] = json.loads(product['nutrition_analysis'])
-            if product['additives']:
-                product['additives'] = json.loads(product['additives'])
-        except json.JSONDecodeError:
-            pass
+        product = decode_product_json(products[0])
         
         return {"success": True, "product": product}
         
@@ -378,9 +638,15 @@ async def get_product(product_id: int):
 async def simple_analysis(request: SimpleAnalysisRequest):
     """同步简化分析接口：支持选择产品ID与自定义产品，返回即时评分"""
     try:
+        if request.callback_url:
+            callback_error = await adb.run(webhook_dispatcher.check_url, request.callback_url)
+            if callback_error:
+                raise HTTPException(status_code=400, detail=callback_error)
+        
         # 处理宠物信息
         if request.pet_id:
-            pet_rows = db.execute_query("SELECT * FROM pet_info WHERE id = ?", (request.pet_id,))
+            await wait_for_pet(request.pet_id)
+            pet_rows = await adb.execute_query("SELECT * FROM pet_info WHERE id = ?", (request.pet_id,))
             if not pet_rows:
                 raise HTTPException(status_code=404, detail="宠物信息不存在")
             pet_info = dict(pet_rows[0])
@@ -392,21 +658,18 @@ async def simple_analysis(request: SimpleAnalysisRequest):
         # 构建产品列表
         products: List[Dict[str, Any]] = []
         invalid_products = []
-        if request.product_ids:
+        
+        def load_selected_products():
+            """读取并校验所选产品（在数据库线程池中执行）；校验失败的产品在读取完成后统一删除"""
             placeholders = ','.join(['?'] * len(request.product_ids))
+            # 一次读完再处理：逐行迭代期间占用一个连接，此时再借连接删除会与其他线程互相等待
             rows = db.execute_query(
                 f"SELECT * FROM products WHERE id IN ({placeholders})",
                 tuple(request.product_ids)
             )
-            for r in rows:
-                prod = dict(r)
+            for prod in rows:
                 # 解析 JSON 字段
-                for key in ["ingredients", "nutrition_analysis", "additives"]:
-                    if prod.get(key):
-                        try:
-                            prod[key] = json.loads(prod[key])
-                        except Exception:
-                            pass
+                decode_product_json(prod)
                 # 补充兼容字段
                 if prod.get("weight_g"):
                     prod["weight"] = f"{round(prod['weight_g']/1000,2)}kg"
@@ -415,14 +678,18 @@ async def simple_analysis(request: SimpleAnalysisRequest):
                 ok, msg = validate_product_basic(prod)
                 if not ok:
                     invalid_products.append({"id": prod.get("id"), "reason": msg})
-                    db.execute_update("DELETE FROM products WHERE id = ?", (prod.get("id"),))
                     continue
                 online_ok, online_msg = validate_product_online(prod)
                 if not online_ok:
                     invalid_products.append({"id": prod.get("id"), "reason": online_msg})
-                    db.execute_update("DELETE FROM products WHERE id = ?", (prod.get("id"),))
                     continue
                 products.append(prod)
+            if invalid_products:
+                db.execute_many("DELETE FROM products WHERE id = ?", [(p["id"],) for p in invalid_products])
+                catalog.products_changed()
+        
+        if request.product_ids:
+            await adb.run(load_selected_products)
         
         for custom in request.custom_products or []:
             products.append({
@@ -431,92 +698,163 @@ async def simple_analysis(request: SimpleAnalysisRequest):
                 "brand": custom.brand or "自定义",
                 "price": custom.price,
                 "weight": custom.weight,
-                "price_per_jin": None,
+                # 自定义产品只有包装价格，换算为每斤价格后再参与排名
+                "price_per_jin": product_price_per_jin({"price": custom.price, "weight": custom.weight}),
             })
         
         if not products:
             raise HTTPException(status_code=400, detail="请选择或添加至少一个有效产品（部分产品可能因校验失败被移除）")
         
-        # 使用Dify进行真实分析时，创建分析会话并返回会话ID，前端通过轮询获取进度
+        # 使用Dify进行真实分析时分两阶段：
+        # 1. 本地引擎立即给出完整排名随响应返回；
+        # 2. 后台逐个调用Dify，每个产品的结果返回后替换其本地评分，前端通过轮询获取。
         if request.use_dify:
             logger.info(f"[DIFY] 开始使用Dify分析，产品数量: {len(products)}")
+            # 生成分析会话ID
+            session_id = generate_analysis_session_id()
             try:
-                # 生成分析会话ID
-                session_id = generate_analysis_session_id()
                 total_products = len(products)
+                # 后台精评占用一个会话名额，直到分析结束
+                await adb.run(admission.reserve_local, session_id, total_products)
                 
                 logger.info(f"[DIFY] 会话ID: {session_id}, 总产品数: {total_products}")
                 
+                # 第一阶段：本地评分，entries 与 products 一一对应
+                engine = DifyAnalysisEngine()
+                local_results = AnalysisEngine().analyze_products(pet_info, products)["results"]
+                entries = [tag_result_source(r, "local") for r in local_results]
+                entries_lock = threading.Lock()
+                quick_result = engine.rank_results(entries, pet_info, products)
+                tracker = PartialRankingTracker(engine, pet_info)
+                partial_rankings[session_id] = tracker
+                
                 # 初始化分析状态
-                analysis_status[session_id] = {
+                await adb.run(set_analysis_status, session_id, {
                     "status": "running",
                     "progress": 0,
                     "total": total_products,
                     "completed": 0,
+                    "refined": 0,
                     "current_product": None,
-                    "message": "开始分析..."
-                }
+                    "message": "已生成快速排名，正在精细分析...",
+                    "result": quick_result
+                })
                 
-                # 在后台线程中执行分析，并实时更新进度
-                def analyze_with_progress():
+                session_state = {"deadline_passed": False, "finished": False}
+                
+                def snapshot_ranking():
+                    """按当前 entries 生成排名；截止时间已过且尚未精评的产品标记为 pending"""
+                    with entries_lock:
+                        items = list(entries)
+                        refined = sum(1 for e in items if e["source"] == "dify")
+                        pending_ids = []
+                        if session_state["deadline_passed"] and not session_state["finished"]:
+                            for idx, item in enumerate(items):
+                                if item["source"] != "dify":
+                                    items[idx] = dict(item, pending=True)
+                                    pending_ids.append(item.get("product_id"))
+                    ranking = engine.rank_results(items, pet_info, products)
+                    ranking["pending_products"] = pending_ids
+                    return ranking, refined, len(pending_ids)
+                
+                def refine_entry(index: int, analysis: Dict[str, Any]):
+                    """第二阶段：用Dify结果替换对应产品的本地评分并重新排名（截止后到达的结果同样合并）"""
+                    tagged = tag_result_source(analysis, "dify")
+                    with entries_lock:
+                        entries[index] = tagged
+                    tracker.upsert(result_key(tagged, index), tagged)
+                    ranking, refined, pending = snapshot_ranking()
+                    changes = {"result": ranking, "refined": refined, "pending": pending,
+                               **shared_partial_ranking(tracker)}
+                    if session_state["deadline_passed"]:
+                        changes.update({"completed": total_products - pending, "partial": pending > 0})
+                    update_analysis_status(session_id, changes)
+                
+                def run_dify(outcome: Dict[str, str]):
                     try:
                         logger.info(f"[DIFY] 后台线程启动，开始调用DifyAnalysisEngine")
-                        engine = DifyAnalysisEngine()
                         user_id = request.user_id or "anonymous-user"
                         
                         logger.info(f"[DIFY] 调用analyze_products_with_progress, user_id={user_id}")
                         
-                        # 使用带进度回调的分析方法
-                        dify_results = engine.analyze_products_with_progress(
+                        # 使用带进度回调的分析方法；失败的产品保留本地评分
+                        engine.analyze_products_with_progress(
                             pet_info, products, user_id=user_id,
                             progress_callback=lambda completed, total, current: update_analysis_progress(
                                 session_id, completed, total, current
-                            )
+                            ),
+                            result_callback=refine_entry
                         )
-                        
-                        logger.info(f"[DIFY] 分析完成，结果类型: {type(dify_results)}")
-                        
-                        # 确保返回结构为字典
-                        if not isinstance(dify_results, dict):
-                            dify_results = {"results": dify_results or []}
-                        
-                        # 分析完成
-                        analysis_status[session_id] = {
-                            "status": "completed",
-                            "progress": 100,
-                            "total": total_products,
-                            "completed": total_products,
-                            "current_product": None,
-                            "message": "分析完成",
-                            "result": dify_results
-                        }
-                        
-                        logger.info(f"[DIFY] 会话 {session_id} 分析完成")
-                        
+                        outcome["message"] = "分析完成"
                     except Exception as e:
-                        logger.error(f"[DIFY] 分析失败: {e}", exc_info=True)
-                        analysis_status[session_id] = {
-                            "status": "failed",
-                            "progress": 0,
-                            "total": total_products,
-                            "completed": 0,
-                            "current_product": None,
-                            "message": f"分析失败: {str(e)}"
-                        }
+                        logger.error(f"[DIFY] 分析失败，保留本地评分: {e}", exc_info=True)
+                        outcome["message"] = f"Dify分析失败，已使用本地评分: {str(e)}"
+                
+                def publish_completed(message: str) -> int:
+                    ranking, refined, pending = snapshot_ranking()
+                    set_analysis_status(session_id, {
+                        "status": "completed",
+                        "progress": 100,
+                        "total": total_products,
+                        "completed": total_products - pending,
+                        "refined": refined,
+                        "pending": pending,
+                        "partial": pending > 0,
+                        "current_product": None,
+                        "message": message,
+                        "result": ranking,
+                        **shared_partial_ranking(tracker)
+                    })
+                    return refined
+                
+                def on_deadline():
+                    session_state["deadline_passed"] = True
+                    with entries_lock:
+                        pending = sum(1 for e in entries if e["source"] != "dify")
+                    publish_completed(f"已超过{ANALYSIS_SESSION_DEADLINE:g}秒，先返回已完成的排名，{pending} 款产品仍在分析")
+                
+                # 在后台线程中执行分析，并实时更新进度
+                def analyze_with_progress():
+                    outcome = {"message": "分析完成"}
+                    try:
+                        run_with_session_deadline(
+                            f"会话 {session_id}", lambda: run_dify(outcome), on_deadline
+                        )
+                    finally:
+                        admission.release_local(session_id)
+                    session_state["finished"] = True
+                    
+                    # Dify失败的产品以本地评分计入已完成排名
+                    with entries_lock:
+                        local_only = [(idx, e) for idx, e in enumerate(entries) if e["source"] != "dify"]
+                    for idx, entry in local_only:
+                        tracker.upsert(result_key(entry, idx), entry)
+                    
+                    # 分析完成（含截止后到达的迟到结果）
+                    refined = publish_completed(outcome["message"])
+                    logger.info(f"[DIFY] 会话 {session_id} 分析完成，Dify精评 {refined}/{total_products}")
+                    notify_analysis_callback(
+                        request.callback_url, session_id, "completed",
+                        result=(progress_store.get(session_id) or {}).get("result"), message=outcome["message"]
+                    )
                 
                 # 启动后台分析任务
                 threading.Thread(target=analyze_with_progress, daemon=True).start()
                 
-                logger.info(f"[DIFY] 后台任务已启动，返回会话ID给前端")
+                logger.info(f"[DIFY] 后台任务已启动，返回会话ID与快速排名给前端")
                 
-                # 立即返回会话ID，让前端开始轮询
+                # 立即返回会话ID与第一阶段排名，让前端先展示再轮询
                 return {
                     "success": True,
                     "session_id": session_id,
                     "total": total_products,
-                    "message": "分析已启动，请轮询进度"
+                    "result": quick_result,
+                    "message": "已生成快速排名，精细分析进行中，请轮询进度"
                 }
+            except AdmissionRejected:
+                raise
             except Exception as e:
+                admission.release_local(session_id)
                 logger.error(f"[DIFY] 分析启动失败，降级为模拟: {e}", exc_info=True)
         
         # Dify 不可用或未启用时，使用简单的本地评分逻辑进行降级
@@ -562,6 +900,8 @@ async def simple_analysis(request: SimpleAnalysisRequest):
         }
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise admission_rejected_error(e)
     except Exception as e:
         logger.error(f"简化分析失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -570,14 +910,20 @@ async def simple_analysis(request: SimpleAnalysisRequest):
 async def start_analysis(analysis_request: AnalysisRequest):
     """启动产品分析"""
     try:
+        if analysis_request.callback_url:
+            callback_error = await adb.run(webhook_dispatcher.check_url, analysis_request.callback_url)
+            if callback_error:
+                raise HTTPException(status_code=400, detail=callback_error)
+        
         # 验证宠物信息存在
-        pet_info = db.execute_query("SELECT * FROM pet_info WHERE id = ?", (analysis_request.pet_id,))
+        await wait_for_pet(analysis_request.pet_id)
+        pet_info = await adb.execute_query("SELECT * FROM pet_info WHERE id = ?", (analysis_request.pet_id,))
         if not pet_info:
             raise HTTPException(status_code=404, detail="宠物信息不存在")
         
         # 如果是懒人模式，自动选择推荐产品
         if analysis_request.lazy_mode:
-            all_products = db.execute_query("SELECT id FROM products ORDER BY price_per_jin ASC LIMIT 5")
+            all_products = await adb.execute_query("SELECT id FROM products ORDER BY price_per_jin ASC LIMIT 5")
             product_ids = [p['id'] for p in all_products]
         else:
             product_ids = analysis_request.product_ids
@@ -586,23 +932,47 @@ async def start_analysis(analysis_request: AnalysisRequest):
         if not product_ids:
             raise HTTPException(status_code=400, detail="请选择至少一个产品")
         
-        # 创建分析会话
-        session_id = db.execute_update(
-            "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)",
-            (analysis_request.pet_id, json.dumps(product_ids), 'running')
-        )
-        
-        # 启动后台分析任务
-        if analysis_request.use_dify:
-            threading.Thread(
-                target=dify_analysis_task,
-                args=(session_id, analysis_request.pet_id, product_ids),
-                daemon=True
-            ).start()
+        # 创建分析会话；任务与会话在同一事务内写入队列，不会出现没有任务的 running 会话
+        kind = "dify" if analysis_request.use_dify else "mock"
+        
+        queue_estimate: Dict[str, Any] = {}
+        
+        def create_session() -> int:
+            with db.transaction():
+                # 准入检查与入队在同一写事务内，各 worker 的并发请求不会同时越过上限
+                if analysis_queue.enabled:
+                    queue_estimate.update(admission.admit(len(product_ids)))
+                new_id = db.execute_update(
+                    "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)",
+                    (analysis_request.pet_id, json.dumps(product_ids), 'running')
+                )
+                if not analysis_queue.enabled:
+                    admission.reserve_local(str(new_id), len(product_ids))
+                else:
+                    analysis_queue.enqueue(new_id, kind, {
+                        "pet_id": analysis_request.pet_id,
+                        "product_ids": product_ids,
+                        "callback_url": analysis_request.callback_url,
+                    })
+                    # 在提交前写入，任务被领取后的 running 状态不会被覆盖
+                    set_analysis_status(new_id, {
+                        "status": "queued",
+                        "progress": 0,
+                        "current_product": None,
+                        "message": "分析任务排队中..."
+                    })
+            return new_id
+        
+        session_id = await adb.run(create_session)
+        
+        # 启动后台分析任务（数据库不支持任务队列时直接交给线程）
+        if analysis_queue.enabled:
+            await adb.run(analysis_queue.notify)
         else:
             threading.Thread(
-                target=mock_analysis_task,
-                args=(session_id, analysis_request.pet_id, product_ids),
+                target=run_unqueued_analysis,
+                args=(dify_analysis_task if analysis_request.use_dify else mock_analysis_task,
+                      session_id, analysis_request.pet_id, product_ids, analysis_request.callback_url),
                 daemon=True
             ).start()
         
@@ -611,116 +981,291 @@ async def start_analysis(analysis_request: AnalysisRequest):
             "success": True,
             "session_id": session_id,
             "message": "分析任务已启动",
-            "product_count": len(product_ids)
+            "product_count": len(product_ids),
+            # 排队位置（1 起）与预计开始时间，之后可从进度接口获取最新值
+            **queue_estimate
         }
         
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise admission_rejected_error(e)
     except Exception as e:
         logger.error(f"启动分析失败: {e}")
         raise HTTPException(status_code=500, detail=f"启动分析失败: {str(e)}")
 
+def admission_rejected_error(e: AdmissionRejected) -> HTTPException:
+    """超出准入上限：429，Retry-After 为按当前积压估算的等待秒数"""
+    logger.warning(f"🚦 拒绝分析请求（{e.limit}），建议 {e.retry_after} 秒后重试")
+    return HTTPException(status_code=429, detail=e.message, headers={"Retry-After": str(e.retry_after)})
+
+def run_unqueued_analysis(task, session_id: int, pet_id: int, product_ids: List[int], callback_url: Optional[str]):
+    """不经过任务队列的分析（数据库不支持队列时）：出错即把会话标记为失败，结束后释放准入名额"""
+    try:
+        task(session_id, pet_id, product_ids, callback_url)
+    except Exception as e:
+        fail_analysis_session(session_id, callback_url, f"分析失败: {str(e)}")
+    finally:
+        admission.release_local(str(session_id))
+
+def set_analysis_status(session_id, state: Dict[str, Any]):
+    """整体替换会话状态；版本号递增并唤醒等待该会话的长轮询/SSE连接"""
+    key = str(session_id)
+    progress_store.set(key, state)
+    _notify_status_waiters(key)
+
+def update_analysis_status(session_id, changes: Dict[str, Any], only_if_running: bool = False) -> bool:
+    """局部更新会话状态，返回是否实际写入"""
+    key = str(session_id)
+    if not progress_store.update(key, changes, only_if_running=only_if_running):
+        return False
+    _notify_status_waiters(key)
+    return True
+
+def _notify_status_waiters(key: str):
+    with _status_waiters_lock:
+        waiters = list(_status_waiters.get(key, ()))
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # 等待方的事件循环已关闭
+            pass
+
+async def wait_for_status_change(session_id: str, version: int, timeout: float) -> bool:
+    """等待会话状态版本号超过 version；超时返回 False。不占用线程，可支撑大量并发等待。"""
+    key = str(session_id)
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    waiter = (loop, event)
+    # 先登记再检查版本号：检查之后发生的变化一定会唤醒本等待方
+    with _status_waiters_lock:
+        _status_waiters.setdefault(key, []).append(waiter)
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            # 其他 worker 的会话：版本号从共享进度读取，每 PROGRESS_POLL_INTERVAL 秒检查一次
+            remote = progress_store.shared is not None and not progress_store.is_local(key)
+            current = await adb.run(progress_store.version, key) if remote else progress_store.version(key)
+            if current > version:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, PROGRESS_POLL_INTERVAL) if remote else remaining)
+                return True
+            except asyncio.TimeoutError:
+                if not remote:
+                    return False
+    finally:
+        with _status_waiters_lock:
+            waiters = _status_waiters.get(key, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                _status_waiters.pop(key, None)
+
 def update_analysis_progress(session_id: str, completed: int, total: int, current_product: Optional[str] = None):
-    """更新分析进度"""
-    if session_id in analysis_status:
-        progress = int((completed / total) * 100) if total > 0 else 0
-        analysis_status[session_id].update({
-            "progress": progress,
-            "completed": completed,
-            "total": total,
-            "current_product": current_product,
-            "message": f"已完成 {completed}/{total} 款产品的分析"
-        })
+    """更新分析进度（会话已因截止时间提前完成时不再回写进度）"""
+    progress = int((completed / total) * 100) if total > 0 else 0
+    update_analysis_status(session_id, {
+        "progress": progress,
+        "completed": completed,
+        "total": total,
+        "current_product": current_product,
+        "message": f"已完成 {completed}/{total} 款产品的分析"
+    }, only_if_running=True)
+
+def build_progress_response(session_id: str, since: Optional[int] = None) -> Dict[str, Any]:
+    """组装进度响应（轮询、长轮询与SSE共用）；已结束会话的结果可能需要从数据库读取，在数据库线程池中调用"""
+    progress_info = progress_store.get(session_id)
+    if not progress_info:
+        return {
+            "success": False,
+            "status": "not_found",
+            "progress": 0,
+            "total": 0,
+            "completed": 0,
+            "current_product": None,
+            "message": "分析会话不存在"
+        }
+    
+    response = {
+        "success": True,
+        "status": progress_info.get("status", "unknown"),
+        "version": progress_info.get("version", 0),
+        "progress": progress_info.get("progress", 0),
+        "total": progress_info.get("total", 0),
+        "completed": progress_info.get("completed", 0),
+        "current_product": progress_info.get("current_product"),
+        "message": progress_info.get("message", "")
+    }
+    
+    # 排队中：当前排队位置与预计开始时间（随前面的会话开始执行而变化）；简化分析的会话ID带前缀，不会是纯数字
+    if response["status"] == "queued" and str(session_id).isdigit():
+        estimate = admission.position(int(session_id))
+        if estimate:
+            response.update(estimate)
+    
+    # 两阶段分析：refined 为已由Dify精评的产品数，结果中每项带 source（local/dify）
+    if "refined" in progress_info:
+        response["refined"] = progress_info["refined"]
+    
+    # 截止时间已过：partial 为 true 时结果只含部分精评，pending 为仍在后台分析的产品数
+    if "partial" in progress_info:
+        response["partial"] = progress_info["partial"]
+        response["pending"] = progress_info.get("pending", 0)
+    
+    tracker = partial_rankings.get(str(session_id))
+    if tracker is not None:
+        response["partial_ranking"] = tracker.delta(since)
+    elif "partial_snapshot" in progress_info:
+        # 会话由其他 worker 执行
+        response["partial_ranking"] = snapshot_delta(progress_info["partial_snapshot"], since)
+    
+    # 返回当前结果（分析中为本地评分与Dify精评混合的排名，完成后为最终排名）
+    if "result" in progress_info and (since is None or response["status"] != "running"):
+        response["result"] = progress_info["result"]
+    
+    return response
+
+def is_final_progress(response: Dict[str, Any]) -> bool:
+    """会话不会再变化：失败、不存在，或已完成且没有仍在后台分析的产品"""
+    status = response.get("status")
+    if status in ("failed", "not_found"):
+        return True
+    return status == "completed" and not response.get("partial")
 
 @app.get("/api/analysis/progress/{session_id}")
-async def get_analysis_progress(session_id: str):
-    """获取分析进度（基于内存状态）"""
+async def get_analysis_progress(session_id: str, since: Optional[int] = None):
+    """
+    获取分析进度（基于内存状态）
+    
+    partial_ranking 为已完成产品的渐进式排名，按版本号增量编码：
+    客户端把上次收到的 partial_ranking.version 作为 since 传回，只会收到之后变化的产品。
+    传了 since 的客户端在分析进行中不再收到完整的 result。
+    """
     try:
-        # 直接从内存状态获取进度信息
-        progress_info = analysis_status.get(session_id)
-        if not progress_info:
-            return {
-                "success": False,
-                "status": "not_found",
-                "progress": 0,
-                "total": 0,
-                "completed": 0,
-                "current_product": None,
-                "message": "分析会话不存在"
-            }
-        
-        response = {
-            "success": True,
-            "status": progress_info.get("status", "unknown"),
-            "progress": progress_info.get("progress", 0),
-            "total": progress_info.get("total", 0),
-            "completed": progress_info.get("completed", 0),
-            "current_product": progress_info.get("current_product"),
-            "message": progress_info.get("message", "")
-        }
-        
-        # 如果分析完成，返回结果
-        if progress_info.get("status") == "completed" and "result" in progress_info:
-            response["result"] = progress_info["result"]
-        
-        return response
-        
+        return await adb.run(build_progress_response, session_id, since)
     except Exception as e:
         logger.error(f"获取分析进度失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取分析进度失败: {str(e)}")
 
+@app.get("/api/analysis/progress/{session_id}/wait")
+async def wait_analysis_progress(
+    session_id: str,
+    version: int = 0,
+    since: Optional[int] = None,
+    timeout: float = LONG_POLL_MAX_WAIT
+):
+    """
+    长轮询：阻塞到会话状态版本号大于 version（或超时）后返回进度
+    
+    适用于不支持SSE的客户端；把上次响应中的 version 传回即可。
+    """
+    try:
+        timeout = max(0.0, min(timeout, LONG_POLL_MAX_WAIT))
+        await wait_for_status_change(session_id, version, timeout)
+        return await adb.run(build_progress_response, session_id, since)
+    except Exception as e:
+        logger.error(f"长轮询分析进度失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取分析进度失败: {str(e)}")
+
+@app.get("/api/analysis/stream/{session_id}")
+async def stream_analysis_progress(session_id: str):
+    """
+    SSE推送分析进度：状态每次变化推送一条 progress 事件，结束时推送 result 事件后关闭
+    
+    事件 data 与进度接口相同；partial_ranking 在首条事件为全量，之后为增量。
+    """
+    async def event_stream():
+        version = -1
+        since = None
+        while True:
+            response = await adb.run(build_progress_response, session_id, since)
+            if response.get("version", 0) != version:
+                version = response.get("version", 0)
+                if "partial_ranking" in response:
+                    since = response["partial_ranking"]["version"]
+                final = is_final_progress(response)
+                event = "result" if final else "progress"
+                data = json.dumps(response, ensure_ascii=False)
+                yield f"event: {event}\nid: {version}\ndata: {data}\n\n"
+                if final:
+                    return
+            if not await wait_for_status_change(session_id, version, SSE_HEARTBEAT_INTERVAL):
+                # 心跳注释行，防止代理因空闲断开连接
+                yield ": keep-alive\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def build_session_result(session_id: int) -> Dict[str, Any]:
+    """读取已保存的分析会话并组装排名结果（结果接口与完成回调共用）"""
+    # 查询分析会话
+    sessions = db.execute_query("SELECT * FROM analysis_sessions WHERE id = ?", (session_id,))
+    if not sessions:
+        raise HTTPException(status_code=404, detail="分析会话不存在")
+    
+    session = sessions[0]
+    
+    if session['status'] != 'completed':
+        return {
+            "success": False,
+            "message": "分析尚未完成",
+            "status": session['status']
+        }
+    
+    # 解析分析结果
+    analysis_results = decode_results(session['analysis_results'])
+    
+    # 计算排序：优先final_score，其次scores.overall，如果分数相同则按价格从低到高排序
+    def sort_key(item):
+        if isinstance(item, dict):
+            score = item.get("final_score")
+            if score is None:
+                score = item.get("scores", {}).get("overall", 0)
+            price = item.get("price_per_jin") or item.get("price") or 999999
+            try:
+                price = float(price)
+            except Exception:
+                price = 999999
+            # 返回元组：负分数实现降序，价格升序
+            return (-score, price)
+        return (0, 999999)
+    
+    ideal_ranking = sorted(analysis_results, key=sort_key)
+    budget_ranking = ideal_ranking  # 当前没有额外预算逻辑，先复用
+    
+    # 截止时间到达时仍在分析的产品（后台完成后会合并进本会话）
+    pending_products = [
+        item.get("product_id") for item in analysis_results
+        if isinstance(item, dict) and item.get("pending")
+    ]
+    
+    # 获取匿名映射
+    mappings = db.execute_query("SELECT * FROM anonymous_mapping WHERE session_id = ?", (session_id,))
+    anonymous_mapping = {m['product_id']: m['anonymous_code'] for m in mappings}
+    
+    return {
+        "success": True,
+        "session_id": session_id,
+        "results": analysis_results,
+        "ideal_ranking": ideal_ranking,
+        "budget_ranking": budget_ranking,
+        "anonymous_mapping": anonymous_mapping,
+        "pending_products": pending_products
+    }
+
 @app.get("/api/analysis/result/{session_id}")
 async def get_analysis_result(session_id: int):
     """获取分析结果"""
     try:
-        # 查询分析会话
-        sessions = db.execute_query("SELECT * FROM analysis_sessions WHERE id = ?", (session_id,))
-        if not sessions:
-            raise HTTPException(status_code=404, detail="分析会话不存在")
-        
-        session = sessions[0]
-        
-        if session['status'] != 'completed':
-            return {
-                "success": False,
-                "message": "分析尚未完成",
-                "status": session['status']
-            }
-        
-        # 解析分析结果
-        analysis_results = json.loads(session['analysis_results']) if session['analysis_results'] else []
-        
-        # 计算排序：优先final_score，其次scores.overall，如果分数相同则按价格从低到高排序
-        def sort_key(item):
-            if isinstance(item, dict):
-                score = item.get("final_score")
-                if score is None:
-                    score = item.get("scores", {}).get("overall", 0)
-                price = item.get("price_per_jin") or item.get("price") or 999999
-                try:
-                    price = float(price)
-                except Exception:
-                    price = 999999
-                # 返回元组：负分数实现降序，价格升序
-                return (-score, price)
-            return (0, 999999)
-        
-        ideal_ranking = sorted(analysis_results, key=sort_key)
-        budget_ranking = ideal_ranking  # 当前没有额外预算逻辑，先复用
-        
-        # 获取匿名映射
-        mappings = db.execute_query("SELECT * FROM anonymous_mapping WHERE session_id = ?", (session_id,))
-        anonymous_mapping = {m['product_id']: m['anonymous_code'] for m in mappings}
-        
-        return {
-            "success": True,
-            "session_id": session_id,
-            "results": analysis_results,
-            "ideal_ranking": ideal_ranking,
-            "budget_ranking": budget_ranking,
-            "anonymous_mapping": anonymous_mapping
-        }
-        
+        return await adb.run(build_session_result, session_id)
     except HTTPException:
         raise
     except Exception as e:
@@ -732,7 +1277,7 @@ async def reveal_product(session_id: int, anonymous_code: str):
     """揭晓匿名产品"""
     try:
         # 查询匿名映射
-        mappings = db.execute_query(
+        mappings = await adb.execute_query(
             "SELECT * FROM anonymous_mapping WHERE session_id = ? AND anonymous_code = ?",
             (session_id, anonymous_code)
         )
@@ -743,7 +1288,7 @@ async def reveal_product(session_id: int, anonymous_code: str):
         mapping = mappings[0]
         
         # 获取产品详情
-        products = db.execute_query("SELECT * FROM products WHERE id = ?", (mapping['product_id'],))
+        products = await adb.execute_query("SELECT * FROM products WHERE id = ?", (mapping['product_id'],))
         if not products:
             raise HTTPException(status_code=404, detail="产品不存在")
         
@@ -772,8 +1317,13 @@ async def reveal_product(session_id: int, anonymous_code: str):
         logger.error(f"揭晓产品失败: {e}")
         raise HTTPException(status_code=500, detail=f"揭晓产品失败: {str(e)}")
 
-def dify_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
+def dify_analysis_task(session_id: int, pet_id: int, product_ids: List[int], callback_url: Optional[str] = None):
     """使用Dify API进行真实分析任务"""
+    # 同一会话的进度与结果写入串行执行；saved 为已写入会话的结果数，final 为最终结果是否已写入，
+    # published 为是否已发布过完成状态（截止时间的部分排名或最终结果）
+    publish_lock = threading.Lock()
+    publish_state = {"saved": 0, "final": False, "published": False}
+    deadline_state = {"passed": False}
     try:
         logger.info(f"🚀 开始Dify分析任务，会话ID: {session_id}")
         
@@ -784,126 +1334,193 @@ def dify_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
         
         pet_info = dict(pet_records[0])
         
-        # 获取产品信息
-        products = []
-        for product_id in product_ids:
-            product_records = db.execute_query("SELECT * FROM products WHERE id = ?", (product_id,))
-            if product_records:
-                product = dict(product_records[0])
-                
-                # 解析JSON字段
-                try:
-                    if product['ingredients']:
-                        product['ingredients'] = json.loads(product['ingredients'])
-                    if product['nutrition_analysis']:
-                        product['nutrition_analysis'] = json.loads(product['nutrition_analysis'])
-                    if product['additives']:
-                        product['additives'] = json.loads(product['additives'])
-                except json.JSONDecodeError:
-                    pass
-                
-                products.append(product)
+        # 获取产品信息（一次查询，保持传入顺序）
+        products = load_products_by_ids(product_ids)
         
         if not products:
             raise Exception("没有找到有效的产品")
+        products_by_id = {p["id"]: p for p in products}
+        
+        # 已完成产品的渐进式排名，会话结束时移除（之后由最终结果替代）
+        tracker = PartialRankingTracker(DifyAnalysisEngine(), pet_info)
+        partial_rankings[str(session_id)] = tracker
         
         # 更新初始状态
-        analysis_status[session_id] = {
+        set_analysis_status(session_id, {
             "status": "running",
             "progress": 0,
             "current_product": None,
             "message": "准备调用Dify API..."
-        }
+        })
         
-        # 调用Dify API分析所有产品
-        logger.info(f"📊 开始调用Dify API分析 {len(products)} 个产品")
-        dify_results = analyze_products_with_dify(pet_info, products)
+        # 续跑时清除上次写入的匿名映射，由本次 save_results 重新写入
+        db.execute_update("DELETE FROM anonymous_mapping WHERE session_id = ?", (session_id,))
         
-        # 处理分析结果
+        # 处理分析结果：每个产品完成即写入，截止时间后到达的迟到结果同样合并到会话
         analysis_results = []
+        unsaved_mappings = []
+        results_lock = threading.Lock()
         anonymous_codes = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
         
-        for i, dify_result in enumerate(dify_results):
-            # 更新进度
-            progress = int(((i + 1) / len(dify_results)) * 90)  # 90%用于分析，10%用于保存
-            analysis_status[session_id] = {
-                "status": "running",
-                "progress": progress,
-                "current_product": dify_result.get("product_name", "Unknown"),
-                "message": f"处理分析结果 {i+1}/{len(dify_results)}..."
-            }
-            
-            # 生成匿名代码
-            anonymous_code = anonymous_codes[i % len(anonymous_codes)]
+        def collect_result(dify_result: Dict[str, Any]):
+            with results_lock:
+                i = len(analysis_results)
+                
+                # 生成匿名代码（匿名映射随结果一起在 save_results 中批量写入）
+                anonymous_code = anonymous_codes[i % len(anonymous_codes)]
+                unsaved_mappings.append((session_id, dify_result.get("product_id"), anonymous_code))
+                
+                # 构建标准化结果
+                result = {
+                    "anonymous_code": anonymous_code,
+                    "product_id": dify_result.get("product_id"),
+                    "scores": {
+                        "overall": dify_result.get("final_score", 0),
+                        "nutrition": dify_result.get("score_breakdown", {}).get("protein_quality_score", 0),
+                        "compatibility": dify_result.get("score_breakdown", {}).get("macro_fit_score", 0),
+                        "safety": dify_result.get("score_breakdown", {}).get("safety_score", 0),
+                        "value": dify_result.get("score_breakdown", {}).get("functional_score", 0)
+                    },
+                    "reason": dify_result.get("reason", ""),
+                    "key_evidence": dify_result.get("key_evidence", []),
+                    "health_tags": dify_result.get("health_tags", []),
+                    "hit_avoid": dify_result.get("hit_avoid", []),
+                    "hard_fail": dify_result.get("hard_fail", False),
+                    "success": dify_result.get("success", True),
+                    "error": dify_result.get("error", ""),
+                    "elapsed_time": dify_result.get("elapsed_time", 0),
+                    "workflow_run_id": dify_result.get("workflow_run_id", "")
+                }
+                analysis_results.append(result)
+                done = len(analysis_results)
+            tracker.upsert(result_key(result, i),
+                           session_partial_ranking_item(result, products_by_id.get(result["product_id"])))
             
-            # 保存匿名映射
-            db.execute_update(
-                "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, ?, ?)",
-                (session_id, dify_result.get("product_id"), anonymous_code)
+            # 更新进度（与 save_results 串行，截止时间发布的完成状态不会被运行中进度覆盖）
+            progress = int((done / len(products)) * 90)  # 90%用于分析，10%用于保存
+            with publish_lock:
+                late = deadline_state["passed"]
+                if not late:
+                    set_analysis_status(session_id, {
+                        "status": "running",
+                        "progress": progress,
+                        "current_product": dify_result.get("product_name", "Unknown"),
+                        "message": f"处理分析结果 {done}/{len(products)}...",
+                        **shared_partial_ranking(tracker)
+                    })
+            if late:
+                # 会话已按截止时间完成，迟到结果直接合并进已保存的会话
+                save_results()
+        
+        def save_results(final: bool = False):
+            """
+            保存当前结果并发布会话状态；尚未返回的产品以 pending 占位，排在最后
+
+            截止时间、迟到结果与任务结束三处调用在 publish_lock 内依次取快照并写入；
+            快照包含的结果数少于已写入的快照（结果只增不减）或最终结果已写入时，不覆盖会话结果与状态
+            """
+            with publish_lock:
+                with results_lock:
+                    saved = list(analysis_results)
+                    mappings = unsaved_mappings[:]
+                    del unsaved_mappings[:]
+                count = len(saved)
+                stale = count < publish_state["saved"] or publish_state["final"]
+                finished_ids = {r["product_id"] for r in saved}
+                pending_ids = [p["id"] for p in products if p["id"] not in finished_ids]
+                saved.extend(
+                    {"product_id": pid, "pending": True, "scores": {"overall": 0}}
+                    for pid in pending_ids
+                )
+                with db.transaction():
+                    if mappings:
+                        db.execute_many(
+                            "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, ?, ?)",
+                            mappings
+                        )
+                    if not stale:
+                        db.execute_update(
+                            "UPDATE analysis_sessions SET status = ?, analysis_results = ? WHERE id = ?",
+                            ('completed', encode_results(saved), session_id)
+                        )
+                if stale:
+                    logger.warning(f"⚠️ 会话 {session_id} 的结果快照已过期，跳过写入")
+                    return
+                publish_state.update(saved=count, final=final, published=True)
+                
+                if final:
+                    set_analysis_status(session_id, {
+                        "status": "completed",
+                        "progress": 100,
+                        "message": "Dify分析完成！"
+                    })
+                else:
+                    set_analysis_status(session_id, {
+                        "status": "completed",
+                        "progress": 100,
+                        "partial": True,
+                        "pending": len(pending_ids),
+                        "message": f"已超过{ANALYSIS_SESSION_DEADLINE:g}秒，先返回已完成的排名，{len(pending_ids)} 款产品仍在分析"
+                    })
+        
+        def on_deadline():
+            with publish_lock:
+                deadline_state["passed"] = True
+            save_results()
+        
+        # 任务被重新领取（进程重启）时，已完成的产品直接使用断点中的结果
+        finished = analysis_queue.checkpoints(session_id)
+        for product in products:
+            if str(product["id"]) in finished:
+                collect_result(finished[str(product["id"])])
+        remaining = [p for p in products if str(p["id"]) not in finished]
+        if finished:
+            logger.info(f"♻️ 会话 {session_id} 续跑：{len(finished)} 个产品已完成，剩余 {len(remaining)} 个")
+        
+        def record_result(dify_result: Dict[str, Any]):
+            analysis_queue.checkpoint(session_id, dify_result.get("product_id"), dify_result)
+            collect_result(dify_result)
+        
+        # 调用Dify API分析剩余产品
+        logger.info(f"📊 开始调用Dify API分析 {len(remaining)} 个产品")
+        if remaining:
+            run_with_session_deadline(
+                f"会话 {session_id}",
+                lambda: analyze_products_with_dify(pet_info, remaining, result_callback=record_result),
+                on_deadline
             )
-            
-            # 构建标准化结果
-            result = {
-                "anonymous_code": anonymous_code,
-                "product_id": dify_result.get("product_id"),
-                "scores": {
-                    "overall": dify_result.get("final_score", 0),
-                    "nutrition": dify_result.get("score_breakdown", {}).get("protein_quality_score", 0),
-                    "compatibility": dify_result.get("score_breakdown", {}).get("macro_fit_score", 0),
-                    "safety": dify_result.get("score_breakdown", {}).get("safety_score", 0),
-                    "value": dify_result.get("score_breakdown", {}).get("functional_score", 0)
-                },
-                "reason": dify_result.get("reason", ""),
-                "key_evidence": dify_result.get("key_evidence", []),
-                "health_tags": dify_result.get("health_tags", []),
-                "hit_avoid": dify_result.get("hit_avoid", []),
-                "hard_fail": dify_result.get("hard_fail", False),
-                "success": dify_result.get("success", True),
-                "error": dify_result.get("error", ""),
-                "elapsed_time": dify_result.get("elapsed_time", 0),
-                "workflow_run_id": dify_result.get("workflow_run_id", "")
-            }
-            
-            analysis_results.append(result)
         
         # 更新进度到95%
-        analysis_status[session_id] = {
-            "status": "running",
-            "progress": 95,
-            "message": "保存分析结果..."
-        }
-        
-        # 保存分析结果到数据库
-        db.execute_update(
-            "UPDATE analysis_sessions SET status = ?, analysis_results = ? WHERE id = ?",
-            ('completed', json.dumps(analysis_results), session_id)
-        )
+        if not deadline_state["passed"]:
+            set_analysis_status(session_id, {
+                "status": "running",
+                "progress": 95,
+                "message": "保存分析结果..."
+            })
         
-        # 更新最终状态
-        analysis_status[session_id] = {
-            "status": "completed",
-            "progress": 100,
-            "message": "Dify分析完成！"
-        }
+        # 保存分析结果到数据库并更新最终状态
+        save_results(final=True)
         
         logger.info(f"✅ Dify分析任务完成，会话ID: {session_id}")
+        notify_analysis_callback(callback_url, session_id, "completed", result=build_session_result(session_id))
         
     except Exception as e:
+        with publish_lock:
+            published, final = publish_state["published"], publish_state["final"]
+        if published:
+            # 已按截止时间返回部分排名（或最终结果已写入）：保留 completed 状态与已保存的排名，不改判为失败
+            logger.error(f"❌ 会话 {session_id} 已返回排名后分析出错，保留已保存的结果: {e}")
+            if not final:
+                update_analysis_status(session_id, {"message": f"部分产品分析失败，已返回已完成的排名: {str(e)}"})
+                notify_analysis_callback(callback_url, session_id, "completed", result=build_session_result(session_id))
+            return
+        # 由调用方决定重试或把会话标记为失败（任务队列按 JOB_MAX_ATTEMPTS 重试，见 run_analysis_job）
         logger.error(f"❌ Dify分析任务失败: {e}")
-        
-        # 更新失败状态
-        db.execute_update(
-            "UPDATE analysis_sessions SET status = ? WHERE id = ?",
-            ('failed', session_id)
-        )
-        
-        analysis_status[session_id] = {
-            "status": "failed",
-            "progress": 0,
-            "message": f"Dify分析失败: {str(e)}"
-        }
+        raise
+    finally:
+        partial_rankings.pop(str(session_id), None)
 
-def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
+def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int], callback_url: Optional[str] = None):
     """模拟分析任务（替代真实的Dify API调用）"""
     try:
         logger.info(f"开始模拟分析任务，会话ID: {session_id}")
@@ -911,27 +1528,42 @@ def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
         # 获取宠物信息
         pet_info = db.execute_query("SELECT * FROM pet_info WHERE id = ?", (pet_id,))[0]
         
-        # 获取产品信息
-        products = []
-        for product_id in product_ids:
-            product = db.execute_query("SELECT * FROM products WHERE id = ?", (product_id,))[0]
-            products.append(product)
+        # 获取产品信息（一次查询，保持传入顺序）
+        products = load_products_by_ids(product_ids)
+        if len(products) != len(product_ids):
+            raise Exception("部分产品不存在")
+        
+        # 已完成产品的渐进式排名，会话结束时移除（之后由最终结果替代）
+        tracker = PartialRankingTracker(DifyAnalysisEngine(), dict(pet_info))
+        partial_rankings[str(session_id)] = tracker
         
         analysis_results = []
+        mappings = []
         anonymous_codes = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
+        finished = analysis_queue.checkpoints(session_id)
         
         for i, product in enumerate(products):
+            anonymous_code = anonymous_codes[i % len(anonymous_codes)]
+            mappings.append((session_id, product['id'], anonymous_code))
+            if str(product['id']) in finished:
+                # 续跑：该产品在上次执行中已完成
+                analysis_results.append(finished[str(product['id'])])
+                tracker.upsert(result_key(analysis_results[-1], i),
+                               session_partial_ranking_item(analysis_results[-1], product))
+                continue
+            
             # 更新进度
             progress = int((i / len(products)) * 100)
-            analysis_status[session_id] = {
+            set_analysis_status(session_id, {
                 "status": "running",
                 "progress": progress,
                 "current_product": f"{product['brand']} {product['product_name']}",
-                "message": f"正在分析第 {i+1}/{len(products)} 个产品..."
-            }
+                "message": f"正在分析第 {i+1}/{len(products)} 个产品...",
+                **shared_partial_ranking(tracker)
+            })
             
             # 模拟分析延迟
-            time.sleep(2)
+            time.sleep(MOCK_ANALYSIS_DELAY)
             
             # 生成模拟评分
             import random
@@ -944,15 +1576,6 @@ def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
             
             overall_score = (nutrition_score + compatibility_score + safety_score + value_score) / 4
             
-            # 生成匿名代码
-            anonymous_code = anonymous_codes[i % len(anonymous_codes)]
-            
-            # 保存匿名映射
-            db.execute_update(
-                "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, ?, ?)",
-                (session_id, product['id'], anonymous_code)
-            )
-            
             # 分析结果
             result = {
                 "anonymous_code": anonymous_code,
@@ -969,6 +1592,8 @@ def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
             }
             
             analysis_results.append(result)
+            analysis_queue.checkpoint(session_id, product['id'], result)
+            tracker.upsert(result_key(result, i), session_partial_ranking_item(result, product))
         
         # 按综合评分排序，如果分数相同则按价格从低到高排序
         analysis_results.sort(key=lambda x: (
@@ -976,45 +1601,166 @@ def mock_analysis_task(session_id: int, pet_id: int, product_ids: List[int]):
             x.get('price_per_jin') or x.get('price') or 999999  # 价格升序（便宜在前）
         ))
         
-        # 更新分析会话状态
-        db.execute_update(
-            "UPDATE analysis_sessions SET status = ?, analysis_results = ? WHERE id = ?",
-            ('completed', json.dumps(analysis_results), session_id)
-        )
+        # 匿名映射与分析会话状态在同一事务内写入（续跑时先清除上次可能已写入的映射）
+        with db.transaction():
+            db.execute_update("DELETE FROM anonymous_mapping WHERE session_id = ?", (session_id,))
+            db.execute_many(
+                "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, ?, ?)",
+                mappings
+            )
+            db.execute_update(
+                "UPDATE analysis_sessions SET status = ?, analysis_results = ? WHERE id = ?",
+                ('completed', encode_results(analysis_results), session_id)
+            )
         
         # 更新全局状态
-        analysis_status[session_id] = {
+        set_analysis_status(session_id, {
             "status": "completed",
             "progress": 100,
             "message": "分析完成！"
-        }
+        })
         
         logger.info(f"分析任务完成，会话ID: {session_id}")
+        notify_analysis_callback(callback_url, session_id, "completed", result=build_session_result(session_id))
         
     except Exception as e:
+        # 由调用方决定重试或把会话标记为失败
         logger.error(f"分析任务失败: {e}")
-        
-        # 更新失败状态
-        db.execute_update(
-            "UPDATE analysis_sessions SET status = ? WHERE id = ?",
-            ('failed', session_id)
+        raise
+    finally:
+        partial_rankings.pop(str(session_id), None)
+
+def fail_analysis_session(session_id: int, callback_url: Optional[str], message: str):
+    """会话标记为失败：数据库状态、进度状态与失败回调"""
+    db.execute_update("UPDATE analysis_sessions SET status = ? WHERE id = ?", ('failed', session_id))
+    set_analysis_status(session_id, {"status": "failed", "progress": 0, "message": message})
+    notify_analysis_callback(callback_url, session_id, "failed", message=message)
+
+def run_analysis_job(job: Dict[str, Any]):
+    """
+    任务队列的执行函数：按任务类型运行 Dify 或模拟分析
+    出错时异常交给任务队列：未到 JOB_MAX_ATTEMPTS 次时会话回到排队状态，退避后续跑；最终失败由 give_up_analysis_job 处理
+    """
+    payload = job["payload"]
+    task = dify_analysis_task if job["kind"] == "dify" else mock_analysis_task
+    started = time.monotonic()
+    try:
+        task(job["session_id"], payload["pet_id"], payload["product_ids"], payload.get("callback_url"))
+    except Exception as e:
+        if job["attempts"] < analysis_queue.max_attempts:
+            set_analysis_status(job["session_id"], {
+                "status": "queued",
+                "progress": 0,
+                "current_product": None,
+                "message": f"第 {job['attempts']} 次分析失败，稍后重试: {str(e)}"
+            })
+        raise
+    if job["attempts"] == 1:
+        # 首次执行的耗时用于估算排队时间（续跑只分析了部分产品，不计入）
+        admission.observe(len(payload["product_ids"]), time.monotonic() - started)
+
+def give_up_analysis_job(job: Dict[str, Any], error: str):
+    """任务达到最大执行次数仍未完成（反复出错，或每次都导致进程退出）：会话标记为失败"""
+    fail_analysis_session(job["session_id"], job["payload"].get("callback_url"), f"分析失败: {error}")
+
+def reconcile_interrupted_sessions() -> int:
+    """
+    启动时处理中断的会话：仍为 running 却没有排队/执行中任务的会话（队列上线前的线程任务、
+    或任务已被放弃）不会再有进展，标记为 failed；有任务的会话由队列续跑。返回标记的会话数
+    """
+    if not analysis_queue.enabled:
+        return 0
+    stuck = [row["id"] for row in db.execute_query(
+        "SELECT id FROM analysis_sessions WHERE status = 'running' AND NOT EXISTS "
+        "(SELECT 1 FROM analysis_jobs j WHERE j.session_id = analysis_sessions.id AND j.status IN ('queued', 'running'))"
+    )]
+    if stuck:
+        db.execute_many(
+            "UPDATE analysis_sessions SET status = 'failed' WHERE id = ? AND status = 'running'",
+            [(session_id,) for session_id in stuck]
         )
-        
-        analysis_status[session_id] = {
-            "status": "failed",
-            "progress": 0,
-            "message": f"分析失败: {str(e)}"
-        }
+        logger.warning(f"🩹 {len(stuck)} 个中断的分析会话已标记为失败: {stuck[:20]}")
+    return len(stuck)
+
+# 持久化的分析任务队列（见 job_queue.py）：/api/analysis/start 的会话在进程重启后继续执行
+analysis_queue = JobQueue(db, run_analysis_job, on_give_up=give_up_analysis_job)
+
+# 分析请求的准入控制（见 admission.py）：超出会话数/排队产品数上限时返回 429
+admission = AdmissionController(analysis_queue)
 
 @app.get("/api/debug/logs")
 async def get_debug_logs():
-    """获取调试日志"""
+    """获取调试日志：进度存储的内存统计与最近访问的会话摘要（不含分析结果）"""
     return {
         "message": "SQLite版本运行正常",
         "database_file": "pet_food_selection.db",
-        "analysis_status": analysis_status
+        "progress_store": progress_store.memory_stats(),
+        "recent_sessions": progress_store.summary()
     }
 
+# 管理接口令牌：设置 ADMIN_TOKEN 后，/api/admin/* 需要携带请求头 X-Admin-Token
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def require_admin(request: Request):
+    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="需要管理员令牌")
+
+@app.get("/api/admin/query-stats")
+async def get_query_stats(request: Request, limit: int = 10, reset: bool = False):
+    """
+    SQL 语句耗时统计：按总耗时与 p95 各取前 limit 条（SQL 已归一化，参数只记录类型）
+    reset=true 时返回后清空统计。
+    """
+    require_admin(request)
+    stats = db.query_stats
+    limit = min(max(1, limit), 100)
+    result = {
+        "success": True,
+        "slow_query_ms": stats.slow_ms,
+        "since": datetime.fromtimestamp(stats.started_at).isoformat(),
+        "statements": len(stats),
+        "by_total": stats.top(limit, "total"),
+        "by_p95": stats.top(limit, "p95"),
+    }
+    if reset:
+        stats.reset()
+    return result
+
+# 上传的产品目录快照大小上限（MB）
+CATALOG_UPLOAD_MAX_MB = float(os.environ.get("CATALOG_UPLOAD_MAX_MB", "200"))
+
+def load_uploaded_catalog(data: bytes, expected_sha256: Optional[str]) -> Dict[str, Any]:
+    """把上传的快照写入临时文件后整体替换产品目录（catalog_publish.load_catalog）"""
+    with tempfile.NamedTemporaryFile(suffix=".tar.gz") as f:
+        f.write(data)
+        f.flush()
+        report = load_catalog(db, f.name, expected_sha256)
+    catalog.products_changed()
+    return report
+
+@app.post("/api/admin/catalog")
+async def upload_catalog(request: Request):
+    """
+    上传产品目录快照（python catalog_publish.py snapshot 生成的 tar.gz）并原子替换产品目录
+    必须配置 ADMIN_TOKEN；请求头 X-Catalog-Sha256 可附带 catalog.db 的校验和再次核对。
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="未配置 ADMIN_TOKEN，不允许上传产品目录")
+    require_admin(request)
+    data = await request.body()
+    if not data:
+        raise HTTPException(status_code=400, detail="请求体为空")
+    if len(data) > CATALOG_UPLOAD_MAX_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"快照超过 {CATALOG_UPLOAD_MAX_MB:g}MB")
+    try:
+        report = await adb.run(load_uploaded_catalog, data, request.headers.get("X-Catalog-Sha256"))
+        return {"success": True, **report}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ 产品目录替换失败: {e}")
+        raise HTTPException(status_code=500, detail=f"产品目录替换失败: {str(e)}")
+
 @app.post("/api/test/dify")
 async def test_dify_connection():
     """测试Dify API连接"""
@@ -1061,11 +1807,18 @@ async def startup_event():
     logger.info("🚀 启动宠物口粮智能决策助手 (集成Dify API版本)")
     
     # 初始化数据库
-    if init_sqlite_database():
+    if await adb.run(init_sqlite_database):
         logger.info("✅ 数据库初始化成功")
     else:
         logger.error("❌ 数据库初始化失败")
     
+    # 产品目录内存副本（CATALOG_REPLICA=1 时启用）
+    if catalog.enabled:
+        try:
+            await adb.run(catalog.refresh)
+        except Exception as e:
+            logger.error(f"❌ 产品目录内存副本加载失败，产品读取将直接访问数据库文件: {e}")
+    
     # 测试Dify连接
     try:
         from dify_client import dify_client
@@ -1074,8 +1827,32 @@ async def startup_event():
     except Exception as e:
         logger.warning(f"⚠️ Dify客户端加载失败: {e}")
     
+    # 中断的会话：没有任务的标记为失败，有任务的由队列续跑
+    try:
+        await adb.run(reconcile_interrupted_sessions)
+        await adb.run(analysis_queue.start)
+    except Exception as e:
+        logger.error(f"❌ 分析任务队列启动失败: {e}")
+    
+    # 数据保留任务（RETENTION_SESSION_DAYS / RETENTION_PET_DAYS 大于 0 时启用）
+    retention_job.start()
+    pet_writer.start()
+    
+    if progress_store.shared is not None:
+        logger.info("🔀 会话进度共享于 analysis_progress 表，支持多 worker 部署")
+    
+    if not webhook_dispatcher.secret:
+        logger.warning("⚠️ 未设置 WEBHOOK_SECRET，带 callback_url 的分析请求将被拒绝")
+    
     logger.info("🎉 应用启动完成！（已关闭产品库自检，不再自动删除任何产品）")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时停止后台任务（执行中的分析任务最多等待 JOB_DRAIN_SECONDS 秒），写入缓冲中的宠物信息"""
+    await adb.run(analysis_queue.stop)
+    retention_job.stop()
+    await adb.run(pet_writer.stop)
+
 # 兼容性路由：支持从根路径访问静态JS文件（用于本地开发）
 # 这样 ./results.js 和 ./app_fixed.js 都能正确加载
 @app.get("/{filename}")
@@ -2,135 +2,265 @@
 # -*- coding: utf-8 -*-
 """
 数据库迁移脚本 - 更新表结构以支持扩展数据
+
+在线、无损地重建 products 表：
+1. 新建 products_new，并在旧表上建触发器，迁移期间的增删改同步写入新表；
+2. 按主键分批复制，每批一个事务，复制进度写入 products_migration_state，中断后重新运行即可续传；
+3. 复制完成后在一个事务内原子切换：旧表改名为 products_backup_<时间戳> 保留，新表改名为 products。
 """
 
-from sqlite_db_utils import db
+import argparse
 import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from sqlite_db_utils import db
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def migrate_database():
-    """迁移数据库表结构"""
+NEW_TABLE = "products_new"
+STATE_TABLE = "products_migration_state"
+TRIGGER_NAMES = ("products_online_ins", "products_online_upd", "products_online_del")
+
+CREATE_PRODUCTS_SQL = """
+CREATE TABLE {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_name TEXT NOT NULL,
+    brand TEXT NOT NULL,
+    species TEXT NOT NULL,  -- 'cat', 'dog', 'both'
+    product_type TEXT NOT NULL,  -- 'dry', 'wet', 'treat', 'fresh', 'prescription'
+    description TEXT,
+    price REAL,
+    weight TEXT,  -- 改为TEXT以支持各种格式 (如 "1.8kg", "16磅")
+    nutrition_analysis TEXT,  -- JSON格式的营养成分
+    ingredients TEXT,  -- JSON格式的原料列表
+    additives TEXT,  -- JSON格式的添加剂列表
+
+    -- 保留原有字段以兼容
+    category TEXT,
+    life_stage TEXT,
+    weight_g INTEGER,
+    price_per_jin REAL,
+
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+TARGET_COLUMNS = [
+    "id", "product_name", "brand", "species", "product_type", "description",
+    "price", "weight", "nutrition_analysis", "ingredients", "additives",
+    "category", "life_stage", "weight_g", "price_per_jin", "created_at",
+]
+
+
+def _column_expressions(source_columns: set, prefix: str = "") -> str:
+    """
+    旧表一行 -> 新表各列的SQL表达式
+
+    旧表已有的列原样保留；缺失的 species / product_type / weight / description 按分类、克重等推导。
+    prefix 为空时用于 SELECT，为 "NEW." 时用于触发器。
+    """
+    def col(name):
+        return f"{prefix}{name}" if name in source_columns else "NULL"
+
+    derived = {
+        "species": f"COALESCE({col('species')}, CASE WHEN {col('category')} LIKE '%猫%' THEN 'cat' "
+                   f"WHEN {col('category')} LIKE '%狗%' THEN 'dog' ELSE 'both' END)",
+        "product_type": f"COALESCE({col('product_type')}, CASE WHEN {col('category')} LIKE '%零食%' "
+                        f"THEN 'treat' ELSE 'dry' END)",
+        "weight": f"COALESCE({col('weight')}, CASE WHEN {col('weight_g')} THEN "
+                  f"({col('weight_g')} / 1000.0) || 'kg' END)",
+        "description": f"COALESCE({col('description')}, {col('brand')} || '品牌的' || {col('product_name')})",
+        "created_at": f"COALESCE({col('created_at')}, CURRENT_TIMESTAMP)",
+    }
+    return ", ".join(derived.get(name, col(name)) for name in TARGET_COLUMNS)
+
+
+def _table_exists(conn, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def _source_columns(conn) -> set:
+    return {row[1] for row in conn.execute("PRAGMA table_info(products)")}
+
+
+def _start(conn, source_columns: set):
+    """建新表、进度表与同步触发器（一个事务内完成）"""
+    columns = ", ".join(TARGET_COLUMNS)
+    new_values = _column_expressions(source_columns, prefix="NEW.")
+    total = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        logger.info("🚀 开始数据库迁移...")
-        
-        # 1. 备份现有数据
-        logger.info("📦 备份现有产品数据...")
-        existing_products = db.execute_query("SELECT * FROM products")
-        logger.info(f"   备份了 {len(existing_products)} 个现有产品")
-        
-        # 2. 删除旧表
-        logger.info("🗑️ 删除旧的products表...")
-        db.execute_update("DROP TABLE IF EXISTS products")
-        
-        # 3. 创建新的products表结构
-        logger.info("🏗️ 创建新的products表结构...")
-        create_table_sql = """
-        CREATE TABLE products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_name TEXT NOT NULL,
-            brand TEXT NOT NULL,
-            species TEXT NOT NULL,  -- 'cat', 'dog', 'both'
-            product_type TEXT NOT NULL,  -- 'dry', 'wet', 'treat', 'fresh', 'prescription'
-            description TEXT,
-            price REAL,
-            weight TEXT,  -- 改为TEXT以支持各种格式 (如 "1.8kg", "16磅")
-            nutrition_analysis TEXT,  -- JSON格式的营养成分
-            ingredients TEXT,  -- JSON格式的原料列表
-            additives TEXT,  -- JSON格式的添加剂列表
-            
-            -- 保留原有字段以兼容
-            category TEXT,
-            life_stage TEXT,
-            weight_g INTEGER,
-            price_per_jin REAL,
-            
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        conn.execute(CREATE_PRODUCTS_SQL.format(table=NEW_TABLE))
+        conn.execute(f"""
+        CREATE TABLE {STATE_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER NOT NULL,
+            copied INTEGER NOT NULL,
+            total INTEGER NOT NULL
         )
-        """
-        
-        db.execute_update(create_table_sql)
-        logger.info("✅ 新表结构创建成功")
-        
-        # 4. 如果有现有数据，尝试迁移
-        if existing_products:
-            logger.info("🔄 迁移现有产品数据...")
-            migrated_count = 0
-            
-            for product in existing_products:
-                try:
-                    # 确定species
-                    category = product.get('category', '')
-                    if '猫' in str(category):
-                        species = 'cat'
-                    elif '狗' in str(category):
-                        species = 'dog'
-                    else:
-                        species = 'both'
-                    
-                    # 确定product_type
-                    if '零食' in str(category):
-                        product_type = 'treat'
-                    else:
-                        product_type = 'dry'
-                    
-                    # 转换weight
-                    weight_g = product.get('weight_g')
-                    weight = f"{weight_g/1000}kg" if weight_g else None
-                    
-                    # 插入迁移数据
-                    db.execute_update("""
-                        INSERT INTO products (
-                            product_name, brand, species, product_type, description,
-                            price, weight, nutrition_analysis, ingredients, additives,
-                            category, life_stage, weight_g, price_per_jin, created_at
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        product.get('product_name'),
-                        product.get('brand'),
-                        species,
-                        product_type,
-                        f"{product.get('brand')}品牌的{product.get('product_name')}",
-                        product.get('price'),
-                        weight,
-                        product.get('nutrition_analysis'),
-                        product.get('ingredients'),
-                        product.get('additives'),
-                        product.get('category'),
-                        product.get('life_stage'),
-                        product.get('weight_g'),
-                        product.get('price_per_jin'),
-                        product.get('created_at')
-                    ))
-                    
-                    migrated_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"   迁移产品失败: {e}")
-                    continue
-            
-            logger.info(f"✅ 成功迁移 {migrated_count} 个产品")
-        
-        # 5. 验证新表结构
-        logger.info("🔍 验证新表结构...")
-        table_info = db.execute_query('PRAGMA table_info(products)')
-        logger.info("📋 新的products表结构:")
-        for row in table_info:
-            logger.info(f"   {row['name']} - {row['type']} - {'NOT NULL' if row['notnull'] else 'NULL'}")
-        
-        # 6. 检查数据
-        count_result = db.execute_query("SELECT COUNT(*) as count FROM products")
-        total_count = count_result[0]['count'] if count_result else 0
-        logger.info(f"🎯 迁移后产品总数: {total_count}")
-        
-        logger.info("🎉 数据库迁移完成！")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ 数据库迁移失败: {e}")
-        return False
+        """)
+        conn.execute(f"INSERT INTO {STATE_TABLE} (id, last_id, copied, total) VALUES (1, 0, 0, ?)", (total,))
+        conn.execute(f"""
+        CREATE TRIGGER {TRIGGER_NAMES[0]} AFTER INSERT ON products BEGIN
+            INSERT OR REPLACE INTO {NEW_TABLE} ({columns}) VALUES ({new_values});
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER {TRIGGER_NAMES[1]} AFTER UPDATE ON products BEGIN
+            DELETE FROM {NEW_TABLE} WHERE id = OLD.id;
+            INSERT OR REPLACE INTO {NEW_TABLE} ({columns}) VALUES ({new_values});
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER {TRIGGER_NAMES[2]} AFTER DELETE ON products BEGIN
+            DELETE FROM {NEW_TABLE} WHERE id = OLD.id;
+        END
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _copy_batch(conn, select_values: str, batch_size: int) -> int:
+    """复制 last_id 之后的一批行并推进进度，返回本批行数"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        last_id = conn.execute(f"SELECT last_id FROM {STATE_TABLE} WHERE id = 1").fetchone()[0]
+        upper = conn.execute(
+            "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM products WHERE id > ? ORDER BY id LIMIT ?)",
+            (last_id, batch_size)
+        ).fetchone()
+        if not upper[1]:
+            conn.rollback()
+            return 0
+        # 触发器已写入的行（迁移期间被改动过）比旧表快照更新，保留触发器写入的版本
+        conn.execute(
+            f"INSERT OR IGNORE INTO {NEW_TABLE} ({', '.join(TARGET_COLUMNS)}) "
+            f"SELECT {select_values} FROM products WHERE id > ? AND id <= ? ORDER BY id",
+            (last_id, upper[0])
+        )
+        conn.execute(
+            f"UPDATE {STATE_TABLE} SET last_id = ?, copied = copied + ? WHERE id = 1",
+            (upper[0], upper[1])
+        )
+        conn.commit()
+        return upper[1]
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _swap(conn) -> str:
+    """原子切换：旧表改名保留，新表改名为 products，并在新表上重建原有索引与触发器"""
+    backup_table = f"products_backup_{time.strftime('%Y%m%d%H%M%S')}"
+    # products 上的索引与触发器（如全文检索同步触发器）随表改名会留在备份表上，需在新表上重建
+    dependents = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') "
+        "AND tbl_name = 'products' AND sql IS NOT NULL AND name NOT IN (?, ?, ?)",
+        TRIGGER_NAMES
+    ).fetchall()
+    # 旧表改名时不改写其他表（anonymous_mapping）对 products 的外键引用
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        old_count = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        new_count = conn.execute(f"SELECT COUNT(*) FROM {NEW_TABLE}").fetchone()[0]
+        if old_count != new_count:
+            raise RuntimeError(f"新旧表行数不一致（旧 {old_count} / 新 {new_count}），已取消切换")
+        for name in TRIGGER_NAMES:
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        for kind, name, _ in dependents:
+            conn.execute(f"DROP {kind.upper()} {name}")
+        conn.execute(f"ALTER TABLE products RENAME TO {backup_table}")
+        conn.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO products")
+        for _, _, sql in dependents:
+            conn.execute(sql)
+        conn.execute(f"DROP TABLE {STATE_TABLE}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+    return backup_table
+
+
+def migrate_database(
+    database=db,
+    batch_size: int = 1000,
+    force: bool = False,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    迁移 products 表结构（可中断、可续传）
+
+    progress_callback 每复制完一批调用一次，参数为当前进度报告。
+    返回最终报告：status、copied、total、seconds、rows_per_sec、backup_table。
+    """
+    logger.info("🚀 开始数据库迁移...")
+    with database.connection() as conn:
+        resumed = _table_exists(conn, STATE_TABLE) and _table_exists(conn, NEW_TABLE)
+        source_columns = _source_columns(conn)
+        if not resumed:
+            missing = set(TARGET_COLUMNS) - source_columns
+            if not missing and not force:
+                logger.info("✅ products 表已是最新结构，无需迁移（--force 可强制重建）")
+                return {"status": "up_to_date", "copied": 0, "total": 0}
+            logger.info(f"🏗️ 创建 {NEW_TABLE} 与同步触发器，待补充的列: {sorted(missing) or '无'}")
+            _start(conn, source_columns)
+        else:
+            logger.info("🔄 检测到未完成的迁移，从上次进度继续")
+
+        select_values = _column_expressions(source_columns)
+        copied_before, total = conn.execute(f"SELECT copied, total FROM {STATE_TABLE} WHERE id = 1").fetchone()
+        started = time.monotonic()
+        copied_now = 0
+        while True:
+            rows = _copy_batch(conn, select_values, batch_size)
+            if not rows:
+                break
+            copied_now += rows
+            elapsed = time.monotonic() - started
+            report = {
+                "status": "copying",
+                "copied": copied_before + copied_now,
+                "total": total,
+                "percent": round((copied_before + copied_now) * 100 / total, 1) if total else 100.0,
+                "rows_per_sec": round(copied_now / elapsed) if elapsed > 0 else None,
+            }
+            logger.info(
+                f"   已复制 {report['copied']}/{total} ({report['percent']}%)，{report['rows_per_sec']} 行/秒"
+            )
+            if progress_callback:
+                progress_callback(report)
+
+        backup_table = _swap(conn)
+        elapsed = time.monotonic() - started
+        report = {
+            "status": "completed",
+            "resumed": resumed,
+            "copied": copied_before + copied_now,
+            "total": total,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(copied_now / elapsed) if elapsed > 0 else None,
+            "backup_table": backup_table,
+        }
+
+    count = database.execute_query("SELECT COUNT(*) as count FROM products")[0]["count"]
+    logger.info(f"🎯 迁移后产品总数: {count}，旧表已保留为 {backup_table}（确认无误后可手动删除）")
+    logger.info(f"🎉 数据库迁移完成！复制 {report['copied']} 行，{report['rows_per_sec']} 行/秒")
+    return report
+
 
 if __name__ == "__main__":
-    migrate_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="在线迁移 products 表结构")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每个事务复制的行数")
+    parser.add_argument("--force", action="store_true", help="表结构已是最新时仍然重建")
+    args = parser.parse_args()
+    migrate_database(batch_size=args.batch_size, force=args.force)
@@ -0,0 +1,73 @@
+"""
+营养成分解析工具
+统一 nutrition_analysis 中不一致的键名（粗蛋白/蛋白质/粗蛋白质 等）与取值格式（40、"32%"、"≥44.0%"）
+"""
+
+import json
+import re
+from typing import Any, Dict, Optional
+
+# 同义键 -> 标准键
+NUTRIENT_ALIASES = {
+    "粗蛋白": "粗蛋白",
+    "蛋白质": "粗蛋白",
+    "粗蛋白质": "粗蛋白",
+    "粗脂肪": "粗脂肪",
+    "脂肪": "粗脂肪",
+    "粗纤维": "粗纤维",
+    "纤维": "粗纤维",
+    "水分": "水分",
+    "灰分": "灰分",
+    "粗灰分": "灰分",
+    "钙": "钙",
+    "磷": "磷",
+    "总磷": "磷",
+}
+
+# 建有数值列、可按范围检索的营养素：列名 -> 标准键（见 db_migrations.py 中的 product_nutrients 表）
+NUTRIENT_COLUMNS = {
+    "protein": "粗蛋白",
+    "fat": "粗脂肪",
+    "fiber": "粗纤维",
+    "moisture": "水分",
+    "ash": "灰分",
+    "calcium": "钙",
+    "phosphorus": "磷",
+}
+
+_NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def to_percent(value: Any) -> Optional[float]:
+    """把 40 / "32%" / "≥44.0%" 之类的取值转换为浮点数，无法解析时返回 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER_PATTERN.search(str(value))
+    return float(match.group()) if match else None
+
+
+def normalize_nutrition(raw: Any) -> Dict[str, float]:
+    """
+    解析营养成分（JSON字符串或字典），返回 {标准键: 数值}
+
+    已知同义键会合并到标准键；未知键按原名保留（只要取值可解析为数字）。
+    """
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except (ValueError, TypeError):
+            return {}
+    if not isinstance(raw, dict):
+        return {}
+
+    normalized: Dict[str, float] = {}
+    for key, value in raw.items():
+        number = to_percent(value)
+        if number is None:
+            continue
+        standard_key = NUTRIENT_ALIASES.get(str(key).strip(), str(key).strip())
+        # 同一营养素出现多个同义键时保留第一个
+        normalized.setdefault(standard_key, number)
+    return normalized
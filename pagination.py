@@ -0,0 +1,103 @@
+"""
+列表接口的游标（keyset）分页
+按排序键记录上一页最后一行的位置，下一页用 "排序键 > 游标" 直接从索引定位，
+翻页代价与页数无关，也不会因翻页期间的增删出现重复或遗漏（OFFSET 分页两者都有）。
+
+游标对客户端不透明：排序键 + 查询条件指纹的 JSON，再做 base64url 编码。
+"""
+
+import base64
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 总数统计的上限：超过时只返回下界，避免大结果集上的全量 COUNT
+DEFAULT_COUNT_CAP = 10000
+
+
+def filter_fingerprint(filters: Dict[str, Any]) -> str:
+    """查询条件的短指纹，用于拒绝换了筛选条件后继续使用的旧游标"""
+    text = json.dumps(filters, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def encode_cursor(keys: Sequence[Any], fingerprint: str = "") -> str:
+    payload = json.dumps({"k": list(keys), "f": fingerprint}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int, fingerprint: str = "") -> List[Any]:
+    """解析游标，返回排序键列表；格式错误、键数量不符或查询条件已变化时抛出 ValueError"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        keys = payload["k"]
+    except (ValueError, TypeError, KeyError, UnicodeError) as e:
+        raise ValueError("无效的分页游标") from e
+    if not isinstance(keys, list) or len(keys) != size:
+        raise ValueError("无效的分页游标")
+    if any(k is not None and not isinstance(k, (int, float, str)) for k in keys):
+        raise ValueError("无效的分页游标")
+    if payload.get("f", "") != fingerprint:
+        raise ValueError("分页游标与当前查询条件不匹配，请从第一页重新查询")
+    return keys
+
+
+def after_keyset(columns: Sequence[str], keys: Sequence[Any]) -> Tuple[str, List[Any]]:
+    """
+    生成 "(columns) > (keys)" 的 WHERE 条件（升序，NULL 排在最前，与 SQLite 的 ORDER BY 一致）
+
+    排序键都不为 NULL 时使用行值比较，SQLite 可直接在 (列..., rowid) 索引上做范围定位；
+    含 NULL 时行值比较的结果为 NULL，改为逐列展开。
+    """
+    if all(k is not None for k in keys):
+        placeholders = ", ".join("?" for _ in keys)
+        return f"({', '.join(columns)}) > ({placeholders})", list(keys)
+
+    branches = []
+    params: List[Any] = []
+    for i, (column, key) in enumerate(zip(columns, keys)):
+        parts = []
+        for prev_column, prev_key in zip(columns[:i], keys[:i]):
+            if prev_key is None:
+                parts.append(f"{prev_column} IS NULL")
+            else:
+                parts.append(f"{prev_column} = ?")
+                params.append(prev_key)
+        if key is None:
+            parts.append(f"{column} IS NOT NULL")
+        else:
+            parts.append(f"{column} > ?")
+            params.append(key)
+        branches.append("(" + " AND ".join(parts) + ")")
+    return "(" + " OR ".join(branches) + ")", params
+
+
+def paginate(rows: List[Dict[str, Any]], limit: int, key_names: Sequence[str],
+             fingerprint: str = "") -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    rows 为按 limit + 1 查询的结果：多出的一行说明还有下一页
+    返回 (本页行, 下一页游标或 None)
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([last[name] for name in key_names], fingerprint)
+
+
+def count_capped(database, from_where: str, params: Sequence[Any] = (),
+                 cap: int = DEFAULT_COUNT_CAP) -> Tuple[int, bool]:
+    """
+    统计总数，最多扫描 cap 行；返回 (数量, 是否精确)
+
+    结果集超过 cap 时数量即为 cap，表示"至少这么多"，前端可显示为 "10000+"。
+    """
+    rows = database.execute_query(
+        # MySQL 要求派生表带别名
+        f"SELECT COUNT(*) AS count FROM (SELECT 1 {from_where} LIMIT ?) AS capped", tuple(params) + (cap + 1,)
+    )
+    count = rows[0]["count"]
+    if count > cap:
+        return cap, False
+    return count, True
@@ -0,0 +1,104 @@
+"""
+渐进式排名
+分析进行中只对已完成的产品排名，并按版本号增量下发，避免轮询时重复传输未变化的产品
+"""
+
+import threading
+from typing import Any, Dict, List, Optional
+
+
+def result_key(item: Dict[str, Any], index: int) -> str:
+    """产品结果的稳定标识：有产品ID用ID，自定义产品用其在候选列表中的位置"""
+    product_id = item.get("product_id")
+    return str(product_id) if product_id is not None else f"custom_{index}"
+
+
+class PartialRankingTracker:
+    """
+    记录已完成产品的结果与排名
+
+    每次有产品完成（或被更新）版本号加一；delta(since) 只返回 since 之后变化过的产品，
+    排名顺序与性价比分数体积很小，随每个新版本完整下发。
+    """
+
+    def __init__(self, engine, pet_info: Dict[str, Any]):
+        self._engine = engine
+        self._pet_info = pet_info
+        self._lock = threading.Lock()
+        self.version = 0
+        self._items: Dict[str, Dict[str, Any]] = {}
+        self._item_versions: Dict[str, int] = {}
+        self._ideal_order: List[str] = []
+        self._budget_order: List[str] = []
+        self._budget_scores: Dict[str, Dict[str, float]] = {}
+
+    def upsert(self, key: str, item: Dict[str, Any]) -> int:
+        """写入一个已完成产品的结果并重新排名，返回新版本号"""
+        with self._lock:
+            self.version += 1
+            item = dict(item, result_key=key)
+            self._items[key] = item
+            self._item_versions[key] = self.version
+            self._rerank()
+            return self.version
+
+    def _rerank(self):
+        # rank_results 内部通过 _calculate_budget_ranking 计算性价比排名
+        ranking = self._engine.rank_results(list(self._items.values()), self._pet_info, [])
+        self._ideal_order = [r["result_key"] for r in ranking["ideal_ranking"]]
+        self._budget_order = [r["result_key"] for r in ranking["budget_ranking"]]
+        self._budget_scores = {
+            r["result_key"]: {"price_score": r.get("price_score"), "budget_score": r.get("budget_score")}
+            for r in ranking["budget_ranking"]
+        }
+
+    def export(self) -> Dict[str, Any]:
+        """可序列化的快照，其他进程用 snapshot_delta 计算增量（多 worker 部署时随会话进度共享）"""
+        with self._lock:
+            return self._export_locked()
+
+    def _export_locked(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "items": dict(self._items),
+            "item_versions": dict(self._item_versions),
+            "ideal_order": list(self._ideal_order),
+            "budget_order": list(self._budget_order),
+            "budget_scores": dict(self._budget_scores),
+        }
+
+    def delta(self, since: Optional[int] = None) -> Dict[str, Any]:
+        """返回 since 版本之后的增量，规则见 snapshot_delta"""
+        with self._lock:
+            if since is not None and since == self.version:
+                return {"version": self.version, "since": since, "unchanged": True}
+            return snapshot_delta(self._export_locked(), since)
+
+
+def snapshot_delta(snapshot: Dict[str, Any], since: Optional[int] = None) -> Dict[str, Any]:
+    """
+    按快照返回 since 版本之后的增量
+
+    - since 为空或大于当前版本（客户端状态失效）时返回全量，full=true；
+    - since 等于当前版本时只返回 unchanged=true。
+    """
+    version = snapshot["version"]
+    if since is not None and since == version:
+        return {"version": version, "since": since, "unchanged": True}
+    full = since is None or since > version
+    item_versions = snapshot["item_versions"]
+    changed = {
+        key: item for key, item in snapshot["items"].items()
+        if full or item_versions[key] > since
+    }
+    return {
+        "version": version,
+        "since": None if full else since,
+        "full": full,
+        "unchanged": False,
+        "count": len(snapshot["items"]),
+        "items": changed,
+        "ideal_order": list(snapshot["ideal_order"]),
+        "budget_order": list(snapshot["budget_order"]),
+        "budget_scores": dict(snapshot["budget_scores"]),
+    }
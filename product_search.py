@@ -0,0 +1,156 @@
+"""
+产品全文检索
+基于 products_fts（FTS5 trigram 分词，见 db_migrations.py）做 BM25 排序、分页与关键词高亮；
+products_fts 只由 SQLite 迁移创建，其他数据库类型退回在 products 表上逐列 LIKE 匹配（不计算相关度，按价格排序）
+"""
+
+import html
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+from pagination import after_keyset, decode_cursor, filter_fingerprint, paginate
+
+# 各列的 BM25 权重：名称 > 品牌 > 原料 > 描述
+BM25_WEIGHTS = (10.0, 5.0, 1.0, 2.0)
+SEARCH_COLUMNS = ("product_name", "brand", "description", "ingredients")
+MAX_TERMS = 8
+SNIPPET_RADIUS = 20
+
+# trigram 分词只能 MATCH 不少于3个字符的词，更短的词（如"鸡肉"）改用 LIKE 在检索表上过滤
+_MIN_MATCH_LENGTH = 3
+
+
+def split_terms(query: str) -> List[str]:
+    """按空白切分搜索词，去重并限制数量"""
+    terms = []
+    for term in re.split(r"\s+", query.strip()):
+        if term and term not in terms:
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def _match_expression(terms: List[str]) -> str:
+    # 每个词作为短语加引号，避免 AND/OR/NEAR/* 等被解释为 FTS5 语法
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _ingredients_text(value: Any) -> str:
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except (ValueError, TypeError):
+            return value
+    if isinstance(value, list):
+        return " ".join(str(v) for v in value)
+    return "" if value is None else str(value)
+
+
+def highlight(text: Optional[str], terms: List[str], pre: str = "<mark>", post: str = "</mark>",
+              radius: Optional[int] = None) -> Optional[str]:
+    """
+    HTML转义后用 pre/post 包裹所有命中的词（不区分大小写）；没有命中时返回 None
+
+    radius 不为空时只保留第一个命中位置前后 radius 个字符的片段。
+    """
+    if not text or not terms:
+        return None
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(text)
+    if not first:
+        return None
+    prefix = suffix = ""
+    if radius is not None:
+        start = max(0, first.start() - radius)
+        end = min(len(text), first.end() + radius)
+        prefix = "…" if start > 0 else ""
+        suffix = "…" if end < len(text) else ""
+        text = text[start:end]
+
+    parts = []
+    last = 0
+    for match in pattern.finditer(text):
+        parts.append(html.escape(text[last:match.start()]))
+        parts.append(pre + html.escape(match.group()) + post)
+        last = match.end()
+    parts.append(html.escape(text[last:]))
+    return prefix + "".join(parts) + suffix
+
+
+def search_products(
+    database,
+    query: str,
+    species: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20,
+    cursor: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    检索产品，返回 {total, page, page_size, products, next_cursor}
+
+    products 中每项为产品行（JSON字段未解析），附加 score（BM25，越小越相关）与 highlights。
+    传入 cursor（上一页的 next_cursor）时按 (score, price_per_jin, id) 游标翻页，忽略 page；
+    游标无效或与本次查询条件不符时抛出 ValueError。
+    """
+    terms = split_terms(query)
+    fingerprint = filter_fingerprint({"terms": terms, "species": species})
+    after = decode_cursor(cursor, 3, fingerprint) if cursor else None
+    if not terms:
+        return {"total": 0, "page": page, "page_size": page_size, "products": [], "next_cursor": None}
+
+    fts = getattr(database, "dialect", "sqlite") == "sqlite"
+    long_terms = [t for t in terms if len(t) >= _MIN_MATCH_LENGTH] if fts else []
+    like_terms = [t for t in terms if t not in long_terms]
+    conditions: List[str] = []
+    params: List[Any] = []
+
+    if long_terms:
+        conditions.append("products_fts MATCH ?")
+        params.append(_match_expression(long_terms))
+    # MySQL 中反斜杠本身就是 LIKE 的默认转义符，且在字符串字面量里需要转义，不写 ESCAPE 子句
+    source, escape = ("products_fts", " ESCAPE '\\'") if fts else ("p", "")
+    for term in like_terms:
+        conditions.append("(" + " OR ".join(f"{source}.{c} LIKE ?{escape}" for c in SEARCH_COLUMNS) + ")")
+        params.extend([_like_pattern(term)] * len(SEARCH_COLUMNS))
+    if species:
+        conditions.append("p.species = ?")
+        params.append(species)
+
+    where = " AND ".join(conditions)
+    # 只有 MATCH 参与时才能计算 BM25；仅含短词（或没有全文索引）时按价格排序
+    score = f"bm25(products_fts, {', '.join(str(w) for w in BM25_WEIGHTS)})" if long_terms else "0.0"
+    if fts:
+        base = f"FROM products_fts JOIN products p ON p.id = products_fts.rowid WHERE {where}"
+    else:
+        base = f"FROM products p WHERE {where}"
+
+    total = database.execute_query(f"SELECT COUNT(*) AS count {base}", tuple(params))[0]["count"]
+    offset = (page - 1) * page_size
+    if after is not None:
+        keyset_sql, keyset_params = after_keyset((score, "p.price_per_jin", "p.id"), after)
+        base += f" AND {keyset_sql}"
+        params.extend(keyset_params)
+        offset = 0
+    rows = database.execute_query(
+        f"SELECT p.*, {score} AS score {base} ORDER BY score, p.price_per_jin, p.id LIMIT ? OFFSET ?",
+        tuple(params) + (page_size + 1, offset)
+    )
+    # 游标保存未取整的 score，保证下一页从同一位置继续
+    rows, next_cursor = paginate(rows, page_size, ("score", "price_per_jin", "id"), fingerprint)
+
+    for row in rows:
+        highlights = {
+            "product_name": highlight(row.get("product_name"), terms),
+            "brand": highlight(row.get("brand"), terms),
+            "description": highlight(row.get("description"), terms, radius=SNIPPET_RADIUS),
+            "ingredients": highlight(_ingredients_text(row.get("ingredients")), terms, radius=SNIPPET_RADIUS),
+        }
+        row["highlights"] = {k: v for k, v in highlights.items() if v}
+        row["score"] = round(row["score"], 4)
+
+    return {"total": total, "page": page, "page_size": page_size, "products": rows, "next_cursor": next_cursor}
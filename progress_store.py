@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+分析会话进度存储
+替代原先的全局 analysis_status 字典：
+
+- 每次写入（整体替换或局部更新）在锁内完成，版本号递增，读取返回副本；
+- 已结束（completed / failed）的会话超过 PROGRESS_TTL_SECONDS 未更新即淘汰，
+  进行中的会话超过 PROGRESS_RUNNING_TTL_SECONDS 未更新视为已停止，同样淘汰；
+- 条目数超过 PROGRESS_MAX_ENTRIES 或估算内存超过 PROGRESS_MAX_MB 时按最近最少访问淘汰，优先淘汰已结束的会话；
+- 已结束会话的 result（完整排名）交给 result_saver 持久化，内存中只保留引用，读取时由 result_loader 取回。
+
+多 worker 部署（uvicorn --workers N）时设置 PROGRESS_BACKEND=sqlite：每次写入同时写入 analysis_progress 表，
+本进程没有的会话从表中读取，进度查询无论路由到哪个 worker 都能得到结果。会话仍由启动它的 worker 写入，
+内存中的条目是该 worker 的本地副本。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from result_codec import decode_results, encode_results
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_TTL_SECONDS = float(os.environ.get("PROGRESS_TTL_SECONDS", "3600"))
+PROGRESS_RUNNING_TTL_SECONDS = float(os.environ.get("PROGRESS_RUNNING_TTL_SECONDS", "21600"))
+PROGRESS_MAX_ENTRIES = int(os.environ.get("PROGRESS_MAX_ENTRIES", "2000"))
+PROGRESS_MAX_MB = float(os.environ.get("PROGRESS_MAX_MB", "64"))
+# memory：仅本进程（单 worker）；sqlite：进程间共享（多 worker）
+PROGRESS_BACKEND = os.environ.get("PROGRESS_BACKEND", "memory").lower()
+# TTL 检查最多每隔多少秒全量扫描一次
+PROGRESS_SWEEP_SECONDS = 30
+
+FINAL_STATUSES = ("completed", "failed")
+# 持久化后在状态中代替 result 的标记
+RESULT_REF = "result_ref"
+
+
+def _estimate_bytes(state: Dict[str, Any]) -> int:
+    """状态的估算内存占用（按 JSON 编码长度计，用于内存上限，不追求精确）"""
+    return len(json.dumps(state, ensure_ascii=False, default=str)) + 200
+
+
+class SQLiteProgressBackend:
+    """
+    进程间共享的会话进度：analysis_progress 表（迁移 9）
+
+    写入带版本号，只有更新的版本才会覆盖（同一会话的多个后台线程乱序写入时不会回退）。
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def write(self, key: str, state: Dict[str, Any], version: int):
+        self.database.execute_update(
+            "INSERT INTO analysis_progress (session_key, state, version, status, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(session_key) DO UPDATE SET state = excluded.state, version = excluded.version, "
+            "status = excluded.status, updated_at = excluded.updated_at "
+            "WHERE excluded.version > analysis_progress.version",
+            (key, encode_results(state), version, state.get("status"), time.time())
+        )
+
+    def read(self, key: str) -> Optional[Tuple[Dict[str, Any], int, float]]:
+        """返回 (状态, 版本号, 最后更新的 Unix 时间)，不存在时返回 None"""
+        rows = self.database.execute_query(
+            "SELECT state, version, updated_at FROM analysis_progress WHERE session_key = ?", (key,)
+        )
+        if not rows:
+            return None
+        return decode_results(rows[0]["state"], {}), rows[0]["version"], rows[0]["updated_at"]
+
+    def version(self, key: str) -> int:
+        rows = self.database.execute_query("SELECT version FROM analysis_progress WHERE session_key = ?", (key,))
+        return rows[0]["version"] if rows else 0
+
+    def purge(self, ttl: float, running_ttl: float) -> int:
+        """删除过期的会话进度，返回删除行数"""
+        now = time.time()
+        removed = 0
+        if ttl > 0:
+            removed += self.database.execute_rowcount(
+                "DELETE FROM analysis_progress WHERE updated_at < ? AND status IN ('completed', 'failed')",
+                (now - ttl,)
+            )
+        if running_ttl > 0:
+            removed += self.database.execute_rowcount(
+                "DELETE FROM analysis_progress WHERE updated_at < ?", (now - max(ttl, running_ttl),)
+            )
+        return removed
+
+
+class _Entry:
+    __slots__ = ("state", "version", "updated_at", "size")
+
+    def __init__(self):
+        self.state: Dict[str, Any] = {}
+        self.version = 0
+        self.updated_at = 0.0
+        self.size = 0
+
+
+class ProgressStore:
+    """
+    线程安全、有上限的会话进度存储
+
+    result_saver(key, result) 在会话结束时持久化完整结果，result_loader(key) 按引用取回；
+    未提供时结果留在内存中。on_evict(key) 在条目被淘汰时调用（清理关联的内存数据）。
+    shared 为进程间共享的后端（SQLiteProgressBackend）时，写入同时写入共享后端，本进程没有的会话从共享后端读取。
+    """
+
+    def __init__(self, ttl: float = PROGRESS_TTL_SECONDS, running_ttl: float = PROGRESS_RUNNING_TTL_SECONDS,
+                 max_entries: int = PROGRESS_MAX_ENTRIES, max_bytes: int = int(PROGRESS_MAX_MB * 1024 * 1024),
+                 result_saver: Optional[Callable[[str, Any], None]] = None,
+                 result_loader: Optional[Callable[[str], Any]] = None,
+                 on_evict: Optional[Callable[[str], None]] = None,
+                 shared: Optional[SQLiteProgressBackend] = None):
+        self.ttl = ttl
+        self.running_ttl = running_ttl
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max_bytes
+        self.result_saver = result_saver
+        self.result_loader = result_loader
+        self.on_evict = on_evict
+        self.shared = shared
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()  # 按最近访问排序，最久未访问的在前
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._swept_at = 0.0
+        self._shared_swept_at = 0.0
+        self.stats = {"evicted_ttl": 0, "evicted_lru": 0, "evicted_memory": 0,
+                      "results_saved": 0, "results_loaded": 0, "save_errors": 0,
+                      "shared_reads": 0, "shared_writes": 0, "shared_errors": 0}
+
+    # ---- 写入 ----
+
+    def _offloadable(self, state: Dict[str, Any]) -> bool:
+        return self.result_saver is not None and state.get("status") in FINAL_STATUSES and "result" in state
+
+    def _offload_result(self, key: str, state: Dict[str, Any]) -> Dict[str, Any]:
+        """已结束会话的 result 持久化后替换为引用；持久化失败时保留在内存中"""
+        if not self._offloadable(state):
+            return state
+        try:
+            self.result_saver(key, state["result"])
+        except Exception as e:
+            self.stats["save_errors"] += 1
+            logger.error(f"❌ 会话 {key} 的结果持久化失败，保留在内存中: {e}")
+            return state
+        self.stats["results_saved"] += 1
+        state = dict(state)
+        del state["result"]
+        state[RESULT_REF] = True
+        return state
+
+    def _store(self, key: str, entry: _Entry, state: Dict[str, Any]) -> int:
+        """锁内调用：写入新状态并递增版本号"""
+        size = _estimate_bytes(state)
+        self._bytes += size - entry.size
+        entry.state = state
+        entry.size = size
+        entry.version += 1
+        entry.updated_at = time.monotonic()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        return entry.version
+
+    def set(self, key: Any, state: Dict[str, Any]) -> int:
+        """整体替换会话状态，返回新版本号"""
+        key = str(key)
+        state = self._offload_result(key, dict(state))
+        # 本进程首次写入该会话：版本号接着共享后端中的版本（进程重启后重新写入同一会话）
+        previous = self._shared_version(key) if self.shared is not None and not self.is_local(key) else 0
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry()
+                entry.version = previous
+            version = self._store(key, entry, state)
+            evicted = self._evict_locked()
+        self._after_write(key, state, version, evicted)
+        return version
+
+    def update(self, key: Any, changes: Dict[str, Any], only_if_running: bool = False) -> bool:
+        """局部更新会话状态，返回是否实际写入（会话不存在，或 only_if_running 且会话已结束时不写入）"""
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (only_if_running and entry.state.get("status") != "running"):
+                return False
+            state = dict(entry.state, **changes)
+            offload = self._offloadable(state)
+            if not offload:
+                version = self._store(key, entry, state)
+                evicted = self._evict_locked()
+        if offload:
+            # 会话结束并带有结果：持久化在锁外进行，之后在期间其他更新写入的最新状态上重新应用 changes；
+            # 结果未被期间的更新替换时改为引用
+            persisted = state["result"]
+            offloaded = RESULT_REF in self._offload_result(key, state)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    return False
+                state = dict(entry.state, **changes)
+                if state.get("result") is persisted:
+                    if offloaded:
+                        del state["result"]
+                        state[RESULT_REF] = True
+                    else:
+                        state.pop(RESULT_REF, None)  # 持久化失败：内存中的结果比已持久化的新
+                version = self._store(key, entry, state)
+                evicted = self._evict_locked()
+        self._after_write(key, state, version, evicted)
+        return True
+
+    # ---- 读取 ----
+
+    def is_local(self, key: Any) -> bool:
+        """会话是否由本进程写入（读取无需访问共享后端）"""
+        with self._lock:
+            return str(key) in self._entries
+
+    def version(self, key: Any) -> int:
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry.version
+        return self._shared_version(key) if self.shared is not None else 0
+
+    def get(self, key: Any) -> Optional[Dict[str, Any]]:
+        """返回状态副本（含 version）；结果已持久化时按引用取回 result。不存在或已过期时返回 None"""
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry, time.monotonic()):
+                    return None
+                self._entries.move_to_end(key)
+                state = dict(entry.state, version=entry.version)
+        if entry is None:
+            state = self._read_shared(key)
+            if state is None:
+                return None
+        if state.pop(RESULT_REF, False) and self.result_loader is not None:
+            try:
+                state["result"] = self.result_loader(key)
+                self.stats["results_loaded"] += 1
+            except Exception as e:
+                logger.error(f"❌ 读取会话 {key} 的持久化结果失败: {e}")
+        return state
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get_meta(key) is not None
+
+    def get_meta(self, key: Any) -> Optional[Dict[str, Any]]:
+        """不含 result 的状态摘要（不触发结果读取，也不改变淘汰顺序）"""
+        with self._lock:
+            entry = self._entries.get(str(key))
+            if entry is None:
+                return None
+            meta = {k: v for k, v in entry.state.items() if k not in ("result", RESULT_REF)}
+            meta.update(version=entry.version, result_persisted=bool(entry.state.get(RESULT_REF)))
+            return meta
+
+    def summary(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近访问的 limit 个会话摘要（调试接口使用，不含结果内容）"""
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._entries.items())[-limit:]
+            return [{
+                "session_id": key,
+                "status": entry.state.get("status"),
+                "progress": entry.state.get("progress"),
+                "version": entry.version,
+                "message": entry.state.get("message"),
+                "idle_seconds": round(now - entry.updated_at, 1),
+                "bytes": entry.size,
+                "result_persisted": bool(entry.state.get(RESULT_REF)),
+            } for key, entry in reversed(items)]
+
+    def memory_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = sum(1 for e in self._entries.values() if e.state.get("status") == "running")
+            return {
+                "entries": len(self._entries),
+                "running": running,
+                "approx_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                **self.stats,
+            }
+
+    # ---- 共享后端 ----
+
+    def _shared_version(self, key: str) -> int:
+        try:
+            return self.shared.version(key)
+        except Exception as e:
+            self.stats["shared_errors"] += 1
+            logger.error(f"❌ 读取共享进度 {key} 失败: {e}")
+            return 0
+
+    def _read_shared(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.shared is None:
+            return None
+        try:
+            found = self.shared.read(key)
+        except Exception as e:
+            self.stats["shared_errors"] += 1
+            logger.error(f"❌ 读取共享进度 {key} 失败: {e}")
+            return None
+        self.stats["shared_reads"] += 1
+        if found is None:
+            return None
+        state, version, updated_at = found
+        ttl = self.ttl if state.get("status") in FINAL_STATUSES else self.running_ttl
+        if ttl > 0 and time.time() - updated_at > ttl:
+            return None
+        return dict(state, version=version)
+
+    def _after_write(self, key: str, state: Dict[str, Any], version: int, evicted: List[str]):
+        """锁外执行：写入共享后端、定期清理共享后端中的过期会话、通知淘汰"""
+        if self.shared is not None:
+            try:
+                self.shared.write(key, state, version)
+                self.stats["shared_writes"] += 1
+            except Exception as e:
+                self.stats["shared_errors"] += 1
+                logger.error(f"❌ 写入共享进度 {key} 失败，其他 worker 暂时读不到最新进度: {e}")
+            now = time.monotonic()
+            if now - self._shared_swept_at >= PROGRESS_SWEEP_SECONDS:
+                self._shared_swept_at = now
+                try:
+                    self.shared.purge(self.ttl, self.running_ttl)
+                except Exception as e:
+                    logger.warning(f"⚠️ 清理共享进度失败: {e}")
+        self._after_evict(evicted)
+
+    # ---- 淘汰 ----
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        ttl = self.ttl if entry.state.get("status") in FINAL_STATUSES else self.running_ttl
+        return ttl > 0 and now - entry.updated_at > ttl
+
+    def _remove_locked(self, key: str, reason: str) -> str:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        self.stats[reason] += 1
+        return key
+
+    def _evict_locked(self) -> List[str]:
+        """锁内调用：按 TTL、条目数、内存上限淘汰，返回被淘汰的键"""
+        evicted = []
+        now = time.monotonic()
+        if now - self._swept_at >= PROGRESS_SWEEP_SECONDS:
+            self._swept_at = now
+            for key in [k for k, e in self._entries.items() if self._expired(e, now)]:
+                evicted.append(self._remove_locked(key, "evicted_ttl"))
+
+        def over_limit():
+            return len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes)
+
+        if not over_limit():
+            return evicted
+        # 先淘汰已结束的会话，仍超限时才淘汰进行中的会话；最新写入的一条不淘汰
+        newest = next(reversed(self._entries))
+        for finished_only in (True, False):
+            for key in list(self._entries):
+                if not over_limit():
+                    return evicted
+                entry = self._entries[key]
+                if key == newest or (finished_only and entry.state.get("status") not in FINAL_STATUSES):
+                    continue
+                reason = "evicted_lru" if len(self._entries) > self.max_entries else "evicted_memory"
+                if not finished_only:
+                    logger.warning(f"⚠️ 进度存储超出上限，淘汰进行中的会话 {key}")
+                evicted.append(self._remove_locked(key, reason))
+        return evicted
+
+    def _after_evict(self, keys: List[str]):
+        if self.on_evict is None:
+            return
+        for key in keys:
+            try:
+                self.on_evict(key)
+            except Exception as e:
+                logger.warning(f"⚠️ 清理会话 {key} 的关联数据失败: {e}")
@@ -0,0 +1,162 @@
+"""
+SQL 语句耗时统计与慢查询日志
+SQLiteDB 的每条语句都计时：按归一化后的 SQL 汇总次数、总耗时、p95、返回行数；
+超过阈值的语句记录警告日志，附带参数形态与执行计划（EXPLAIN QUERY PLAN）。
+"""
+
+import functools
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 每条语句保留的耗时样本数（用于计算 p95）
+SAMPLE_SIZE = 1000
+# 最多统计的不同语句数，超出时淘汰总耗时最少的一条
+MAX_STATEMENTS = 500
+# 同一条语句的执行计划最多每隔多少秒重新获取一次
+PLAN_REFRESH_SECONDS = 60
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql(query: str) -> str:
+    """
+    归一化 SQL：合并空白，字面量替换为 ?，IN (?, ?, ...) 合并为 IN (?...)
+
+    只是参数个数或字面量不同的语句归为同一条统计。
+    """
+    text = _WHITESPACE.sub(" ", query).strip()
+    text = _STRING_LITERAL.sub("?", text)
+    text = _NUMBER_LITERAL.sub("?", text)
+    return _PLACEHOLDER_LIST.sub("(?...)", text)
+
+
+def param_shape(params: Optional[Iterable[Any]]) -> str:
+    """参数形态（只记录类型，不记录取值）：如 (str, float, int×3)"""
+    if not params:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    runs: List[List[Any]] = []
+    for value in params:
+        name = "None" if value is None else type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return "(" + ", ".join(name if count == 1 else f"{name}×{count}" for name, count in runs) + ")"
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+class _Statement:
+    __slots__ = ("sql", "calls", "total_ms", "max_ms", "rows", "slow_calls", "samples",
+                 "last_params", "plan", "plan_at")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.slow_calls = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+        self.last_params = "()"
+        self.plan: Optional[List[str]] = None
+        self.plan_at = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+        return {
+            "sql": self.sql,
+            "calls": self.calls,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+            "p95_ms": round(_percentile(samples, 95), 3),
+            "max_ms": round(self.max_ms, 3),
+            "rows": self.rows,
+            "slow_calls": self.slow_calls,
+            "params": self.last_params,
+            "plan": self.plan,
+        }
+
+
+class QueryStats:
+    """线程安全的语句耗时汇总"""
+
+    def __init__(self, slow_ms: float = 100.0, max_statements: int = MAX_STATEMENTS):
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self._statements: Dict[str, _Statement] = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def is_slow(self, elapsed_ms: float) -> bool:
+        return self.slow_ms >= 0 and elapsed_ms >= self.slow_ms
+
+    def needs_plan(self, query: str) -> bool:
+        """慢语句是否需要（重新）获取执行计划"""
+        with self._lock:
+            statement = self._statements.get(normalize_sql(query))
+            return statement is None or time.monotonic() - statement.plan_at >= PLAN_REFRESH_SECONDS
+
+    def record(self, query: str, params: Any, elapsed_ms: float, rows: int, plan: Optional[List[str]] = None):
+        sql = normalize_sql(query)
+        slow = self.is_slow(elapsed_ms)
+        shape = param_shape(params) if slow else None
+        with self._lock:
+            statement = self._statements.get(sql)
+            if statement is None:
+                if len(self._statements) >= self.max_statements:
+                    evicted = min(self._statements.values(), key=lambda s: s.total_ms)
+                    del self._statements[evicted.sql]
+                statement = self._statements[sql] = _Statement(sql)
+            statement.calls += 1
+            statement.total_ms += elapsed_ms
+            statement.max_ms = max(statement.max_ms, elapsed_ms)
+            statement.rows += max(rows, 0)
+            statement.samples.append(elapsed_ms)
+            if slow:
+                statement.slow_calls += 1
+                statement.last_params = shape
+                if plan is not None:
+                    statement.plan = plan
+                    statement.plan_at = time.monotonic()
+                else:
+                    plan = statement.plan
+        if slow:
+            plan_text = " | ".join(plan) if plan else "无"
+            logger.warning(
+                f"🐢 慢查询 {elapsed_ms:.1f}ms（阈值 {self.slow_ms:g}ms），{rows} 行，参数 {shape}\n"
+                f"   SQL: {sql}\n   执行计划: {plan_text}"
+            )
+
+    def top(self, limit: int = 10, order_by: str = "total") -> List[Dict[str, Any]]:
+        """按总耗时（total）或 p95 排序的前 limit 条语句"""
+        with self._lock:
+            summaries = [s.summary() for s in self._statements.values()]
+        key = "p95_ms" if order_by == "p95" else "total_ms"
+        return sorted(summaries, key=lambda s: s[key], reverse=True)[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self.started_at = time.time()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._statements)
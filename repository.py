@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+数据库访问层的公共接口
+SQLiteDB（sqlite_db_utils.py）与 MySQLDB（db_utils.py）实现同一组方法，业务代码只依赖这里的接口，
+不关心底层是哪种数据库。通过环境变量 DB_BACKEND 选择：sqlite（默认）或 mysql。
+
+两种实现都接受 "?" 占位符（MySQLDB 内部转换为 %s）；
+全文检索、产品目录内存副本、增量 VACUUM 等依赖 SQLite 特性的功能按 dialect 判断，只在 SQLite 下启用。
+"""
+
+import keyword
+import os
+from collections import namedtuple
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Protocol, Tuple, Union
+
+DB_BACKEND = os.environ.get("DB_BACKEND", "sqlite").lower()
+
+# 行对象工厂：接收列名元组，返回 "原始元组 -> 行对象" 的转换函数（None 表示直接使用元组）
+RowFactory = Callable[[Tuple[str, ...]], Optional[Callable[[tuple], Any]]]
+
+def _tuple_rows(columns: Tuple[str, ...]):
+    return None
+
+def _dict_rows(columns: Tuple[str, ...]):
+    return lambda values: dict(zip(columns, values))
+
+_namedtuple_types: Dict[Tuple[str, ...], type] = {}
+
+def _namedtuple_rows(columns: Tuple[str, ...]):
+    row_type = _namedtuple_types.get(columns)
+    if row_type is None:
+        row_type = _namedtuple_types[columns] = namedtuple("Row", columns, rename=True)
+    return row_type._make
+
+class Record:
+    """轻量行对象：__slots__ 存储，无每行字典；支持属性、下标与 get 访问"""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"Record({self._asdict()!r})"
+
+_record_types: Dict[Tuple[str, ...], type] = {}
+
+def _record_rows(columns: Tuple[str, ...]):
+    record_type = _record_types.get(columns)
+    if record_type is None:
+        # 与 namedtuple(rename=True) 一致：非法或重复的列名改为 _<序号>
+        slots, seen = [], set()
+        for i, name in enumerate(columns):
+            if not name.isidentifier() or keyword.iskeyword(name) or name.startswith("_") or name in seen:
+                name = f"_{i}"
+            seen.add(name)
+            slots.append(name)
+        # 生成 "self.a, self.b = values" 形式的 __init__，逐行构造只做一次元组解包
+        targets = ", ".join(f"self.{name}" for name in slots) + ("," if len(slots) == 1 else "")
+        namespace: Dict[str, Any] = {}
+        exec(f"def __init__(self, values):\n    {targets} = values", namespace)
+        record_type = _record_types[columns] = type(
+            "Record", (Record,), {"__slots__": tuple(slots), "__init__": namespace["__init__"]}
+        )
+    return record_type
+
+ROW_FACTORIES: Dict[str, RowFactory] = {
+    "tuple": _tuple_rows,
+    "dict": _dict_rows,
+    "namedtuple": _namedtuple_rows,
+    "record": _record_rows,
+}
+
+class PoolTimeoutError(Exception):
+    """连接池中的连接全部借出，且在等待时限内没有归还（SQLITE_POOL_TIMEOUT / MYSQL_POOL_TIMEOUT）"""
+
+class Repository(Protocol):
+    """
+    数据库实现需要提供的接口
+
+    - dialect："sqlite" 或 "mysql"；pool_size：连接池上限；query_stats：语句耗时统计（query_stats.py）
+    - connection()：借出一个底层连接；transaction()：块内的 execute_* 共用一个连接，退出时整体提交或回滚
+    - execute_update 返回新插入行的 id（无则为影响行数）；execute_rowcount 与 execute_many 返回影响行数
+    """
+    dialect: str
+    pool_size: int
+    query_stats: Any
+
+    def connection(self) -> ContextManager[Any]: ...
+
+    def transaction(self) -> ContextManager[Any]: ...
+
+    def iter_query(self, query: str, params: tuple = None, row_factory: Union[str, RowFactory] = "dict",
+                   batch_size: int = 256) -> Iterator[Any]: ...
+
+    def execute_query(self, query: str, params: tuple = None) -> List[Dict]: ...
+
+    def execute_update(self, query: str, params: tuple = None) -> int: ...
+
+    def execute_rowcount(self, query: str, params: tuple = None) -> int: ...
+
+    def execute_many(self, query: str, params_seq: Iterable[tuple]) -> int: ...
+
+    def close(self): ...
+
+def open_database(backend: str = DB_BACKEND) -> Repository:
+    """按 backend 创建数据库实例：sqlite 使用 SQLITE_DB_PATH，mysql 使用 MYSQL_* 环境变量"""
+    if backend == "mysql":
+        from db_utils import MySQLDB
+        return MySQLDB()
+    if backend != "sqlite":
+        raise ValueError(f"不支持的数据库类型 DB_BACKEND={backend}（可选 sqlite / mysql）")
+    from sqlite_db_utils import SQLiteDB
+    return SQLiteDB(os.environ.get("SQLITE_DB_PATH", "pet_food_selection.db"))
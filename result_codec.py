@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+分析结果（analysis_sessions.analysis_results）的存储编码
+
+新写入的结果为 BLOB：1 字节格式版本 + 内容。
+- 版本 1：紧凑 JSON（UTF-8 原文、无多余空白）经 zlib 压缩。
+
+旧数据是 json.dumps 的文本（以 "[" / "{" 开头），读取时按原样解析，无需迁移；
+也可运行 python result_codec.py 把旧数据批量转换为新编码。
+"""
+
+import argparse
+import json
+import logging
+import os
+import zlib
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+FORMAT_ZLIB_JSON = 1
+CURRENT_FORMAT = FORMAT_ZLIB_JSON
+RESULT_COMPRESS_LEVEL = int(os.environ.get("RESULT_COMPRESS_LEVEL", "6"))
+
+
+def encode_results(results: Any) -> bytes:
+    """编码分析结果，返回带格式版本前缀的 bytes（写入 analysis_results）"""
+    text = json.dumps(results, ensure_ascii=False, separators=(",", ":"), default=str)
+    return bytes([FORMAT_ZLIB_JSON]) + zlib.compress(text.encode("utf-8"), RESULT_COMPRESS_LEVEL)
+
+
+def decode_results(value: Any, default: Any = None) -> Any:
+    """
+    解码 analysis_results 列：兼容新编码（bytes）与旧的 JSON 文本
+
+    值为空时返回 default（默认 []）；格式版本未知时抛出 ValueError。
+    """
+    if value is None or value == "" or value == b"":
+        return [] if default is None else default
+    if isinstance(value, str):
+        return json.loads(value)
+    data = bytes(value)
+    if data[0] == FORMAT_ZLIB_JSON:
+        return json.loads(zlib.decompress(data[1:]).decode("utf-8"))
+    if data[:1] in (b"[", b"{"):
+        return json.loads(data.decode("utf-8"))
+    raise ValueError(f"未知的分析结果编码格式: {data[0]}")
+
+
+def recompress_sessions(database, batch_size: int = 500) -> Dict[str, int]:
+    """
+    把旧格式（JSON 文本）的分析结果批量转换为当前编码，每批一个事务
+
+    按 id 递增分批，可随时中断后重新运行。返回 {converted, bytes_before, bytes_after}。
+    """
+    report = {"converted": 0, "bytes_before": 0, "bytes_after": 0}
+    last_id = 0
+    while True:
+        rows = database.execute_query(
+            "SELECT id, analysis_results FROM analysis_sessions "
+            "WHERE id > ? AND typeof(analysis_results) = 'text' ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        updates = []
+        for row in rows:
+            try:
+                encoded = encode_results(decode_results(row["analysis_results"]))
+            except ValueError as e:
+                logger.warning(f"⚠️ 会话 {row['id']} 的分析结果无法解析，跳过: {e}")
+                continue
+            report["bytes_before"] += len(row["analysis_results"].encode("utf-8"))
+            report["bytes_after"] += len(encoded)
+            updates.append((encoded, row["id"], row["analysis_results"]))
+        # 只转换仍未被改写的行（期间被分析任务重新写入的行保持新值）
+        with database.transaction():
+            report["converted"] += database.execute_many(
+                "UPDATE analysis_sessions SET analysis_results = ? WHERE id = ? AND analysis_results = ?",
+                updates
+            )
+        logger.info(f"   已转换 {report['converted']} 个会话")
+    return report
+
+
+if __name__ == "__main__":
+    from sqlite_db_utils import db
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="把旧格式的分析结果转换为压缩编码")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    result = recompress_sessions(db, args.batch_size)
+    saved = result["bytes_before"] - result["bytes_after"]
+    logger.info(
+        f"🎉 转换完成：{result['converted']} 个会话，"
+        f"{result['bytes_before']} -> {result['bytes_after']} 字节（节省 {saved} 字节）"
+    )
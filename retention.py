@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+数据保留任务
+pet_info、analysis_sessions、anonymous_mapping 每次提交表单 / 分析都会新增行，这里按保留天数定期清理：
+
+- 过期会话连同其匿名映射分批删除，每批一个短事务，批与批之间让出写锁；
+  会话的任务队列记录与断点随会话一起删除，进度存储持久化的过期结果（analysis_progress_results）同样分批删除；
+- 配置了归档目录时，删除前先把会话（含解码后的分析结果与匿名映射）追加写入 NDJSON.gz；
+- 过期且不再被任何会话引用的宠物信息分批删除；
+- 数据库为 auto_vacuum=INCREMENTAL 时，删除后分步执行 incremental_vacuum 归还空闲页。
+
+保留天数为 0 表示永久保留（默认），此时后台任务不启动。
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from result_codec import decode_results
+from sqlite_db_utils import db
+
+logger = logging.getLogger(__name__)
+
+RETENTION_SESSION_DAYS = float(os.environ.get("RETENTION_SESSION_DAYS", "0"))
+RETENTION_PET_DAYS = float(os.environ.get("RETENTION_PET_DAYS", "0"))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "500"))
+RETENTION_INTERVAL_SECONDS = float(os.environ.get("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "")
+# 每批删除之间的停顿（秒），让其他写请求拿到写锁
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", "0.05"))
+# 每步 incremental_vacuum 归还的页数
+VACUUM_STEP_PAGES = 256
+
+
+def _cutoff(days: float) -> str:
+    """与 created_at（CURRENT_TIMESTAMP，UTC）同格式的截止时间"""
+    return (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _placeholders(values: List[Any]) -> str:
+    return ",".join("?" * len(values))
+
+
+class _Archive:
+    """按次运行写一个 sessions-<时间>.ndjson.gz，每批写完即 flush；首次写入时才创建文件"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path: Optional[str] = None
+        self._file = None
+
+    def write(self, records: List[Dict[str, Any]]):
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.join(self.directory, f"sessions-{time.strftime('%Y%m%d-%H%M%S')}.ndjson.gz")
+            self._file = gzip.open(self.path, "at", encoding="utf-8")
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _archive_records(database, session_ids: List[int]) -> List[Dict[str, Any]]:
+    marks = _placeholders(session_ids)
+    sessions = database.execute_query(f"SELECT * FROM analysis_sessions WHERE id IN ({marks})", tuple(session_ids))
+    mappings: Dict[int, List[Dict[str, Any]]] = {}
+    for row in database.iter_query(
+        f"SELECT session_id, product_id, anonymous_code FROM anonymous_mapping WHERE session_id IN ({marks})",
+        tuple(session_ids)
+    ):
+        mappings.setdefault(row["session_id"], []).append(
+            {"product_id": row["product_id"], "anonymous_code": row["anonymous_code"]}
+        )
+    records = []
+    for session in sessions:
+        try:
+            session["analysis_results"] = decode_results(session["analysis_results"])
+        except ValueError:
+            session["analysis_results"] = None
+        session["anonymous_mapping"] = mappings.get(session["id"], [])
+        records.append(session)
+    return records
+
+
+def _delete_in_batches(database, table: str, key: str, select_sql: str, params: tuple,
+                       batch_size: int, pause: float) -> int:
+    """
+    按 select_sql 每次查出至多 batch_size 个键再按键删除，直到不足一批，返回删除行数
+
+    MySQL 不支持 DELETE ... WHERE id IN (SELECT ... LIMIT ?)（IN 子查询不能带 LIMIT，也不能查询正在删除的表），
+    两种数据库都先查键再删除。
+    """
+    deleted = 0
+    while True:
+        keys = [row[key] for row in database.execute_query(f"{select_sql} LIMIT ?", params + (batch_size,))]
+        if keys:
+            deleted += database.execute_rowcount(
+                f"DELETE FROM {table} WHERE {key} IN ({_placeholders(keys)})", tuple(keys)
+            )
+        if len(keys) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def purge_sessions(database, days: float, batch_size: int = RETENTION_BATCH_SIZE,
+                   archive: Optional[_Archive] = None, pause: float = RETENTION_BATCH_PAUSE) -> int:
+    """删除 created_at 早于 days 天前的会话及其匿名映射、进度结果，返回删除的会话数"""
+    cutoff = _cutoff(days)
+    # 任务队列与进度结果表只由 SQLite 迁移创建
+    sqlite = getattr(database, "dialect", "sqlite") == "sqlite"
+    deleted = 0
+    while True:
+        ids = [row["id"] for row in database.execute_query(
+            "SELECT id FROM analysis_sessions WHERE created_at < ? ORDER BY created_at LIMIT ?", (cutoff, batch_size)
+        )]
+        if not ids:
+            break
+        # 先归档再删除：中途失败时下次运行会再次归档同一批（至少一次）
+        if archive is not None:
+            archive.write(_archive_records(database, ids))
+        marks = _placeholders(ids)
+        with database.transaction():
+            database.execute_rowcount(f"DELETE FROM anonymous_mapping WHERE session_id IN ({marks})", tuple(ids))
+            if sqlite:
+                database.execute_rowcount(f"DELETE FROM analysis_job_checkpoints WHERE session_id IN ({marks})", tuple(ids))
+                database.execute_rowcount(f"DELETE FROM analysis_jobs WHERE session_id IN ({marks})", tuple(ids))
+            database.execute_rowcount(f"DELETE FROM analysis_sessions WHERE id IN ({marks})", tuple(ids))
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+    # 会话已不存在的过期匿名映射（早期数据）
+    _delete_in_batches(
+        database, "anonymous_mapping", "id",
+        "SELECT id FROM anonymous_mapping WHERE created_at < ? "
+        "AND NOT EXISTS (SELECT 1 FROM analysis_sessions s WHERE s.id = anonymous_mapping.session_id)",
+        (cutoff,), batch_size, pause
+    )
+
+    # 进度存储持久化的结果（/api/simple-analysis 会话）
+    if sqlite:
+        _delete_in_batches(
+            database, "analysis_progress_results", "session_key",
+            "SELECT session_key FROM analysis_progress_results WHERE created_at < ?",
+            (cutoff,), batch_size, pause
+        )
+    return deleted
+
+
+def purge_pets(database, days: float, batch_size: int = RETENTION_BATCH_SIZE,
+               pause: float = RETENTION_BATCH_PAUSE) -> int:
+    """删除早于 days 天前创建、且没有任何会话引用的宠物信息，返回删除行数"""
+    return _delete_in_batches(
+        database, "pet_info", "id",
+        "SELECT id FROM pet_info p WHERE p.created_at < ? "
+        "AND NOT EXISTS (SELECT 1 FROM analysis_sessions s WHERE s.pet_id = p.id)",
+        (_cutoff(days),), batch_size, pause
+    )
+
+
+def incremental_vacuum(database, step_pages: int = VACUUM_STEP_PAGES, pause: float = RETENTION_BATCH_PAUSE) -> int:
+    """auto_vacuum=INCREMENTAL 时分步归还空闲页，返回归还的页数；其他模式（及非 SQLite 数据库）不做处理"""
+    if getattr(database, "dialect", "sqlite") != "sqlite":
+        return 0
+    with database.connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+    released = 0
+    while True:
+        with database.connection() as conn:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({min(free, step_pages)})").fetchall()
+            conn.commit()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        released += free - remaining
+        if pause:
+            time.sleep(pause)
+    return released
+
+
+def convert_to_incremental_vacuum(database) -> bool:
+    """
+    已有数据库切换为 auto_vacuum=INCREMENTAL：需要一次完整 VACUUM（重写整个文件，期间阻塞写入），
+    只应在维护窗口手动执行。已是增量模式时返回 False。
+    """
+    with database.connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    logger.info("✅ 数据库已切换为 auto_vacuum=INCREMENTAL")
+    return True
+
+
+def run_retention(database=db, session_days: float = RETENTION_SESSION_DAYS, pet_days: float = RETENTION_PET_DAYS,
+                  batch_size: int = RETENTION_BATCH_SIZE, archive_dir: str = RETENTION_ARCHIVE_DIR,
+                  pause: float = RETENTION_BATCH_PAUSE) -> Dict[str, Any]:
+    """执行一轮清理，返回 {sessions, pets, vacuumed_pages, archive, seconds}"""
+    started = time.monotonic()
+    archive = _Archive(archive_dir) if archive_dir else None
+    report: Dict[str, Any] = {"sessions": 0, "pets": 0, "vacuumed_pages": 0, "archive": None}
+    try:
+        if session_days > 0:
+            report["sessions"] = purge_sessions(database, session_days, batch_size, archive, pause)
+        if pet_days > 0:
+            report["pets"] = purge_pets(database, pet_days, batch_size, pause)
+    finally:
+        if archive is not None:
+            archive.close()
+            report["archive"] = archive.path
+    if report["sessions"] or report["pets"]:
+        report["vacuumed_pages"] = incremental_vacuum(database, pause=pause)
+    report["seconds"] = round(time.monotonic() - started, 3)
+    if report["sessions"] or report["pets"]:
+        logger.info(
+            f"🧹 数据清理完成：会话 {report['sessions']}，宠物 {report['pets']}，"
+            f"归还 {report['vacuumed_pages']} 页，归档 {report['archive'] or '未开启'}，耗时 {report['seconds']}s"
+        )
+    return report
+
+
+class RetentionJob:
+    """后台定期执行 run_retention 的线程"""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL_SECONDS, **options):
+        self.interval = interval
+        self.options = options
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return (self.options.get("session_days", RETENTION_SESSION_DAYS) > 0
+                or self.options.get("pet_days", RETENTION_PET_DAYS) > 0)
+
+    def start(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        logger.info(f"🧹 数据保留任务已启动，每 {self.interval:g} 秒执行一次")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.last_report = run_retention(**self.options)
+            except Exception as e:
+                logger.error(f"❌ 数据清理失败: {e}")
+            self._stop.wait(self.interval)
+
+
+retention_job = RetentionJob()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="清理过期的分析会话与宠物信息")
+    parser.add_argument("--session-days", type=float, default=RETENTION_SESSION_DAYS, help="会话保留天数（0 为永久）")
+    parser.add_argument("--pet-days", type=float, default=RETENTION_PET_DAYS, help="宠物信息保留天数（0 为永久）")
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    parser.add_argument("--archive-dir", default=RETENTION_ARCHIVE_DIR, help="删除前归档会话的目录（为空不归档）")
+    parser.add_argument("--convert-vacuum", action="store_true",
+                        help="先把已有数据库切换为 auto_vacuum=INCREMENTAL（执行一次完整 VACUUM）")
+    args = parser.parse_args()
+    if args.convert_vacuum:
+        convert_to_incremental_vacuum(db)
+    print(json.dumps(run_retention(
+        db, args.session_days, args.pet_days, args.batch_size, args.archive_dir
+    ), ensure_ascii=False, indent=2))
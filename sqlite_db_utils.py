@@ -7,80 +7,330 @@ SQLite 数据库工具
 import sqlite3
 import os
 import json
-from typing import Dict, List, Any, Optional
+import asyncio
+import functools
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Callable, Iterable, Iterator, Optional, Tuple, Union
 import logging
 
+from query_stats import QueryStats
+from repository import ROW_FACTORIES, PoolTimeoutError, Record, Repository, RowFactory, open_database
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 连接池与 PRAGMA 配置（可通过环境变量调整）
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+# 连接全部借出时最多等待的秒数，超时抛出 PoolTimeoutError（连接泄漏或同一线程嵌套借出时报错而不是永久挂起）
+SQLITE_POOL_TIMEOUT = float(os.environ.get("SQLITE_POOL_TIMEOUT", "10"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_STATEMENT_CACHE = int(os.environ.get("SQLITE_STATEMENT_CACHE", "512"))
+# 慢查询阈值（毫秒）：超过时记录日志与执行计划；设为负数关闭慢查询日志（耗时统计照常）
+SQLITE_SLOW_QUERY_MS = float(os.environ.get("SQLITE_SLOW_QUERY_MS", "100"))
+
 class SQLiteDB:
-    def __init__(self, db_path: str = "pet_food_selection.db"):
-        """初始化SQLite数据库连接"""
+    """
+    SQLite 数据库访问
+    
+    每次操作从连接池借出一个连接、用完归还，不同线程不会共用同一个连接。
+    数据库以 WAL 模式运行：读不阻塞写、写不阻塞读，写冲突时按 busy_timeout 等待而不是立即报错。
+    """
+    
+    dialect = "sqlite"
+    
+    def __init__(self, db_path: str = "pet_food_selection.db", pool_size: int = SQLITE_POOL_SIZE,
+                 pool_timeout: float = SQLITE_POOL_TIMEOUT):
+        """初始化SQLite数据库连接池"""
         self.db_path = db_path
-        self.connection = None
+        # 内存数据库每个连接各自独立，只能用单连接
+        self.pool_size = 1 if db_path == ":memory:" else max(1, pool_size)
+        self.pool_timeout = pool_timeout
+        self._idle = queue.LifoQueue()
+        self._all_connections: List[sqlite3.Connection] = []
+        self._opened = 0  # 已创建（含正在创建）的连接数
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()  # 当前线程进行中的事务所持有的连接
+        self.query_stats = QueryStats(slow_ms=SQLITE_SLOW_QUERY_MS)  # 每条语句的耗时统计（见 query_stats.py）
         self.connect()
     
     def connect(self):
-        """连接到SQLite数据库"""
+        """建立第一个连接并切换到 WAL 模式"""
         try:
-            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.connection.row_factory = sqlite3.Row  # 使结果可以通过列名访问
-            logger.info(f"✅ SQLite数据库连接成功: {self.db_path}")
+            with self._pool_lock:
+                self._opened += 1
+            self._idle.put(self._new_connection())
+            logger.info(f"✅ SQLite数据库连接成功: {self.db_path}（WAL，连接池上限 {self.pool_size}）")
         except Exception as e:
             logger.error(f"❌ SQLite数据库连接失败: {e}")
             raise
     
+    def _new_connection(self) -> sqlite3.Connection:
+        # "file:" 开头按 URI 打开，如共享缓存的命名内存数据库 file:name?mode=memory&cache=shared
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=SQLITE_STATEMENT_CACHE, uri=self.db_path.startswith("file:")
+        )
+        conn.row_factory = sqlite3.Row  # 使结果可以通过列名访问
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        # 新建（空）的数据库文件启用增量 VACUUM，须在切换 WAL（写入文件头）之前设置；
+        # 已有数据库上设置会等待写锁，且需执行一次 VACUUM 才生效，见 retention.py --convert-vacuum
+        if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # WAL 下 NORMAL 只在检查点时 fsync，断电最多丢失最近的事务，不会损坏数据库
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        with self._pool_lock:
+            self._all_connections.append(conn)
+        return conn
+    
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            can_grow = self._opened < self.pool_size
+            if can_grow:
+                self._opened += 1
+        if can_grow:
+            try:
+                return self._new_connection()
+            except Exception:
+                with self._pool_lock:
+                    self._opened -= 1
+                raise
+        # 连接已全部借出，等待归还
+        try:
+            return self._idle.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(
+                f"等待 SQLite 连接超时（{self.pool_timeout:g}s，连接池上限 {self.pool_size}）"
+            ) from None
+    
+    def _release(self, conn: sqlite3.Connection):
+        self._idle.put(conn)
+    
+    def _in_transaction(self) -> bool:
+        return getattr(self._local, "conn", None) is not None
+    
+    @contextmanager
+    def connection(self):
+        """借出一个连接，退出时归还连接池；在 transaction() 内则复用事务的连接"""
+        pinned = getattr(self._local, "conn", None)
+        if pinned is not None:
+            yield pinned
+            return
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+    
+    @contextmanager
+    def transaction(self):
+        """
+        显式事务：块内当前线程的 execute_* 共用一个连接且不单独提交，
+        正常退出时一次性提交，抛出异常时整体回滚。嵌套使用时并入外层事务。
+        """
+        if self._in_transaction():
+            yield self._local.conn
+            return
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._local.conn = None
+    
+    def _record(self, conn: sqlite3.Connection, query: str, params: Any, elapsed: float, rows: int,
+                plan_params: Any = None):
+        """记录一次语句耗时；慢语句顺带在同一连接上获取执行计划（不会执行语句本身）"""
+        elapsed_ms = elapsed * 1000
+        plan = None
+        if self.query_stats.is_slow(elapsed_ms) and self.query_stats.needs_plan(query):
+            try:
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", plan_params or ())]
+            except sqlite3.Error:
+                plan = None
+        self.query_stats.record(query, params, elapsed_ms, rows, plan)
+    
+    def iter_query(
+        self,
+        query: str,
+        params: tuple = None,
+        row_factory: Union[str, RowFactory] = "dict",
+        batch_size: int = 256
+    ) -> Iterator[Any]:
+        """
+        流式查询：按 batch_size 分批从游标取行，逐行产出，不构建完整结果列表
+        
+        row_factory 可选 "dict" / "tuple" / "namedtuple" / "record"（__slots__ 轻量对象），
+        也可传入自定义工厂。迭代期间占用一个连接，应迭代完毕（或关闭生成器）以归还连接。
+        """
+        factory = ROW_FACTORIES[row_factory] if isinstance(row_factory, str) else row_factory
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            # 只统计数据库耗时（执行与取行），不含调用方逐行处理的时间
+            elapsed = 0.0
+            count = 0
+            executed = False
+            try:
+                started = time.perf_counter()
+                try:
+                    cursor.execute(query, params or ())
+                    executed = True
+                except Exception as e:
+                    logger.error(f"查询执行失败: {e}")
+                    logger.error(f"SQL: {query}")
+                    logger.error(f"参数: {params}")
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - started
+                columns = tuple(d[0] for d in cursor.description or ())
+                make_row = factory(columns)
+                while True:
+                    started = time.perf_counter()
+                    rows = cursor.fetchmany(batch_size)
+                    elapsed += time.perf_counter() - started
+                    if not rows:
+                        break
+                    count += len(rows)
+                    if make_row is None:
+                        yield from rows
+                    else:
+                        yield from map(make_row, rows)
+            finally:
+                cursor.close()
+                if executed:
+                    self._record(conn, query, params, elapsed, count, params)
+    
     def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
         """执行查询并返回结果"""
-        try:
-            cursor = self.connection.cursor()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            
-            # 获取结果
-            rows = cursor.fetchall()
-            result = [dict(row) for row in rows]
-            cursor.close()
-            return result
-        except Exception as e:
-            logger.error(f"查询执行失败: {e}")
-            logger.error(f"SQL: {query}")
-            logger.error(f"参数: {params}")
-            raise
+        return list(self.iter_query(query, params))
     
     def execute_update(self, query: str, params: tuple = None) -> int:
-        """执行更新/插入/删除操作"""
-        try:
-            cursor = self.connection.cursor()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            
-            self.connection.commit()
-            affected_rows = cursor.rowcount
-            last_id = cursor.lastrowid
-            cursor.close()
-            
-            return last_id if last_id else affected_rows
-        except Exception as e:
-            logger.error(f"更新执行失败: {e}")
-            logger.error(f"SQL: {query}")
-            logger.error(f"参数: {params}")
-            self.connection.rollback()
-            raise
+        """执行更新/插入/删除操作，返回新插入行的 id（无则为影响行数）"""
+        last_id, affected_rows = self._execute(query, params)
+        return last_id if last_id else affected_rows
+    
+    def execute_rowcount(self, query: str, params: tuple = None) -> int:
+        """执行更新/删除操作，返回影响的行数（execute_update 在连接上有过插入时返回的是 rowid）"""
+        return self._execute(query, params)[1]
+    
+    def _execute(self, query: str, params: tuple = None) -> Tuple[int, int]:
+        """执行单条写语句，返回 (lastrowid, rowcount)"""
+        with self.connection() as conn:
+            try:
+                started = time.perf_counter()
+                cursor = conn.cursor()
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                
+                if not self._in_transaction():
+                    conn.commit()
+                affected_rows = cursor.rowcount
+                last_id = cursor.lastrowid
+                cursor.close()
+                self._record(conn, query, params, time.perf_counter() - started, affected_rows, params)
+                
+                return last_id, affected_rows
+            except Exception as e:
+                logger.error(f"更新执行失败: {e}")
+                logger.error(f"SQL: {query}")
+                logger.error(f"参数: {params}")
+                if not self._in_transaction():
+                    conn.rollback()
+                raise
+    
+    def execute_many(self, query: str, params_seq: Iterable[tuple]) -> int:
+        """同一语句批量执行（一次提交），返回影响的行数"""
+        with self.connection() as conn:
+            try:
+                # 执行计划用第一组参数获取（仅在参数为列表/元组时可取）
+                first = params_seq[0] if isinstance(params_seq, (list, tuple)) and params_seq else None
+                started = time.perf_counter()
+                cursor = conn.executemany(query, params_seq)
+                if not self._in_transaction():
+                    conn.commit()
+                affected_rows = cursor.rowcount
+                cursor.close()
+                self._record(conn, query, first, time.perf_counter() - started, affected_rows, first)
+                return affected_rows
+            except Exception as e:
+                logger.error(f"批量执行失败: {e}")
+                logger.error(f"SQL: {query}")
+                if not self._in_transaction():
+                    conn.rollback()
+                raise
     
     def close(self):
-        """关闭数据库连接"""
-        if self.connection:
-            self.connection.close()
+        """关闭连接池中的所有连接"""
+        with self._pool_lock:
+            connections, self._all_connections = self._all_connections, []
+            self._opened = 0
+        for conn in connections:
+            conn.close()
+        self._idle = queue.LifoQueue()
+        if connections:
             logger.info("数据库连接已关闭")
 
-# 全局数据库实例
-db = SQLiteDB()
+class AsyncSQLiteDB:
+    """
+    数据库的异步外观：接口与 SQLiteDB / MySQLDB 相同，但在专用线程池中执行，不阻塞事件循环
+    
+    线程池与任务队列、心跳、数据保留、write-behind 等后台线程共用同一个连接池，且一个工作线程可能同时
+    借出两个连接（流式读取中写入、事务外的嵌套读取等），因此线程数默认取连接池上限的一半：
+    全部工作线程各借两个连接时连接池恰好够用，不会互相等待而挂起；后台线程占用连接时工作线程可能短暂等待归还。
+    需要多条语句配合的逻辑（事务、流式处理）写成同步函数后交给 run() 整体执行。
+    """
+    
+    def __init__(self, database: Repository, max_workers: Optional[int] = None):
+        self.database = database
+        self.max_workers = max_workers or max(1, database.pool_size // 2)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sqlite")
+    
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """在数据库线程池中执行任意同步函数"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
+        return await self.run(self.database.execute_query, query, params)
+    
+    async def execute_update(self, query: str, params: tuple = None) -> int:
+        return await self.run(self.database.execute_update, query, params)
+    
+    async def execute_rowcount(self, query: str, params: tuple = None) -> int:
+        return await self.run(self.database.execute_rowcount, query, params)
+    
+    async def execute_many(self, query: str, params_seq: Iterable[tuple]) -> int:
+        return await self.run(self.database.execute_many, query, list(params_seq))
+    
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+# 全局数据库实例：DB_BACKEND 选择 sqlite（默认，SQLITE_DB_PATH 指定文件）或 mysql（MYSQL_* 环境变量）
+db = open_database()
+# 异步接口（FastAPI 的 async 路由使用）
+adb = AsyncSQLiteDB(db)
 
 def safe_str_exception(e):
     """安全地转换异常为字符串"""
@@ -94,82 +344,16 @@ def get_db_connection():
     return db
 
 def init_sqlite_database():
-    """初始化SQLite数据库表结构"""
-    
-    # 创建宠物信息表
-    create_pet_info_table = """
-    CREATE TABLE IF NOT EXISTS pet_info (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        species TEXT NOT NULL,
-        breed TEXT,
-        age_months INTEGER,
-        weight_kg REAL,
-        health_status TEXT,
-        allergies TEXT,
-        doctor_notes TEXT,
-        budget_mode TEXT,
-        monthly_budget REAL,
-        price_range_min REAL,
-        price_range_max REAL,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """
-    
-    # 创建产品表
-    create_products_table = """
-    CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        brand TEXT NOT NULL,
-        product_name TEXT NOT NULL,
-        category TEXT,
-        life_stage TEXT,
-        species TEXT DEFAULT 'cat',
-        product_type TEXT DEFAULT 'dry',
-        price REAL,
-        weight_g INTEGER,
-        price_per_jin REAL,
-        ingredients TEXT,
-        nutrition_analysis TEXT,
-        additives TEXT,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    """
-    
-    # 创建分析会话表
-    create_analysis_sessions_table = """
-    CREATE TABLE IF NOT EXISTS analysis_sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        pet_id INTEGER,
-        product_ids TEXT,
-        analysis_results TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (pet_id) REFERENCES pet_info (id)
-    )
-    """
-    
-    # 创建匿名映射表
-    create_anonymous_mapping_table = """
-    CREATE TABLE IF NOT EXISTS anonymous_mapping (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        session_id INTEGER,
-        product_id INTEGER,
-        anonymous_code TEXT,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (session_id) REFERENCES analysis_sessions (id),
-        FOREIGN KEY (product_id) REFERENCES products (id)
-    )
-    """
+    """初始化SQLite数据库：执行未完成的版本化迁移（见 db_migrations.py）"""
+    from db_migrations import apply_migrations
     
     try:
-        # 执行建表语句
-        db.execute_update(create_pet_info_table)
-        db.execute_update(create_products_table)
-        db.execute_update(create_analysis_sessions_table)
-        db.execute_update(create_anonymous_mapping_table)
-        _ensure_product_columns()
-        
-        logger.info("✅ SQLite数据库表结构创建成功")
+        if db.dialect == "sqlite":
+            apply_migrations(db)
+            logger.info("✅ SQLite数据库表结构创建成功")
+        else:
+            # MySQL 表结构由 init_database.py 创建，迁移脚本只适用于 SQLite
+            logger.info("✅ 使用 MySQL 数据库，跳过 SQLite 迁移")
         
         # 检查是否需要插入示例数据
         products_count = db.execute_query("SELECT COUNT(*) as count FROM products")[0]['count']
@@ -182,25 +366,6 @@ def init_sqlite_database():
         logger.error(f"❌ 数据库初始化失败: {e}")
         return False
 
-def _ensure_product_columns():
-    """在已有表上补充缺失的列，避免老数据库报错"""
-    try:
-        columns = db.execute_query("PRAGMA table_info(products)")
-        existing = {c['name'] for c in columns}
-        alter_sqls = []
-        if 'species' not in existing:
-            alter_sqls.append("ALTER TABLE products ADD COLUMN species TEXT DEFAULT 'cat'")
-        if 'product_type' not in existing:
-            alter_sqls.append("ALTER TABLE products ADD COLUMN product_type TEXT DEFAULT 'dry'")
-        # 逐条执行，失败不影响后续
-        for sql in alter_sqls:
-            try:
-                db.execute_update(sql)
-            except Exception as e:
-                logger.warning(f"⚠️ 忽略列补充失败: {e}")
-    except Exception as e:
-        logger.warning(f"⚠️ 检查产品表结构失败: {e}")
-
 def insert_sample_products():
     """插入示例产品数据"""
     
@@ -284,8 +449,8 @@ def insert_sample_products():
     """
     
     try:
-        for product in sample_products:
-            db.execute_update(insert_query, (
+        db.execute_many(insert_query, [
+            (
                 product['brand'],
                 product['product_name'],
                 product['category'],
@@ -298,7 +463,9 @@ def insert_sample_products():
                 product['ingredients'],
                 product['nutrition_analysis'],
                 product['additives']
-            ))
+            )
+            for product in sample_products
+        ])
         
         logger.info(f"✅ 插入了 {len(sample_products)} 个示例产品")
         
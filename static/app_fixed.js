@@ -1,6 +1,7 @@
 // 导入模块
 import { ProductSelector } from './products.js';
 import { ResultsDisplay } from './results.js';
+import { createPartialRanking, mergePartialRanking, renderPartialRanking } from './partial_ranking.js';
 // HistoryManager 和 ShareManager 通过 window 对象全局访问
 
 // 生成或获取用户ID
@@ -93,6 +94,9 @@ const showStep = (stepNumber) => {
         currentContent.classList.add('fade-in');
     }
     
+    // 离开分析页（如在快速排名中点击“重新选择产品”）时不再接收进度，避免完成后跳转
+    if (stepNumber !== 3) stopAnalysisUpdates();
+    
     appState.currentStep = stepNumber;
     window.scrollTo({ top: 0, behavior: 'smooth' });
 };
@@ -711,6 +715,26 @@ async function initStep2() {
 }
 
 // 步骤3：同步分析（简化版）
+// 停止接收分析进度（关闭SSE连接、结束长轮询）
+function stopAnalysisUpdates() {
+    if (!window.appState) return;
+    window.appState.analysisUpdatesActive = false;
+    if (window.appState.analysisEventSource) {
+        window.appState.analysisEventSource.close();
+        window.appState.analysisEventSource = null;
+    }
+}
+
+// 刷新已完成产品的实时排名面板（沿用快速排名的匿名代号）
+function showPartialRanking() {
+    const panel = document.getElementById('partialRankingPanel');
+    if (!panel) return;
+    const mapping = appState.analysisResult?.anonymous_mapping || {};
+    const html = renderPartialRanking(appState.partialRanking, mapping);
+    panel.innerHTML = html;
+    panel.classList.toggle('hidden', !html);
+}
+
 window.initStep3 = async function() {
     const step3Content = document.getElementById('step3-content');
     if (!step3Content) return;
@@ -749,7 +773,9 @@ window.initStep3 = async function() {
                     <div id="progressPercent" class="mt-1 text-xs text-gray-500">0%</div>
                 </div>
             </div>
+            <div id="partialRankingPanel" class="hidden mt-2 pt-6 border-t border-gray-200"></div>
         </div>
+        <div id="quickResults" class="mt-6"></div>
     `;
 
     // 初始化进度条 - 确保从0%开始
@@ -772,10 +798,7 @@ window.initStep3 = async function() {
         clearInterval(window.appState.analysisProgressTimer);
         window.appState.analysisProgressTimer = null;
     }
-    if (window.appState.analysisPollTimer) {
-        clearInterval(window.appState.analysisPollTimer);
-        window.appState.analysisPollTimer = null;
-    }
+    stopAnalysisUpdates();
     if (window.appState.analysisTimeout) {
         clearTimeout(window.appState.analysisTimeout);
         window.appState.analysisTimeout = null;
@@ -828,106 +851,161 @@ window.initStep3 = async function() {
             const sessionId = data.session_id;
             const totalProducts = data.total || totalCandidates;
             
-            // 开始轮询进度
-            window.appState.analysisPollTimer = setInterval(async () => {
-                try {
-                    const progressRes = await fetch(`${API_BASE}/api/analysis/progress/${sessionId}`);
-                    if (!progressRes.ok) {
-                        if (progressRes.status === 404) {
-                            // 会话不存在，可能是后端还没创建，继续等待
-                            console.log('[DEBUG] 会话尚未创建，继续等待...');
-                            return;
-                        }
-                        console.error('[ERROR] 获取进度失败:', progressRes.status);
-                        return;
+            // 两阶段分析：立即展示本地快速排名，精细分析完成后替换为最终结果
+            const quickResults = document.getElementById('quickResults');
+            if (data.result) {
+                appState.analysisResult = data.result;
+                renderAnalysisResults(data.result, { container: quickResults, provisional: true });
+                if (progressDetail) progressDetail.textContent = '已生成快速排名（见下方），正在精细分析...';
+            }
+            
+            // 已完成产品的渐进式排名（服务端按版本号增量下发）
+            appState.partialRanking = createPartialRanking();
+            
+            // 处理一条进度数据（SSE事件或长轮询响应），返回 true 表示会话已结束
+            const handleProgress = (progressData) => {
+                if (!progressData.success) {
+                    console.error('[ERROR] 进度数据格式错误');
+                    return false;
+                }
+                
+                // 更新进度条
+                const completed = progressData.completed || 0;
+                const total = progressData.total || totalProducts;
+                const percent = total > 0 ? Math.round((completed / total) * 100) : 0;
+                
+                if (progressBar) {
+                    progressBar.style.width = `${percent}%`;
+                }
+                if (progressPercent) {
+                    progressPercent.textContent = `${percent}%`;
+                }
+                if (progressText) {
+                    progressText.textContent = progressData.message || `正在分析 ${total} 款产品...`;
+                }
+                if (progressData.result) {
+                    appState.analysisResult = progressData.result;
+                }
+                if (mergePartialRanking(appState.partialRanking, progressData.partial_ranking)) {
+                    showPartialRanking();
+                }
+                if (progressDetail) {
+                    // 显示进度信息，如果已完成则显示完成数，否则显示预估等待时间
+                    if (completed > 0 && completed < total) {
+                        const refinedText = typeof progressData.refined === 'number' ? `（精评 ${progressData.refined} 款）` : '';
+                        progressDetail.textContent = `已完成 ${completed}/${total} 款产品的分析${refinedText}`;
+                    } else if (completed === 0) {
+                        progressDetail.textContent = '预估等待1~2分钟';
+                    } else {
+                        progressDetail.textContent = `已完成 ${completed}/${total} 款产品的分析`;
                     }
+                }
+                
+                // 检查是否完成
+                if (progressData.status === 'completed' && progressData.result) {
+                    stopAnalysisUpdates();
                     
-                    const progressData = await progressRes.json();
+                    // 更新进度为100%
+                    if (progressBar) progressBar.style.width = '100%';
+                    if (progressPercent) progressPercent.textContent = '100%';
+                    if (progressText) progressText.textContent = '分析完成！';
+                    if (progressDetail) progressDetail.textContent = `已完成 ${total}/${total} 款产品的分析`;
                     
-                    if (!progressData.success) {
-                        console.error('[ERROR] 进度数据格式错误');
-                        return;
+                    // 清除超时定时器
+                    if (window.appState.analysisTimeout) {
+                        clearTimeout(window.appState.analysisTimeout);
+                        window.appState.analysisTimeout = null;
                     }
                     
-                    // 更新进度条
-                    const completed = progressData.completed || 0;
-                    const total = progressData.total || totalProducts;
-                    const percent = total > 0 ? Math.round((completed / total) * 100) : 0;
+                    // 保存结果并跳转（快速排名被最终结果替换，保留已选的排序方式与已显示的产品名）
+                    appState.analysisResult = progressData.result;
+                    showMessage('分析完成！', 'success');
+                    setTimeout(() => {
+                        if (quickResults) quickResults.innerHTML = '';
+                        showStep(4);
+                        renderAnalysisResults(appState.analysisResult, { resetView: !data.result });
+                    }, 1000);
+                    return true;
+                } else if (progressData.status === 'failed') {
+                    stopAnalysisUpdates();
                     
-                    if (progressBar) {
-                        progressBar.style.width = `${percent}%`;
-                    }
-                    if (progressPercent) {
-                        progressPercent.textContent = `${percent}%`;
-                    }
-                    if (progressText) {
-                        progressText.textContent = progressData.message || `正在分析 ${total} 款产品...`;
-                    }
-                    if (progressDetail) {
-                        // 显示进度信息，如果已完成则显示完成数，否则显示预估等待时间
-                        if (completed > 0 && completed < total) {
-                            progressDetail.textContent = `已完成 ${completed}/${total} 款产品的分析`;
-                        } else if (completed === 0) {
-                            progressDetail.textContent = '预估等待1~2分钟';
-                        } else {
-                            progressDetail.textContent = `已完成 ${completed}/${total} 款产品的分析`;
+                    // 显示错误信息
+                    step3Content.innerHTML = `
+                        <div class="max-w-3xl mx-auto bg-white rounded-2xl shadow-xl p-8 text-center">
+                            <div class="text-red-500 text-3xl mb-4"><i class="fas fa-times-circle"></i></div>
+                            <h3 class="text-xl font-bold text-gray-800 mb-2">分析失败</h3>
+                            <p class="text-gray-600 mb-6">${progressData.message || '请稍后重试'}</p>
+                            <div class="flex justify-center gap-4">
+                                <button onclick="showStep(2); initStep2();" class="btn-secondary px-6">返回重新选择</button>
+                                <button onclick="initStep3();" class="btn-primary px-6">重试</button>
+                            </div>
+                        </div>
+                    `;
+                    showMessage(progressData.message || '分析失败，请重试', 'error');
+                    return true;
+                }
+                return false;
+            };
+            
+            // 优先使用SSE接收服务端推送；不支持或连接失败时退回长轮询
+            window.appState.analysisUpdatesActive = true;
+            const longPoll = async () => {
+                let version = 0;
+                while (window.appState.analysisUpdatesActive) {
+                    try {
+                        const sinceVersion = appState.partialRanking.version;
+                        const sinceQuery = sinceVersion === null ? '' : `&since=${sinceVersion}`;
+                        const progressRes = await fetch(`${API_BASE}/api/analysis/progress/${sessionId}/wait?version=${version}${sinceQuery}`);
+                        if (!progressRes.ok) {
+                            console.error('[ERROR] 获取进度失败:', progressRes.status);
+                            await new Promise(resolve => setTimeout(resolve, 1000));
+                            continue;
                         }
-                    }
-                    
-                    // 检查是否完成
-                    if (progressData.status === 'completed' && progressData.result) {
-                        clearInterval(window.appState.analysisPollTimer);
-                        window.appState.analysisPollTimer = null;
-                        
-                        // 更新进度为100%
-                        if (progressBar) progressBar.style.width = '100%';
-                        if (progressPercent) progressPercent.textContent = '100%';
-                        if (progressText) progressText.textContent = '分析完成！';
-                        if (progressDetail) progressDetail.textContent = `已完成 ${total}/${total} 款产品的分析`;
-                        
-                        // 清除超时定时器
-                        if (window.appState.analysisTimeout) {
-                            clearTimeout(window.appState.analysisTimeout);
-                            window.appState.analysisTimeout = null;
+                        const progressData = await progressRes.json();
+                        if (!progressData.success) {
+                            // 会话不存在，可能是后端还没创建，稍后重试
+                            console.log('[DEBUG] 会话尚未创建，继续等待...');
+                            await new Promise(resolve => setTimeout(resolve, 1000));
+                            continue;
                         }
-                        
-                        // 保存结果并跳转
-                        appState.analysisResult = progressData.result;
-                        showMessage('分析完成！', 'success');
-                        setTimeout(() => {
-                            showStep(4);
-                            renderAnalysisResults(appState.analysisResult);
-                        }, 1000);
-                    } else if (progressData.status === 'failed') {
-                        clearInterval(window.appState.analysisPollTimer);
-                        window.appState.analysisPollTimer = null;
-                        
-                        // 显示错误信息
-                        step3Content.innerHTML = `
-                            <div class="max-w-3xl mx-auto bg-white rounded-2xl shadow-xl p-8 text-center">
-                                <div class="text-red-500 text-3xl mb-4"><i class="fas fa-times-circle"></i></div>
-                                <h3 class="text-xl font-bold text-gray-800 mb-2">分析失败</h3>
-                                <p class="text-gray-600 mb-6">${progressData.message || '请稍后重试'}</p>
-                                <div class="flex justify-center gap-4">
-                                    <button onclick="showStep(2); initStep2();" class="btn-secondary px-6">返回重新选择</button>
-                                    <button onclick="initStep3();" class="btn-primary px-6">重试</button>
-                                </div>
-                            </div>
-                        `;
-                        showMessage(progressData.message || '分析失败，请重试', 'error');
-                        return;
+                        version = progressData.version || version;
+                        if (handleProgress(progressData)) break;
+                    } catch (error) {
+                        console.error('[ERROR] 长轮询进度失败:', error);
+                        // 不中断，稍后继续尝试
+                        await new Promise(resolve => setTimeout(resolve, 1000));
                     }
-                } catch (error) {
-                    console.error('[ERROR] 轮询进度失败:', error);
-                    // 不中断轮询，继续尝试
                 }
-            }, 1000); // 每1秒轮询一次
+            };
+            
+            if (window.EventSource) {
+                const source = new EventSource(`${API_BASE}/api/analysis/stream/${sessionId}`);
+                window.appState.analysisEventSource = source;
+                const onEvent = (event) => {
+                    try {
+                        handleProgress(JSON.parse(event.data));
+                    } catch (error) {
+                        console.error('[ERROR] 解析进度事件失败:', error);
+                    }
+                };
+                source.addEventListener('progress', onEvent);
+                source.addEventListener('result', onEvent);
+                source.onerror = () => {
+                    source.close();
+                    window.appState.analysisEventSource = null;
+                    if (window.appState.analysisUpdatesActive) {
+                        console.log('[DEBUG] SSE连接中断，改用长轮询');
+                        longPoll();
+                    }
+                };
+            } else {
+                longPoll();
+            }
             
             // 设置超时保护（5分钟）
             window.appState.analysisTimeout = setTimeout(() => {
-                if (window.appState.analysisPollTimer) {
-                    clearInterval(window.appState.analysisPollTimer);
-                    window.appState.analysisPollTimer = null;
+                if (window.appState.analysisUpdatesActive) {
+                    stopAnalysisUpdates();
                     
                     // 显示超时错误
                     step3Content.innerHTML = `
@@ -1011,8 +1089,9 @@ window.initStep3 = async function() {
 };
 
 // 步骤4：结果展示（同步版，支持双 Tab + 匿名代号）
-function renderAnalysisResults(analysisResult) {
-    const container = document.getElementById('step4-content');
+// provisional 为分析进行中的快速排名：渲染到分析页，不保存历史记录；resetView 为 false 时保留排序方式与已显示的产品名
+function renderAnalysisResults(analysisResult, { container: target = null, provisional = false, resetView = true } = {}) {
+    const container = target || document.getElementById('step4-content');
     if (!container) {
         console.error('未找到 step4-content 容器');
         return;
@@ -1043,8 +1122,8 @@ function renderAnalysisResults(analysisResult) {
         return;
     }
 
-    // 💾 保存到历史记录
-    if (window.HistoryManager && appState.petInfo) {
+    // 💾 保存到历史记录（快速排名只是临时结果）
+    if (!provisional && window.HistoryManager && appState.petInfo) {
         try {
             const historyId = window.HistoryManager.saveHistory({
                 pet_info: appState.petInfo,
@@ -1071,8 +1150,10 @@ function renderAnalysisResults(analysisResult) {
     if (window.ResultsDisplay && typeof window.ResultsDisplay.render === 'function') {
         console.log('[DEBUG] 使用 ResultsDisplay 渲染结果');
         window.ResultsDisplay.analysisResult = analysisResult;
-        window.ResultsDisplay.currentSortMode = 'ideal'; // 默认显示营养排名
-        window.ResultsDisplay.revealedProducts = new Set(); // 重置已揭示的产品
+        if (resetView) {
+            window.ResultsDisplay.currentSortMode = 'ideal'; // 默认显示营养排名
+            window.ResultsDisplay.revealedProducts = new Set(); // 重置已揭示的产品
+        }
         window.ResultsDisplay.render(container);
     } else {
         console.error('[ERROR] ResultsDisplay 未加载，请检查 results.js 是否正确引入');
@@ -0,0 +1,70 @@
+// 渐进式排名模块：合并进度接口按版本号下发的增量，并渲染已完成产品的实时排名
+
+// 空的渐进式排名状态（尚未收到任何版本）
+export function createPartialRanking() {
+    return { version: null, items: {}, ideal_order: [], budget_order: [], budget_scores: {} };
+}
+
+// 合并进度接口返回的增量排名：full 时重置，否则只覆盖变化的产品
+export function mergePartialRanking(state, delta) {
+    if (!state || !delta) return false;
+    state.version = delta.version;
+    if (delta.unchanged) return false;
+    if (delta.full) state.items = {};
+    Object.assign(state.items, delta.items || {});
+    state.ideal_order = delta.ideal_order || [];
+    state.budget_order = delta.budget_order || [];
+    state.budget_scores = delta.budget_scores || {};
+    return true;
+}
+
+// 产品在列表中的代号：沿用快速排名的匿名代号，保持双盲
+function displayCode(item, key, mapping) {
+    const productId = item?.product_id;
+    if (productId != null && mapping[productId]) return mapping[productId];
+    if (item?.anonymous_code) return item.anonymous_code;
+    return key.startsWith('custom_') ? '自定义' : '?';
+}
+
+function formatScore(value) {
+    return typeof value === 'number' && !isNaN(value) ? value.toFixed(1) : '-';
+}
+
+function renderColumn(title, icon, order, state, mapping, scoreOf) {
+    const rows = order.map((key, index) => {
+        const item = state.items[key];
+        if (!item) return '';
+        const sourceTag = item.source === 'local'
+            ? '<span class="ml-2 px-2 py-0.5 bg-gray-100 text-gray-600 rounded text-xs">初评</span>'
+            : '';
+        return `
+            <li class="flex items-center justify-between py-1" data-result-key="${key}">
+                <span><span class="text-gray-400 mr-2">#${index + 1}</span><strong class="text-purple-700">${displayCode(item, key, mapping)}</strong>${sourceTag}</span>
+                <span class="font-semibold text-gray-700">${formatScore(scoreOf(key, item))}</span>
+            </li>
+        `;
+    }).join('');
+    return `
+        <div class="flex-1 min-w-0">
+            <h4 class="text-sm font-semibold text-gray-700 mb-2"><i class="fas ${icon} mr-1"></i>${title}</h4>
+            <ol class="text-sm divide-y divide-gray-100">${rows}</ol>
+        </div>
+    `;
+}
+
+// 已完成产品的实时排名（纯营养视角与性价比两列）；mapping 为 product_id -> 匿名代号
+export function renderPartialRanking(state, mapping = {}) {
+    const count = state ? Object.keys(state.items).length : 0;
+    if (count === 0) return '';
+    return `
+        <div class="text-left">
+            <h3 class="text-base font-bold text-gray-800 mb-3">已完成 ${count} 款产品的实时排名</h3>
+            <div class="flex gap-6">
+                ${renderColumn('纯营养视角排名', 'fa-star', state.ideal_order, state, mapping,
+                    (key, item) => item.final_score)}
+                ${renderColumn('性价比综合排名', 'fa-dollar-sign', state.budget_order, state, mapping,
+                    (key) => state.budget_scores[key]?.budget_score)}
+            </div>
+        </div>
+    `;
+}
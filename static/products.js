@@ -832,15 +832,43 @@ export const ProductSelector = {
         }
     },
     
-    // 搜索过滤：支持品牌 / 名称 / 类别 / 描述 / 功能关键词
-    filterProducts(query) {
-        const lowerQuery = query.toLowerCase().trim();
-        if (!lowerQuery) {
+    // 搜索：优先使用服务端全文检索（覆盖全部产品，按相关度排序），失败时退回本地过滤
+    async filterProducts(query) {
+        const trimmed = query.trim();
+        if (!trimmed) {
             this.filteredProducts = [...this.allProducts];
             this.renderProducts();
             return;
         }
 
+        try {
+            const params = new URLSearchParams({ q: trimmed, page_size: '50' });
+            if (this.petInfo && this.petInfo.species) {
+                params.set('species', this.petInfo.species);
+            }
+            const response = await fetch(`${window.API_BASE}/api/products/search?${params}`, {
+                method: 'GET',
+                headers: { 'Content-Type': 'application/json' },
+                signal: AbortSignal.timeout(10000)
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            const data = await response.json();
+            this.filteredProducts = Array.isArray(data.products) ? data.products : [];
+            this.renderProducts();
+            window.showMessage(`已为你找到 ${data.total} 款匹配的产品`, 'success');
+            return;
+        } catch (error) {
+            console.warn('[SEARCH] 服务端搜索失败，使用本地过滤:', error);
+        }
+
+        this.filterProductsLocally(trimmed);
+    },
+
+    // 本地过滤：支持品牌 / 名称 / 类别 / 描述 / 功能关键词
+    filterProductsLocally(query) {
+        const lowerQuery = query.toLowerCase();
         this.filteredProducts = this.allProducts.filter(product => {
             const fields = [
                 product.brand,
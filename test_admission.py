@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+准入控制测试：排队位置与预计开始时间、会话数/排队产品数上限、Retry-After 估算、
+接口在超限时返回 429，进度接口返回排队中会话的当前位置
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main_sqlite
+from admission import AdmissionController, AdmissionRejected
+from sqlite_db_utils import db, init_sqlite_database
+
+
+class FakeQueue:
+    workers = 2
+
+    def __init__(self, backlog=()):
+        self.jobs = list(backlog)
+
+    def backlog(self):
+        return self.jobs
+
+
+def _job(session_id, status, products, finished=0):
+    return {"id": session_id, "session_id": session_id, "status": status, "products": products, "finished": finished}
+
+
+def test_queue_position_and_start_estimate_follow_worker_slots():
+    # 2 个槽位：执行中的任务还剩 1 个和 3 个产品，每个产品 10 秒
+    queue = FakeQueue([_job(1, "running", 4, finished=3), _job(2, "running", 3), _job(3, "queued", 2)])
+    admission = AdmissionController(queue, max_active_sessions=0, max_queued_products=0, seconds_per_product=10)
+
+    # 会话 3 在第一个槽位空出（10 秒）时开始，新会话在第二个槽位空出（30 秒）时开始
+    assert admission.position(3)["queue_position"] == 1
+    assert admission.position(3)["estimated_wait_seconds"] == 10
+    estimate = admission.admit(5)
+    assert estimate["queue_position"] == 2 and estimate["estimated_wait_seconds"] == 30
+    assert admission.position(2) is None
+
+    # 空闲时立即开始
+    assert AdmissionController(FakeQueue(), seconds_per_product=10).admit(3)["estimated_wait_seconds"] == 0
+
+
+def test_limits_reject_with_retry_after_from_backlog():
+    queue = FakeQueue([_job(1, "running", 2), _job(2, "running", 6), _job(3, "queued", 4)])
+    admission = AdmissionController(queue, max_active_sessions=3, max_queued_products=0, seconds_per_product=5)
+
+    # 3 个会话已达上限：最早结束的会话 10 秒后结束
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit(1)
+    assert rejected.value.limit == "active_sessions" and rejected.value.retry_after == 10
+
+    # 排队产品数上限：会话 3（4 个产品）10 秒后开始，之后排队产品为 0
+    admission = AdmissionController(queue, max_active_sessions=0, max_queued_products=6, seconds_per_product=5)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit(3)
+    assert rejected.value.limit == "queued_products" and rejected.value.retry_after == 10
+    assert admission.admit(2)["queue_position"] == 2
+    assert admission.stats == {"admitted": 1, "rejected_sessions": 0, "rejected_products": 1}
+
+    # 队列为空时产品数超过上限的单个请求仍被接受
+    assert AdmissionController(FakeQueue(), max_queued_products=6).admit(20)["queue_position"] == 1
+
+
+def test_local_sessions_count_toward_session_limit_and_estimates_learn():
+    admission = AdmissionController(FakeQueue(), max_active_sessions=1, seconds_per_product=10)
+    admission.reserve_local("a", 3)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.reserve_local("b", 1)
+    assert 29 <= rejected.value.retry_after <= 30
+    admission.release_local("a")
+    admission.reserve_local("b", 1)
+
+    admission.observe(4, 8.0)
+    assert admission.status()["seconds_per_product"] == 8.4
+
+
+def _reset_queue():
+    db.execute_update("UPDATE analysis_jobs SET status = 'done' WHERE status IN ('queued', 'running')")
+
+
+def test_start_endpoint_returns_429_and_progress_reports_position(monkeypatch):
+    init_sqlite_database()
+    _reset_queue()
+    # 队列线程不启动，会话保持排队
+    monkeypatch.setattr(main_sqlite.analysis_queue, "notify", lambda: None)
+    admission = AdmissionController(main_sqlite.analysis_queue, max_active_sessions=2, seconds_per_product=10)
+    monkeypatch.setattr(main_sqlite, "admission", admission)
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    product_ids = [r["id"] for r in db.execute_query("SELECT id FROM products ORDER BY id LIMIT 3")]
+
+    def start():
+        request = main_sqlite.AnalysisRequest(pet_id=pet_id, product_ids=product_ids, use_dify=False)
+        return asyncio.run(main_sqlite.start_analysis(request))
+
+    try:
+        first, second = start(), start()
+        assert first["queue_position"] == 1 and second["queue_position"] == 2
+        assert "estimated_start_at" in second
+
+        with pytest.raises(HTTPException) as rejected:
+            start()
+        assert rejected.value.status_code == 429
+        assert int(rejected.value.headers["Retry-After"]) >= 1
+
+        progress = asyncio.run(main_sqlite.get_analysis_progress(str(second["session_id"])))
+        assert progress["status"] == "queued" and progress["queue_position"] == 2
+        assert progress["estimated_wait_seconds"] == second["estimated_wait_seconds"]
+    finally:
+        _reset_queue()
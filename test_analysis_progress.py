@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+分析会话进度测试：两阶段排名等
+Dify调用替换为本地函数，不访问外部服务
+"""
+
+import asyncio
+import threading
+import time
+
+import main_sqlite
+from dify_analysis_engine import DifyAnalysisEngine
+from sqlite_db_utils import db, init_sqlite_database
+
+
+def _sample_product_ids(count=3):
+    init_sqlite_database()
+    rows = db.execute_query("SELECT id FROM products ORDER BY id LIMIT ?", (count,))
+    return [r["id"] for r in rows]
+
+
+def _fake_dify(release: threading.Event, scores):
+    """返回一个替代 _analyze_single_product 的函数：等待 release 后给出指定分数"""
+    def analyze(self, pet_info, product, user_id=None):
+        release.wait(5)
+        return {
+            "product_id": product["id"],
+            "brand": product["brand"],
+            "product_name": product["product_name"],
+            "price_per_jin": product.get("price_per_jin") or 0,
+            "final_score": scores.get(product["id"], 60),
+            "reason": "Dify评分",
+            "key_evidence": [],
+            "score_breakdown": {},
+        }
+    return analyze
+
+
+def _wait_progress(session_id, predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        progress = asyncio.run(main_sqlite.get_analysis_progress(session_id))
+        if predicate(progress):
+            return progress
+        time.sleep(0.02)
+    raise AssertionError(f"等待进度超时: {progress}")
+
+
+def test_quick_ranking_normalises_custom_product_price_per_jin():
+    """自定义产品的包装价格按重量换算为每斤价格（price / (weight_g / 500)），与产品库一致"""
+    from analysis_engine import AnalysisEngine
+
+    custom = {"id": None, "product_name": "自定义粮", "price": 120, "weight": "2kg", "price_per_jin": None}
+    cheap = {"id": None, "product_name": "自定义粮", "price": 60, "weight": "4kg", "price_per_jin": None}
+    results = {r["price_per_jin"]: r for r in AnalysisEngine().analyze_products({"species": "猫"}, [custom, cheap])["results"]}
+    assert set(results) == {30.0, 7.5}
+    # 每斤30元为基准价，不应被当作每斤120元判为高价
+    assert results[30.0]["value_score"] == 100
+
+
+def test_simple_analysis_returns_local_ranking_then_refines(monkeypatch):
+    """第一阶段立即返回本地完整排名，Dify结果陆续替换为 dify 来源"""
+    product_ids = _sample_product_ids()
+    release = threading.Event()
+    scores = {product_ids[-1]: 99}
+    monkeypatch.setenv("DIFY_SUBMIT_INTERVAL", "0")
+    monkeypatch.setattr(DifyAnalysisEngine, "_analyze_single_product", _fake_dify(release, scores))
+
+    request = main_sqlite.SimpleAnalysisRequest(
+        pet=main_sqlite.PetInfo(species="猫"), product_ids=product_ids
+    )
+    response = asyncio.run(main_sqlite.simple_analysis(request))
+
+    quick = response["result"]
+    assert len(quick["results"]) == len(product_ids)
+    assert {item["source"] for item in quick["results"]} == {"local"}
+    assert len(quick["budget_ranking"]) == len(product_ids)
+
+    release.set()
+    progress = _wait_progress(response["session_id"], lambda p: p["status"] == "completed")
+
+    assert progress["refined"] == len(product_ids)
+    final = progress["result"]
+    assert {item["source"] for item in final["results"]} == {"dify"}
+    assert final["ideal_ranking"][0]["product_id"] == product_ids[-1]
+
+
+def test_failed_dify_product_keeps_local_score(monkeypatch):
+    """单个产品Dify失败时保留其本地评分与 local 标记"""
+    product_ids = _sample_product_ids()
+    failing_id = product_ids[0]
+    release = threading.Event()
+    release.set()
+    fake = _fake_dify(release, {})
+
+    def analyze(self, pet_info, product, user_id=None):
+        if product["id"] == failing_id:
+            raise Exception("Dify API超时")
+        return fake(self, pet_info, product, user_id)
+
+    monkeypatch.setenv("DIFY_SUBMIT_INTERVAL", "0")
+    monkeypatch.setattr(DifyAnalysisEngine, "_analyze_single_product", analyze)
+
+    request = main_sqlite.SimpleAnalysisRequest(
+        pet=main_sqlite.PetInfo(species="猫"), product_ids=product_ids
+    )
+    response = asyncio.run(main_sqlite.simple_analysis(request))
+    progress = _wait_progress(response["session_id"], lambda p: p["status"] == "completed")
+
+    sources = {item["product_id"]: item["source"] for item in progress["result"]["results"]}
+    assert sources[failing_id] == "local"
+    assert progress["refined"] == len(product_ids) - 1
+
+
+def test_session_deadline_returns_partial_ranking_and_merges_late_results(monkeypatch):
+    """超过会话截止时间：先完成并标记 pending，迟到结果随后合并进会话"""
+    product_ids = _sample_product_ids()
+    straggler_id = product_ids[0]
+    straggler_release = threading.Event()
+    ready = threading.Event()
+    ready.set()
+    fast = _fake_dify(ready, {})
+    slow = _fake_dify(straggler_release, {straggler_id: 99})
+
+    def analyze(self, pet_info, product, user_id=None):
+        if product["id"] == straggler_id:
+            return slow(self, pet_info, product, user_id)
+        return fast(self, pet_info, product, user_id)
+
+    monkeypatch.setenv("DIFY_SUBMIT_INTERVAL", "0")
+    monkeypatch.setattr(main_sqlite, "ANALYSIS_SESSION_DEADLINE", 0.2)
+    monkeypatch.setattr(DifyAnalysisEngine, "_analyze_single_product", analyze)
+
+    request = main_sqlite.SimpleAnalysisRequest(
+        pet=main_sqlite.PetInfo(species="猫"), product_ids=product_ids
+    )
+    session_id = asyncio.run(main_sqlite.simple_analysis(request))["session_id"]
+
+    partial = _wait_progress(session_id, lambda p: p["status"] == "completed")
+    assert partial["partial"] is True
+    assert partial["pending"] == 1
+    assert partial["result"]["pending_products"] == [straggler_id]
+    pending_items = [i for i in partial["result"]["results"] if i.get("pending")]
+    assert [i["product_id"] for i in pending_items] == [straggler_id]
+
+    straggler_release.set()
+    merged = _wait_progress(session_id, lambda p: not p.get("partial"))
+    assert merged["refined"] == len(product_ids)
+    assert merged["result"]["pending_products"] == []
+    assert merged["result"]["ideal_ranking"][0]["product_id"] == straggler_id
+
+
+def test_start_analysis_deadline_merges_late_results_into_stored_session(monkeypatch):
+    """/api/analysis/start 的会话：截止后结果接口返回部分排名，迟到结果写回数据库"""
+    product_ids = _sample_product_ids(2)
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    release = threading.Event()
+
+    def fake_batch(pet_info, products, user_id="test", result_callback=None):
+        for i, product in enumerate(products):
+            if i == 1:
+                release.wait(5)
+            result_callback({"product_id": product["id"], "product_name": product["product_name"],
+                             "final_score": 80 + i})
+
+    monkeypatch.setattr(main_sqlite, "analyze_products_with_dify", fake_batch)
+    monkeypatch.setattr(main_sqlite, "ANALYSIS_SESSION_DEADLINE", 0.2)
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)",
+        (pet_id, "[]", "running")
+    )
+    worker = threading.Thread(
+        target=main_sqlite.dify_analysis_task, args=(session_id, pet_id, product_ids), daemon=True
+    )
+    worker.start()
+
+    deadline = time.time() + 5
+    while (main_sqlite.progress_store.get_meta(session_id) or {}).get("status") != "completed":
+        assert time.time() < deadline
+        time.sleep(0.02)
+    partial = asyncio.run(main_sqlite.get_analysis_result(session_id))
+    assert partial["pending_products"] == [product_ids[1]]
+
+    release.set()
+    worker.join(5)
+    merged = asyncio.run(main_sqlite.get_analysis_result(session_id))
+    assert merged["pending_products"] == []
+    assert merged["ideal_ranking"][0]["product_id"] == product_ids[1]
+
+
+def test_partial_ranking_is_delta_encoded():
+    """渐进式排名：全量 -> 无变化 -> 只下发新完成的产品，性价比排名同步更新"""
+    from partial_ranking import PartialRankingTracker
+
+    tracker = PartialRankingTracker(DifyAnalysisEngine(), {"species": "猫"})
+    tracker.upsert("1", {"product_id": 1, "final_score": 80, "price_per_jin": 50})
+    first = tracker.delta(None)
+    assert first["full"] is True and set(first["items"]) == {"1"}
+
+    assert tracker.delta(first["version"])["unchanged"] is True
+
+    tracker.upsert("2", {"product_id": 2, "final_score": 80, "price_per_jin": 20})
+    second = tracker.delta(first["version"])
+    assert set(second["items"]) == {"2"}
+    assert second["ideal_order"] == ["2", "1"]
+    assert second["budget_order"] == ["2", "1"]
+    assert second["budget_scores"]["2"]["budget_score"] > second["budget_scores"]["1"]["budget_score"]
+
+
+def test_progress_endpoint_serves_partial_ranking(monkeypatch):
+    """进度接口在分析进行中返回已完成产品的排名，带 since 时不再重复下发完整结果"""
+    product_ids = _sample_product_ids(2)
+    slow_id = product_ids[1]
+    release = threading.Event()
+    ready = threading.Event()
+    ready.set()
+    fast = _fake_dify(ready, {})
+    slow = _fake_dify(release, {})
+
+    def analyze(self, pet_info, product, user_id=None):
+        return (slow if product["id"] == slow_id else fast)(self, pet_info, product, user_id)
+
+    monkeypatch.setenv("DIFY_SUBMIT_INTERVAL", "0")
+    monkeypatch.setattr(DifyAnalysisEngine, "_analyze_single_product", analyze)
+    request = main_sqlite.SimpleAnalysisRequest(
+        pet=main_sqlite.PetInfo(species="猫"), product_ids=product_ids
+    )
+    session_id = asyncio.run(main_sqlite.simple_analysis(request))["session_id"]
+
+    first = _wait_progress(session_id, lambda p: p["partial_ranking"]["count"] == 1)
+    assert list(first["partial_ranking"]["items"]) == [str(product_ids[0])]
+
+    version = first["partial_ranking"]["version"]
+    repeat = asyncio.run(main_sqlite.get_analysis_progress(session_id, since=version))
+    assert repeat["partial_ranking"]["unchanged"] is True
+    assert "result" not in repeat
+
+    release.set()
+    done = _wait_progress(session_id, lambda p: p["status"] == "completed")
+    delta = asyncio.run(main_sqlite.get_analysis_progress(session_id, since=version))["partial_ranking"]
+    assert list(delta["items"]) == [str(slow_id)]
+    assert len(delta["budget_order"]) == 2
+    assert "result" in done
+
+
+def test_late_result_is_not_overwritten_by_stale_deadline_snapshot(monkeypatch):
+    """截止时间的写入与迟到结果的写入串行：截止快照写入较慢时，迟到结果不会被旧快照覆盖"""
+    product_ids = _sample_product_ids(2)
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)", (pet_id, "[]", "running")
+    )
+    deadline_saving, late_saved, finish = threading.Event(), threading.Event(), threading.Event()
+    encode = main_sqlite.encode_results
+
+    def slow_first_encode(value):
+        # 截止时间的快照在编码时停住，给迟到结果抢先写入的机会
+        if isinstance(value, list) and not deadline_saving.is_set():
+            deadline_saving.set()
+            late_saved.wait(0.5)
+        return encode(value)
+
+    def fake_batch(pet_info, products, user_id="test", result_callback=None):
+        result_callback({"product_id": products[0]["id"], "final_score": 70})
+        deadline_saving.wait(5)
+        result_callback({"product_id": products[1]["id"], "final_score": 90})
+        late_saved.set()
+        finish.wait(5)
+
+    monkeypatch.setattr(main_sqlite, "encode_results", slow_first_encode)
+    monkeypatch.setattr(main_sqlite, "analyze_products_with_dify", fake_batch)
+    monkeypatch.setattr(main_sqlite, "ANALYSIS_SESSION_DEADLINE", 0.1)
+    worker = threading.Thread(target=main_sqlite.dify_analysis_task, args=(session_id, pet_id, product_ids))
+    worker.start()
+    try:
+        late_saved.wait(5)
+        merged = _wait_progress(str(session_id), lambda p: p["status"] == "completed" and p.get("pending") == 0,
+                                timeout=2)
+        assert merged["partial"] is True
+        time.sleep(0.1)
+        stored = asyncio.run(main_sqlite.get_analysis_result(session_id))
+        assert stored["pending_products"] == []
+        assert main_sqlite.progress_store.get(str(session_id))["pending"] == 0
+    finally:
+        finish.set()
+        worker.join(5)
+
+
+def test_start_session_serves_partial_ranking_while_running(monkeypatch):
+    """/api/analysis/start 的会话（任务队列执行）同样在分析进行中下发已完成产品的排名，结束后移除"""
+    product_ids = _sample_product_ids(2)
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)", (pet_id, "[]", "running")
+    )
+    release = threading.Event()
+
+    def fake_batch(pet_info, products, user_id="test", result_callback=None):
+        result_callback({"product_id": products[0]["id"], "final_score": 70})
+        release.wait(5)
+        result_callback({"product_id": products[1]["id"], "final_score": 90})
+
+    monkeypatch.setattr(main_sqlite, "analyze_products_with_dify", fake_batch)
+    worker = threading.Thread(target=main_sqlite.dify_analysis_task, args=(session_id, pet_id, product_ids))
+    worker.start()
+    try:
+        first = _wait_progress(str(session_id), lambda p: p.get("partial_ranking", {}).get("count") == 1)
+        assert first["status"] == "running"
+        assert first["partial_ranking"]["ideal_order"] == [str(product_ids[0])]
+    finally:
+        release.set()
+        worker.join(5)
+
+    assert str(session_id) not in main_sqlite.partial_rankings
+    done = asyncio.run(main_sqlite.get_analysis_progress(str(session_id)))
+    assert done["status"] == "completed" and "partial_ranking" not in done
+
+
+def test_long_poll_returns_when_state_version_changes():
+    """长轮询在 update_analysis_progress 写入后立即返回，无变化时等到超时"""
+    main_sqlite.set_analysis_status("lp-test", {"status": "running", "progress": 0, "total": 2})
+    version = main_sqlite.progress_store.version("lp-test")
+
+    async def scenario():
+        idle = await main_sqlite.wait_analysis_progress("lp-test", version=version, timeout=0.05)
+        threading.Timer(0.1, main_sqlite.update_analysis_progress, args=("lp-test", 1, 2, "A")).start()
+        started = time.monotonic()
+        changed = await main_sqlite.wait_analysis_progress("lp-test", version=version, timeout=5)
+        return idle, changed, time.monotonic() - started
+
+    idle, changed, elapsed = asyncio.run(scenario())
+    assert idle["version"] == version
+    assert changed["version"] > version and changed["completed"] == 1
+    assert elapsed < 2
+
+
+def test_sse_stream_pushes_progress_then_result():
+    """SSE：每次状态变化推送 progress 事件，完成时推送 result 事件并结束"""
+    main_sqlite.set_analysis_status("sse-test", {"status": "running", "progress": 0, "total": 2})
+
+    def finish():
+        main_sqlite.update_analysis_progress("sse-test", 1, 2, "A")
+        time.sleep(0.05)
+        main_sqlite.set_analysis_status("sse-test", {
+            "status": "completed", "progress": 100, "total": 2, "completed": 2,
+            "result": {"results": []}
+        })
+
+    async def scenario():
+        response = await main_sqlite.stream_analysis_progress("sse-test")
+        threading.Timer(0.1, finish).start()
+        chunks = []
+
+        async def collect():
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+
+        await asyncio.wait_for(collect(), 5)
+        return chunks
+
+    events = [c for c in asyncio.run(scenario()) if c.startswith("event:")]
+    assert events[0].startswith("event: progress")
+    assert events[-1].startswith("event: result")
+    assert '"completed": 2' in events[-1]
+
+
+def test_simple_session_ids_never_look_like_integer_session_ids():
+    """简化分析的会话ID带前缀，与 /api/analysis/start 的整数会话ID 在进度存储中互不覆盖"""
+    ids = {main_sqlite.generate_analysis_session_id() for _ in range(2000)}
+    assert len(ids) == 2000
+    assert all(i.startswith(main_sqlite.SIMPLE_SESSION_PREFIX) and not i.isdigit() for i in ids)
+
+
+def test_error_after_deadline_keeps_published_partial_ranking(monkeypatch):
+    """截止时间已发布部分排名后 Dify 出错：会话保持 completed 与已保存的排名，回调按完成投递"""
+    product_ids = _sample_product_ids(2)
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)", (pet_id, "[]", "running")
+    )
+    callbacks = []
+
+    def fake_batch(pet_info, products, user_id="test", result_callback=None):
+        result_callback({"product_id": products[0]["id"], "final_score": 70})
+        deadline = time.time() + 5
+        while (main_sqlite.progress_store.get_meta(session_id) or {}).get("status") != "completed":
+            assert time.time() < deadline
+            time.sleep(0.02)
+        raise RuntimeError("Dify API 不可用")
+
+    monkeypatch.setattr(main_sqlite, "analyze_products_with_dify", fake_batch)
+    monkeypatch.setattr(main_sqlite, "ANALYSIS_SESSION_DEADLINE", 0.1)
+    monkeypatch.setattr(main_sqlite, "notify_analysis_callback",
+                        lambda url, sid, status, **kwargs: callbacks.append(status))
+    main_sqlite.dify_analysis_task(session_id, pet_id, product_ids, "http://example.com/hook")
+
+    stored = asyncio.run(main_sqlite.get_analysis_result(session_id))
+    assert stored["success"] and stored["pending_products"] == [product_ids[1]]
+    assert stored["ideal_ranking"][0]["product_id"] == product_ids[0]
+    progress = main_sqlite.progress_store.get(str(session_id))
+    assert progress["status"] == "completed" and progress["partial"] is True
+    assert callbacks == ["completed"]
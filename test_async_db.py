@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+异步数据库外观测试：数据库被写锁阻塞时，事件循环仍能及时调度其他协程；并发请求不会耗尽连接池
+"""
+
+import ast
+import asyncio
+import inspect
+import threading
+import time
+
+import main_sqlite
+from sqlite_db_utils import AsyncSQLiteDB, SQLiteDB
+
+LOCK_SECONDS = 0.4
+
+
+def _hold_write_lock(db, started: threading.Event):
+    """另一个连接持有写事务 LOCK_SECONDS 秒"""
+    def run():
+        with db.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO items (value) VALUES (0)")
+            started.set()
+            time.sleep(LOCK_SECONDS)
+            conn.commit()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _max_loop_lag(db_call) -> float:
+    """db_call 执行期间，每 5ms 一次的心跳协程观察到的最大调度延迟"""
+    async def scenario():
+        lags = []
+        done = asyncio.Event()
+
+        async def heartbeat():
+            while not done.is_set():
+                before = time.monotonic()
+                await asyncio.sleep(0.005)
+                lags.append(time.monotonic() - before - 0.005)
+
+        beat = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0.02)
+        await db_call()
+        done.set()
+        await beat
+        return max(lags)
+
+    return asyncio.run(scenario())
+
+
+def test_async_facade_does_not_block_event_loop(tmp_path):
+    db = SQLiteDB(str(tmp_path / "async.db"))
+    db.execute_update("CREATE TABLE items (id INTEGER PRIMARY KEY, value INTEGER)")
+    adb = AsyncSQLiteDB(db)
+
+    # 之前：async 路由中直接调用同步接口，等待写锁期间整个事件循环停顿
+    started = threading.Event()
+    holder = _hold_write_lock(db, started)
+    started.wait(5)
+
+    async def sync_call():
+        db.execute_update("INSERT INTO items (value) VALUES (1)")
+
+    blocking_lag = _max_loop_lag(sync_call)
+    holder.join()
+
+    # 之后：经由线程池执行，事件循环照常调度
+    started.clear()
+    holder = _hold_write_lock(db, started)
+    started.wait(5)
+
+    async def async_call():
+        await adb.execute_update("INSERT INTO items (value) VALUES (2)")
+
+    async_lag = _max_loop_lag(async_call)
+    holder.join()
+
+    assert blocking_lag > LOCK_SECONDS / 2
+    assert async_lag < 0.1
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 4
+    adb.shutdown()
+    db.close()
+
+
+class _SyncDbCalls(ast.NodeVisitor):
+    """收集 async 函数体中直接调用 db.* 的位置（嵌套的同步函数交给 adb.run 执行，不计入）"""
+
+    def __init__(self):
+        self.calls = []
+
+    def visit_FunctionDef(self, node):
+        pass
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "db":
+            self.calls.append(f"第{node.lineno}行 db.{func.attr}")
+        self.generic_visit(node)
+
+
+def test_endpoints_use_async_facade():
+    """async 路由中不再直接调用同步数据库接口"""
+    tree = ast.parse(inspect.getsource(main_sqlite))
+    offenders = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.AsyncFunctionDef):
+            visitor = _SyncDbCalls()
+            for statement in node.body:
+                visitor.visit(statement)
+            offenders.extend(f"{node.name}: {call}" for call in visitor.calls)
+    assert offenders == []
+
+
+def test_concurrent_invalid_product_cleanup_does_not_exhaust_pool(monkeypatch):
+    """数据库线程数个含无效产品的请求同时校验：读取时借出的连接已归还，删除无效产品不会互相等待连接"""
+    from sqlite_db_utils import db, init_sqlite_database
+
+    init_sqlite_database()
+    valid_id = db.execute_query("SELECT id FROM products ORDER BY id LIMIT 1")[0]["id"]
+    invalid_id = db.execute_update(
+        "INSERT INTO products (brand, product_name, price, weight_g, price_per_jin) VALUES ('测试', '无效产品', 1, 500, 1)"
+    )
+    workers = main_sqlite.adb.max_workers
+    all_validating = threading.Barrier(workers, timeout=5)
+
+    def validate(product):
+        if product["id"] == invalid_id:
+            all_validating.wait()  # 所有数据库线程同时处于校验中
+            return False, "测试用无效产品"
+        return True, ""
+
+    monkeypatch.setattr(main_sqlite, "validate_product_basic", validate)
+    monkeypatch.setattr(db, "pool_timeout", 2)
+    request = main_sqlite.SimpleAnalysisRequest(
+        pet=main_sqlite.PetInfo(species="猫"), product_ids=[valid_id, invalid_id], use_dify=False
+    )
+
+    async def scenario():
+        return await asyncio.gather(*[main_sqlite.simple_analysis(request) for _ in range(workers)])
+
+    responses = asyncio.run(scenario())
+    assert all(r["invalid_removed"] == [{"id": invalid_id, "reason": "测试用无效产品"}] for r in responses)
+    assert not db.execute_query("SELECT id FROM products WHERE id = ?", (invalid_id,))
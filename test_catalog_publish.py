@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+产品目录快照测试：备份期间写入不被阻塞、快照只含目录表、校验和不符拒绝加载、加载后整体替换
+"""
+
+import asyncio
+import os
+import tarfile
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main_sqlite
+from catalog_publish import _manifest_of, load_catalog, snapshot
+from db_migrations import apply_migrations
+from sqlite_db_utils import SQLiteDB
+
+
+def _insert(database, name, price=30):
+    return database.execute_update(
+        "INSERT INTO products (brand, product_name, species, product_type, price_per_jin, nutrition_analysis) "
+        "VALUES ('快照测试', ?, 'cat', 'dry', ?, '{\"蛋白质\": \"36%\"}')",
+        (name, price)
+    )
+
+
+def _database(tmp_path, name):
+    database = SQLiteDB(str(tmp_path / name))
+    apply_migrations(database)
+    return database
+
+
+def test_snapshot_is_consistent_and_does_not_block_writers(tmp_path):
+    source = _database(tmp_path, "source.db")
+    for i in range(300):
+        _insert(source, f"产品{i}")
+    source.execute_update("INSERT INTO analysis_sessions (product_ids, status) VALUES ('[]', 'completed')")
+    writer = SQLiteDB(source.db_path, pool_size=1)
+    written = []
+
+    def progress(status, remaining, total):
+        # 备份进行中：另一连接的写入立即提交，不等待备份结束
+        if not written:
+            written.append(_insert(writer, "备份期间新增"))
+
+    manifest = snapshot(source, str(tmp_path / "dist"), pages_per_step=1, progress=progress)
+    assert written and source.execute_query("SELECT COUNT(*) AS n FROM products")[0]["n"] == 301
+    assert manifest["products"] == 300 and manifest["schema_version"] > 0
+    assert os.path.basename(manifest["path"]).startswith(f"catalog-v{manifest['catalog_version']}-")
+    assert _manifest_of(manifest["path"])["sha256"] == manifest["sha256"]
+    assert manifest["compressed_size"] < manifest["size"]
+    writer.close()
+    source.close()
+
+
+def test_load_replaces_catalog_and_rebuilds_derived_tables(tmp_path):
+    source = _database(tmp_path, "source.db")
+    _insert(source, "爱肯拿鸭肉梨配方", price=55)
+    _insert(source, "渴望六种鱼", price=83)
+    artifact = snapshot(source, str(tmp_path / "dist"))["path"]
+
+    target = _database(tmp_path, "target.db")
+    _insert(target, "旧产品")
+    target.execute_update("INSERT INTO pet_info (species) VALUES ('cat')")
+    before = target.execute_query("SELECT version FROM catalog_version")[0]["version"]
+
+    report = load_catalog(target, artifact)
+    assert report["products"] == 2 and report["catalog_version"] > before
+    names = [r["product_name"] for r in target.execute_query("SELECT product_name FROM products ORDER BY id")]
+    assert names == ["爱肯拿鸭肉梨配方", "渴望六种鱼"]
+    assert target.execute_query("SELECT rowid FROM products_fts WHERE products_fts MATCH '鸭肉梨'") == [{"rowid": 1}]
+    assert target.execute_query("SELECT COUNT(*) AS n FROM product_nutrients WHERE protein = 36")[0]["n"] == 2
+    # 用户数据不受影响
+    assert target.execute_query("SELECT COUNT(*) AS n FROM pet_info")[0]["n"] == 1
+    source.close()
+    target.close()
+
+
+def test_tampered_or_mismatched_artifacts_are_rejected(tmp_path):
+    source = _database(tmp_path, "source.db")
+    _insert(source, "皇家成猫粮")
+    artifact = snapshot(source, str(tmp_path / "dist"))["path"]
+    target = _database(tmp_path, "target.db")
+    _insert(target, "保留的产品")
+
+    with pytest.raises(ValueError, match="校验和"):
+        load_catalog(target, artifact, expected_sha256="0" * 64)
+
+    # 替换 catalog.db 但保留原 manifest
+    tampered = str(tmp_path / "tampered.tar.gz")
+    other = _database(tmp_path, "other.db")
+    other_artifact = snapshot(other, str(tmp_path / "dist2"))["path"]
+    with tarfile.open(artifact) as good, tarfile.open(other_artifact) as bad, tarfile.open(tampered, "w:gz") as out:
+        out.addfile(good.getmember("manifest.json"), good.extractfile("manifest.json"))
+        out.addfile(bad.getmember("catalog.db"), bad.extractfile("catalog.db"))
+    with pytest.raises(ValueError, match="校验和"):
+        load_catalog(target, tampered)
+
+    assert [r["product_name"] for r in target.execute_query("SELECT product_name FROM products")] == ["保留的产品"]
+    for database in (source, target, other):
+        database.close()
+
+
+def test_upload_endpoint_requires_configured_token(tmp_path, monkeypatch):
+    def request(token):
+        headers = [(b"x-admin-token", token.encode())] if token else []
+        return Request({"type": "http", "method": "POST", "path": "/api/admin/catalog", "headers": headers})
+
+    monkeypatch.setattr(main_sqlite, "ADMIN_TOKEN", "")
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main_sqlite.upload_catalog(request("anything")))
+    assert excinfo.value.status_code == 403
+
+    monkeypatch.setattr(main_sqlite, "ADMIN_TOKEN", "secret")
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main_sqlite.upload_catalog(request("wrong")))
+    assert excinfo.value.status_code == 403
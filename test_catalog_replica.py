@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+产品目录内存副本测试：只加载目录表、只读、版本变化后重新加载、替换期间读请求不受影响
+"""
+
+import asyncio
+
+import pytest
+
+import main_sqlite
+from catalog_replica import CatalogReplica
+from db_migrations import apply_migrations
+from sqlite_db_utils import SQLiteDB, db, init_sqlite_database
+
+
+def _insert(database, name, price=30, species="cat"):
+    return database.execute_update(
+        "INSERT INTO products (brand, product_name, species, product_type, price_per_jin) VALUES (?, ?, ?, 'dry', ?)",
+        ("副本测试", name, species, price)
+    )
+
+
+@pytest.fixture
+def source(tmp_path):
+    database = SQLiteDB(str(tmp_path / "catalog.db"))
+    apply_migrations(database)
+    _insert(database, "爱肯拿鸭肉梨配方", price=55)
+    _insert(database, "皇家成猫粮", price=22)
+    database.execute_update(
+        "INSERT INTO analysis_sessions (product_ids, status) VALUES ('[]', 'completed')"
+    )
+    yield database
+    database.close()
+
+
+def test_replica_holds_catalog_tables_only_and_is_read_only(source):
+    replica = CatalogReplica(source, enabled=True, check_interval=60)
+    assert replica.refresh()["products"] == 2
+
+    with replica.reader() as database:
+        assert database is not source
+        tables = {row["name"] for row in database.execute_query("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert {"products", "products_fts", "product_nutrients"} <= tables
+        assert "analysis_sessions" not in tables
+        with pytest.raises(Exception):
+            database.execute_update("DELETE FROM products")
+
+    query = "SELECT id, product_name FROM products ORDER BY price_per_jin, id"
+    assert replica.execute_query(query) == source.execute_query(query)
+    matches = replica.execute_query("SELECT rowid FROM products_fts WHERE products_fts MATCH '鸭肉梨'")
+    assert len(matches) == 1
+    replica.close()
+
+
+def test_writes_from_other_connections_are_picked_up_by_version(source):
+    replica = CatalogReplica(source, enabled=True, check_interval=60)
+    replica.refresh()
+    _insert(source, "其他进程写入的产品")
+
+    # 检查间隔内继续读旧副本
+    assert replica.execute_query("SELECT COUNT(*) AS n FROM products")[0]["n"] == 2
+
+    replica.check_interval = 0
+    assert replica.execute_query("SELECT COUNT(*) AS n FROM products")[0]["n"] == 3
+    assert replica.stats["refreshes"] == 2
+    replica.close()
+
+
+def test_refresh_swaps_atomically_while_reader_is_active(source):
+    replica = CatalogReplica(source, enabled=True, check_interval=60)
+    replica.refresh()
+
+    rows = replica.iter_query("SELECT id FROM products ORDER BY id", row_factory="tuple")
+    first = next(rows)
+    old_generation = replica._current
+    _insert(source, "读取期间新增")
+    replica.refresh()
+
+    # 旧副本在读请求结束前保持可用，结束后关闭
+    assert [first] + list(rows) == [(1,), (2,)]
+    assert old_generation.readers == 0 and old_generation.database._all_connections == []
+    assert replica.execute_query("SELECT COUNT(*) AS n FROM products")[0]["n"] == 3
+    replica.close()
+
+
+def test_endpoints_read_from_replica_and_see_own_writes(monkeypatch):
+    init_sqlite_database()
+    monkeypatch.setattr(main_sqlite.catalog, "enabled", True)
+    main_sqlite.catalog.refresh()
+    try:
+        created = asyncio.run(main_sqlite.create_manual_product(main_sqlite.ManualProductInput(
+            brand="副本测试", product_name="新录入产品", price=10, weight_g=500
+        )))
+        product = asyncio.run(main_sqlite.get_product(created["product_id"]))["product"]
+        assert product["product_name"] == "新录入产品"
+        assert main_sqlite.catalog.stats["replica_reads"] > 0
+        assert main_sqlite.catalog.status()["version"] == db.execute_query(
+            "SELECT version FROM catalog_version"
+        )[0]["version"]
+    finally:
+        main_sqlite.catalog.close()
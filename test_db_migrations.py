@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+版本化迁移测试：版本记录、幂等、老库补列，以及热点查询不做全表扫描、产品列表按索引顺序取数
+"""
+
+import asyncio
+import re
+import sqlite3
+
+import pytest
+
+from db_migrations import LATEST_VERSION, apply_migrations, current_version
+from sqlite_db_utils import SQLiteDB
+
+# /api/products 的产品列表（main_sqlite.get_products 生成的 SQL，首页与游标翻页两种形式）：
+# 除不做全表扫描外，还要求按索引顺序取数，不能有 USE TEMP B-TREE FOR ORDER BY
+PRODUCT_LIST_QUERIES = [
+    ("SELECT * FROM products ORDER BY price_per_jin, id LIMIT ?", (51,)),
+    ("SELECT * FROM products WHERE (price_per_jin, id) > (?, ?) ORDER BY price_per_jin, id LIMIT ?", (30, 5, 51)),
+    ("SELECT * FROM products WHERE species = ? ORDER BY price_per_jin, id LIMIT ?", ("猫", 51)),
+    ("SELECT * FROM products WHERE species = ? AND (price_per_jin, id) > (?, ?) "
+     "ORDER BY price_per_jin, id LIMIT ?", ("猫", 30, 5, 51)),
+    ("SELECT * FROM products WHERE species = ? AND category = ? ORDER BY price_per_jin, id LIMIT ?", ("猫", "干粮", 51)),
+    ("SELECT * FROM products WHERE category = ? AND (price_per_jin, id) > (?, ?) "
+     "ORDER BY price_per_jin, id LIMIT ?", ("干粮", 30, 5, 51)),
+    ("SELECT * FROM products WHERE (+life_stage = ? OR +life_stage = '全阶段') "
+     "ORDER BY price_per_jin, id LIMIT ?", ("成猫", 51)),
+    ("SELECT * FROM products WHERE species = ? AND (+life_stage = ? OR +life_stage = '全阶段') "
+     "AND (price_per_jin, id) > (?, ?) ORDER BY price_per_jin, id LIMIT ?", ("猫", "成猫", 30, 5, 51)),
+    ("SELECT * FROM products WHERE price_per_jin >= ? AND price_per_jin <= ? "
+     "ORDER BY price_per_jin, id LIMIT ?", (10, 50, 51)),
+    ("SELECT * FROM products WHERE species = ? AND id IN (SELECT product_id FROM product_nutrients "
+     "WHERE protein >= ? AND fat <= ?) ORDER BY price_per_jin, id LIMIT ?", ("猫", 38, 16, 51)),
+]
+
+# get_products 的筛选组合，每种都按首页与游标翻页各生成一次 SQL
+PRODUCT_LIST_FILTERS = [
+    {},
+    {"species": "cat"},
+    {"species": "cat", "category": "干粮"},
+    {"category": "干粮"},
+    {"life_stage": "成猫"},
+    {"species": "cat", "life_stage": "成猫"},
+    {"category": "干粮", "life_stage": "成猫"},
+    {"min_price": 10, "max_price": 50},
+    {"species": "cat", "min_protein": 38, "max_fat": 16},
+]
+
+# main_sqlite.py 等模块中按条件执行的查询（参数只用于生成执行计划）
+HOT_QUERIES = PRODUCT_LIST_QUERIES + [
+    ("SELECT id FROM products ORDER BY price_per_jin ASC LIMIT 5", ()),
+    ("SELECT * FROM products WHERE id = ?", (1,)),
+    ("SELECT * FROM products WHERE id IN (?, ?, ?)", (1, 2, 3)),
+    ("SELECT * FROM pet_info WHERE id = ?", (1,)),
+    ("SELECT * FROM analysis_sessions WHERE id = ?", (1,)),
+    ("SELECT * FROM anonymous_mapping WHERE session_id = ?", (1,)),
+    ("SELECT * FROM anonymous_mapping WHERE session_id = ? AND anonymous_code = ?", (1, "A")),
+    ("UPDATE analysis_sessions SET status = ? WHERE id = ?", ("completed", 1)),
+    ("DELETE FROM products WHERE id = ?", (1,)),
+    # retention.py
+    ("SELECT id FROM analysis_sessions WHERE created_at < ? ORDER BY created_at LIMIT ?", ("2020-01-01", 500)),
+    ("SELECT 1 FROM analysis_sessions s WHERE s.pet_id = ?", (1,)),
+    ("SELECT id FROM pet_info p WHERE p.created_at < ? LIMIT ?", ("2020-01-01", 500)),
+    ("SELECT id FROM anonymous_mapping WHERE created_at < ? LIMIT ?", ("2020-01-01", 500)),
+    ("SELECT session_key FROM analysis_progress_results WHERE created_at < ? LIMIT ?", ("2020-01-01", 500)),
+    # progress_store 结果引用
+    ("SELECT result FROM analysis_progress_results WHERE session_key = ?", ("abc",)),
+    ("SELECT state, version, updated_at FROM analysis_progress WHERE session_key = ?", ("abc",)),
+    ("DELETE FROM analysis_progress WHERE updated_at < ? AND status IN ('completed', 'failed')", (0,)),
+    # job_queue.py
+    ("SELECT * FROM analysis_jobs WHERE (status = 'queued' AND COALESCE(lease_expires_at, 0) <= ?) "
+     "OR (status = 'running' AND lease_expires_at < ?) ORDER BY id LIMIT 1", (0, 0)),
+    ("UPDATE analysis_jobs SET lease_expires_at = ? WHERE lease_owner = ? AND status = 'running'", (0, "w")),
+    ("SELECT item_key, result FROM analysis_job_checkpoints WHERE session_id = ?", (1,)),
+    ("SELECT id FROM analysis_sessions WHERE status = 'running' AND NOT EXISTS "
+     "(SELECT 1 FROM analysis_jobs j WHERE j.session_id = analysis_sessions.id AND j.status IN ('queued', 'running'))", ()),
+    ("SELECT j.id, j.session_id, j.status, json_array_length(j.payload, '$.product_ids') AS products, "
+     "(SELECT COUNT(*) FROM analysis_job_checkpoints c WHERE c.session_id = j.session_id) AS finished "
+     "FROM analysis_jobs j WHERE j.status IN ('queued', 'running') ORDER BY j.id", ()),
+]
+
+_FULL_SCAN = re.compile(r"^SCAN \w+$")
+
+
+@pytest.fixture
+def fresh_db(tmp_path):
+    database = SQLiteDB(str(tmp_path / "migrations.db"))
+    yield database
+    database.close()
+
+
+def test_migrations_are_recorded_and_idempotent(fresh_db):
+    assert current_version(fresh_db) == 0
+    assert apply_migrations(fresh_db) == list(range(1, LATEST_VERSION + 1))
+    assert current_version(fresh_db) == LATEST_VERSION
+    assert apply_migrations(fresh_db) == []
+
+
+def test_old_products_table_gets_missing_columns(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, brand TEXT NOT NULL, "
+                 "product_name TEXT NOT NULL, category TEXT, life_stage TEXT, price_per_jin REAL, ingredients TEXT, "
+                 "nutrition_analysis TEXT)")
+    conn.execute("INSERT INTO products (brand, product_name) VALUES ('皇家', '成猫粮')")
+    conn.commit()
+    conn.close()
+
+    database = SQLiteDB(path)
+    apply_migrations(database)
+    columns = {c["name"] for c in database.execute_query("PRAGMA table_info(products)")}
+    assert {"species", "product_type", "description", "weight"} <= columns
+    assert database.execute_query("SELECT species FROM products")[0]["species"] == "cat"
+    database.close()
+
+
+@pytest.mark.parametrize("query,params", HOT_QUERIES)
+def test_hot_queries_do_not_scan_full_tables(fresh_db, query, params):
+    apply_migrations(fresh_db)
+    plan = fresh_db.execute_query(f"EXPLAIN QUERY PLAN {query}", params)
+    details = [row["detail"] for row in plan]
+    assert not [d for d in details if _FULL_SCAN.match(d)], details
+
+
+def _assert_index_ordered(database, query, params):
+    details = [row["detail"] for row in database.execute_query(f"EXPLAIN QUERY PLAN {query}", params)]
+    assert not [d for d in details if _FULL_SCAN.match(d) or d.startswith("USE TEMP B-TREE")], (query, details)
+
+
+@pytest.mark.parametrize("query,params", PRODUCT_LIST_QUERIES)
+def test_product_list_queries_follow_index_order(fresh_db, query, params):
+    apply_migrations(fresh_db)
+    _assert_index_ordered(fresh_db, query, params)
+
+
+def test_get_products_sql_follows_index_order(fresh_db, monkeypatch):
+    """截获 /api/products 实际执行的 SQL（各筛选组合的首页与翻页），逐条检查执行计划"""
+    import main_sqlite
+
+    apply_migrations(fresh_db)
+    executed = []
+
+    class RecordingCatalog:
+        dialect = "sqlite"
+
+        def iter_query(self, query, params=None):
+            executed.append((query, params))
+            return iter(())
+
+    monkeypatch.setattr(main_sqlite, "catalog", RecordingCatalog())
+    monkeypatch.setattr(main_sqlite, "decode_cursor", lambda cursor, size, fingerprint: (30.0, 5))
+    for filters in PRODUCT_LIST_FILTERS:
+        for cursor in (None, "next-page"):
+            asyncio.run(main_sqlite.get_products(**filters, cursor=cursor))
+
+    assert len(executed) == 2 * len(PRODUCT_LIST_FILTERS)
+    for query, params in executed:
+        _assert_index_ordered(fresh_db, query, params)
+
+
+def test_nutrient_range_is_answered_by_index(fresh_db):
+    apply_migrations(fresh_db)
+    plan = fresh_db.execute_query(
+        "EXPLAIN QUERY PLAN SELECT * FROM products WHERE id IN "
+        "(SELECT product_id FROM product_nutrients WHERE protein >= ? AND fat <= ?)", (38, 16)
+    )
+    assert any("idx_product_nutrients_" in row["detail"] for row in plan)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+前端渐进式排名测试：用 node 执行 static/partial_ranking.js，
+按进度接口的增量依次合并，检查实时排名面板随每个版本更新（两列顺序、匿名代号、分数）
+"""
+
+import json
+import re
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+MODULE = (Path(__file__).parent / "static" / "partial_ranking.js").as_uri()
+
+pytestmark = pytest.mark.skipif(shutil.which("node") is None, reason="需要 node 执行前端模块")
+
+
+def _render_after_each(deltas, mapping):
+    """依次合并增量，返回每次合并后的 [是否变化, 面板HTML]"""
+    script = f"""
+        import {{ createPartialRanking, mergePartialRanking, renderPartialRanking }} from {json.dumps(MODULE)};
+        const state = createPartialRanking();
+        const out = {json.dumps(deltas)}.map(delta => {{
+            const changed = mergePartialRanking(state, delta);
+            return [changed, renderPartialRanking(state, {json.dumps(mapping)})];
+        }});
+        console.log(JSON.stringify(out));
+    """
+    completed = subprocess.run(
+        ["node", "--input-type=module", "-e", script], capture_output=True, text=True, timeout=30, check=True
+    )
+    return json.loads(completed.stdout)
+
+
+def _column_codes(html, title):
+    column = html.split(title, 1)[1].split("</ol>", 1)[0]
+    return re.findall(r'<strong class="text-purple-700">([^<]+)</strong>', column)
+
+
+def test_partial_ranking_panel_updates_with_each_delta():
+    first = {
+        "version": 1, "full": True, "unchanged": False, "count": 1,
+        "items": {"11": {"product_id": 11, "final_score": 70, "source": "dify"}},
+        "ideal_order": ["11"], "budget_order": ["11"], "budget_scores": {"11": {"budget_score": 79}},
+    }
+    second = {
+        "version": 2, "full": False, "since": 1, "unchanged": False, "count": 2,
+        "items": {"12": {"product_id": 12, "brand": "某品牌", "final_score": 90, "source": "dify"}},
+        "ideal_order": ["12", "11"], "budget_order": ["11", "12"],
+        "budget_scores": {"11": {"budget_score": 88}, "12": {"budget_score": 84}},
+    }
+    unchanged = {"version": 2, "since": 2, "unchanged": True}
+
+    steps = _render_after_each([first, second, unchanged], {"11": "A", "12": "B"})
+
+    changed, html = steps[0]
+    assert changed is True
+    assert "已完成 1 款产品的实时排名" in html
+    assert _column_codes(html, "纯营养视角排名") == ["A"]
+
+    changed, html = steps[1]
+    assert changed is True
+    assert "已完成 2 款产品的实时排名" in html
+    assert _column_codes(html, "纯营养视角排名") == ["B", "A"]
+    assert _column_codes(html, "性价比综合排名") == ["A", "B"]
+    assert "88.0" in html and "90.0" in html
+    # 只显示匿名代号，不显示品牌
+    assert "某品牌" not in html
+
+    changed, _ = steps[2]
+    assert changed is False
+
+
+def test_empty_partial_ranking_renders_nothing():
+    assert _render_after_each([{"version": 0, "full": True, "unchanged": False, "items": {}}], {}) == [[True, ""]]
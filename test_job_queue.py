@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+分析任务队列测试：租约与心跳、租约过期后被接管、断点续跑、关闭时排空、已退出进程的任务立即释放、启动时清理中断的会话
+"""
+
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import main_sqlite
+from db_migrations import apply_migrations
+from job_queue import JobQueue
+from sqlite_db_utils import SQLiteDB, db, init_sqlite_database
+
+
+def _database(tmp_path):
+    database = SQLiteDB(str(tmp_path / "jobs.db"))
+    apply_migrations(database)
+    return database
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+
+def _job_status(database, job_id):
+    return database.execute_query("SELECT status, attempts FROM analysis_jobs WHERE id = ?", (job_id,))[0]
+
+
+def test_lease_blocks_other_workers_until_it_expires(tmp_path):
+    database = _database(tmp_path)
+    first = JobQueue(database, handler=None, lease_seconds=0.3, owner="host:1:a")
+    second = JobQueue(database, handler=None, lease_seconds=0.3, owner="host:2:b")
+    job_id = first.enqueue(1, "mock", {"pet_id": 1, "product_ids": [1]})
+
+    job = first.claim()
+    assert job["id"] == job_id and job["payload"] == {"pet_id": 1, "product_ids": [1]}
+    assert second.claim() is None
+
+    # 心跳续约期间其他 worker 领取不到
+    for _ in range(3):
+        time.sleep(0.15)
+        assert first.heartbeat() == 1
+        assert second.claim() is None
+
+    # 持有者停止心跳（进程退出）后租约过期，被其他 worker 接管
+    time.sleep(0.4)
+    taken = second.claim()
+    assert taken["id"] == job_id and taken["attempts"] == 2
+    assert first.complete(job) is False and first.stats["lost_leases"] == 1
+    assert second.complete(taken) is True
+    assert _job_status(database, job_id)["status"] == "done"
+    database.close()
+
+
+def test_failed_jobs_are_retried_then_given_up(tmp_path):
+    database = _database(tmp_path)
+    given_up = []
+
+    def handler(job):
+        raise RuntimeError("Dify 不可用")
+
+    queue = JobQueue(database, handler, on_give_up=lambda job, error: given_up.append((job["session_id"], error)),
+                     workers=1, max_attempts=2, retry_seconds=0.3, poll_seconds=0.02)
+    job_id = queue.enqueue(7, "dify", {"pet_id": 1, "product_ids": [1]})
+    queue.notify()
+    _wait_for(lambda: queue.stats["retried"] == 1)
+    # 退避期间不会被重新领取
+    time.sleep(0.1)
+    assert _job_status(database, job_id) == {"status": "queued", "attempts": 1}
+    _wait_for(lambda: given_up)
+    queue.stop()
+    assert given_up == [(7, "Dify 不可用")] and queue.stats["retried"] == 1
+    assert _job_status(database, job_id) == {"status": "failed", "attempts": 2}
+    database.close()
+
+
+def test_analysis_errors_are_retried_by_the_queue(monkeypatch):
+    """分析任务出错时异常交给任务队列：会话回到排队状态并续跑，达到最大次数后才标记为失败"""
+    init_sqlite_database()
+    monkeypatch.setattr(main_sqlite, "MOCK_ANALYSIS_DELAY", 0)
+    product_id = db.execute_query("SELECT id FROM products ORDER BY id LIMIT 1")[0]["id"]
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    flaky, broken = [db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)", (pet_id, "[]", "running")
+    ) for _ in range(2)]
+    load_products = main_sqlite.load_products_by_ids
+    loads = []
+
+    def load_once_failing(product_ids):
+        loads.append(product_ids)
+        return [] if len(loads) == 1 else load_products(product_ids)  # 第一次读取失败
+
+    monkeypatch.setattr(main_sqlite, "load_products_by_ids", load_once_failing)
+    queue = JobQueue(db, main_sqlite.run_analysis_job, on_give_up=main_sqlite.give_up_analysis_job,
+                     workers=1, max_attempts=2, retry_seconds=0.05, poll_seconds=0.02)
+    monkeypatch.setattr(main_sqlite, "analysis_queue", queue)
+    with db.transaction():
+        queue.enqueue(flaky, "mock", {"pet_id": pet_id, "product_ids": [product_id]})
+        queue.enqueue(broken, "mock", {"pet_id": pet_id, "product_ids": [-1]})  # 产品不存在，每次都失败
+    queue.start()
+    try:
+        _wait_for(lambda: queue.stats["completed"] == 1 and queue.stats["given_up"] == 1)
+    finally:
+        queue.stop()
+
+    statuses = {r["id"]: r["status"] for r in db.execute_query(
+        "SELECT id, status FROM analysis_sessions WHERE id IN (?, ?)", (flaky, broken))}
+    assert statuses == {flaky: "completed", broken: "failed"}
+    assert queue.stats["retried"] == 2
+    assert main_sqlite.progress_store.get(broken)["status"] == "failed"
+
+
+def test_shutdown_drains_or_releases_running_jobs(tmp_path):
+    database = _database(tmp_path)
+    release = threading.Event()
+    done = []
+
+    def handler(job):
+        if job["session_id"] == 2:
+            release.wait(5)
+        done.append(job["session_id"])
+
+    queue = JobQueue(database, handler, workers=2, poll_seconds=0.02)
+    quick = queue.enqueue(1, "mock", {})
+    slow = queue.enqueue(2, "mock", {})
+    queue.notify()
+    _wait_for(lambda: 1 in done and queue.status()["in_flight"] == 1)
+
+    report = queue.stop(timeout=0.2)
+    assert report == {"unfinished": 1, "released": 1}
+    assert _job_status(database, quick)["status"] == "done"
+    # 未完成的任务放回队列，不计入领取次数
+    assert _job_status(database, slow) == {"status": "queued", "attempts": 0}
+
+    release.set()
+    restarted = JobQueue(database, lambda job: done.append(("restarted", job["session_id"])), poll_seconds=0.02)
+    restarted.start()
+    _wait_for(lambda: ("restarted", 2) in done)
+    restarted.stop()
+    assert _job_status(database, slow)["status"] == "done"
+    database.close()
+
+
+def test_jobs_of_exited_processes_are_released_immediately(tmp_path):
+    database = _database(tmp_path)
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    job_id = database.execute_update(
+        "INSERT INTO analysis_jobs (session_id, kind, payload, status, attempts, lease_owner, lease_expires_at, "
+        "created_at, updated_at) VALUES (3, 'mock', '{}', 'running', 1, ?, ?, 0, 0)",
+        (f"{socket.gethostname()}:{exited.pid}:dead", time.time() + 3600)
+    )
+    finished = []
+    queue = JobQueue(database, lambda job: finished.append(job["id"]), poll_seconds=0.02)
+    started = time.monotonic()
+    queue.start()
+    _wait_for(lambda: finished)
+    queue.stop()
+    assert finished == [job_id] and queue.stats["recovered"] == 1
+    assert time.monotonic() - started < 1
+    database.close()
+
+
+def test_resumed_session_skips_finished_products(monkeypatch):
+    init_sqlite_database()
+    monkeypatch.setattr(main_sqlite, "MOCK_ANALYSIS_DELAY", 0)
+    product_ids = [r["id"] for r in db.execute_query("SELECT id FROM products ORDER BY id LIMIT 2")]
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)", (pet_id, "[]", "running")
+    )
+    queue = main_sqlite.analysis_queue
+    with db.transaction():
+        queue.enqueue(session_id, "mock", {"pet_id": pet_id, "product_ids": product_ids})
+    # 上一次执行已完成第一个产品并写过匿名映射，随后进程退出
+    queue.checkpoint(session_id, product_ids[0], {
+        "anonymous_code": "A", "product_id": product_ids[0], "scores": {"overall": 99.9}, "price_per_jin": 1
+    })
+    db.execute_update(
+        "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, ?, 'A')",
+        (session_id, product_ids[0])
+    )
+
+    queue.start()
+    try:
+        _wait_for(lambda: db.execute_query(
+            "SELECT status FROM analysis_sessions WHERE id = ?", (session_id,))[0]["status"] == "completed")
+        _wait_for(lambda: not queue.checkpoints(session_id))
+    finally:
+        queue.stop()
+    result = main_sqlite.build_session_result(session_id)
+    scores = {r["product_id"]: r["scores"]["overall"] for r in result["ideal_ranking"]}
+    assert scores[product_ids[0]] == 99.9 and len(scores) == 2
+    assert len(db.execute_query("SELECT id FROM anonymous_mapping WHERE session_id = ?", (session_id,))) == 2
+
+
+def test_startup_fails_running_sessions_without_jobs():
+    init_sqlite_database()
+    orphan = db.execute_update("INSERT INTO analysis_sessions (product_ids, status) VALUES ('[]', 'running')")
+    queued = db.execute_update("INSERT INTO analysis_sessions (product_ids, status) VALUES ('[]', 'running')")
+    with db.transaction():
+        main_sqlite.analysis_queue.enqueue(queued, "mock", {"pet_id": 1, "product_ids": []})
+
+    assert main_sqlite.reconcile_interrupted_sessions() >= 1
+    statuses = {r["id"]: r["status"] for r in db.execute_query(
+        "SELECT id, status FROM analysis_sessions WHERE id IN (?, ?)", (orphan, queued))}
+    assert statuses == {orphan: "failed", queued: "running"}
+    db.execute_update("UPDATE analysis_jobs SET status = 'done' WHERE session_id = ?", (queued,))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+products 表在线迁移测试：分批复制、迁移期间的写入同步、中断续传与原子切换
+"""
+
+import sqlite3
+
+import pytest
+
+from migrate_database import NEW_TABLE, STATE_TABLE, migrate_database
+from sqlite_db_utils import SQLiteDB
+
+ROWS = 250
+
+
+@pytest.fixture
+def old_db(tmp_path):
+    """旧版 products 表结构（没有 species / product_type / weight / description）"""
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("""
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, brand TEXT NOT NULL, product_name TEXT NOT NULL,
+        category TEXT, life_stage TEXT, price REAL, weight_g INTEGER, price_per_jin REAL,
+        ingredients TEXT, nutrition_analysis TEXT, additives TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX idx_products_price_per_jin ON products (price_per_jin)")
+    conn.execute("CREATE TABLE anonymous_mapping (id INTEGER PRIMARY KEY, product_id INTEGER, "
+                 "FOREIGN KEY (product_id) REFERENCES products (id))")
+    conn.executemany(
+        "INSERT INTO products (brand, product_name, category, weight_g, price_per_jin) VALUES (?, ?, ?, ?, ?)",
+        [(f"品牌{i}", f"产品{i}", "狗零食" if i % 2 else "猫干粮", 1500, i) for i in range(1, ROWS + 1)]
+    )
+    conn.commit()
+    conn.close()
+    database = SQLiteDB(path)
+    yield database
+    database.close()
+
+
+def test_interrupted_migration_resumes_and_swaps(old_db):
+    class Interrupted(Exception):
+        pass
+
+    def crash_after_two_batches(report):
+        if report["copied"] >= 80:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        migrate_database(old_db, batch_size=40, progress_callback=crash_after_two_batches)
+
+    # 中断后旧表完好，新表只有已复制的部分
+    assert old_db.execute_query("SELECT COUNT(*) AS n FROM products")[0]["n"] == ROWS
+    assert old_db.execute_query(f"SELECT copied FROM {STATE_TABLE}")[0]["copied"] == 80
+
+    reports = []
+    report = migrate_database(old_db, batch_size=40, progress_callback=reports.append)
+
+    assert report["status"] == "completed" and report["resumed"] is True
+    assert report["copied"] == ROWS and report["rows_per_sec"] > 0
+    assert reports[0]["copied"] == 120 and reports[-1]["percent"] == 100.0
+
+    rows = old_db.execute_query("SELECT * FROM products ORDER BY id")
+    assert len(rows) == ROWS
+    assert rows[0]["species"] == "dog" and rows[0]["product_type"] == "treat"
+    assert rows[1]["species"] == "cat" and rows[1]["weight"] == "1.5kg"
+    assert rows[1]["description"] == "品牌2品牌的产品2"
+
+    tables = {r["name"] for r in old_db.execute_query("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert report["backup_table"] in tables and NEW_TABLE not in tables and STATE_TABLE not in tables
+    indexes = old_db.execute_query("SELECT tbl_name FROM sqlite_master WHERE name = 'idx_products_price_per_jin'")
+    assert indexes[0]["tbl_name"] == "products"
+    # 外键引用仍指向 products，而不是备份表
+    mapping_sql = old_db.execute_query("SELECT sql FROM sqlite_master WHERE name = 'anonymous_mapping'")[0]["sql"]
+    assert "REFERENCES products (id)" in mapping_sql
+
+
+def test_writes_during_copy_are_carried_over(old_db):
+    def write_while_copying(report):
+        if report["copied"] == 50:
+            old_db.execute_update("UPDATE products SET product_name = '已改名' WHERE id = 10")
+            old_db.execute_update("UPDATE products SET product_name = '未复制时改名' WHERE id = 200")
+            old_db.execute_update("DELETE FROM products WHERE id = 20")
+            old_db.execute_update("DELETE FROM products WHERE id = 220")
+            old_db.execute_update(
+                "INSERT INTO products (brand, product_name, category) VALUES ('新品牌', '新产品', '猫干粮')"
+            )
+
+    report = migrate_database(old_db, batch_size=50, progress_callback=write_while_copying)
+
+    assert report["status"] == "completed"
+    names = {r["id"]: r["product_name"] for r in old_db.execute_query("SELECT id, product_name FROM products")}
+    assert len(names) == ROWS - 1
+    assert names[10] == "已改名" and names[200] == "未复制时改名"
+    assert 20 not in names and 220 not in names
+    assert names[ROWS + 1] == "新产品"
+
+
+def test_up_to_date_schema_is_left_alone(old_db):
+    migrate_database(old_db, batch_size=100)
+    assert migrate_database(old_db)["status"] == "up_to_date"
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+/api/products 列表测试：营养素范围筛选、游标分页
+"""
+
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main_sqlite
+import pagination
+from sqlite_db_utils import db, init_sqlite_database
+
+
+def _insert(name, nutrition, species="cat", price=30):
+    return db.execute_update(
+        "INSERT INTO products (brand, product_name, species, product_type, nutrition_analysis, price_per_jin) "
+        "VALUES (?, ?, ?, 'dry', ?, ?)",
+        ("营养测试", name, species, json.dumps(nutrition, ensure_ascii=False), price)
+    )
+
+
+def test_nutrient_ranges_use_normalized_keys():
+    """不同写法的键（粗蛋白/蛋白质/粗蛋白质）与取值（40、"38%"、"≥44%"）都能参与范围筛选"""
+    init_sqlite_database()
+    high = _insert("高蛋白低脂", {"粗蛋白质": "≥44%", "脂肪": "14%"})
+    edge = _insert("边界值", {"蛋白质": 38, "粗脂肪": "16%"})
+    fatty = _insert("高蛋白高脂", {"粗蛋白": 45, "粗脂肪": 22})
+    _insert("低蛋白", {"粗蛋白": "30%", "粗脂肪": "12%"})
+
+    response = asyncio.run(main_sqlite.get_products(min_protein=38, max_fat=16, limit=500))
+    ids = {p["id"] for p in response["products"]}
+    assert {high, edge} <= ids
+    assert fatty not in ids
+    assert all(p["brand"] != "营养测试" or p["id"] in (high, edge) for p in response["products"])
+
+    db.execute_update(
+        "UPDATE products SET nutrition_analysis = ? WHERE id = ?",
+        (json.dumps({"粗蛋白": 45, "粗脂肪": 15}), fatty)  # 默认 ensure_ascii，键名为 \uXXXX 转义
+    )
+    response = asyncio.run(main_sqlite.get_products(min_protein=38, max_fat=16, limit=500))
+    assert fatty in {p["id"] for p in response["products"]}
+
+
+def test_cursor_pagination_walks_price_order_including_null_prices():
+    """游标翻页覆盖全部产品且不重复，顺序与一次性按 (price_per_jin, id) 排序一致（NULL 价格在最前）"""
+    init_sqlite_database()
+    for i in range(3):
+        _insert(f"无价格{i}", {}, price=None)
+        _insert(f"同价{i}", {}, price=25)
+    expected = [row["id"] for row in db.execute_query("SELECT id FROM products ORDER BY price_per_jin, id")]
+
+    seen, cursor = [], None
+    while True:
+        response = asyncio.run(main_sqlite.get_products(limit=4, cursor=cursor))
+        seen.extend(p["id"] for p in response["products"])
+        cursor = response["next_cursor"]
+        assert response["has_more"] == (cursor is not None)
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_cursor_is_bound_to_filters_and_total_is_capped():
+    init_sqlite_database()
+    first = asyncio.run(main_sqlite.get_products(species="cat", limit=1, include_total=True))
+    exact_total = db.execute_query("SELECT COUNT(*) AS count FROM products WHERE species = 'cat'")[0]["count"]
+    assert (first["total"], first["total_exact"]) == (exact_total, True)
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main_sqlite.get_products(species="dog", limit=1, cursor=first["next_cursor"]))
+    assert excinfo.value.status_code == 400
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main_sqlite.get_products(cursor="not-a-cursor"))
+    assert excinfo.value.status_code == 400
+
+    total, exact = pagination.count_capped(db, "FROM products WHERE species = ?", ("cat",), cap=1)
+    assert (total, exact) == (1, exact_total <= 1)
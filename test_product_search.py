@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+产品全文检索测试：触发器同步、BM25排序、中文短词、分页与高亮
+"""
+
+import asyncio
+import json
+
+import pytest
+
+import main_sqlite
+from db_migrations import apply_migrations
+from product_search import highlight, search_products
+from sqlite_db_utils import SQLiteDB
+
+
+def _insert(database, name, brand, ingredients, description="", species="cat", price=30):
+    return database.execute_update(
+        "INSERT INTO products (brand, product_name, species, description, ingredients, price_per_jin) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (brand, name, species, description, json.dumps(ingredients, ensure_ascii=False), price)
+    )
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    database = SQLiteDB(str(tmp_path / "search.db"))
+    apply_migrations(database)
+    _insert(database, "渴望六种鱼全猫粮", "渴望", ["去骨鲱鱼", "去骨鲭鱼"], "高蛋白无谷配方", price=83)
+    _insert(database, "皇家成猫粮", "皇家", ["鸡肉粉", "玉米"], "经典配方", price=22)
+    _insert(database, "爱肯拿鸭肉梨配方", "爱肯拿", ["去骨鸭肉", "鸭肉粉"], "单一动物蛋白", price=55)
+    _insert(database, "Orijen Six Fish Dog", "Orijen", ["herring"], "whole prey", species="dog", price=90)
+    yield database
+    database.close()
+
+
+def test_fts_is_kept_in_sync_by_triggers(catalog):
+    assert search_products(catalog, "六种鱼")["total"] == 1
+
+    product_id = _insert(catalog, "渴望六种鱼幼猫粮", "渴望", ["去骨鲱鱼"])
+    assert search_products(catalog, "六种鱼")["total"] == 2
+
+    catalog.execute_update("UPDATE products SET product_name = '渴望海洋鱼幼猫粮' WHERE id = ?", (product_id,))
+    assert search_products(catalog, "六种鱼")["total"] == 1
+
+    catalog.execute_update("DELETE FROM products WHERE id = ?", (product_id,))
+    assert search_products(catalog, "海洋鱼")["total"] == 0
+
+
+def test_bm25_ranks_name_matches_above_ingredient_matches(catalog):
+    """名称命中排在只有原料命中的产品前面"""
+    _insert(catalog, "鸭肉冻干零食", "某品牌", ["鸭胸肉"], price=10)
+    result = search_products(catalog, "鸭肉")
+    names = [p["product_name"] for p in result["products"]]
+    assert set(names) == {"爱肯拿鸭肉梨配方", "鸭肉冻干零食"}
+
+    _insert(catalog, "全价猫粮", "某品牌", ["鸭肉梨冻干"], price=5)
+    ranked = search_products(catalog, "鸭肉梨")["products"]
+    assert [p["product_name"] for p in ranked] == ["爱肯拿鸭肉梨配方", "全价猫粮"]
+    assert ranked[0]["score"] <= ranked[-1]["score"]
+
+
+def test_short_terms_species_and_pagination(catalog):
+    # 两个字的中文词（少于 trigram 的3个字符）同样能检索到
+    assert [p["brand"] for p in search_products(catalog, "皇家")["products"]] == ["皇家"]
+    # 多个关键词须全部命中
+    assert search_products(catalog, "去骨 鸭肉")["total"] == 1
+    # 英文不区分大小写，物种过滤
+    assert search_products(catalog, "six fish", species="dog")["total"] == 1
+    assert search_products(catalog, "six fish", species="cat")["total"] == 0
+
+    first = search_products(catalog, "配方", page=1, page_size=1)
+    second = search_products(catalog, "配方", page=2, page_size=1)
+    assert first["total"] == second["total"] == 3
+    assert first["products"][0]["id"] != second["products"][0]["id"]
+
+
+def test_highlights_escape_html_and_mark_matches(catalog):
+    product = search_products(catalog, "鸭肉")["products"][0]
+    assert product["highlights"]["product_name"] == "爱肯拿<mark>鸭肉</mark>梨配方"
+    assert "<mark>鸭肉</mark>" in product["highlights"]["ingredients"]
+    assert highlight("<b>鸡肉</b>", ["鸡肉"]) == "&lt;b&gt;<mark>鸡肉</mark>&lt;/b&gt;"
+    assert highlight("a" * 50 + "鸡肉", ["鸡肉"], radius=5).startswith("…aaaaa<mark>")
+
+
+def test_search_endpoint_returns_ranked_page():
+    from sqlite_db_utils import init_sqlite_database
+
+    init_sqlite_database()
+    response = asyncio.run(main_sqlite.search_products_endpoint(q="皇家", species="猫"))
+    assert response["success"] is True and response["total"] >= 1
+    assert response["products"][0]["highlights"]["brand"] == "<mark>皇家</mark>"
+    assert isinstance(response["products"][0]["ingredients"], list)
+
+
+def test_cursor_pages_follow_ranking_order(catalog):
+    for i in range(5):
+        _insert(catalog, f"鸭肉梨冻干{i}", "测试", ["鸭肉"], price=40 + i % 2)
+    expected = [p["id"] for p in search_products(catalog, "鸭肉梨", page_size=50)["products"]]
+
+    seen, cursor = [], None
+    while True:
+        result = search_products(catalog, "鸭肉梨", page_size=2, cursor=cursor)
+        seen.extend(p["id"] for p in result["products"])
+        cursor = result["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == expected
+
+    with pytest.raises(ValueError):
+        search_products(catalog, "六种鱼", page_size=2, cursor=search_products(catalog, "鸭肉梨", page_size=2)["next_cursor"])
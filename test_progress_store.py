@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+进度存储测试：并发局部更新不丢失、版本号递增、TTL 与条目数/内存上限淘汰、已结束会话的结果按引用持久化、
+多 worker 之间共享会话进度
+"""
+
+import asyncio
+import threading
+
+import benchmark_workers
+import main_sqlite
+import progress_store as progress_store_module
+from dify_analysis_engine import DifyAnalysisEngine
+from db_migrations import apply_migrations
+from partial_ranking import PartialRankingTracker
+from progress_store import ProgressStore, SQLiteProgressBackend
+from sqlite_db_utils import SQLiteDB, init_sqlite_database
+
+
+def test_concurrent_updates_are_atomic_and_versioned():
+    store = ProgressStore()
+    store.set("s1", {"status": "running", "counts": {}})
+
+    def worker(n):
+        for i in range(200):
+            store.update("s1", {f"w{n}-{i}": i})
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    state = store.get("s1")
+    assert len([k for k in state if k.startswith("w")]) == 1600
+    assert state["version"] == store.version("s1") == 1601
+    # 读取返回副本
+    state["status"] = "changed"
+    assert store.get("s1")["status"] == "running"
+    assert store.update("missing", {"status": "x"}) is False
+    store.set("s1", {"status": "completed"})
+    assert store.update("s1", {"progress": 50}, only_if_running=True) is False
+
+
+def test_ttl_and_lru_eviction_prefer_finished_sessions(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(progress_store_module.time, "monotonic", lambda: clock[0])
+    evicted = []
+    store = ProgressStore(ttl=60, running_ttl=600, max_entries=3, max_bytes=0, on_evict=evicted.append)
+
+    store.set("running", {"status": "running"})
+    store.set("done-old", {"status": "completed"})
+    store.set("done-new", {"status": "completed"})
+    store.get("done-old")  # 最近访问
+    store.set("new", {"status": "running"})
+    # 超出条目数：淘汰最久未访问的已结束会话，进行中的会话保留
+    assert evicted == ["done-new"] and "running" in store
+
+    clock[0] += 120
+    assert store.get("done-old") is None and store.get("running") is not None
+    store.set("trigger", {"status": "running"})
+    assert "done-old" in evicted and store.memory_stats()["evicted_ttl"] == 1
+    assert store.memory_stats()["entries"] == 3
+
+
+def test_memory_cap_bounds_approximate_size():
+    store = ProgressStore(max_entries=1000, max_bytes=20_000)
+    for i in range(100):
+        store.set(f"s{i}", {"status": "completed", "message": "x" * 1000})
+    stats = store.memory_stats()
+    assert stats["approx_bytes"] <= 20_000 and stats["evicted_memory"] > 0
+    assert store.get("s99") is not None and store.get("s0") is None
+
+
+def test_finished_results_are_held_by_reference():
+    saved = {}
+    store = ProgressStore(result_saver=saved.__setitem__, result_loader=saved.get)
+    ranking = {"ranking": [{"product_id": 1, "score": 90}]}
+
+    store.set("s1", {"status": "running", "result": ranking})
+    assert saved == {}
+    store.update("s1", {"status": "completed", "progress": 100})
+    assert saved == {"s1": ranking}
+    assert "result" not in store.get_meta("s1") and store.get_meta("s1")["result_persisted"]
+    assert store.get("s1")["result"] == ranking
+
+    # 截止后到达的迟到结果覆盖已持久化的结果
+    late = {"ranking": [{"product_id": 2, "score": 95}]}
+    store.update("s1", {"result": late})
+    assert saved["s1"] == late and store.get("s1")["result"] == late
+
+
+def test_update_during_result_offload_is_not_overwritten():
+    """结果持久化期间（锁外）写入的其他更新，不会被持久化前的旧快照覆盖"""
+    saving, release, saved = threading.Event(), threading.Event(), {}
+
+    def slow_saver(key, result):
+        saving.set()
+        release.wait(5)
+        saved[key] = result
+
+    store = ProgressStore(result_saver=slow_saver, result_loader=saved.get)
+    store.set("s1", {"status": "running", "pending": 2, "message": "分析中"})
+    ranking = {"ranking": [{"product_id": 1}]}
+    finisher = threading.Thread(target=store.update, args=("s1", {"status": "completed", "result": ranking}))
+    finisher.start()
+    assert saving.wait(5)
+    store.update("s1", {"pending": 0, "message": "迟到结果已合并"})
+    release.set()
+    finisher.join(5)
+
+    state = store.get("s1")
+    assert state["status"] == "completed" and state["result"] == ranking
+    assert state["pending"] == 0 and state["message"] == "迟到结果已合并"
+    assert store.get_meta("s1")["result_persisted"]
+
+
+def test_progress_endpoint_loads_persisted_result_and_debug_is_bounded():
+    init_sqlite_database()
+    ranking = {"ranking": [{"product_id": 7, "score": 88}], "total": 1}
+    main_sqlite.set_analysis_status("persisted", {"status": "completed", "progress": 100, "result": ranking})
+    assert main_sqlite.progress_store.get_meta("persisted")["result_persisted"]
+
+    response = asyncio.run(main_sqlite.get_analysis_progress("persisted"))
+    assert response["status"] == "completed" and response["result"] == ranking
+
+    logs = asyncio.run(main_sqlite.get_debug_logs())
+    assert "analysis_status" not in logs and logs["progress_store"]["results_saved"] >= 1
+    recent = next(s for s in logs["recent_sessions"] if s["session_id"] == "persisted")
+    assert recent["result_persisted"] and "result" not in recent
+
+
+def _shared_database(tmp_path):
+    database = SQLiteDB(str(tmp_path / "shared.db"))
+    apply_migrations(database)
+    return database
+
+
+def test_sessions_written_by_one_worker_are_readable_by_another(tmp_path):
+    database = _shared_database(tmp_path)
+    other = SQLiteDB(database.db_path)  # 另一个 worker 进程的连接
+    owner = ProgressStore(shared=SQLiteProgressBackend(database))
+    reader = ProgressStore(shared=SQLiteProgressBackend(other))
+
+    owner.set("s1", {"status": "running", "progress": 10})
+    owner.update("s1", {"progress": 40})
+    assert not reader.is_local("s1")
+    assert reader.get("s1") == {"status": "running", "progress": 40, "version": 2}
+    assert reader.version("s1") == 2 and reader.get("missing") is None
+
+    # 乱序到达的旧版本不会覆盖新版本
+    SQLiteProgressBackend(other).write("s1", {"status": "running", "progress": 0}, 1)
+    assert reader.get("s1")["progress"] == 40
+
+    # 进程重启后重新写入同一会话：版本号接着共享后端递增
+    restarted = ProgressStore(shared=SQLiteProgressBackend(database))
+    assert restarted.set("s1", {"status": "completed", "progress": 100}) == 3
+    assert reader.get("s1")["status"] == "completed"
+    other.close()
+    database.close()
+
+
+def test_progress_endpoints_answer_sessions_owned_by_another_worker(tmp_path, monkeypatch):
+    database = _shared_database(tmp_path)
+    owner = ProgressStore(shared=SQLiteProgressBackend(database))
+    local = ProgressStore(shared=SQLiteProgressBackend(SQLiteDB(database.db_path)))
+    monkeypatch.setattr(main_sqlite, "progress_store", local)
+    monkeypatch.setattr(main_sqlite, "PROGRESS_POLL_INTERVAL", 0.02)
+
+    tracker = PartialRankingTracker(DifyAnalysisEngine(), {"species": "猫"})
+    tracker.upsert("1", {"product_id": 1, "product_name": "A", "score": 90, "final_score": 90})
+    owner.set("remote", {"status": "running", "progress": 50, "total": 2, "partial_snapshot": tracker.export()})
+
+    first = asyncio.run(main_sqlite.get_analysis_progress("remote"))
+    assert first["status"] == "running" and first["partial_ranking"]["count"] == 1
+
+    async def scenario():
+        threading.Timer(0.1, owner.update, args=("remote", {"status": "completed", "progress": 100})).start()
+        return await main_sqlite.wait_analysis_progress("remote", version=first["version"], timeout=5)
+
+    done = asyncio.run(scenario())
+    assert done["status"] == "completed" and done["version"] == first["version"] + 1
+    assert done["partial_ranking"]["unchanged"] is False
+
+
+def test_multiple_uvicorn_workers_answer_every_progress_poll():
+    """真实的多 worker 部署：进度请求分散到各 worker，没有一个返回会话不存在"""
+    report = benchmark_workers.bench(workers=2, seconds=1, clients=2)
+    assert report["requests"] > 0 and report["errors"] == 0 and report["not_found"] == 0
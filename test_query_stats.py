@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+语句耗时统计测试：SQL 归一化、慢查询日志与执行计划、排行与管理接口
+"""
+
+import asyncio
+import logging
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main_sqlite
+from query_stats import QueryStats, normalize_sql, param_shape
+from sqlite_db_utils import SQLiteDB, init_sqlite_database
+
+
+def _request(token=None):
+    headers = [(b"x-admin-token", token.encode())] if token else []
+    return Request({"type": "http", "method": "GET", "path": "/api/admin/query-stats", "headers": headers})
+
+
+def test_normalize_sql_groups_statements_that_differ_only_in_literals():
+    assert normalize_sql("SELECT *\n  FROM products WHERE id IN (?, ?, ?) LIMIT 50") == \
+        normalize_sql("SELECT * FROM products WHERE id IN (?,?) LIMIT 10") == \
+        "SELECT * FROM products WHERE id IN (?...) LIMIT ?"
+    assert normalize_sql("SELECT * FROM t WHERE name = 'it''s' AND v2 > 3.5") == \
+        "SELECT * FROM t WHERE name = ? AND v2 > ?"
+    assert param_shape(("cat", 1.5, 1, 2, 3, None)) == "(str, float, int×3, None)"
+    assert param_shape(None) == "()"
+
+
+def test_slow_statements_are_logged_with_plan(tmp_path, caplog, monkeypatch):
+    database = SQLiteDB(str(tmp_path / "stats.db"))
+    database.execute_update("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+    database.execute_many("INSERT INTO items (name) VALUES (?)", [(f"n{i}",) for i in range(20)])
+    monkeypatch.setattr(database.query_stats, "slow_ms", 0)
+
+    with caplog.at_level(logging.WARNING, logger="query_stats"):
+        rows = database.execute_query("SELECT * FROM items WHERE name = ?", ("n3",))
+    assert len(rows) == 1
+    message = caplog.records[-1].getMessage()
+    assert "慢查询" in message and "1 行" in message and "(str)" in message
+    assert "SELECT * FROM items WHERE name = ?" in message
+    assert "SCAN items" in message
+
+    summary = next(s for s in database.query_stats.top(10) if s["sql"].startswith("SELECT"))
+    assert summary["calls"] == 1 and summary["rows"] == 1 and summary["plan"]
+    database.close()
+
+
+def test_top_orders_by_total_and_p95_and_evicts_cheapest():
+    stats = QueryStats(slow_ms=-1, max_statements=3)
+    for _ in range(50):
+        stats.record("SELECT 1 FROM a", (), 1.0, 1)  # 总耗时最高
+    for _ in range(2):
+        stats.record("SELECT 1 FROM b", (), 20.0, 1)  # p95 最高
+    stats.record("SELECT 1 FROM c", (), 0.5, 1)
+    assert [s["sql"] for s in stats.top(3, "total")][:2] == ["SELECT ? FROM a", "SELECT ? FROM b"]
+    assert stats.top(1, "p95")[0]["sql"] == "SELECT ? FROM b"
+
+    stats.record("SELECT 1 FROM d", (), 5.0, 1)
+    assert len(stats) == 3
+    assert "SELECT ? FROM c" not in {s["sql"] for s in stats.top(10)}
+
+
+def test_admin_endpoint_requires_token_when_configured(monkeypatch):
+    init_sqlite_database()
+    main_sqlite.db.execute_query("SELECT COUNT(*) FROM products")
+    monkeypatch.setattr(main_sqlite, "ADMIN_TOKEN", "secret")
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(main_sqlite.get_query_stats(_request()))
+    assert excinfo.value.status_code == 403
+
+    result = asyncio.run(main_sqlite.get_query_stats(_request("secret"), limit=5))
+    assert result["by_total"] and len(result["by_p95"]) <= 5
+    assert {"sql", "calls", "total_ms", "p95_ms", "rows", "params", "plan"} <= set(result["by_total"][0])
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+数据库访问层测试：同一组用例分别跑 SQLiteDB 与 MySQLDB，
+MySQL 服务端用本地替身代替（sqlite3 实现的 mysql.connector 连接接口：%s 占位符、ping、start_transaction），
+并覆盖 MySQL 连接池的上限、健康检查与断线重连。
+
+接口层用例（app_database）把 main_sqlite 的数据库换成独立实例：SQLite 执行全部迁移，
+MySQL 替身只有业务表，没有全文检索、营养素表、任务队列等 SQLite 专属对象，与真实 MySQL 部署一致。
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+from mysql.connector import errors as mysql_errors
+
+import main_sqlite
+from admission import AdmissionController
+from catalog_replica import CatalogReplica
+from db_migrations import _add_product_columns, _create_base_tables, apply_migrations
+from db_utils import MySQLDB, PoolTimeoutError, to_mysql_paramstyle
+from job_queue import JobQueue
+from progress_store import ProgressStore
+from retention import run_retention
+from sqlite_db_utils import AsyncSQLiteDB, SQLiteDB
+
+SCHEMA = "CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, value INTEGER)"
+
+
+class _StandInCursor:
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def description(self):
+        return self._cursor.description if self._cursor else None
+
+    def execute(self, operation, params=()):
+        self._connection._check()
+        self._cursor = self._connection._sqlite.execute(operation.replace("%s", "?"), params)
+        self.rowcount, self.lastrowid = self._cursor.rowcount, self._cursor.lastrowid
+
+    def executemany(self, operation, seq_params):
+        self._connection._check()
+        self._cursor = self._connection._sqlite.executemany(operation.replace("%s", "?"), seq_params)
+        self.rowcount = self._cursor.rowcount
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        if self._cursor:
+            self._cursor.close()
+
+
+class StandInMySQLConnection:
+    """MySQL 连接替身：kill() 模拟服务端断开（wait_timeout 或重启）"""
+
+    def __init__(self, path, **config):
+        self._sqlite = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self.autocommit = False
+        self.alive = True
+
+    def _check(self):
+        if not self.alive:
+            raise mysql_errors.OperationalError("2013 (HY000): Lost connection to MySQL server during query")
+
+    def cursor(self):
+        return _StandInCursor(self)
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if not self.alive:
+            raise mysql_errors.InterfaceError("2055: Lost connection to MySQL server")
+
+    def start_transaction(self):
+        self._check()
+        self._sqlite.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self._check()
+        if self._sqlite.in_transaction:
+            self._sqlite.execute("COMMIT")
+
+    def rollback(self):
+        self._check()
+        if self._sqlite.in_transaction:
+            self._sqlite.execute("ROLLBACK")
+
+    def consume_results(self):
+        pass
+
+    def kill(self):
+        self.alive = False
+
+    def close(self):
+        self._sqlite.close()
+
+
+class StandInServer:
+    """记录建立过的连接，便于测试中断开它们"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = []
+
+    def connect(self, **config):
+        conn = StandInMySQLConnection(self.path, **config)
+        self.connections.append(conn)
+        return conn
+
+    def kill_all(self):
+        for conn in self.connections:
+            conn.kill()
+
+
+def _mysql(tmp_path, **options):
+    server = StandInServer(str(tmp_path / "mysql-standin.db"))
+    return MySQLDB(config={"database": "test"}, connect_fn=server.connect, **options), server
+
+
+@pytest.fixture(params=["sqlite", "mysql"])
+def database(request, tmp_path):
+    if request.param == "sqlite":
+        database = SQLiteDB(str(tmp_path / "repo.db"), pool_size=4)
+    else:
+        database, _ = _mysql(tmp_path, pool_size=4)
+    database.execute_update(SCHEMA)
+    yield database
+    database.close()
+
+
+@pytest.fixture(params=["sqlite", "mysql"])
+def app_database(request, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        database = SQLiteDB(str(tmp_path / "app.db"))
+        apply_migrations(database)
+    else:
+        database, server = _mysql(tmp_path)
+        conn = sqlite3.connect(server.path)
+        _create_base_tables(conn)
+        _add_product_columns(conn)
+        conn.commit()
+        conn.close()
+    async_database = AsyncSQLiteDB(database)
+    queue = JobQueue(database, main_sqlite.run_analysis_job, on_give_up=main_sqlite.give_up_analysis_job,
+                     workers=1, poll_seconds=0.02)
+    for name, value in {
+        "db": database,
+        "adb": async_database,
+        "catalog": CatalogReplica(database, enabled=False),
+        "analysis_queue": queue,
+        "admission": AdmissionController(queue),
+        "progress_store": ProgressStore(on_evict=main_sqlite._drop_partial_ranking),
+    }.items():
+        monkeypatch.setattr(main_sqlite, name, value)
+    monkeypatch.setattr(main_sqlite.pet_writer, "database", database)
+    yield database
+    queue.stop(timeout=1)
+    async_database.shutdown()
+    database.close()
+
+
+def _insert_product(database, name, brand, ingredients, nutrition=None, species="cat", price=30):
+    return database.execute_update(
+        "INSERT INTO products (brand, product_name, species, ingredients, nutrition_analysis, price_per_jin) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (brand, name, species, json.dumps(ingredients, ensure_ascii=False),
+         json.dumps(nutrition or {}, ensure_ascii=False), price)
+    )
+
+
+def test_crud_and_row_factories(database):
+    first = database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("a", 1))
+    assert first == 1
+    assert database.execute_many("INSERT INTO items (name, value) VALUES (?, ?)",
+                                 [(f"n{i}", i) for i in range(2, 12)]) == 10
+    rows = database.execute_query("SELECT name, value FROM items WHERE name = ? OR name = '?'", ("a",))
+    assert rows == [{"name": "a", "value": 1}]
+
+    records = list(database.iter_query("SELECT id, value FROM items ORDER BY id", row_factory="record",
+                                       batch_size=3))
+    assert len(records) == 11 and records[-1].value == 11
+    # 提前结束的流式查询同样归还连接
+    stream = database.iter_query("SELECT id FROM items", row_factory="tuple", batch_size=2)
+    assert next(stream) == (1,)
+    stream.close()
+    assert database.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 11
+    # 影响行数：连接上有过插入时 execute_update 返回的是 rowid，execute_rowcount 返回行数
+    assert database.execute_rowcount("UPDATE items SET value = value + 100 WHERE value > ?", (5,)) == 6
+    assert database.execute_rowcount("DELETE FROM items WHERE value > ?", (1000,)) == 0
+    assert database.query_stats.top(1)[0]["calls"] >= 1
+
+
+def test_transaction_commits_or_rolls_back(database):
+    with database.transaction():
+        database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("kept", 1))
+        with database.transaction():  # 嵌套并入外层事务
+            database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("kept", 2))
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("lost", 3))
+            raise RuntimeError("中途失败")
+    names = [row["name"] for row in database.execute_query("SELECT name FROM items ORDER BY id")]
+    assert names == ["kept", "kept"]
+
+
+def test_handlers_run_unchanged_on_either_backend(database, monkeypatch):
+    database.execute_update(
+        "CREATE TABLE pet_info (id INTEGER PRIMARY KEY AUTOINCREMENT, species TEXT, breed TEXT, age_months INTEGER,"
+        " weight_kg REAL, health_status TEXT, allergies TEXT, doctor_notes TEXT, budget_mode TEXT,"
+        " monthly_budget REAL, price_range_min REAL, price_range_max REAL)"
+    )
+    async_database = AsyncSQLiteDB(database)
+    monkeypatch.setattr(main_sqlite, "adb", async_database)
+    monkeypatch.setattr(main_sqlite.pet_writer, "database", database)
+    pet = main_sqlite.PetInfo(species="cat", breed="英短", age_months=12, weight_kg=4.0, health_status="健康")
+    result = asyncio.run(main_sqlite.create_pet(pet))
+    assert result["success"] and result["pet_id"] == 1
+    assert database.execute_query("SELECT breed FROM pet_info WHERE id = ?", (1,))[0]["breed"] == "英短"
+    async_database.shutdown()
+
+
+def test_placeholders_outside_literals_are_converted():
+    assert to_mysql_paramstyle("SELECT * FROM t WHERE a = ? AND b = '?' AND c IN (?, ?)") == \
+        "SELECT * FROM t WHERE a = %s AND b = '?' AND c IN (%s, %s)"
+    assert to_mysql_paramstyle("SELECT 'it''s ?', `col?` FROM t WHERE d = ?") == \
+        "SELECT 'it''s ?', `col?` FROM t WHERE d = %s"
+
+
+def test_mysql_pool_is_bounded(tmp_path):
+    database, _ = _mysql(tmp_path, pool_size=2, pool_timeout=0.2)
+    held = [database._acquire(), database._acquire()]
+    with pytest.raises(PoolTimeoutError):
+        database.execute_query("SELECT 1 AS one")
+    assert database.status()["timeouts"] == 1
+
+    # 归还后等待中的请求拿到连接
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(database.execute_query("SELECT 1 AS one")))
+    database.pool_timeout = 5
+    waiter.start()
+    database._release(held.pop())
+    waiter.join(5)
+    assert result == [[{"one": 1}]]
+    assert database.status()["opened"] == 2
+    database.close()
+
+
+def test_mysql_stale_connections_are_health_checked_and_replaced(tmp_path):
+    database, server = _mysql(tmp_path, health_check_after=0)
+    database.execute_update(SCHEMA)
+    server.kill_all()  # 闲置期间被服务端断开
+    assert database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("x", 1)) == 1
+    status = database.status()
+    assert status["health_checks"] >= 1 and status["discarded"] == 1 and status["created"] == 2
+    database.close()
+
+
+def test_mysql_query_reconnects_once_when_connection_drops(tmp_path):
+    database, server = _mysql(tmp_path, health_check_after=3600)
+    database.execute_update(SCHEMA)
+    database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("x", 1))
+    server.kill_all()  # 未到健康检查时间，借出时不会 ping
+    assert database.execute_query("SELECT name FROM items") == [{"name": "x"}]
+    assert database.status()["retries"] == 1
+
+    # 写语句不重试：报错并丢弃失效连接，下一次请求使用新连接
+    server.kill_all()
+    with pytest.raises(mysql_errors.OperationalError):
+        database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("y", 2))
+    assert database.execute_update("INSERT INTO items (name, value) VALUES (?, ?)", ("z", 3)) == 2
+    database.close()
+
+
+def test_search_endpoint_on_either_backend(app_database):
+    """没有全文索引（MySQL）时退回 LIKE 匹配：同样要求全部关键词命中、支持游标翻页与高亮"""
+    _insert_product(app_database, "渴望六种鱼全猫粮", "渴望", ["去骨鲱鱼"], price=83)
+    _insert_product(app_database, "皇家成猫粮", "皇家", ["鸡肉粉"], price=22)
+    _insert_product(app_database, "渴望原味鸡幼猫粮", "渴望", ["鸡肉"], price=60)
+
+    fish = asyncio.run(main_sqlite.search_products_endpoint(q="六种鱼"))
+    assert fish["total"] == 1
+    assert fish["products"][0]["highlights"]["product_name"] == "渴望<mark>六种鱼</mark>全猫粮"
+    assert asyncio.run(main_sqlite.search_products_endpoint(q="渴望 鸡肉"))["total"] == 1
+
+    first = asyncio.run(main_sqlite.search_products_endpoint(q="渴望", page_size=1))
+    second = asyncio.run(main_sqlite.search_products_endpoint(q="渴望", page_size=1, cursor=first["next_cursor"]))
+    assert first["total"] == 2 and second["next_cursor"] is None
+    assert {first["products"][0]["product_name"], second["products"][0]["product_name"]} == \
+        {"渴望六种鱼全猫粮", "渴望原味鸡幼猫粮"}
+
+
+def test_nutrient_ranges_need_product_nutrients(app_database):
+    """营养素范围依赖 SQLite 的 product_nutrients：MySQL 上返回 400，不筛选的列表照常返回"""
+    high = _insert_product(app_database, "高蛋白", "营养测试", [], {"粗蛋白": 45})
+    low = _insert_product(app_database, "低蛋白", "营养测试", [], {"粗蛋白": 30})
+
+    if app_database.dialect == "sqlite":
+        response = asyncio.run(main_sqlite.get_products(min_protein=40))
+        assert [p["id"] for p in response["products"]] == [high]
+    else:
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(main_sqlite.get_products(min_protein=40))
+        assert error.value.status_code == 400
+    response = asyncio.run(main_sqlite.get_products(include_total=True))
+    assert {p["id"] for p in response["products"]} == {high, low} and response["total"] == 2
+
+
+def test_retention_on_either_backend(app_database, monkeypatch):
+    """数据保留任务两种数据库都能运行；删除语句只按查出的键删除（MySQL 不支持 IN 子查询带 LIMIT）"""
+    old = "2020-01-01 00:00:00"
+    for _ in range(3):
+        pet_id = app_database.execute_update("INSERT INTO pet_info (species) VALUES ('cat')")
+        app_database.execute_update("UPDATE pet_info SET created_at = ? WHERE id = ?", (old, pet_id))
+    session_id = app_database.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, '[]', 'completed')", (pet_id,)
+    )
+    app_database.execute_update("UPDATE analysis_sessions SET created_at = ? WHERE id = ?", (old, session_id))
+    app_database.execute_update(
+        "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code, created_at) VALUES (?, 1, 'A', ?)",
+        (session_id + 100, old)
+    )
+
+    deletes = []
+    execute_rowcount = app_database.execute_rowcount
+    monkeypatch.setattr(app_database, "execute_rowcount",
+                        lambda query, params=None: deletes.append(query) or execute_rowcount(query, params))
+    report = run_retention(app_database, session_days=30, pet_days=30, batch_size=2, archive_dir="", pause=0)
+
+    assert report["sessions"] == 1 and report["pets"] == 3
+    assert all(app_database.execute_query(f"SELECT COUNT(*) AS n FROM {table}")[0]["n"] == 0
+               for table in ("pet_info", "analysis_sessions", "anonymous_mapping"))
+    assert deletes and not any("SELECT" in query for query in deletes)
+
+
+def test_product_listing_on_either_backend(app_database):
+    """/api/products：筛选、游标翻页与总数在两种数据库上结果一致"""
+    ids = [_insert_product(app_database, f"产品{i}", "列表测试", [], price=price)
+           for i, price in enumerate([30, None, 20, 30, 25])]
+    _insert_product(app_database, "狗粮", "列表测试", [], species="dog", price=10)
+    app_database.execute_update("UPDATE products SET life_stage = '幼年' WHERE id = ?", (ids[0],))
+    app_database.execute_update("UPDATE products SET life_stage = '全阶段' WHERE id = ?", (ids[2],))
+
+    seen, cursor = [], None
+    while True:
+        response = asyncio.run(main_sqlite.get_products(species="cat", limit=2, cursor=cursor))
+        seen.extend(p["id"] for p in response["products"])
+        cursor = response["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [ids[1], ids[2], ids[4], ids[0], ids[3]]
+
+    stage = asyncio.run(main_sqlite.get_products(life_stage="幼年", include_total=True))
+    assert [p["id"] for p in stage["products"]] == [ids[2], ids[0]] and stage["total"] == 2
+    product = asyncio.run(main_sqlite.get_product(ids[0]))["product"]
+    assert product["product_name"] == "产品0" and product["ingredients"] == []
+
+
+def test_analysis_start_and_result_on_either_backend(app_database, monkeypatch):
+    """/api/analysis/start -> 进度 -> 结果 -> 揭晓：SQLite 经任务队列执行，MySQL 直接交给线程"""
+    monkeypatch.setattr(main_sqlite, "MOCK_ANALYSIS_DELAY", 0)
+    product_ids = [_insert_product(app_database, f"分析{i}", "分析测试", ["鸡肉"], price=20 + i) for i in range(3)]
+    pet_id = asyncio.run(main_sqlite.create_pet(main_sqlite.PetInfo(species="cat", breed="英短")))["pet_id"]
+
+    started = asyncio.run(main_sqlite.start_analysis(
+        main_sqlite.AnalysisRequest(pet_id=pet_id, product_ids=product_ids, use_dify=False)
+    ))
+    session_id = started["session_id"]
+    deadline = time.time() + 5
+    while asyncio.run(main_sqlite.get_analysis_progress(str(session_id)))["status"] != "completed":
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+    result = asyncio.run(main_sqlite.get_analysis_result(session_id))
+    assert result["success"] and len(result["ideal_ranking"]) == 3
+    assert sorted(result["anonymous_mapping"]) == sorted(product_ids)
+    code = result["anonymous_mapping"][product_ids[0]]
+    assert asyncio.run(main_sqlite.reveal_product(session_id, code))["product"]["id"] == product_ids[0]
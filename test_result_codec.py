@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+分析结果编码测试：新编码往返、旧 JSON 文本兼容、批量转换
+"""
+
+import json
+
+import pytest
+
+import main_sqlite
+from result_codec import FORMAT_ZLIB_JSON, decode_results, encode_results, recompress_sessions
+from sqlite_db_utils import db, init_sqlite_database
+
+RESULTS = [
+    {"anonymous_code": "A", "product_id": 1, "scores": {"overall": 88}, "reason": "蛋白质含量高，适合成猫" * 5},
+    {"anonymous_code": "B", "product_id": 2, "scores": {"overall": 72}, "reason": "含谷物，需谨慎", "pending": False},
+]
+
+
+def _insert_session(value):
+    return db.execute_update(
+        "INSERT INTO analysis_sessions (product_ids, status, analysis_results) VALUES ('[1, 2]', 'completed', ?)",
+        (value,)
+    )
+
+
+def test_encode_round_trip_is_versioned_and_smaller():
+    encoded = encode_results(RESULTS)
+    assert encoded[0] == FORMAT_ZLIB_JSON
+    assert decode_results(encoded) == RESULTS
+    assert len(encoded) < len(json.dumps(RESULTS)) / 2
+
+
+def test_legacy_values_and_unknown_versions():
+    assert decode_results(json.dumps(RESULTS)) == RESULTS
+    assert decode_results(json.dumps(RESULTS).encode("utf-8")) == RESULTS
+    assert decode_results(None) == [] and decode_results("") == []
+    with pytest.raises(ValueError):
+        decode_results(b"\x7fgarbage")
+
+
+def test_result_endpoint_reads_old_and_new_rows_and_recompress_converts_old():
+    init_sqlite_database()
+    legacy_id = _insert_session(json.dumps(RESULTS))
+    new_id = _insert_session(encode_results(RESULTS))
+
+    for session_id in (legacy_id, new_id):
+        result = main_sqlite.build_session_result(session_id)
+        assert result["results"] == RESULTS
+        assert [r["product_id"] for r in result["ideal_ranking"]] == [1, 2]
+
+    report = recompress_sessions(db, batch_size=1)
+    assert report["converted"] >= 1 and report["bytes_after"] < report["bytes_before"]
+    row = db.execute_query(
+        "SELECT typeof(analysis_results) AS kind, analysis_results FROM analysis_sessions WHERE id = ?", (legacy_id,)
+    )[0]
+    assert row["kind"] == "blob" and decode_results(row["analysis_results"]) == RESULTS
+    assert main_sqlite.build_session_result(legacy_id)["results"] == RESULTS
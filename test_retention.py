@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+数据保留任务测试：过期会话归档并分批删除、仍被引用的宠物保留、增量 VACUUM 归还空间
+"""
+
+import gzip
+import json
+
+import pytest
+
+from db_migrations import apply_migrations
+from result_codec import encode_results
+from retention import incremental_vacuum, run_retention
+from sqlite_db_utils import SQLiteDB
+
+OLD = "2020-01-01 00:00:00"
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = SQLiteDB(str(tmp_path / "retention.db"))
+    apply_migrations(database)
+    yield database
+    database.close()
+
+
+def _pet(database, created_at=None):
+    pet_id = database.execute_update("INSERT INTO pet_info (species) VALUES ('cat')")
+    if created_at:
+        database.execute_update("UPDATE pet_info SET created_at = ? WHERE id = ?", (created_at, pet_id))
+    return pet_id
+
+
+def _session(database, pet_id, created_at=None, results=None):
+    session_id = database.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status, analysis_results) VALUES (?, '[1]', 'completed', ?)",
+        (pet_id, encode_results(results or [{"product_id": 1, "reason": "适合成猫"}]))
+    )
+    database.execute_update(
+        "INSERT INTO anonymous_mapping (session_id, product_id, anonymous_code) VALUES (?, 1, 'A')", (session_id,)
+    )
+    if created_at:
+        database.execute_update("UPDATE analysis_sessions SET created_at = ? WHERE id = ?", (created_at, session_id))
+        database.execute_update("UPDATE anonymous_mapping SET created_at = ? WHERE session_id = ?", (created_at, session_id))
+    return session_id
+
+
+def _count(database, table):
+    return database.execute_query(f"SELECT COUNT(*) AS n FROM {table}")[0]["n"]
+
+
+def test_expired_sessions_are_archived_and_deleted_in_batches(database, tmp_path):
+    old_pet = _pet(database, OLD)
+    orphan_pet = _pet(database, OLD)
+    new_pet = _pet(database)
+    expired = [_session(database, old_pet, OLD) for _ in range(5)]
+    kept = _session(database, new_pet)
+
+    report = run_retention(database, session_days=30, pet_days=30, batch_size=2,
+                           archive_dir=str(tmp_path / "archive"), pause=0)
+    assert report["sessions"] == 5
+    assert report["pets"] == 2  # old_pet 的会话已删除，不再被引用
+    assert [r["id"] for r in database.execute_query("SELECT id FROM analysis_sessions")] == [kept]
+    assert _count(database, "anonymous_mapping") == 1
+    assert [r["id"] for r in database.execute_query("SELECT id FROM pet_info")] == [new_pet]
+    assert orphan_pet not in [r["id"] for r in database.execute_query("SELECT id FROM pet_info")]
+
+    with gzip.open(report["archive"], "rt", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r["id"] for r in records) == expired
+    assert records[0]["analysis_results"] == [{"product_id": 1, "reason": "适合成猫"}]
+    assert records[0]["anonymous_mapping"] == [{"product_id": 1, "anonymous_code": "A"}]
+
+
+def test_pets_still_referenced_are_kept_and_zero_days_keeps_everything(database):
+    pet = _pet(database, OLD)
+    _session(database, pet)
+    assert run_retention(database, session_days=0, pet_days=0, pause=0)["pets"] == 0
+    assert run_retention(database, session_days=0, pet_days=30, pause=0)["pets"] == 0
+    assert _count(database, "pet_info") == 1
+
+
+def test_incremental_vacuum_releases_free_pages(database):
+    assert database.execute_query("PRAGMA auto_vacuum")[0]["auto_vacuum"] == 2
+    pet = _pet(database)
+    big = [{"product_id": i, "reason": "x" * 4000} for i in range(5)]
+    for _ in range(50):
+        session_id = _session(database, pet, results=big)
+        database.execute_update(
+            "UPDATE analysis_sessions SET analysis_results = ?, created_at = ? WHERE id = ?",
+            (json.dumps(big), OLD, session_id)
+        )
+    pages_before = database.execute_query("PRAGMA page_count")[0]["page_count"]
+
+    report = run_retention(database, session_days=1, pause=0)
+    assert report["sessions"] == 50 and report["vacuumed_pages"] > 0
+    assert database.execute_query("PRAGMA freelist_count")[0]["freelist_count"] == 0
+    assert database.execute_query("PRAGMA page_count")[0]["page_count"] < pages_before
+    assert incremental_vacuum(database) == 0
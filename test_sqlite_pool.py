@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+SQLite 连接池并发测试：WAL 下读不被写阻塞，多线程混合读写无报错，连接耗尽时超时报错，
+异步线程池的嵌套借出不会挂起
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from repository import PoolTimeoutError
+from sqlite_db_utils import AsyncSQLiteDB, SQLiteDB
+
+
+def _make_db(tmp_path, pool_size=8):
+    db = SQLiteDB(str(tmp_path / "pool.db"), pool_size=pool_size)
+    db.execute_update("CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, value INTEGER)")
+    return db
+
+
+def test_connection_uses_wal_and_busy_timeout(tmp_path):
+    db = _make_db(tmp_path)
+    assert db.execute_query("PRAGMA journal_mode")[0]["journal_mode"] == "wal"
+    assert db.execute_query("PRAGMA busy_timeout")[0]["timeout"] >= 1000
+    db.close()
+
+
+def test_reads_do_not_block_behind_open_write_transaction(tmp_path):
+    """写事务未提交期间，其他线程的读取立即返回已提交的数据"""
+    db = _make_db(tmp_path)
+    db.execute_update("INSERT INTO items (value) VALUES (?)", (1,))
+    in_transaction = threading.Event()
+    finish = threading.Event()
+
+    def long_writer():
+        with db.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO items (value) VALUES (2)")
+            in_transaction.set()
+            finish.wait(5)
+            conn.commit()
+
+    writer = threading.Thread(target=long_writer)
+    writer.start()
+    assert in_transaction.wait(5)
+
+    latencies = []
+    counts = []
+
+    def reader():
+        started = time.monotonic()
+        counts.append(db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"])
+        latencies.append(time.monotonic() - started)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join(5)
+    finish.set()
+    writer.join(5)
+
+    assert counts == [1, 1, 1, 1]
+    assert max(latencies) < 0.5
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 2
+    db.close()
+
+
+def test_concurrent_mixed_reads_and_writes(tmp_path):
+    """16个线程并发读写，连接数不超过池上限且没有 database is locked"""
+    db = _make_db(tmp_path, pool_size=4)
+    errors = []
+    per_thread = 50
+
+    def worker(n):
+        try:
+            for i in range(per_thread):
+                db.execute_update("INSERT INTO items (value) VALUES (?)", (n * 1000 + i,))
+                db.execute_query("SELECT MAX(id) AS m FROM items")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    assert errors == []
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 16 * per_thread
+    assert len(db._all_connections) <= 4
+    db.close()
+
+
+def test_execute_many_and_transaction(tmp_path):
+    """execute_many 一次提交；transaction 内的写入整体提交或整体回滚"""
+    db = _make_db(tmp_path)
+    assert db.execute_many("INSERT INTO items (value) VALUES (?)", [(i,) for i in range(100)]) == 100
+
+    with db.transaction():
+        db.execute_update("INSERT INTO items (value) VALUES (?)", (1000,))
+        db.execute_many("INSERT INTO items (value) VALUES (?)", [(1001,), (1002,)])
+        with db.transaction():  # 嵌套并入外层事务
+            db.execute_update("INSERT INTO items (value) VALUES (?)", (1003,))
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 104
+
+    try:
+        with db.transaction():
+            db.execute_many("INSERT INTO items (value) VALUES (?)", [(2000,), (2001,)])
+            raise RuntimeError("中途失败")
+    except RuntimeError:
+        pass
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items WHERE value >= 2000")[0]["n"] == 0
+    db.close()
+
+
+def test_iter_query_row_factories(tmp_path):
+    """流式查询支持 tuple / namedtuple / record / dict 行对象，迭代结束后连接归还"""
+    db = _make_db(tmp_path, pool_size=1)
+    db.execute_many("INSERT INTO items (value) VALUES (?)", [(i,) for i in range(1000)])
+    query = "SELECT id, value FROM items ORDER BY id"
+
+    assert next(iter(db.iter_query(query, row_factory="tuple"))) == (1, 0)
+    rows = list(db.iter_query(query, row_factory="namedtuple", batch_size=64))
+    assert len(rows) == 1000 and rows[-1].value == 999
+    record = list(db.iter_query(query, row_factory="record"))[10]
+    assert record.value == 10 and record["id"] == 11 and record.get("missing", 0) == 0
+    assert record._asdict() == {"id": 11, "value": 10}
+    assert not hasattr(record, "__dict__")
+    assert sum(row["value"] for row in db.iter_query(query)) == sum(range(1000))
+
+    # 单连接池：前面的迭代都已归还连接，这里不会阻塞
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 1000
+    db.close()
+
+
+def test_exhausted_pool_times_out_instead_of_hanging(tmp_path):
+    """连接全部借出（含同一线程迭代中再借连接）时等待 pool_timeout 后报错，不会永久挂起"""
+    db = SQLiteDB(str(tmp_path / "pool.db"), pool_size=1, pool_timeout=0.2)
+    db.execute_update("CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, value INTEGER)")
+    db.execute_update("INSERT INTO items (value) VALUES (1)")
+    started = time.monotonic()
+    with pytest.raises(PoolTimeoutError):
+        for row in db.iter_query("SELECT id FROM items"):
+            db.execute_update("DELETE FROM items WHERE id = ?", (row["id"],))
+    assert time.monotonic() - started < 2
+    # 超时后连接已归还，可以继续使用
+    assert db.execute_query("SELECT COUNT(*) AS n FROM items")[0]["n"] == 1
+    db.close()
+
+
+def test_async_executor_survives_pool_size_nested_acquisitions(tmp_path):
+    """pool_size 个同时进行的嵌套借出（流式读取中写入）全部完成：线程数留出了第二个连接的余量"""
+    db = _make_db(tmp_path, pool_size=4)
+    db.pool_timeout = 2
+    db.execute_many("INSERT INTO items (value) VALUES (?)", [(i,) for i in range(db.pool_size)])
+    adb = AsyncSQLiteDB(db)
+    all_reading = threading.Barrier(adb.max_workers, timeout=5)
+
+    def nested(value):
+        for row in db.iter_query("SELECT id FROM items WHERE value = ?", (value,)):
+            all_reading.wait()  # 每个工作线程都已借出一个连接
+            db.execute_update("UPDATE items SET value = value + 100 WHERE id = ?", (row["id"],))
+        return value
+
+    async def scenario():
+        return await asyncio.gather(*[adb.run(nested, i) for i in range(db.pool_size)])
+
+    assert asyncio.run(scenario()) == list(range(db.pool_size))
+    assert db.execute_query("SELECT MIN(value) AS v FROM items")[0]["v"] == 100
+    adb.shutdown()
+    db.close()
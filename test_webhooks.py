@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+分析完成回调测试：本地起一个HTTP接收端，校验签名、失败重试与队列上限；
+回调地址不得指向内网/回环地址，未配置签名密钥时拒绝回调
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from fastapi import HTTPException
+
+import main_sqlite
+from webhooks import (
+    SIGNATURE_HEADER, TIMESTAMP_HEADER, EVENT_HEADER,
+    WebhookDispatcher, check_callback_url, verify_signature
+)
+
+SECRET = "test-secret"
+LOCAL = ("127.0.0.1",)  # 测试接收端在本机，需显式放行
+
+
+def _start_receiver(fail_first=0):
+    """启动本地回调接收端，前 fail_first 次请求返回500"""
+    received = []
+    state = {"calls": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            state["calls"] += 1
+            if state["calls"] <= fail_first:
+                self.send_response(500)
+                self.end_headers()
+                return
+            received.append({
+                "body": body,
+                "event": self.headers[EVENT_HEADER],
+                "valid": verify_signature(SECRET, self.headers[TIMESTAMP_HEADER], body, self.headers[SIGNATURE_HEADER]),
+            })
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/hook", received, state
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return
+        time.sleep(0.02)
+    raise AssertionError("等待回调超时")
+
+
+def test_webhook_is_signed_and_retried_after_failure():
+    """首次返回500后按退避重试，接收端收到的签名可校验"""
+    server, url, received, state = _start_receiver(fail_first=1)
+    dispatcher = WebhookDispatcher(SECRET, max_attempts=3, base_delay=0.05, allowed_hosts=LOCAL)
+    try:
+        dispatcher.enqueue(url, "analysis.completed", {"session_id": 1, "status": "completed"})
+        _wait_for(lambda: received)
+    finally:
+        dispatcher.stop()
+        server.shutdown()
+
+    assert state["calls"] == 2
+    assert received[0]["valid"] is True
+    assert received[0]["event"] == "analysis.completed"
+    assert json.loads(received[0]["body"])["data"]["session_id"] == 1
+    assert dispatcher.stats["retried"] == 1 and dispatcher.stats["delivered"] == 1
+
+
+def test_webhook_gives_up_after_max_attempts():
+    server, url, received, state = _start_receiver(fail_first=10)
+    dispatcher = WebhookDispatcher(SECRET, max_attempts=2, base_delay=0.01, allowed_hosts=LOCAL)
+    try:
+        dispatcher.enqueue(url, "analysis.failed", {"session_id": 2})
+        _wait_for(lambda: dispatcher.stats["failed"] == 1)
+    finally:
+        dispatcher.stop()
+        server.shutdown()
+    assert state["calls"] == 2 and not received
+
+
+def test_webhook_queue_is_bounded():
+    """队列满时丢弃新的投递，而不是无限堆积"""
+    dispatcher = WebhookDispatcher(SECRET, max_pending=2)
+    dispatcher.stop()  # 不启动投递线程，任务只会留在队列中
+    dispatcher._ensure_worker = lambda: None
+    assert dispatcher.enqueue("http://127.0.0.1:9/a", "analysis.completed", {}) is not None
+    assert dispatcher.enqueue("http://127.0.0.1:9/b", "analysis.completed", {}) is not None
+    assert dispatcher.enqueue("http://127.0.0.1:9/c", "analysis.completed", {}) is None
+    assert dispatcher.pending() == 2 and dispatcher.stats["dropped"] == 1
+
+
+def test_start_analysis_posts_final_result_to_callback(monkeypatch):
+    """/api/analysis/start 的会话完成后把最终结果投递到 callback_url"""
+    from sqlite_db_utils import db, init_sqlite_database
+
+    init_sqlite_database()
+    product_ids = [r["id"] for r in db.execute_query("SELECT id FROM products ORDER BY id LIMIT 2")]
+    pet_id = db.execute_update("INSERT INTO pet_info (species) VALUES (?)", ("猫",))
+    session_id = db.execute_update(
+        "INSERT INTO analysis_sessions (pet_id, product_ids, status) VALUES (?, ?, ?)",
+        (pet_id, "[]", "running")
+    )
+
+    def fake_batch(pet_info, products, user_id="test", result_callback=None):
+        for product in products:
+            result_callback({"product_id": product["id"], "final_score": 80})
+
+    server, url, received, _ = _start_receiver()
+    dispatcher = WebhookDispatcher(SECRET, base_delay=0.05, allowed_hosts=LOCAL)
+    monkeypatch.setattr(main_sqlite, "webhook_dispatcher", dispatcher)
+    monkeypatch.setattr(main_sqlite, "analyze_products_with_dify", fake_batch)
+    try:
+        main_sqlite.dify_analysis_task(session_id, pet_id, product_ids, url)
+        _wait_for(lambda: received)
+    finally:
+        dispatcher.stop()
+        server.shutdown()
+
+    payload = json.loads(received[0]["body"])
+    assert payload["event"] == "analysis.completed"
+    assert payload["data"]["session_id"] == session_id
+    assert len(payload["data"]["result"]["ideal_ranking"]) == 2
+
+
+def test_callback_url_rejects_internal_addresses():
+    """回环、云元数据、内网与非 http(s) 地址都会被拒绝，除非主机在白名单中"""
+    for url in ("http://127.0.0.1:8000/hook", "http://localhost/hook", "http://169.254.169.254/latest/meta-data",
+                "http://10.0.0.5/hook", "http://192.168.1.1/hook", "http://[::1]/hook", "http://[::ffff:127.0.0.1]/",
+                "http://0.0.0.0/hook", "ftp://example.com/hook", "http:///hook"):
+        assert check_callback_url(url) is not None, url
+    assert check_callback_url("http://8.8.8.8/hook") is None
+    assert check_callback_url("http://127.0.0.1:8000/hook", allowed_hosts={"127.0.0.1"}) is None
+
+
+def test_unsafe_callback_is_not_posted_at_delivery_time():
+    """投递时重新校验地址，不在白名单中的本机接收端收不到请求"""
+    server, url, received, state = _start_receiver()
+    dispatcher = WebhookDispatcher(SECRET, base_delay=0.01)
+    try:
+        dispatcher.enqueue(url, "analysis.completed", {"session_id": 3})
+        _wait_for(lambda: dispatcher.stats["failed"] == 1)
+    finally:
+        dispatcher.stop()
+        server.shutdown()
+    assert state["calls"] == 0
+
+
+def test_callback_requires_webhook_secret(monkeypatch):
+    """未配置签名密钥时不投递，接口直接返回400"""
+    dispatcher = WebhookDispatcher("", allowed_hosts=LOCAL)
+    assert dispatcher.enqueue("http://127.0.0.1:9/a", "analysis.completed", {}) is None
+    assert "WEBHOOK_SECRET" in dispatcher.check_url("http://127.0.0.1:9/a")
+
+    monkeypatch.setattr(main_sqlite, "webhook_dispatcher", dispatcher)
+    request = main_sqlite.AnalysisRequest(pet_id=1, product_ids=[1], callback_url="http://127.0.0.1:9/a")
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(main_sqlite.start_analysis(request))
+    assert rejected.value.status_code == 400
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+延迟批量写入测试：ID 同步分配且与直接插入不冲突、按批提交、读己之写、关闭时写完缓冲、丢弃的行按 ID 报错
+"""
+
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+import main_sqlite
+from db_migrations import apply_migrations
+from sqlite_db_utils import SQLiteDB
+from write_behind import WriteBehindBuffer, WriteBehindError
+
+COLUMNS = ("species", "breed")
+
+
+def _database(tmp_path):
+    database = SQLiteDB(str(tmp_path / "pets.db"))
+    apply_migrations(database)
+    return database
+
+
+def test_concurrent_inserts_get_unique_ids_and_are_grouped(tmp_path):
+    database = _database(tmp_path)
+    buffer = WriteBehindBuffer(database, "pet_info", COLUMNS, enabled=True, interval_ms=50, max_rows=1000,
+                               id_block=64)
+    ids = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for i in range(100):
+            row_id = buffer.insert(("cat", f"w{n}-{i}"))
+            with lock:
+                ids.append(row_id)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    buffer.stop()
+
+    assert len(set(ids)) == 800 and buffer.pending() == 0
+    rows = database.execute_query("SELECT id, breed FROM pet_info")
+    assert sorted(r["id"] for r in rows) == sorted(ids)
+    status = buffer.status()
+    assert status["rows"] == 800 and status["batches"] < 100 and status["reservations"] == 13
+    database.close()
+
+
+def test_reserved_ids_do_not_collide_with_direct_inserts(tmp_path):
+    database = _database(tmp_path)
+    other = SQLiteDB(database.db_path, pool_size=1)  # 另一个进程（未启用缓冲）的写入
+    buffer = WriteBehindBuffer(database, "pet_info", COLUMNS, enabled=True, interval_ms=10000, id_block=10)
+
+    first = buffer.insert(("cat", "缓冲1"))
+    direct = other.execute_update("INSERT INTO pet_info (species, breed) VALUES ('dog', '直接')")
+    second = buffer.insert(("cat", "缓冲2"))
+    assert direct > first + 9 and second == first + 1
+    buffer.stop()
+
+    breeds = {r["id"]: r["breed"] for r in database.execute_query("SELECT id, breed FROM pet_info")}
+    assert breeds == {first: "缓冲1", second: "缓冲2", direct: "直接"}
+    other.close()
+    database.close()
+
+
+def test_read_your_writes_and_create_pet_endpoint(tmp_path, monkeypatch):
+    database = _database(tmp_path)
+    buffer = WriteBehindBuffer(database, "pet_info", main_sqlite.pet_writer.columns, enabled=True,
+                               interval_ms=60000)
+    monkeypatch.setattr(main_sqlite, "pet_writer", buffer)
+
+    pet = main_sqlite.PetInfo(species="cat", breed="布偶", age_months=6)
+    pet_id = asyncio.run(main_sqlite.create_pet(pet))["pet_id"]
+    assert buffer.pending() == 1
+    assert database.execute_query("SELECT * FROM pet_info WHERE id = ?", (pet_id,)) == []
+
+    buffer.wait_for(pet_id)
+    row = database.execute_query("SELECT breed, age_months FROM pet_info WHERE id = ?", (pet_id,))[0]
+    assert row == {"breed": "布偶", "age_months": 6} and buffer.pending() == 0
+    buffer.stop()
+    database.close()
+
+
+def test_bad_row_is_dropped_instead_of_blocking_later_inserts(tmp_path):
+    """整批因一行违反约束失败时逐行写入：该行被丢弃，其余行与之后的插入照常写入"""
+    database = _database(tmp_path)
+    buffer = WriteBehindBuffer(database, "pet_info", COLUMNS, enabled=True, interval_ms=60000)
+    taken = buffer.insert(("cat", "冲突"))
+    kept = buffer.insert(("cat", "正常"))
+    # 预留的 ID 被另一次写入占用（主键冲突）
+    database.execute_update("INSERT INTO pet_info (id, species, breed) VALUES (?, 'dog', '占用')", (taken,))
+
+    assert buffer.flush() == 1
+    assert buffer.pending() == 0 and buffer.stats["dropped"] == 1
+    later = buffer.insert(("cat", "之后"))
+    assert buffer.flush() == 1
+
+    breeds = {r["id"]: r["breed"] for r in database.execute_query("SELECT id, breed FROM pet_info")}
+    assert breeds == {taken: "占用", kept: "正常", later: "之后"}
+    buffer.stop()
+    database.close()
+
+
+def test_dropped_row_is_reported_to_readers(tmp_path, monkeypatch):
+    """已返回给调用方的 ID 对应的行被丢弃时，wait_for 报错，分析接口返回 409 而不是当作宠物不存在"""
+    database = _database(tmp_path)
+    buffer = WriteBehindBuffer(database, "pet_info", main_sqlite.pet_writer.columns, enabled=True,
+                               interval_ms=60000)
+    monkeypatch.setattr(main_sqlite, "pet_writer", buffer)
+    pet_id = asyncio.run(main_sqlite.create_pet(main_sqlite.PetInfo(species="cat", breed="布偶")))["pet_id"]
+    database.execute_update("INSERT INTO pet_info (id, species) VALUES (?, 'dog')", (pet_id,))  # 预留 ID 被占用
+    kept = buffer.insert(("cat",) + (None,) * (len(buffer.columns) - 1))
+
+    with pytest.raises(WriteBehindError):
+        buffer.wait_for(pet_id)
+    buffer.wait_for(kept)
+    assert buffer.stats["dropped"] == 1 and buffer.pending() == 0
+
+    request = main_sqlite.AnalysisRequest(pet_id=pet_id, product_ids=[1], use_dify=False)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main_sqlite.start_analysis(request))
+    assert error.value.status_code == 409
+    buffer.stop()
+    database.close()
+
+
+def test_multi_worker_deployment_writes_directly(tmp_path):
+    """多 worker 部署时其他 worker 读不到缓冲中的行，延迟写入不启用"""
+    database = _database(tmp_path)
+    buffer = WriteBehindBuffer(database, "pet_info", COLUMNS, enabled=True, multi_worker=True)
+    row_id = buffer.insert(("cat", "直接"))
+    assert buffer.enabled is False and buffer.pending() == 0
+    assert database.execute_query("SELECT breed FROM pet_info WHERE id = ?", (row_id,)) == [{"breed": "直接"}]
+    database.close()
@@ -2,6 +2,9 @@
 """
 将本地数据库的产品数据上传到 Render 后端
 通过 API 接口批量导入产品
+
+逐个产品调用接口，只能新增不能替换；整个产品目录的同步请使用
+sync_database_to_render.sh（catalog_publish.py 快照 + 一次上传原子替换）。
 """
 
 import sqlite3
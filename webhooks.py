@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+分析完成回调（Webhook）
+分析会话完成或失败时把最终结果POST到调用方提供的 callback_url：
+- HMAC-SHA256 签名（X-PetFood-Signature），接收方可用 verify_signature 校验，未配置 WEBHOOK_SECRET 时不接受回调；
+- 回调地址解析后不得指向回环、内网、链路本地等地址（防 SSRF），WEBHOOK_ALLOWED_HOSTS 中的主机除外；
+- 失败按指数退避重试；
+- 投递队列有上限，队列满时丢弃新任务并记录日志，不拖垮分析线程。
+"""
+
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-PetFood-Signature"
+TIMESTAMP_HEADER = "X-PetFood-Timestamp"
+EVENT_HEADER = "X-PetFood-Event"
+DELIVERY_HEADER = "X-PetFood-Delivery"
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    """签名内容为 "{timestamp}.{body}"，返回 "sha256=<hex>" """
+    digest = hmac.new(secret.encode("utf-8"), timestamp.encode("utf-8") + b"." + body, hashlib.sha256)
+    return f"sha256={digest.hexdigest()}"
+
+
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str) -> bool:
+    """接收方校验签名"""
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature or "")
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # is_global 已排除回环、内网、链路本地、保留与运营商 NAT 地址
+    return ip.is_global and not ip.is_multicast
+
+
+def check_callback_url(url: Optional[str], allowed_hosts: Iterable[str] = ()) -> Optional[str]:
+    """校验回调地址，合法时返回 None，否则返回错误信息
+
+    主机名解析出的每个地址都必须是公网地址；allowed_hosts 中的主机（如内网的接收服务）跳过该检查
+    """
+    if not url:
+        return "callback_url 不能为空"
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        return "callback_url 格式错误"
+    if parts.scheme not in ("http", "https") or not host:
+        return "callback_url 必须是 http(s) 地址"
+    if host.lower() in allowed_hosts:
+        return None
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        return f"callback_url 主机无法解析: {host}"
+    if not addresses or not all(_is_public_address(address) for address in addresses):
+        return f"callback_url 不能指向内网、回环或保留地址: {host}"
+    return None
+
+
+def is_valid_callback_url(url: Optional[str], allowed_hosts: Iterable[str] = ()) -> bool:
+    return check_callback_url(url, allowed_hosts) is None
+
+
+class WebhookDispatcher:
+    """带重试与容量上限的回调投递器（单个后台线程按到期时间依次投递）"""
+
+    def __init__(
+        self,
+        secret: str,
+        max_pending: int = 1000,
+        max_attempts: int = 5,
+        base_delay: float = 2.0,
+        max_delay: float = 300.0,
+        timeout: float = 10.0,
+        allowed_hosts: Iterable[str] = ()
+    ):
+        self.secret = secret
+        self.allowed_hosts = frozenset(host.strip().lower() for host in allowed_hosts if host.strip())
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._heap = []  # (due_time, seq, delivery)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._stopped = False
+        self.stats = {"enqueued": 0, "delivered": 0, "retried": 0, "failed": 0, "dropped": 0}
+
+    def check_url(self, url: Optional[str]) -> Optional[str]:
+        """接口收到 callback_url 时调用：未配置签名密钥或地址不合法时返回错误信息（会解析 DNS，勿在事件循环中直接调用）"""
+        if not self.secret:
+            return "服务端未配置 WEBHOOK_SECRET，不支持 callback_url"
+        return check_callback_url(url, self.allowed_hosts)
+
+    def enqueue(self, url: str, event: str, payload: Dict[str, Any]) -> Optional[str]:
+        """加入投递队列，返回投递ID；未配置签名密钥或队列已满时丢弃并返回 None"""
+        if not self.secret:
+            logger.warning(f"⚠️ 未配置 WEBHOOK_SECRET，不投递 {event} -> {url}")
+            return None
+        delivery = {
+            "id": uuid.uuid4().hex,
+            "url": url,
+            "event": event,
+            "body": json.dumps({"event": event, "data": payload}, ensure_ascii=False, default=str).encode("utf-8"),
+            "attempt": 0,
+        }
+        with self._cond:
+            if len(self._heap) >= self.max_pending:
+                self.stats["dropped"] += 1
+                logger.warning(f"⚠️ 回调队列已满（{self.max_pending}），丢弃 {event} -> {url}")
+                return None
+            heapq.heappush(self._heap, (time.monotonic(), next(self._seq), delivery))
+            self.stats["enqueued"] += 1
+            self._ensure_worker()
+            self._cond.notify()
+        return delivery["id"]
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def stop(self, timeout: float = 5.0):
+        """停止后台线程（尚未投递的任务会被放弃）"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker:
+            self._worker.join(timeout)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._stopped = False
+            self._worker = threading.Thread(target=self._run, name="webhook-dispatcher", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                _, _, delivery = heapq.heappop(self._heap)
+            self._attempt(delivery)
+
+    def _attempt(self, delivery: Dict[str, Any]):
+        delivery["attempt"] += 1
+        # 投递前重新解析：接口校验之后 DNS 记录可能已被改为内网地址
+        error = check_callback_url(delivery["url"], self.allowed_hosts)
+        if error:
+            with self._cond:
+                self.stats["failed"] += 1
+            logger.error(f"❌ 回调地址不安全，已放弃 {delivery['event']} -> {delivery['url']}: {error}")
+            return
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            EVENT_HEADER: delivery["event"],
+            DELIVERY_HEADER: delivery["id"],
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign_payload(self.secret, timestamp, delivery["body"]),
+        }
+        try:
+            response = requests.post(delivery["url"], data=delivery["body"], headers=headers,
+                                     timeout=self.timeout, allow_redirects=False)
+            if 200 <= response.status_code < 300:
+                with self._cond:
+                    self.stats["delivered"] += 1
+                logger.info(f"✅ 回调投递成功 {delivery['event']} -> {delivery['url']}（第{delivery['attempt']}次）")
+                return
+            error = f"HTTP {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+
+        with self._cond:
+            if delivery["attempt"] >= self.max_attempts:
+                self.stats["failed"] += 1
+                logger.error(f"❌ 回调投递失败，已放弃 {delivery['event']} -> {delivery['url']}: {error}")
+                return
+            delay = min(self.max_delay, self.base_delay * (2 ** (delivery["attempt"] - 1)))
+            self.stats["retried"] += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), delivery))
+            self._cond.notify()
+        logger.warning(f"⚠️ 回调投递失败（{error}），{delay:g}秒后第{delivery['attempt'] + 1}次重试: {delivery['url']}")
+
+
+# 全局投递器：签名密钥、允许的内网主机与队列上限来自环境变量
+webhook_dispatcher = WebhookDispatcher(
+    secret=os.environ.get("WEBHOOK_SECRET", ""),
+    max_pending=int(os.environ.get("WEBHOOK_MAX_PENDING", "1000")),
+    max_attempts=int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "5")),
+    allowed_hosts=os.environ.get("WEBHOOK_ALLOWED_HOSTS", "").split(",")
+)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+只追加表的延迟批量写入（write-behind）
+高频的单行插入（如 /api/pet/create）先放进内存缓冲，后台线程每 WRITE_BEHIND_INTERVAL_MS 毫秒
+或攒够 WRITE_BEHIND_MAX_ROWS 行时用一个事务批量写入，一批只提交一次。
+
+- ID 同步返回：每次从 sqlite_sequence 预留 WRITE_BEHIND_ID_BLOCK 个连续 ID（一个短写事务），
+  插入时直接分配，写入时带上显式 ID；其他进程（或未启用缓冲的写入）按 AUTOINCREMENT 取到预留段之后的 ID，不会冲突；
+  进程退出时未用完的预留 ID 留下空洞，不影响正确性。
+- 读己之写：按 ID 读取前调用 wait_for(row_id)，该行仍在缓冲中时立即刷新。
+  wait_for 只能刷新本进程的缓冲，因此只支持单 worker：多 worker 部署（WEB_CONCURRENCY > 1）时不启用，直接逐行插入。
+- 批量写入失败时逐行重试：违反约束等无法写入的行记录日志后丢弃，不会阻塞之后的插入；
+  其 ID 已返回给调用方，因此记下失败原因，之后 wait_for(该 ID) 抛出 WriteBehindError，而不是当作已写入；
+  数据库不可用等其他错误时，未写入的行保留在缓冲中稍后重试。
+- 关闭时 stop() 写入缓冲中的全部行；进程崩溃会丢失最近一个刷新间隔内的行，因此默认关闭（WRITE_BEHIND=1 启用）。
+- 只适用于 SQLite（依赖 sqlite_sequence）；其他数据库类型直接逐行插入。
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_INTERVAL_MS = float(os.environ.get("WRITE_BEHIND_INTERVAL_MS", "20"))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", "200"))
+WRITE_BEHIND_ID_BLOCK = int(os.environ.get("WRITE_BEHIND_ID_BLOCK", "100"))
+# uvicorn/gunicorn 的 worker 数；大于 1 时缓冲中的行对其他 worker 不可见，不启用延迟写入
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1") or "1")
+
+# 逐行重试时，这些错误说明该行本身无法写入（违反约束、值类型不支持），丢弃该行
+_BAD_ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.DataError)
+# 记住最近多少个被丢弃行的 ID（供 wait_for 报错）
+_FAILED_ROWS_KEPT = 10000
+
+
+class WriteBehindError(Exception):
+    """缓冲中的行无法写入、已被丢弃（wait_for 该行时抛出）"""
+
+
+class WriteBehindBuffer:
+    """某一张 INTEGER PRIMARY KEY AUTOINCREMENT 表的插入缓冲"""
+
+    def __init__(self, database, table: str, columns: Sequence[str], enabled: bool = WRITE_BEHIND_ENABLED,
+                 interval_ms: float = WRITE_BEHIND_INTERVAL_MS, max_rows: int = WRITE_BEHIND_MAX_ROWS,
+                 id_block: int = WRITE_BEHIND_ID_BLOCK, multi_worker: bool = WEB_CONCURRENCY > 1):
+        self.database = database
+        self.table = table
+        self.columns = tuple(columns)
+        enabled = enabled and getattr(database, "dialect", "sqlite") == "sqlite"
+        if enabled and multi_worker:
+            logger.warning(f"⚠️ 多 worker 部署不支持 {table} 延迟批量写入（其他 worker 读不到缓冲中的行），改为直接写入")
+        self.enabled = enabled and not multi_worker
+        self.interval = interval_ms / 1000
+        self.max_rows = max(1, max_rows)
+        self.id_block = max(1, id_block)
+        marks = ", ".join("?" * len(self.columns))
+        self._direct_sql = f"INSERT INTO {table} ({', '.join(self.columns)}) VALUES ({marks})"
+        self._batch_sql = f"INSERT INTO {table} (id, {', '.join(self.columns)}) VALUES (?, {marks})"
+        self._pending: Dict[int, Tuple[Any, ...]] = {}  # 按插入顺序
+        self._failed: "OrderedDict[int, str]" = OrderedDict()  # 被丢弃行的 ID -> 失败原因
+        self._next_id = 1
+        self._end_id = 0  # 当前预留段的最后一个 ID
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时间只有一个批次在写入
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"rows": 0, "batches": 0, "reservations": 0, "errors": 0, "max_batch": 0, "dropped": 0}
+
+    def _reserve_ids(self):
+        """预留下一段 ID：sqlite_sequence 前移 id_block，与其他进程的 AUTOINCREMENT 互斥"""
+        with self.database.transaction():
+            rows = self.database.execute_query(
+                f"SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0), "
+                f"COALESCE((SELECT MAX(id) FROM {self.table}), 0)) AS last", (self.table,)
+            )
+            start = rows[0]["last"] + 1
+            end = start + self.id_block - 1
+            if self.database.execute_rowcount("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (end, self.table)) == 0:
+                self.database.execute_update("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (self.table, end))
+        self._next_id, self._end_id = start, end
+        self.stats["reservations"] += 1
+
+    def insert(self, values: Sequence[Any]) -> int:
+        """插入一行（值与 columns 一一对应），立即返回分配的 ID"""
+        if not self.enabled:
+            return self.database.execute_update(self._direct_sql, tuple(values))
+        with self._reserve_lock:
+            if self._next_id > self._end_id:
+                self._reserve_ids()
+            row_id = self._next_id
+            self._next_id += 1
+            with self._lock:
+                self._pending[row_id] = tuple(values)
+                full = len(self._pending) >= self.max_rows
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+        return row_id
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        立即写入缓冲中的全部行（一个事务），返回写入的行数
+
+        整批因某一行无法写入而回滚时改为逐行写入并丢弃该行；其他错误向上抛出，未写入的行保留在缓冲中
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.items())
+            if not batch:
+                return 0
+            try:
+                self.database.execute_many(self._batch_sql, [(row_id,) + values for row_id, values in batch])
+            except _BAD_ROW_ERRORS as e:
+                logger.warning(f"⚠️ {self.table} 批量写入 {len(batch)} 行失败（{e}），改为逐行写入")
+                return self._flush_rows(batch)
+            with self._lock:
+                for row_id, _ in batch:
+                    self._pending.pop(row_id, None)
+                self.stats["rows"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            return len(batch)
+
+    def _flush_rows(self, batch) -> int:
+        """逐行写入（持有 _flush_lock 时调用），每处理完一行即移出缓冲，返回写入的行数"""
+        written = 0
+        for row_id, values in batch:
+            try:
+                self.database.execute_update(self._batch_sql, (row_id,) + values)
+                ok = True
+            except _BAD_ROW_ERRORS as e:
+                ok = False
+                logger.error(f"❌ {self.table} 第 {row_id} 行无法写入，已丢弃: {e}; 值: {values}")
+                with self._lock:
+                    self._failed[row_id] = str(e)
+                    while len(self._failed) > _FAILED_ROWS_KEPT:
+                        self._failed.popitem(last=False)
+            with self._lock:
+                self._pending.pop(row_id, None)
+                self.stats["rows" if ok else "dropped"] += 1
+            written += ok
+        return written
+
+    def wait_for(self, row_id: Any):
+        """确保 row_id 已写入数据库（仍在缓冲中时立即刷新），之后按 ID 读取能读到该行；该行已被丢弃时抛出 WriteBehindError"""
+        if not self.enabled:
+            return
+        with self._lock:
+            buffered = row_id in self._pending
+        if buffered:
+            self.flush()
+        with self._lock:
+            error = self._failed.get(row_id)
+        if error is not None:
+            raise WriteBehindError(f"{self.table} 第 {row_id} 行未能写入: {error}")
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stop.clear()
+                    self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.table}", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"❌ {self.table} 批量写入失败，{self.pending()} 行保留在缓冲中稍后重试: {e}")
+                self._stop.wait(min(1.0, self.interval * 10))
+
+    def start(self):
+        if self.enabled:
+            self._ensure_thread()
+            logger.info(
+                f"✍️ {self.table} 延迟批量写入已启用：每 {self.interval * 1000:g}ms 或 {self.max_rows} 行提交一次"
+            )
+
+    def stop(self, timeout: float = 5.0):
+        """停止后台线程并写入剩余的行"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ 关闭时写入 {self.table} 失败: {e}")
+                time.sleep(0.1)
+        if self.pending():
+            logger.error(f"❌ {self.table} 仍有 {self.pending()} 行未写入")
+
+    def status(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "pending": self.pending(), **self.stats}